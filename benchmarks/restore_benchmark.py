@@ -0,0 +1,65 @@
+"""Measure how long restoring a stream takes as the stream gets longer.
+
+Builds streams of increasing length in a temporary directory and times restoring each one from its
+state journal and, for comparison, by parsing its playlist.
+
+    python benchmarks/restore_benchmark.py --segments 1000 10000 100000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import hls_relay  # noqa: E402
+
+
+def build_stream(segments):
+    stream = hls_relay.StreamState("bench")
+    stream.initialize_playlist(0, "p0_segment_000000.mp4")
+    stream.arrived_segments[0] = {"filename": "p0_segment_000000.mp4", "duration": 0, "is_init": True, "discontinuity": False}
+    stream.update_playlist()
+    for seq in range(1, segments + 1):
+        stream.arrived_segments[seq] = {"filename": f"p0_segment_{seq:06d}.m4s", "duration": 2.0, "is_init": False, "discontinuity": False}
+        stream.update_playlist()
+    stream.journal.close()
+    return stream.stream_dir
+
+
+def time_restore(stream_dir, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hls_relay.StreamState.restore("bench", stream_dir)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark stream restore time against stream length")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp()
+    hls_relay.BASE_SEGMENTS_DIR = base_dir
+    try:
+        print(f"{'segments':>10} {'journal ms':>12} {'playlist ms':>12}")
+        for segments in args.segments:
+            stream_dir = build_stream(segments)
+            journal = time_restore(stream_dir, args.repeat)
+            with patch.object(hls_relay.StateJournal, "exists", return_value=False), \
+                 patch.object(hls_relay.StreamState, "_journal_restored_state"):
+                playlist = time_restore(stream_dir, args.repeat)
+            print(f"{segments:>10} {journal * 1000:>12.2f} {playlist * 1000:>12.2f}")
+            shutil.rmtree(stream_dir)
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Compare upload throughput and latency of the waitress and asyncio server modes.
+
+Starts the relay in a temporary directory once per server mode. While some connections trickle
+slow uploads, as mobile clients on a poor network do, client processes upload segments to their own
+streams as fast as they can and a poller fetches a playlist over loopback as FFmpeg does, from the
+relay listener with --relay-listener.
+
+    python benchmarks/server_benchmark.py --clients 4 --slow-clients 32 --seconds 10 [--relay-listener]
+"""
+import argparse
+import http.client
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor
+
+RELAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hls_relay.py")
+AUTHORIZATION = "Basic " + b64encode(b"brute:force").decode()
+
+
+def upload_headers(stream_key, sequence):
+    return {
+        "Authorization": AUTHORIZATION,
+        "Target": "passive",
+        "Stream-Key": stream_key,
+        "Segment-Type": "Initialization" if sequence == 0 else "Media",
+        "Discontinuity": "false",
+        "Duration": "0" if sequence == 0 else "2.0",
+        "Sequence": str(sequence),
+    }
+
+
+def timed_request(connection, method, path, body=None, headers=None):
+    start = time.perf_counter()
+    connection.request(method, path, body=body, headers=headers or {})
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise RuntimeError(f"{method} {path} failed with HTTP {response.status}")
+    return time.perf_counter() - start, data
+
+
+def upload_stream(port, stream_key, segment_size, seconds):
+    """Upload segments until seconds have passed; returns (bytes uploaded, request latencies)"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    segment = os.urandom(segment_size)
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        latency, _ = timed_request(connection, "POST", "/upload_segment", segment, upload_headers(stream_key, len(latencies)))
+        latencies.append(latency)
+    connection.close()
+    return len(latencies) * segment_size, latencies
+
+
+def poll_playlist(port, relay_port, seconds, interval=0.05):
+    """Fetch a stream's playlist from relay_port every interval seconds; returns the fetch latencies"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    timed_request(connection, "POST", "/upload_segment", b"init", upload_headers("bench_poll", 0))
+    _, status = timed_request(connection, "GET", "/status/bench_poll")
+    stream_id = status.split(b'"stream_id":"')[1].split(b'"')[0].decode()
+    connection.close()
+    connection = http.client.HTTPConnection("127.0.0.1", relay_port, timeout=60)
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        latency, _ = timed_request(connection, "GET", f"/segments/{stream_id}/playlist.m3u8")
+        latencies.append(latency)
+        time.sleep(interval)
+    connection.close()
+    return latencies
+
+
+def trickle_upload(port, stream_key, stop):
+    """Send an upload a few bytes at a time until stop is set, never completing it"""
+    sock = socket.create_connection(("127.0.0.1", port))
+    headers = "".join(f"{name}: {value}\r\n" for name, value in upload_headers(stream_key, 0).items())
+    sock.sendall(f"POST /upload_segment HTTP/1.1\r\nHost: relay\r\n{headers}Content-Length: {1 << 30}\r\n\r\n".encode())
+    try:
+        while not stop.wait(0.1):
+            sock.sendall(b"x" * 64)
+    except OSError:
+        # The relay gave up on the upload
+        pass
+    sock.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Relay did not start listening on port {port}")
+
+
+def measure(server, args):
+    directory = tempfile.mkdtemp()
+    relay_port = args.port + 100 if args.relay_listener else args.port
+    relay = subprocess.Popen(
+        [sys.executable, RELAY, "--port", str(args.port), "--server", server]
+        + (["--relay-port", str(relay_port)] if args.relay_listener else []),
+        cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+    )
+    stop = threading.Event()
+    try:
+        wait_for_port(args.port)
+        tricklers = [
+            threading.Thread(target=trickle_upload, args=(args.port, f"bench_slow_{n}", stop), daemon=True)
+            for n in range(args.slow_clients)
+        ]
+        for trickler in tricklers:
+            trickler.start()
+        with ProcessPoolExecutor(max_workers=args.clients + 1) as pool:
+            start = time.monotonic()
+            poller = pool.submit(poll_playlist, args.port, relay_port, args.seconds)
+            uploads = list(pool.map(
+                upload_stream,
+                [args.port] * args.clients,
+                [f"bench_{client}" for client in range(args.clients)],
+                [args.segment_size] * args.clients,
+                [args.seconds] * args.clients,
+            ))
+            elapsed = time.monotonic() - start
+            playlist_latencies = poller.result()
+    finally:
+        stop.set()
+        relay.send_signal(signal.SIGTERM)
+        relay.wait()
+        shutil.rmtree(directory)
+    upload_latencies = [latency for _, latencies in uploads for latency in latencies]
+    return {
+        "mb_per_s": sum(uploaded for uploaded, _ in uploads) / elapsed / 1e6,
+        "upload_p50": percentile(upload_latencies, 0.5) * 1000,
+        "upload_p99": percentile(upload_latencies, 0.99) * 1000,
+        "playlist_p99": percentile(playlist_latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servers", nargs="+", default=["waitress", "asyncio"])
+    parser.add_argument("--clients", type=int, default=4, help="Streams uploading as fast as they can")
+    parser.add_argument("--slow-clients", type=int, default=32, help="Connections trickling an upload")
+    parser.add_argument("--segment-size", type=int, default=1024 * 1024)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--relay-listener", action="store_true", help="Poll the playlist from a separate relay listener")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients, {args.slow_clients} slow clients, {args.segment_size} byte segments"
+          + (", playlist read from the relay listener" if args.relay_listener else ""))
+    print(f"{'server':>10} {'MB/s':>8} {'upload p50 ms':>14} {'upload p99 ms':>14} {'playlist p99 ms':>16}")
+    for server in args.servers:
+        result = measure(server, args)
+        print(f"{server:>10} {result['mb_per_s']:>8.1f} {result['upload_p50']:>14.1f} {result['upload_p99']:>14.1f} {result['playlist_p99']:>16.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
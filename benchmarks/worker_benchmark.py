@@ -0,0 +1,110 @@
+"""Measure upload throughput with different numbers of worker processes.
+
+Starts the relay in a temporary directory once per worker count, and has several client processes
+upload segments to their own streams for a fixed time. Clients connect to the shared port, so most
+of their uploads are passed on to the worker that owns the stream key, as in production.
+
+    python benchmarks/worker_benchmark.py --workers 1 2 4 --clients 8 --seconds 10
+"""
+import argparse
+import http.client
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor
+
+RELAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hls_relay.py")
+AUTHORIZATION = "Basic " + b64encode(b"brute:force").decode()
+
+
+def upload_stream(port, stream_key, segment_size, seconds):
+    """Upload segments of one stream until seconds have passed; returns the bytes uploaded"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    segment = os.urandom(segment_size)
+    uploaded = 0
+    sequence = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        connection.request("POST", "/upload_segment", body=segment, headers={
+            "Authorization": AUTHORIZATION,
+            "Target": "passive",
+            "Stream-Key": stream_key,
+            "Segment-Type": "Initialization" if sequence == 0 else "Media",
+            "Discontinuity": "false",
+            "Duration": "0" if sequence == 0 else "2.0",
+            "Sequence": str(sequence),
+        })
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"Upload of {stream_key} segment {sequence} failed with HTTP {response.status}")
+        uploaded += segment_size
+        sequence += 1
+    connection.close()
+    return uploaded
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Relay did not start listening on port {port}")
+
+
+def measure(workers, args):
+    directory = tempfile.mkdtemp()
+    relay = subprocess.Popen(
+        [sys.executable, RELAY, "--port", str(args.port), "--workers", str(workers)],
+        cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+    )
+    try:
+        wait_for_port(args.port)
+        # Give every worker time to start accepting
+        time.sleep(1)
+        with ProcessPoolExecutor(max_workers=args.clients) as pool:
+            start = time.monotonic()
+            uploaded = sum(pool.map(
+                upload_stream,
+                [args.port] * args.clients,
+                [f"bench_{workers}_{client}" for client in range(args.clients)],
+                [args.segment_size] * args.clients,
+                [args.seconds] * args.clients,
+            ))
+            elapsed = time.monotonic() - start
+    finally:
+        relay.send_signal(signal.SIGTERM)
+        relay.wait()
+        shutil.rmtree(directory)
+    return uploaded / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent uploading streams")
+    parser.add_argument("--segment-size", type=int, default=1024 * 1024)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients, {args.segment_size} byte segments")
+    print(f"{'workers':>8} {'MB/s':>10} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        throughput = measure(workers, args) / 1e6
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.1f} {throughput / baseline:>7.2f}x", flush=True)
+
+
+if __name__ == "__main__":
+    main()
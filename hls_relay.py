@@ -1,6 +1,8 @@
-# Typical start command: 
-# python -u hls_relay.py &> 20250119.log
+# Typical start command (logs to a YYYYMMDD.log file per day under logs/):
+# ./run_hls_relay.sh  or  python hls_relay.py --log-dir logs
 from flask import Flask, request, Response, jsonify
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import ClosingIterator
 from functools import wraps
 from collections import deque
 import os
@@ -9,7 +11,26 @@ import subprocess
 import time
 import sys
 import argparse
+import asyncio
 import re
+import shutil
+import struct
+import math
+import http.client
+import urllib.parse
+import tempfile
+import hashlib
+import hmac
+import secrets
+import signal
+import socket
+import json
+import zlib
+import contextlib
+import queue
+import atexit
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Set username and password for BASIC HTTP authentication for /upload_segment
@@ -20,9 +41,81 @@ AUTH_PASSWORD = 'force'
 # Needs to be over 1024 if you are not a privileged user
 PORT = 8080
 
+# Log records are written by a background thread, so request threads never wait for log I/O: as JSON
+# lines, or as plain text with LOG_FORMAT = "text", to stdout, or with LOG_DIR (also --log-dir) to a
+# YYYYMMDD.log file there, a new one each day. Records below LOG_LEVEL are left out, and records
+# arriving while LOG_QUEUE_SIZE are waiting to be written are dropped and counted
+LOG_LEVEL = "info"
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_FORMAT = "json"
+LOG_DIR = None
+LOG_QUEUE_SIZE = 10000
+# Each stream may log LOG_STREAM_RATE info and debug records per second, in bursts of up to
+# LOG_STREAM_BURST; the next record let through counts the ones left out. Warnings and errors always pass
+LOG_STREAM_RATE = 20
+LOG_STREAM_BURST = 100
+
 # Base directory for all streams
 BASE_SEGMENTS_DIR = "segments"
 
+# Optional fast directory for live segments, e.g. on tmpfs such as /dev/shm/hls-relay. Segments are
+# written there, and a background mover copies them to BASE_SEGMENTS_DIR once every running relay of
+# their stream has fetched them, or HOT_TIER_HOLD seconds after they were written when no relay reads
+# them. Playlists and journals stay in BASE_SEGMENTS_DIR. Segments not moved yet survive a restart of
+# the relay but not of the machine
+HOT_TIER_DIR = None
+HOT_TIER_MAX_BYTES = 512 * 1024 * 1024
+HOT_TIER_HOLD = 30
+HOT_TIER_MOVE_INTERVAL = 1
+# Seconds after which a hot segment moves even though a running relay has not fetched it, e.g. a stalled one
+HOT_TIER_MAX_HOLD = 120
+# When the hot tier is full, new segments are written to BASE_SEGMENTS_DIR directly. With "spill" the
+# mover is also woken to move the oldest hot segments there, read or not, to make room for later ones
+HOT_TIER_OVERFLOW = "disk"
+
+# Retention of old stream directories under BASE_SEGMENTS_DIR (None = no limit). A directory is
+# removed once its playlist has not changed for RETENTION_MAX_AGE seconds, when its stream key has
+# RETENTION_MAX_SESSIONS_PER_KEY newer directories, or, oldest first, while all directories together
+# take more than RETENTION_MAX_BYTES. Streams in memory, and unfinalized ones changed within the last
+# RECOVERY_MAX_AGE seconds, are never removed
+RETENTION_MAX_AGE = None
+RETENTION_MAX_BYTES = None
+RETENTION_MAX_SESSIONS_PER_KEY = None
+# Move removed directories here instead of deleting them
+RETENTION_ARCHIVE_DIR = None
+# Seconds between retention passes
+RETENTION_INTERVAL = 300
+# Removal is paced to this many bytes per second (None = unpaced), checked every RETENTION_BATCH_FILES
+# files, so deleting a large stream does not hold up the disk writes of live ones
+RETENTION_IO_BYTES_PER_SECOND = 32 * 1024 * 1024
+RETENTION_BATCH_FILES = 64
+# Directories are renamed into this subdirectory of BASE_SEGMENTS_DIR before their files are removed,
+# so a half-removed stream is never restored; the next pass, also after a restart, finishes them
+RETENTION_TRASH_DIR = ".trash"
+
+# Disk health watchdog for BASE_SEGMENTS_DIR. Every DISK_HEALTH_INTERVAL seconds it checks the free
+# space and times the write and fsync of a small probe file; segment writes, playlist appends and
+# fsyncs are also timed as they happen. The disk is "degraded" or "critical" when its free space falls
+# below, or the 95th percentile of any latency over the last DISK_LATENCY_WINDOW seconds rises above,
+# the thresholds of that level (None = not checked)
+DISK_HEALTH_INTERVAL = 5
+DISK_LATENCY_WINDOW = 60
+DISK_FREE_DEGRADED_BYTES = 10 * 1024 * 1024 * 1024
+DISK_FREE_CRITICAL_BYTES = 2 * 1024 * 1024 * 1024
+DISK_LATENCY_DEGRADED = 0.5
+DISK_LATENCY_CRITICAL = 2.0
+# Actions taken while the disk is at a level, each logged as an event of every stream:
+# "drop_archive" deletes the directories retention removes instead of moving them to RETENTION_ARCHIVE_DIR,
+# "memory_tier" keeps segments in HOT_TIER_DIR instead of moving them to disk,
+# "emergency_retention" removes the oldest finished streams until DISK_FREE_DEGRADED_BYTES are free,
+# only while a RETENTION_* policy is set, "refuse_streams" refuses new streams with 503. All but
+# "memory_tier" delete recordings or turn clients away, so they are only taken when added here
+DISK_HEALTH_ACTIONS = {
+    "degraded": ["memory_tier"],
+    "critical": ["memory_tier"],
+}
+DISK_PROBE_FILE = ".disk_probe"
+
 # Segment "buffer" size, before ffmpeg starts
 SEGMENTS_BEFORE_RELAY = 3
 
@@ -41,12 +134,228 @@ GAP_SKIP_TIMEOUT = 10
 # Sliding window (seconds) for measuring upload utilization
 UPLOAD_UTIL_WINDOW = 60
 
+# Maximum number of segments accepted in one POST /upload_segments batch
+BATCH_MAX_SEGMENTS = 256
+
+# Resumable uploads keep partial segments in this subdirectory of BASE_SEGMENTS_DIR
+RESUMABLE_UPLOADS_DIR = ".uploads"
+
+# Partial uploads that received no data for this many seconds are deleted
+RESUMABLE_UPLOAD_TTL = 3600
+
+# Seconds between sweeps that delete expired partial uploads of every stream key
+RESUMABLE_UPLOAD_SWEEP_INTERVAL = 300
+
+# Largest segment accepted through a resumable upload, in bytes
+RESUMABLE_UPLOAD_MAX_BYTES = 256 * 1024 * 1024
+
+# Limits shared by all streams (None = unlimited). A new stream, or an upload that would push
+# the in-flight or reorder-buffer bytes over their limit, is refused with 503 and Retry-After;
+# FFmpeg relays over the limit are started later instead. Stream and relay counts are unlimited
+# by default; set them to what the host's CPU and upstream can carry, e.g. 16 and 24.
+MAX_ACTIVE_STREAMS = None
+MAX_FFMPEG_RELAYS = None
+MAX_PENDING_REORDER_BYTES = 512 * 1024 * 1024
+MAX_INFLIGHT_UPLOAD_BYTES = 256 * 1024 * 1024
+
+# Seconds a refused client is asked to wait (Retry-After), and a deferred relay waits, before trying again
+ADMISSION_RETRY_AFTER = 5
+
+# Histogram buckets of GET /metrics: durations in seconds, sizes in bytes (4 KiB to 256 MiB) and
+# reorder-buffer depths in segments
+METRICS_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_BYTES_BUCKETS = tuple(1024 * 4 ** n for n in range(1, 10))
+METRICS_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+# Retransmits are recognised by content hash for this many segments behind the playlist's newest
+# one; older segments are not hashed from disk again
+DEDUP_WINDOW_SEGMENTS = 64
+
 # Maximum number of recent events to record per stream
 MAX_EVENT_HISTORY = 20
 
+# Each stream directory keeps an append-only journal of playlist state changes plus a periodic
+# checkpoint, so restoring a stream does not have to re-read its whole playlist
+STATE_JOURNAL_FILE = "journal.jsonl"
+STATE_CHECKPOINT_FILE = "checkpoint.json"
+# Journal records between checkpoints, which bounds the records replayed on restore
+STATE_CHECKPOINT_INTERVAL = 500
+# Newest playlist entries stored in a checkpoint; older ones are read back from the journal on demand
+STATE_CHECKPOINT_ENTRIES = 64
+
+# At startup, restore the streams a previous run left unfinalized whose playlist changed within the
+# last RECOVERY_MAX_AGE seconds, using RECOVERY_WORKERS threads, so returning clients find them ready.
+# With RECOVERY_PRELAUNCH_RELAYS their relays are started again too, instead of on the first upload.
+RECOVER_STREAMS_ON_STARTUP = True
+RECOVERY_MAX_AGE = 300
+RECOVERY_WORKERS = 4
+RECOVERY_PRELAUNCH_RELAYS = False
+
+# SIGHUP re-executes the relay in place, e.g. to deploy a new version of this file. The listening
+# socket and the running ffmpeg relays are handed to the new process once requests in progress have
+# finished (waiting at most HANDOVER_DRAIN_TIMEOUT seconds), so no connection upstream is dropped.
+HANDOVER_DRAIN_TIMEOUT = 30
+HANDOVER_FILE = ".handover.json"
+HANDOVER_ENV = "HLS_RELAY_HANDOVER"
+
+# Worker processes to serve uploads with. With more than one, a supervisor process forks the workers,
+# which all accept connections on PORT. Each stream key belongs to one worker, chosen by its hash, and
+# a worker passes requests for other workers' streams on to them over loopback, where worker i also
+# listens on PORT + 1 + i. Limits such as MAX_ACTIVE_STREAMS apply to each worker. Experimental: how
+# throughput scales with CPU cores has not been measured yet (see benchmarks/worker_benchmark.py)
+WORKER_PROCESSES = 1
+# Seconds before a worker that exited is started again, and timeout for a request passed to a worker
+WORKER_RESTART_COOLDOWN = 1
+WORKER_FORWARD_TIMEOUT = 60
+# Requests passed to another worker carry WORKER_TOKEN_HEADER with a random token the supervisor keeps
+# in WORKER_TOKEN_ENV, so the owning worker accepts uploads and status queries on its loopback port
+# from other workers only
+WORKER_TOKEN_HEADER = "Relay-Worker-Token"
+WORKER_TOKEN_ENV = "HLS_RELAY_WORKER_TOKEN"
+
+# HTTP server: "waitress", or "asyncio" to read requests on an event loop, so connections holding a
+# slow upload or download tie up no thread. Complete requests run on ASYNC_EXECUTOR_THREADS threads,
+# which also do the disk reads of responses. Can also be set with --server
+SERVER_MODE = "waitress"
+SERVER_MODES = {"waitress", "asyncio"}
+ASYNC_EXECUTOR_THREADS = 8
+# Largest request head and body accepted by the asyncio server, and the part of a body kept in memory
+# before it is spooled to a temporary file (as waitress does)
+ASYNC_MAX_HEADER_BYTES = 64 * 1024
+ASYNC_MAX_REQUEST_BYTES = 1024 * 1024 * 1024
+ASYNC_BODY_SPOOL_BYTES = 512 * 1024
+# Seconds a connection may stay silent, between requests or within one, before it is closed
+ASYNC_IDLE_TIMEOUT = 120
+# Connections served at once by the asyncio server; more wait in the listening socket's backlog
+ASYNC_MAX_CONNECTIONS = 1000
+
+# Loopback port of a separate listener, with its own RELAY_LISTENER_THREADS threads, from which FFmpeg
+# relays read playlists and segments, so their reads do not queue behind uploads and status polls.
+# Worker i uses RELAY_LISTENER_PORT + i. None serves relay reads from the main server on PORT
+RELAY_LISTENER_PORT = None
+RELAY_LISTENER_THREADS = 2
+
+# Stream keys are spread over this many locks, so restoring one stream from disk does not hold up
+# uploads to streams with other keys
+STREAM_LOCK_STRIPES = 64
+
+# Catch-up policy when the relay falls behind the live edge: "off", "restart" (relaunch ffmpeg
+# without -re until it is back near the edge) or "jump" (relaunch ffmpeg at the live edge).
+# Can be overridden per stream with the Catch-Up header.
+CATCHUP_MODE = "restart"
+CATCHUP_MODES = {"off", "restart", "jump"}
+
+# Relay lag (seconds of media behind the newest playlist entry) that triggers catch-up
+CATCHUP_LAG_THRESHOLD = 20
+
+# Relay lag (seconds) at which a catch-up is considered complete
+CATCHUP_LAG_TARGET = 4
+
+# Minimum seconds between catch-up actions for the same stream
+CATCHUP_COOLDOWN = 30
+
 # Targets that indicate we should only store segments and serve HLS locally (no relay)
 PASSIVE_TARGETS = {"passive"}
 
+# Destinations the relay can upload to. The Target header may list several, comma separated,
+# each optionally with its own key ("youtube, twitch=live_123"); the Stream-Key is used otherwise.
+RELAY_TARGETS = {"youtube", "twitch"}
+
+# How the Twitch relay handles video: "auto" copies H.264 8-bit SDR input that Twitch accepts as-is
+# and transcodes anything else (HEVC, HDR, Dolby Vision); "copy" and "transcode" force either way
+TWITCH_VIDEO_MODE = "auto"
+
+# Limits for copying H.264 to Twitch unchanged: Baseline/Main/High profile, level and resolution
+TWITCH_COPY_PROFILES = {66, 77, 100}
+TWITCH_COPY_MAX_LEVEL = 42
+TWITCH_COPY_MAX_DIMENSIONS = (1920, 1080)
+
+# Adaptive Twitch transcoding: x264 presets from fastest to slowest that the encoder controller may
+# choose from, the preset each transcode starts with, and the video bitrate range it may move within
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast"]
+X264_DEFAULT_PRESET = "veryfast"
+X264_BITRATE_MAX_KBPS = 8000
+X264_BITRATE_MIN_KBPS = 3000
+X264_BITRATE_STEP_KBPS = 1000
+
+# Average ffmpeg encode speed below which the controller makes the encode cheaper, and the speed
+# plus idle CPU share it needs before it spends more CPU on quality again
+ENCODER_SPEED_LOW = 0.97
+ENCODER_SPEED_OK = 0.99
+ENCODER_CPU_HEADROOM_UP = 0.35
+
+# Seconds of speed readings averaged per decision, and minimum seconds between encoder changes
+ENCODER_SAMPLE_WINDOW = 10
+ENCODER_ADJUST_COOLDOWN = 30
+
+# Process placement. CPU sets are collections of CPU ids, e.g. {0, 1} for the ingest server and
+# {2, 3, 4, 5} for ffmpeg relays, so heavy transcodes cannot starve upload handling. None leaves
+# placement to the OS; pinning only the ingest server still lets ffmpeg use every CPU.
+INGEST_CPUS = None
+FFMPEG_CPUS = None
+
+# Niceness (0-19) and I/O scheduling class ("best-effort" or "idle") and level (0-7) for ffmpeg relays.
+# None leaves the setting inherited from the relay. Applied with taskset/nice/ionice when installed.
+FFMPEG_NICE = None
+FFMPEG_IONICE_CLASS = None
+FFMPEG_IONICE_LEVEL = 7
+
+# Optional cgroup v2 CPU cap shared by all ffmpeg relays, in CPUs (e.g. 4.0). The cgroup is created
+# at FFMPEG_CGROUP_PATH if missing; this needs a delegated, writable cgroup and is skipped otherwise.
+FFMPEG_CGROUP_CPU_LIMIT = None
+FFMPEG_CGROUP_PATH = "/sys/fs/cgroup/hls-relay-ffmpeg"
+
+# User-Agent prefix ffmpeg relays send to the segment endpoint, so fetches can be attributed per target
+RELAY_USER_AGENT_PREFIX = "hls-relay/"
+
+# How each destination is relayed: "ffmpeg" runs an ffmpeg process, "native" (YouTube only) uploads the
+# client's fMP4 segments and generated playlists directly over pooled keep-alive HTTP connections, and
+# "remux" (YouTube only) does the same with MPEG-TS segments remuxed inside the relay process
+RELAY_ENGINES = {"youtube": "ffmpeg", "twitch": "ffmpeg"}
+NATIVE_ENGINE_TARGETS = {"youtube"}
+
+# YouTube HLS ingest URL used by the native engine; {stream_key} and {file} are filled in per upload.
+# Point it at a local stand-in server to test without going live.
+YOUTUBE_UPLOAD_URL = os.environ.get(
+    "RELAY_YOUTUBE_UPLOAD_URL",
+    "https://a.upload.youtube.com/http_upload_hls?cid={stream_key}&copy=0&file={file}",
+)
+
+# Native engine: attempts per file, first retry delay (doubling up to the max) and per-request timeout
+NATIVE_UPLOAD_RETRIES = 5
+NATIVE_UPLOAD_BACKOFF = 0.5
+NATIVE_UPLOAD_BACKOFF_MAX = 8
+NATIVE_UPLOAD_TIMEOUT = 10
+
+# Native engine: number of segments listed in the uploaded sliding-window media playlist
+NATIVE_PLAYLIST_WINDOW = 10
+NATIVE_MEDIA_PLAYLIST = "media.m3u8"
+NATIVE_MASTER_PLAYLIST = "master.m3u8"
+
+# Clients may upload alternative renditions (e.g. a 1080p fallback next to a 4K HDR main stream) by
+# adding a Rendition header; uploads without it, or with Rendition: main, are the main rendition.
+# Each rendition gets its own playlist in a subdirectory and master.m3u8 lists them all.
+MAIN_RENDITION = "main"
+
+# Relays switch to a lower rendition at the next segment boundary when they lag this many seconds,
+# choosing the highest one that fits RENDITION_BANDWIDTH_HEADROOM of the measured upstream throughput
+RENDITION_DOWNSWITCH_LAG = 10
+RENDITION_BANDWIDTH_HEADROOM = 0.8
+
+# Seconds without lag before trying the next higher rendition; doubles (up to the max) whenever a
+# higher rendition had to be abandoned again within that time
+RENDITION_UPSWITCH_HOLD = 60
+RENDITION_UPSWITCH_HOLD_MAX = 600
+
+# Number of recent segments averaged for a rendition's bitrate
+RENDITION_BITRATE_SEGMENTS = 10
+
+# Window (seconds) over which the host's upstream throughput is measured from /proc/net/dev
+UPSTREAM_SAMPLE_WINDOW = 10
+
+# Seconds between reads of /proc/net/dev by the upstream monitor's background thread
+UPSTREAM_SAMPLE_INTERVAL = 1
+
 # Optional forced target override (environment or CLI). If set, overrides incoming Target header.
 FORCE_TARGET = os.environ.get("RELAY_FORCE_TARGET", "").strip().lower() or None
 
@@ -55,50 +364,3225 @@ app = Flask(__name__)
 # Ensure the base directory exists
 os.makedirs(BASE_SEGMENTS_DIR, exist_ok=True)
 
-# Dictionary to store stream-specific variables
-stream_creation_lock = threading.Lock()
+
+class LogPipeline:
+    """Log records queued by any thread and written in batches by a background writer thread"""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # Also in a forked child, which has no writer thread and must not wait on the parent's queue
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+        self.buckets = {}  # stream -> (tokens, monotonic time of last record, records left out since)
+        self.file = None
+        self.file_day = None
+
+    def log(self, message, level="info", stream=None, **fields):
+        if LOG_LEVELS[level] < LOG_LEVELS[LOG_LEVEL]:
+            return
+        record = {"time": time.time(), "level": level, "message": message}
+        if stream is not None:
+            record["stream"] = stream
+            if LOG_LEVELS[level] < LOG_LEVELS["warning"]:
+                suppressed = self._throttle(stream)
+                if suppressed is None:
+                    return
+                if suppressed:
+                    record["suppressed"] = suppressed
+        record.update(fields)
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def _throttle(self, stream):
+        """Records of the stream left out since its last one, or None to leave this one out too"""
+        now = time.monotonic()
+        with self.lock:
+            if len(self.buckets) > 1024:
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < 60}
+            tokens, last, suppressed = self.buckets.get(stream, (LOG_STREAM_BURST, now, 0))
+            tokens = min(LOG_STREAM_BURST, tokens + (now - last) * LOG_STREAM_RATE)
+            if tokens < 1:
+                self.buckets[stream] = (tokens, now, suppressed + 1)
+                return None
+            self.buckets[stream] = (tokens - 1, now, 0)
+            return suppressed
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < 256:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(records)
+            for _ in records:
+                self.queue.task_done()
+
+    def flush(self, timeout=5):
+        """Wait until the queued records are written, e.g. before the process exits or execs"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and self.thread is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def write(self, records):
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            records = records + [{"time": time.time(), "level": "warning", "message": f"{dropped} log records dropped, queue full"}]
+        text = "".join(self.format(record) + "\n" for record in records)
+        try:
+            output = self._output(records[-1]["time"])
+            output.write(text)
+            output.flush()
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"Error writing log: {e}\n{text}")
+
+    @staticmethod
+    def format(record):
+        timestamp = datetime.fromtimestamp(record["time"]).isoformat(timespec="milliseconds")
+        if LOG_FORMAT == "json":
+            return json.dumps({**record, "time": timestamp}, separators=(",", ":"), default=str)
+        extra = "".join(f" {name}={value}" for name, value in record.items() if name not in ("time", "level", "message"))
+        return f"{timestamp} {record['level'].upper()} {record['message']}{extra}"
+
+    def _output(self, timestamp):
+        if LOG_DIR is None:
+            return sys.stdout
+        day = time.strftime("%Y%m%d", time.localtime(timestamp))
+        if day != self.file_day:
+            if self.file is not None:
+                self.file.close()
+            os.makedirs(LOG_DIR, exist_ok=True)
+            self.file = open(os.path.join(LOG_DIR, f"{day}.log"), "a")
+            self.file_day = day
+        return self.file
+
+
+log_pipeline = LogPipeline()
+os.register_at_fork(after_in_child=log_pipeline._reset)
+atexit.register(log_pipeline.flush)
+
+
+def log(message, level="info", stream=None, **fields):
+    """Queue a log record; never waits for the write. Records of a stream are rate limited per stream"""
+    log_pipeline.log(message, level, stream, **fields)
+
+
+class MetricFamily:
+    """A series of GET /metrics; label values must come from a small fixed set, never from stream keys"""
+
+    def __init__(self, name, kind, help_text, labels=()):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def samples(self):
+        """(sample name, [(label, value), ...], value) of each sample"""
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(self.name, list(zip(self.labels, key)), value) for key, value in items]
+
+
+class Counter(MetricFamily):
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, "counter", help_text, labels)
+        if not labels:
+            # An unlabelled counter is reported from the start, so rate() sees its first increment
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(MetricFamily):
+    """Read when /metrics is served: collect() returns {label values: value}"""
+
+    def __init__(self, name, help_text, collect, labels=()):
+        super().__init__(name, "gauge", help_text, labels)
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, list(zip(self.labels, key)), value) for key, value in sorted(self.collect().items())]
+
+
+class Histogram(MetricFamily):
+    """Counts per fixed bucket, so an observation is a bisect and an increment under a lock"""
+
+    def __init__(self, name, help_text, buckets, labels=()):
+        super().__init__(name, "histogram", help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # A count per bucket, one for +Inf, and the sum
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, list(state)) for key, state in self.values.items())
+        samples = []
+        for key, state in items:
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state[:-1]):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + [("le", "+Inf" if bound == math.inf else repr(float(bound)))], cumulative))
+            samples.append((f"{self.name}_sum", labels, state[-1]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+def render_metric_families(families):
+    """Prometheus text exposition format of (name, kind, help, samples) families"""
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample_name, labels, value in samples:
+            label_text = ",".join(f'{label}="{escape_label_value(label_value)}"' for label, label_value in labels)
+            lines.append(f"{sample_name}{{{label_text}}} {format_metric_value(value)}" if labels else f"{sample_name} {format_metric_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_metric_value(value):
+    if isinstance(value, float):
+        return "+Inf" if value == math.inf else repr(value)
+    return str(value)
+
+
+class RelayMetrics:
+    """Everything GET /metrics reports; histograms are updated on every upload, gauges read per scrape"""
+
+    def __init__(self):
+        self.upload_requests = Counter("hls_relay_upload_requests_total", "Upload requests by endpoint and status class", ("endpoint", "status"))
+        self.upload_seconds = Histogram("hls_relay_upload_request_duration_seconds", "Time to handle an upload request, including reading its body", METRICS_SECONDS_BUCKETS, ("endpoint",))
+        self.upload_bytes = Histogram("hls_relay_upload_body_bytes", "Body size of upload requests", METRICS_BYTES_BUCKETS, ("endpoint",))
+        self.disk_seconds = Histogram("hls_relay_disk_operation_seconds", "Segment writes to disk, playlist appends and fsyncs", METRICS_SECONDS_BUCKETS, ("operation",))
+        self.playlist_update_seconds = Histogram("hls_relay_playlist_update_seconds", "Time to move arrived segments into the playlist, with the playlist lock held", METRICS_SECONDS_BUCKETS)
+        self.reorder_depth = Histogram("hls_relay_reorder_depth_segments", "Segments waiting in the reorder buffer after each playlist update", METRICS_DEPTH_BUCKETS)
+        self.gap_skips = Counter("hls_relay_gap_skips_total", "Missing sequences skipped after GAP_SKIP_TIMEOUT")
+        self.relay_restarts = Counter("hls_relay_relay_restarts_total", "Relay restarts by target, after an exit or on request (catch-up, rendition or encoder change)", ("target", "cause"))
+        self.relay_exits = Counter("hls_relay_relay_exits_total", "Relay process exits by target and exit code", ("target", "exit"))
+        self.families = [
+            self.upload_requests, self.upload_seconds, self.upload_bytes, self.disk_seconds,
+            self.playlist_update_seconds, self.reorder_depth, self.gap_skips, self.relay_restarts, self.relay_exits,
+            Gauge("hls_relay_active_streams", "Streams not finalized", lambda: {(): sum(1 for stream in self._streams() if not stream.finalized)}),
+            Gauge("hls_relay_reorder_pending_bytes", "Bytes waiting in the reorder buffers of all streams", lambda: {(): sum(stream.pending_bytes() for stream in self._streams())}),
+            Gauge("hls_relay_relays_running", "Running relays by target", self._relays_running, ("target",)),
+            Gauge("hls_relay_relay_lag_seconds_max", "Largest relay lag behind the live edge, by target", self._relay_lag_max, ("target",)),
+            Gauge("hls_relay_ffmpeg_relays", "Running FFmpeg processes", lambda: {(): resource_governor.running_ffmpeg_relays()}),
+        ]
+
+    @staticmethod
+    def _streams():
+        with stream_creation_lock:
+            return list(streams.values())
+
+    def _running_relays(self):
+        return [relay for stream in self._streams() for relay in list(stream.relays.values()) if relay.is_running()]
+
+    def _relays_running(self):
+        counts = {}
+        for relay in self._running_relays():
+            counts[(relay.target,)] = counts.get((relay.target,), 0) + 1
+        return counts
+
+    def _relay_lag_max(self):
+        lags = {}
+        for relay in self._running_relays():
+            lag = relay.lag()
+            if lag is not None:
+                lags[(relay.target,)] = max(lag, lags.get((relay.target,), 0.0))
+        return lags
+
+    def record_exit(self, target, code, signal):
+        # Exit codes are few in practice; anything else is folded into a couple of values
+        exit_label = str(code) if isinstance(code, int) and -64 <= code <= 255 else ("killed" if signal == "SIGKILL" else "error")
+        self.relay_exits.inc(target=target, exit=exit_label)
+
+    def render(self):
+        return render_metric_families([(family.name, family.kind, family.help_text, family.samples()) for family in self.families])
+
+
+metrics = RelayMetrics()
+
+
+class TimedLock:
+    """Mutex that records how often and how long callers had to wait for it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self):
+        if self._lock.acquire(blocking=False):
+            wait = None
+        else:
+            started = time.perf_counter()
+            self._lock.acquire()
+            wait = time.perf_counter() - started
+        # The statistics are only updated while holding the lock
+        self.acquisitions += 1
+        if wait is not None:
+            self.contended += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def lock_wait_stats(locks):
+    """Combined wait statistics of one or more TimedLocks"""
+    acquisitions = sum(lock.acquisitions for lock in locks)
+    contended = sum(lock.contended for lock in locks)
+    total_wait = sum(lock.total_wait for lock in locks)
+    return {
+        "acquisitions": acquisitions,
+        "contended": contended,
+        "mean_wait_ms": 1000 * total_wait / contended if contended else 0.0,
+        "max_wait_ms": 1000 * max((lock.max_wait for lock in locks), default=0.0),
+    }
+
+
+# Dictionary to store stream-specific variables. stream_creation_lock only guards the dictionary;
+# finding, restoring or creating the stream for a key happens under that key's stripe lock.
+stream_creation_lock = TimedLock()
 streams = {}
+stream_key_locks = [TimedLock() for _ in range(STREAM_LOCK_STRIPES)]
+
+
+def stream_key_lock(stream_key):
+    return stream_key_locks[zlib.crc32(stream_key.encode()) % len(stream_key_locks)]
+
+
+class Worker:
+    """This process's place among the WORKER_PROCESSES workers, with its loopback listening socket"""
+
+    def __init__(self, index, sock):
+        self.index = index
+        self.socket = sock
+        self.port = worker_port(index)
+
+
+# Set in a worker process; None when the relay runs as a single process
+current_worker = None
+
+
+def worker_port(index):
+    return PORT + 1 + index
+
+
+def stream_worker(stream_key):
+    """Index of the worker process that owns a stream key"""
+    return zlib.crc32(stream_key.encode()) % WORKER_PROCESSES
+
+
+def local_port():
+    """Port on which this process serves the segments of its own streams"""
+    return PORT if current_worker is None else current_worker.port
+
+
+def relay_listener_port():
+    return RELAY_LISTENER_PORT + (0 if current_worker is None else current_worker.index)
+
+
+def relay_input_port():
+    """Port FFmpeg relays read playlists and segments from"""
+    return local_port() if RELAY_LISTENER_PORT is None else relay_listener_port()
+
+
+def on_worker_port():
+    """Whether the current request came in on this worker's loopback port, i.e. from another worker or FFmpeg"""
+    return current_worker is not None and request.environ.get("SERVER_PORT") == str(current_worker.port)
+
+# Partial file path -> [lock that orders the chunks of one resumable upload, requests holding or waiting on it]
+resumable_upload_locks_guard = threading.Lock()
+resumable_upload_locks = {}
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+def is_valid_stream_key(stream_key):
+    if not stream_key:
+        return False
+    return re.fullmatch(r"[A-Za-z0-9_-]+", stream_key) is not None
+
+
+def is_valid_stream_id(stream_id):
+    if not stream_id:
+        return False
+    return re.fullmatch(r"[A-Za-z0-9_-]+", stream_id) is not None
+
+
+def validate_path_component(component, component_name="path component"):
+    if not component or component in {".", ".."}:
+        return False, f"Invalid {component_name}", 400
+    if "/" in component or "\\" in component or ".." in component:
+        return False, f"Invalid {component_name}", 400
+    return True, None, None
+
+# Sample entries and colour descriptions that rule out relaying video to Twitch as-is
+DOLBY_VISION_SAMPLE_ENTRIES = {"dvh1", "dvhe", "dva1", "dvav"}
+HDR_TRANSFER_CHARACTERISTICS = {16, 18}  # SMPTE ST 2084 (PQ) and ARIB STD-B67 (HLG)
+
+
+def iter_mp4_boxes(data, start=0, end=None):
+    """Yield (box_type, payload_start, box_end) for the ISO BMFF boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            return
+        yield box_type.decode("latin-1"), offset + header_size, offset + size
+        offset += size
+
+
+def find_mp4_box(data, path, start=0, end=None):
+    """Return (payload_start, box_end) of the first box matching a path like "moov/trak", or None"""
+    box_type, _, rest = path.partition("/")
+    for found_type, payload_start, box_end in iter_mp4_boxes(data, start, end):
+        if found_type == box_type:
+            if not rest:
+                return payload_start, box_end
+            found = find_mp4_box(data, rest, payload_start, box_end)
+            if found:
+                return found
+    return None
+
+
+def probe_init_segment(data):
+    """Describe the video track of an fMP4 initialization segment.
+
+    Returns a dict with the sample entry codec, AVC profile/level/bit depth/chroma format when
+    available, colour description from the colr box and Dolby Vision signalling, or None if no
+    video track is found.
+    """
+    moov = find_mp4_box(data, "moov")
+    if not moov:
+        return None
+    for box_type, trak_start, trak_end in iter_mp4_boxes(data, *moov):
+        if box_type != "trak":
+            continue
+        hdlr = find_mp4_box(data, "mdia/hdlr", trak_start, trak_end)
+        if not hdlr or data[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+            continue
+        stsd = find_mp4_box(data, "mdia/minf/stbl/stsd", trak_start, trak_end)
+        if not stsd:
+            return None
+        # Full box header (4) + entry count (4), then the first sample entry
+        for codec, entry_start, entry_end in iter_mp4_boxes(data, stsd[0] + 8, stsd[1]):
+            info = {
+                "codec": codec,
+                "width": None,
+                "height": None,
+                "profile": None,
+                "level": None,
+                "bit_depth": None,
+                "chroma_format": None,
+                "colour_primaries": None,
+                "transfer_characteristics": None,
+                "matrix_coefficients": None,
+                "dolby_vision": codec in DOLBY_VISION_SAMPLE_ENTRIES,
+            }
+            if entry_start + 78 <= entry_end:
+                info["width"], info["height"] = struct.unpack_from(">HH", data, entry_start + 24)
+            # Visual sample entries carry 78 bytes of fixed fields before their child boxes
+            for child, child_start, child_end in iter_mp4_boxes(data, entry_start + 78, entry_end):
+                payload = data[child_start:child_end]
+                if child == "avcC" and len(payload) >= 4:
+                    info["profile"] = payload[1]
+                    info["level"] = payload[3]
+                    info.update(_parse_avcc_format(payload))
+                elif child == "colr" and payload[:4] == b"nclx" and len(payload) >= 10:
+                    (info["colour_primaries"],
+                     info["transfer_characteristics"],
+                     info["matrix_coefficients"]) = struct.unpack_from(">HHH", payload, 4)
+                elif child in ("dvcC", "dvvC", "dvwC"):
+                    info["dolby_vision"] = True
+            return info
+    return None
+
+
+def _parse_avcc_format(payload):
+    """Chroma format and bit depth from an avcC record, falling back to the profile defaults"""
+    profile = payload[1]
+    try:
+        offset = 5
+        sps_count = payload[offset] & 0x1F
+        offset += 1
+        for _ in range(sps_count):
+            offset += 2 + struct.unpack_from(">H", payload, offset)[0]
+        pps_count = payload[offset]
+        offset += 1
+        for _ in range(pps_count):
+            offset += 2 + struct.unpack_from(">H", payload, offset)[0]
+        # The chroma/bit depth extension follows the parameter sets for every profile but these
+        if profile not in (66, 77, 88) and offset + 3 <= len(payload):
+            return {
+                "chroma_format": payload[offset] & 0x03,
+                "bit_depth": (payload[offset + 1] & 0x07) + 8,
+            }
+    except (IndexError, struct.error):
+        pass
+    if profile in (110, 122, 244):
+        # High 10 / 4:2:2 / 4:4:4 without the extension: assume they use what the profile allows
+        return {"chroma_format": 3 if profile == 244 else (2 if profile == 122 else 1), "bit_depth": 10}
+    return {"chroma_format": 1, "bit_depth": 8}
+
+
+def twitch_copy_decision(info):
+    """Return (copy_ok, reason) for relaying a video track to Twitch without re-encoding"""
+    if info is None:
+        return False, "init segment could not be parsed"
+    codec = info["codec"]
+    if info["dolby_vision"]:
+        return False, f"Dolby Vision ({codec})"
+    if codec not in ("avc1", "avc3"):
+        return False, f"codec {codec} is not H.264"
+    if info["transfer_characteristics"] in HDR_TRANSFER_CHARACTERISTICS or info["colour_primaries"] == 9:
+        return False, f"HDR colour (primaries {info['colour_primaries']}, transfer {info['transfer_characteristics']})"
+    if info["bit_depth"] != 8 or info["chroma_format"] != 1:
+        return False, f"{info['bit_depth']}-bit chroma format {info['chroma_format']} is not 8-bit 4:2:0"
+    if info["profile"] not in TWITCH_COPY_PROFILES:
+        return False, f"H.264 profile {info['profile']} is not accepted by Twitch"
+    if info["level"] is not None and info["level"] > TWITCH_COPY_MAX_LEVEL:
+        return False, f"H.264 level {info['level'] / 10:.1f} exceeds {TWITCH_COPY_MAX_LEVEL / 10:.1f}"
+    if info["width"] and info["height"]:
+        long_side, short_side = max(info["width"], info["height"]), min(info["width"], info["height"])
+        if long_side > TWITCH_COPY_MAX_DIMENSIONS[0] or short_side > TWITCH_COPY_MAX_DIMENSIONS[1]:
+            return False, f"resolution {info['width']}x{info['height']} exceeds {TWITCH_COPY_MAX_DIMENSIONS[0]}x{TWITCH_COPY_MAX_DIMENSIONS[1]}"
+    level = "" if info["level"] is None else f"@{info['level'] / 10:.1f}"
+    return True, f"H.264 profile {info['profile']}{level} 8-bit SDR"
+
+
+# In-process fMP4 to MPEG-TS remuxing: sample entries per codec, their TS stream types and PIDs
+REMUX_VIDEO_CODECS = {"avc1": "avc", "avc3": "avc", "hvc1": "hevc", "hev1": "hevc", "dvh1": "hevc", "dvhe": "hevc"}
+REMUX_AUDIO_CODECS = {"mp4a": "aac", "ac-3": "ac3", "ec-3": "eac3"}
+TS_STREAM_TYPES = {"avc": 0x1B, "hevc": 0x24, "aac": 0x0F, "ac3": 0x81, "eac3": 0x87}
+TS_PACKET_SIZE = 188
+TS_PMT_PID = 0x1000
+TS_VIDEO_PID = 0x100
+TS_AUDIO_PID = 0x101
+# PTS/DTS are offset by 0.7 s (90 kHz units) so the PCR, taken from the unshifted DTS, stays ahead of
+# decoding like ffmpeg's default muxdelay
+TS_MUX_DELAY = 63000
+TS_TIMESTAMP_MASK = (1 << 33) - 1
+ANNEXB_START_CODE = b"\x00\x00\x00\x01"
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _mpeg_crc32_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_MPEG_CRC32_TABLE = _mpeg_crc32_table()
+
+
+def mpeg_crc32(data):
+    """CRC-32/MPEG-2 used by PSI sections"""
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _MPEG_CRC32_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def _read_descriptor_length(data, offset):
+    length = 0
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        length = (length << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return length, offset
+
+
+def _parse_esds_audio_config(payload):
+    """(ADTS profile, sampling frequency index, channel configuration) from an esds box payload"""
+    offset = 4  # full box header
+    if payload[offset] != 0x03:
+        raise ValueError("esds has no ES descriptor")
+    _, offset = _read_descriptor_length(payload, offset + 1)
+    flags = payload[offset + 2]
+    offset += 3
+    if flags & 0x80:
+        offset += 2
+    if flags & 0x40:
+        offset += 1 + payload[offset]
+    if flags & 0x20:
+        offset += 2
+    if payload[offset] != 0x04:
+        raise ValueError("esds has no decoder config descriptor")
+    _, offset = _read_descriptor_length(payload, offset + 1)
+    offset += 13
+    if payload[offset] != 0x05:
+        raise ValueError("esds has no AudioSpecificConfig")
+    _, offset = _read_descriptor_length(payload, offset + 1)
+    bits = int.from_bytes(payload[offset:offset + 8].ljust(8, b"\x00"), "big")
+    position = 64
+
+    def read(count):
+        nonlocal position
+        position -= count
+        return (bits >> position) & ((1 << count) - 1)
+
+    object_type = read(5)
+    if object_type == 31:
+        object_type = 32 + read(6)
+    frequency_index = read(4)
+    if frequency_index == 15:
+        raise ValueError("explicit AAC sampling rates are not supported")
+    channel_config = read(4)
+    if object_type in (5, 29):
+        # HE-AAC with explicit SBR/PS signalling: ADTS carries the AAC core
+        if read(4) == 15:
+            read(24)
+        object_type = read(5)
+    if not 1 <= object_type <= 4:
+        raise ValueError(f"AAC object type {object_type} cannot be carried in ADTS")
+    return object_type - 1, frequency_index, channel_config
+
+
+def _parse_parameter_sets(codec, payload):
+    """(NAL length size, Annex B parameter sets) from an avcC or hvcC record"""
+    nals = []
+    if codec == "avc":
+        length_size = (payload[4] & 0x03) + 1
+        offset = 5
+        for count_mask in (0x1F, 0xFF):
+            count = payload[offset] & count_mask
+            offset += 1
+            for _ in range(count):
+                size = struct.unpack_from(">H", payload, offset)[0]
+                nals.append(payload[offset + 2:offset + 2 + size])
+                offset += 2 + size
+    else:
+        length_size = (payload[21] & 0x03) + 1
+        offset = 23
+        for _ in range(payload[22]):
+            count = struct.unpack_from(">H", payload, offset + 1)[0]
+            offset += 3
+            for _ in range(count):
+                size = struct.unpack_from(">H", payload, offset)[0]
+                nals.append(payload[offset + 2:offset + 2 + size])
+                offset += 2 + size
+    return length_size, b"".join(ANNEXB_START_CODE + nal for nal in nals)
+
+
+def parse_init_tracks(data):
+    """Describe the tracks of an fMP4 initialization segment for remuxing, keyed by track id"""
+    moov = find_mp4_box(data, "moov")
+    if not moov:
+        raise ValueError("init segment has no moov box")
+    defaults = {}
+    mvex = find_mp4_box(data, "mvex", *moov)
+    if mvex:
+        for box_type, start, end in iter_mp4_boxes(data, *mvex):
+            if box_type == "trex" and end - start >= 24:
+                track_id, _, duration, size, flags = struct.unpack_from(">IIIII", data, start + 4)
+                defaults[track_id] = (duration, size, flags)
+
+    tracks = {}
+    for box_type, trak_start, trak_end in iter_mp4_boxes(data, *moov):
+        if box_type != "trak":
+            continue
+        tkhd = find_mp4_box(data, "tkhd", trak_start, trak_end)
+        mdhd = find_mp4_box(data, "mdia/mdhd", trak_start, trak_end)
+        stsd = find_mp4_box(data, "mdia/minf/stbl/stsd", trak_start, trak_end)
+        if not (tkhd and mdhd and stsd):
+            continue
+        track_id = struct.unpack_from(">I", data, tkhd[0] + (20 if data[tkhd[0]] == 1 else 12))[0]
+        timescale = struct.unpack_from(">I", data, mdhd[0] + (20 if data[mdhd[0]] == 1 else 12))[0]
+        for entry, entry_start, entry_end in iter_mp4_boxes(data, stsd[0] + 8, stsd[1]):
+            track = {
+                "timescale": timescale,
+                "defaults": defaults.get(track_id, (0, 0, 0)),
+            }
+            if entry in REMUX_VIDEO_CODECS:
+                codec = REMUX_VIDEO_CODECS[entry]
+                config = find_mp4_box(data, "avcC" if codec == "avc" else "hvcC", entry_start + 78, entry_end)
+                if not config:
+                    raise ValueError(f"{entry} sample entry has no decoder configuration")
+                track["length_size"], track["parameter_sets"] = _parse_parameter_sets(codec, data[config[0]:config[1]])
+                track.update(kind="video", codec=codec)
+            elif entry in REMUX_AUDIO_CODECS:
+                codec = REMUX_AUDIO_CODECS[entry]
+                if codec == "aac":
+                    # Audio sample entries carry 28 bytes of fixed fields before their child boxes
+                    esds = find_mp4_box(data, "esds", entry_start + 28, entry_end)
+                    if not esds:
+                        raise ValueError("mp4a sample entry has no esds box")
+                    track["adts"] = _parse_esds_audio_config(data[esds[0]:esds[1]])
+                track.update(kind="audio", codec=codec)
+            else:
+                raise ValueError(f"codec {entry} cannot be remuxed to MPEG-TS")
+            tracks[track_id] = track
+            break
+    return tracks
+
+
+def parse_fragment_samples(data, tracks):
+    """Yield (track id, decode time, composition offset, is sync sample, sample bytes) from moof/mdat pairs"""
+    box_start = 0
+    for box_type, payload_start, box_end in iter_mp4_boxes(data):
+        moof_start, box_start = box_start, box_end
+        if box_type != "moof":
+            continue
+        for traf_type, traf_start, traf_end in iter_mp4_boxes(data, payload_start, box_end):
+            if traf_type != "traf":
+                continue
+            tfhd = find_mp4_box(data, "tfhd", traf_start, traf_end)
+            if not tfhd:
+                continue
+            flags = struct.unpack_from(">I", data, tfhd[0])[0] & 0xFFFFFF
+            track_id = struct.unpack_from(">I", data, tfhd[0] + 4)[0]
+            if track_id not in tracks:
+                continue
+            default_duration, default_size, default_flags = tracks[track_id]["defaults"]
+            offset = tfhd[0] + 8
+            base_offset = moof_start
+            if flags & 0x01:
+                base_offset = struct.unpack_from(">Q", data, offset)[0]
+                offset += 8
+            if flags & 0x02:
+                offset += 4
+            if flags & 0x08:
+                default_duration = struct.unpack_from(">I", data, offset)[0]
+                offset += 4
+            if flags & 0x10:
+                default_size = struct.unpack_from(">I", data, offset)[0]
+                offset += 4
+            if flags & 0x20:
+                default_flags = struct.unpack_from(">I", data, offset)[0]
+
+            decode_time = 0
+            tfdt = find_mp4_box(data, "tfdt", traf_start, traf_end)
+            if tfdt:
+                decode_time = struct.unpack_from(">Q" if data[tfdt[0]] == 1 else ">I", data, tfdt[0] + 4)[0]
+
+            data_offset = base_offset
+            for trun_type, trun_start, trun_end in iter_mp4_boxes(data, traf_start, traf_end):
+                if trun_type != "trun":
+                    continue
+                version = data[trun_start]
+                trun_flags, sample_count = struct.unpack_from(">II", data, trun_start)
+                trun_flags &= 0xFFFFFF
+                offset = trun_start + 8
+                if trun_flags & 0x01:
+                    data_offset = base_offset + struct.unpack_from(">i", data, offset)[0]
+                    offset += 4
+                first_flags = None
+                if trun_flags & 0x04:
+                    first_flags = struct.unpack_from(">I", data, offset)[0]
+                    offset += 4
+                for index in range(sample_count):
+                    duration, size, sample_flags, composition = default_duration, default_size, default_flags, 0
+                    if trun_flags & 0x100:
+                        duration = struct.unpack_from(">I", data, offset)[0]
+                        offset += 4
+                    if trun_flags & 0x200:
+                        size = struct.unpack_from(">I", data, offset)[0]
+                        offset += 4
+                    if trun_flags & 0x400:
+                        sample_flags = struct.unpack_from(">I", data, offset)[0]
+                        offset += 4
+                    if trun_flags & 0x800:
+                        composition = struct.unpack_from(">i" if version == 1 else ">I", data, offset)[0]
+                        offset += 4
+                    if index == 0 and first_flags is not None:
+                        sample_flags = first_flags
+                    if data_offset + size > len(data):
+                        raise ValueError("sample data runs past the end of the segment")
+                    # sample_is_non_sync_sample is bit 16 of the sample flags
+                    yield track_id, decode_time, composition, not sample_flags & 0x10000, data[data_offset:data_offset + size]
+                    decode_time += duration
+                    data_offset += size
+
+
+def length_prefixed_to_annexb(sample, length_size, codec, parameter_sets=None):
+    """Convert one length-prefixed AVC/HEVC access unit to Annex B, with an access unit delimiter
+    first and the parameter sets ahead of sync samples that do not carry their own"""
+    if codec == "avc":
+        parts = [ANNEXB_START_CODE, b"\x09\xf0"]
+        parameter_set_types, delimiter_type = {7, 8}, 9
+    else:
+        parts = [ANNEXB_START_CODE, b"\x46\x01\x50"]
+        parameter_set_types, delimiter_type = {32, 33, 34}, 35
+    nals = []
+    has_parameter_sets = False
+    offset = 0
+    end = len(sample)
+    while offset + length_size <= end:
+        size = int.from_bytes(sample[offset:offset + length_size], "big")
+        offset += length_size
+        if size == 0 or offset + size > end:
+            break
+        nal = sample[offset:offset + size]
+        offset += size
+        nal_type = nal[0] & 0x1F if codec == "avc" else (nal[0] >> 1) & 0x3F
+        if nal_type == delimiter_type:
+            continue
+        has_parameter_sets = has_parameter_sets or nal_type in parameter_set_types
+        nals.append(nal)
+    if parameter_sets and not has_parameter_sets:
+        parts.append(parameter_sets)
+    for nal in nals:
+        parts.append(ANNEXB_START_CODE)
+        parts.append(nal)
+    return b"".join(parts)
+
+
+def _adts_header(config, frame_length):
+    profile, frequency_index, channel_config = config
+    length = frame_length + 7
+    return bytes([
+        0xFF,
+        0xF1,
+        (profile << 6) | (frequency_index << 2) | (channel_config >> 2),
+        ((channel_config & 0x03) << 6) | (length >> 11),
+        (length >> 3) & 0xFF,
+        ((length & 0x07) << 5) | 0x1F,
+        0xFC,
+    ])
+
+
+def _encode_timestamp(marker, timestamp):
+    return bytes([
+        (marker << 4) | ((timestamp >> 29) & 0x0E) | 0x01,
+        (timestamp >> 22) & 0xFF,
+        ((timestamp >> 14) & 0xFE) | 0x01,
+        (timestamp >> 7) & 0xFF,
+        ((timestamp << 1) & 0xFE) | 0x01,
+    ])
+
+
+def _encode_pcr(base):
+    return bytes([
+        (base >> 25) & 0xFF,
+        (base >> 17) & 0xFF,
+        (base >> 9) & 0xFF,
+        (base >> 1) & 0xFF,
+        ((base & 0x01) << 7) | 0x7E,
+        0x00,
+    ])
+
+
+def _psi_section(table_id, table_id_extension, body):
+    # section_syntax_indicator, reserved bits and a length covering the 5 header bytes, body and CRC
+    length = 5 + len(body) + 4
+    section = bytes([table_id, 0xB0 | (length >> 8), length & 0xFF]) + struct.pack(">H", table_id_extension) + b"\xc1\x00\x00" + body
+    return section + struct.pack(">I", mpeg_crc32(section))
+
+
+class TsRemuxer:
+    """Remuxes the fMP4 media segments of one initialization segment into MPEG-TS.
+
+    Each call to remux_segment returns a self-contained TS segment starting with PAT/PMT; continuity
+    counters carry over between calls, so consecutive segments also form one continuous TS byte stream.
+    Carries the first video (H.264/HEVC) and audio (AAC/AC-3/E-AC-3) track. Uses NumPy, when installed,
+    to lay out runs of full TS packets.
+    """
+
+    def __init__(self, init_data):
+        tracks = parse_init_tracks(init_data)
+        self.video_id = next((track_id for track_id, track in tracks.items() if track["kind"] == "video"), None)
+        self.audio_id = next((track_id for track_id, track in tracks.items() if track["kind"] == "audio"), None)
+        if self.video_id is None and self.audio_id is None:
+            raise ValueError("init segment has no track that can be remuxed")
+        self.tracks = tracks
+        self.pcr_pid = TS_VIDEO_PID if self.video_id is not None else TS_AUDIO_PID
+        self.continuity = {}
+
+        streams = b""
+        for track_id, pid in ((self.video_id, TS_VIDEO_PID), (self.audio_id, TS_AUDIO_PID)):
+            if track_id is not None:
+                streams += bytes([TS_STREAM_TYPES[tracks[track_id]["codec"]], 0xE0 | (pid >> 8), pid & 0xFF, 0xF0, 0x00])
+        self.pat = _psi_section(0x00, 1, struct.pack(">HH", 1, 0xE000 | TS_PMT_PID))
+        self.pmt = _psi_section(0x02, 1, struct.pack(">HH", 0xE000 | self.pcr_pid, 0xF000) + streams)
+
+    def _next_continuity(self, pid, count=1):
+        counter = self.continuity.get(pid, 0)
+        self.continuity[pid] = (counter + count) & 0x0F
+        return counter
+
+    def _write_psi(self, out, pid, section):
+        header = bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF, 0x10 | self._next_continuity(pid), 0x00])
+        out += (header + section).ljust(TS_PACKET_SIZE, b"\xff")
+
+    def _write_packet(self, out, pid, payload, start, adaptation=None):
+        """Append one TS packet; adaptation holds the adaptation field flags and PCR, padded with stuffing"""
+        stuffing = 184 - len(payload) - (len(adaptation) + 1 if adaptation is not None else 0)
+        if adaptation is None and stuffing > 0:
+            adaptation = b"" if stuffing == 1 else b"\x00"
+            stuffing -= 1 if stuffing == 1 else 2
+        header = bytes([0x47, (0x40 if start else 0x00) | (pid >> 8), pid & 0xFF,
+                        (0x30 if adaptation is not None else 0x10) | self._next_continuity(pid)])
+        out += header
+        if adaptation is not None:
+            out.append(len(adaptation) + stuffing)
+            out += adaptation
+            out += b"\xff" * stuffing
+        out += payload
+
+    def _write_full_packets(self, out, pid, pes, offset, count):
+        """Append count full 184-byte payload packets taken from pes[offset:]"""
+        first_counter = self._next_continuity(pid, count)
+        if numpy is not None and count >= 8:
+            packets = numpy.empty((count, TS_PACKET_SIZE), dtype=numpy.uint8)
+            packets[:, 0] = 0x47
+            packets[:, 1] = pid >> 8
+            packets[:, 2] = pid & 0xFF
+            packets[:, 3] = 0x10 | ((first_counter + numpy.arange(count)) & 0x0F)
+            packets[:, 4:] = numpy.frombuffer(pes, dtype=numpy.uint8, count=count * 184, offset=offset).reshape(count, 184)
+            out += packets.tobytes()
+            return
+        for index in range(count):
+            out += bytes([0x47, pid >> 8, pid & 0xFF, 0x10 | ((first_counter + index) & 0x0F)])
+            out += pes[offset + index * 184:offset + (index + 1) * 184]
+
+    def _write_pes(self, out, pid, pes, pcr=None, random_access=False):
+        adaptation = None
+        if pcr is not None or random_access:
+            adaptation = bytes([(0x40 if random_access else 0x00) | (0x10 if pcr is not None else 0x00)])
+            if pcr is not None:
+                adaptation += _encode_pcr(pcr)
+        first_size = min(len(pes), 184 - (len(adaptation) + 1 if adaptation is not None else 0))
+        self._write_packet(out, pid, pes[:first_size], True, adaptation)
+        offset = first_size
+        full_count = (len(pes) - offset) // 184
+        if full_count:
+            self._write_full_packets(out, pid, pes, offset, full_count)
+            offset += full_count * 184
+        if offset < len(pes):
+            self._write_packet(out, pid, pes[offset:], False)
+
+    @staticmethod
+    def _pes(stream_id, payload, pts, dts=None, bounded=True):
+        if dts is not None and dts != pts:
+            header = b"\x80\xc0\x0a" + _encode_timestamp(3, pts) + _encode_timestamp(1, dts)
+        else:
+            header = b"\x80\x80\x05" + _encode_timestamp(2, pts)
+        length = len(header) + len(payload)
+        if not bounded or length > 0xFFFF:
+            length = 0
+        return b"\x00\x00\x01" + bytes([stream_id]) + struct.pack(">H", length) + header + payload
+
+    def remux_segment(self, data):
+        """Return the MPEG-TS bytes for one fMP4 media segment"""
+        units = []
+        for track_id, decode_time, composition, sync, sample in parse_fragment_samples(data, self.tracks):
+            if track_id not in (self.video_id, self.audio_id):
+                continue
+            timescale = self.tracks[track_id]["timescale"]
+            dts = decode_time * 90000 // timescale
+            pts = (decode_time + composition) * 90000 // timescale
+            units.append((dts, 0 if track_id == self.video_id else 1, pts, sync, sample))
+        units.sort(key=lambda unit: (unit[0], unit[1]))
+
+        out = bytearray()
+        self._write_psi(out, 0, self.pat)
+        self._write_psi(out, TS_PMT_PID, self.pmt)
+        for dts, kind, pts, sync, sample in units:
+            shifted_pts = (pts + TS_MUX_DELAY) & TS_TIMESTAMP_MASK
+            shifted_dts = (dts + TS_MUX_DELAY) & TS_TIMESTAMP_MASK
+            pcr = max(0, dts) & TS_TIMESTAMP_MASK
+            if kind == 0:
+                track = self.tracks[self.video_id]
+                payload = length_prefixed_to_annexb(sample, track["length_size"], track["codec"], track["parameter_sets"] if sync else None)
+                pes = self._pes(0xE0, payload, shifted_pts, shifted_dts, bounded=False)
+                self._write_pes(out, TS_VIDEO_PID, pes, pcr=pcr, random_access=sync)
+            else:
+                track = self.tracks[self.audio_id]
+                if track["codec"] == "aac":
+                    payload = _adts_header(track["adts"], len(sample)) + sample
+                    stream_id = 0xC0
+                else:
+                    payload = sample
+                    stream_id = 0xBD
+                pes = self._pes(stream_id, payload, shifted_pts)
+                self._write_pes(out, TS_AUDIO_PID, pes, pcr=pcr if self.pcr_pid == TS_AUDIO_PID else None, random_access=self.video_id is None)
+        return bytes(out)
+
+
+FFMPEG_SPEED_RE = re.compile(r"speed=\s*([0-9.]+)x")
+
+
+class SystemCpuMonitor:
+    """Share of idle CPU time across the host, sampled from /proc/stat"""
+
+    MIN_INTERVAL = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_sample = None
+        self.last_sample_time = 0.0
+        self.last_headroom = None
+
+    def _read_proc_stat(self):
+        with open("/proc/stat", "r") as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+        # idle + iowait count as headroom
+        return fields[3] + (fields[4] if len(fields) > 4 else 0), sum(fields)
+
+    def headroom(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_sample_time < self.MIN_INTERVAL:
+                return self.last_headroom
+            self.last_sample_time = now
+            try:
+                sample = self._read_proc_stat()
+            except (OSError, ValueError, IndexError):
+                try:
+                    load = os.getloadavg()[0]
+                except OSError:
+                    return None
+                self.last_headroom = max(0.0, 1.0 - load / (os.cpu_count() or 1))
+                return self.last_headroom
+            if self.last_sample is not None:
+                idle_delta = sample[0] - self.last_sample[0]
+                total_delta = sample[1] - self.last_sample[1]
+                if total_delta > 0:
+                    self.last_headroom = max(0.0, min(1.0, idle_delta / total_delta))
+            self.last_sample = sample
+            return self.last_headroom
+
+
+cpu_monitor = SystemCpuMonitor()
+
+
+class UpstreamMonitor:
+    """Host-wide transmit throughput (all interfaces but loopback) from /proc/net/dev"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = deque()  # (monotonic time, transmitted bytes)
+        self.bps = None
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            self.sample()
+            time.sleep(UPSTREAM_SAMPLE_INTERVAL)
+
+    def _read_tx_bytes(self):
+        total = 0
+        with open("/proc/net/dev") as f:
+            for line in f.readlines()[2:]:
+                interface, _, counters = line.partition(":")
+                if interface.strip() == "lo":
+                    continue
+                fields = counters.split()
+                if len(fields) >= 9:
+                    total += int(fields[8])
+        return total
+
+    def sample(self):
+        """Take one reading and update the throughput over the sample window"""
+        try:
+            tx_bytes = self._read_tx_bytes()
+        except (OSError, ValueError):
+            with self.lock:
+                self.bps = None
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.samples.append((now, tx_bytes))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= UPSTREAM_SAMPLE_WINDOW:
+                self.samples.popleft()
+            first_time, first_bytes = self.samples[0]
+            if now - first_time <= 0 or tx_bytes < first_bytes:
+                self.bps = None
+            else:
+                self.bps = (tx_bytes - first_bytes) * 8 / (now - first_time)
+
+    def throughput_bps(self):
+        """Bits per second sent over the sample window, or None until two samples are available.
+
+        Only reads the figure of the background thread, so status polls do not change the measurement.
+        """
+        self.start()
+        with self.lock:
+            return self.bps
+
+
+upstream_monitor = UpstreamMonitor()
+
+
+class EncoderController:
+    """Steps the x264 preset and bitrate of one transcoding relay to keep it at realtime speed"""
+
+    def __init__(self):
+        self.preset_index = X264_PRESETS.index(X264_DEFAULT_PRESET)
+        self.bitrate_kbps = X264_BITRATE_MAX_KBPS
+        self.speed_samples = deque()
+        self.adjust_not_before = 0.0
+
+    @property
+    def preset(self):
+        return X264_PRESETS[self.preset_index]
+
+    def video_args(self):
+        return [
+            "-c:v", "libx264",
+            "-preset", self.preset,
+            "-b:v", f"{self.bitrate_kbps}k",
+            "-pix_fmt", "yuv420p",
+            "-bufsize", f"{self.bitrate_kbps * 2}k",
+            "-g", "60",
+        ]
+
+    def record_speed(self, speed, now=None):
+        now = time.time() if now is None else now
+        self.speed_samples.append((now, speed))
+        cutoff = now - ENCODER_SAMPLE_WINDOW
+        while self.speed_samples and self.speed_samples[0][0] < cutoff:
+            self.speed_samples.popleft()
+
+    def reset(self, now=None):
+        """Forget speed readings from a previous process and let the new one settle"""
+        now = time.time() if now is None else now
+        self.speed_samples.clear()
+        self.adjust_not_before = max(self.adjust_not_before, now + ENCODER_SAMPLE_WINDOW)
+
+    def average_speed(self):
+        if not self.speed_samples:
+            return None
+        return sum(speed for _, speed in self.speed_samples) / len(self.speed_samples)
+
+    def decide(self, cpu_headroom, now=None):
+        """Step the settings if needed; returns a description of the change or None"""
+        now = time.time() if now is None else now
+        speed = self.average_speed()
+        if speed is None or now < self.adjust_not_before:
+            return None
+        if self.speed_samples[-1][0] - self.speed_samples[0][0] < ENCODER_SAMPLE_WINDOW / 2:
+            return None
+
+        previous = f"{self.preset}/{self.bitrate_kbps}k"
+        if speed < ENCODER_SPEED_LOW:
+            # Too slow: a faster preset saves the most CPU, then trade bitrate
+            if self.preset_index > 0:
+                self.preset_index -= 1
+            elif self.bitrate_kbps > X264_BITRATE_MIN_KBPS:
+                self.bitrate_kbps = max(X264_BITRATE_MIN_KBPS, self.bitrate_kbps - X264_BITRATE_STEP_KBPS)
+            else:
+                return None
+        elif speed >= ENCODER_SPEED_OK and cpu_headroom is not None and cpu_headroom >= ENCODER_CPU_HEADROOM_UP:
+            # Spare CPU: restore bitrate first, then spend it on a slower preset
+            if self.bitrate_kbps < X264_BITRATE_MAX_KBPS:
+                self.bitrate_kbps = min(X264_BITRATE_MAX_KBPS, self.bitrate_kbps + X264_BITRATE_STEP_KBPS)
+            elif self.preset_index < len(X264_PRESETS) - 1:
+                self.preset_index += 1
+            else:
+                return None
+        else:
+            return None
+
+        self.adjust_not_before = now + ENCODER_ADJUST_COOLDOWN
+        headroom_desc = "unknown" if cpu_headroom is None else f"{cpu_headroom * 100:.0f}%"
+        return f"encoder {previous} -> {self.preset}/{self.bitrate_kbps}k (speed {speed:.2f}x, cpu headroom {headroom_desc})"
+
+    def status(self):
+        speed = self.average_speed()
+        return {
+            "preset": self.preset,
+            "bitrate_kbps": self.bitrate_kbps,
+            "speed": None if speed is None else round(speed, 3),
+        }
+
+
+IONICE_CLASSES = {"best-effort": "2", "idle": "3"}
+
+# Affinity of the process before INGEST_CPUS is applied, so relays can be given back every CPU
+_initial_cpus = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+_placement_warnings = set()
+_ffmpeg_cgroup_lock = threading.Lock()
+_ffmpeg_cgroup = None  # None until set up, then the cgroup path or False when unavailable
+
+
+def _warn_placement_once(message):
+    if message not in _placement_warnings:
+        _placement_warnings.add(message)
+        log(message, level="warning")
+
+
+def ffmpeg_placement_prefix():
+    """Wrapper commands that apply the configured CPU set, niceness and I/O priority before exec"""
+    prefix = []
+    cpus = FFMPEG_CPUS if FFMPEG_CPUS is not None else (_initial_cpus if INGEST_CPUS is not None else None)
+    if cpus:
+        if shutil.which("taskset"):
+            prefix += ["taskset", "-c", ",".join(str(cpu) for cpu in sorted(cpus))]
+        else:
+            _warn_placement_once("taskset not found; ffmpeg CPU affinity not applied")
+    if FFMPEG_NICE is not None:
+        if shutil.which("nice"):
+            prefix += ["nice", "-n", str(FFMPEG_NICE)]
+        else:
+            _warn_placement_once("nice not found; ffmpeg niceness not applied")
+    if FFMPEG_IONICE_CLASS is not None:
+        if shutil.which("ionice"):
+            prefix += ["ionice", "-c", IONICE_CLASSES[FFMPEG_IONICE_CLASS]]
+            if FFMPEG_IONICE_CLASS == "best-effort":
+                prefix += ["-n", str(FFMPEG_IONICE_LEVEL)]
+        else:
+            _warn_placement_once("ionice not found; ffmpeg I/O priority not applied")
+    return prefix
+
+
+def _setup_ffmpeg_cgroup():
+    path = FFMPEG_CGROUP_PATH
+    parent = os.path.dirname(path)
+    with open(os.path.join(parent, "cgroup.controllers"), "r") as f:
+        if "cpu" not in f.read().split():
+            raise OSError(f"cpu controller not available in {parent}")
+    os.makedirs(path, exist_ok=True)
+    if not os.path.exists(os.path.join(path, "cpu.max")):
+        with open(os.path.join(parent, "cgroup.subtree_control"), "w") as f:
+            f.write("+cpu\n")
+    period = 100000
+    with open(os.path.join(path, "cpu.max"), "w") as f:
+        f.write(f"{max(1000, int(FFMPEG_CGROUP_CPU_LIMIT * period))} {period}\n")
+    return path
+
+
+def assign_ffmpeg_cgroup(pid):
+    """Move an ffmpeg process into the capped cgroup, if FFMPEG_CGROUP_CPU_LIMIT is configured"""
+    global _ffmpeg_cgroup
+    if FFMPEG_CGROUP_CPU_LIMIT is None:
+        return
+    with _ffmpeg_cgroup_lock:
+        if _ffmpeg_cgroup is None:
+            try:
+                _ffmpeg_cgroup = _setup_ffmpeg_cgroup()
+                log(f"ffmpeg relays capped at {FFMPEG_CGROUP_CPU_LIMIT} CPUs via {_ffmpeg_cgroup}")
+            except OSError as e:
+                _ffmpeg_cgroup = False
+                log(f"cgroup v2 CPU cap unavailable, continuing without it: {e}", level="warning")
+        path = _ffmpeg_cgroup
+    if not path:
+        return
+    try:
+        with open(os.path.join(path, "cgroup.procs"), "w") as f:
+            f.write(f"{pid}\n")
+    except OSError as e:
+        _warn_placement_once(f"could not move ffmpeg into {path}: {e}")
+
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def read_process_usage(pid):
+    """Return (cpu_seconds, rss_bytes) for a process from /proc, or None if unavailable"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+        with open(f"/proc/{pid}/statm", "r") as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    # Fields after the parenthesised command name; utime and stime are fields 14 and 15
+    fields = stat[stat.rfind(")") + 2:].split()
+    try:
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (ValueError, IndexError):
+        return None
+    return cpu_seconds, rss_pages * PAGE_SIZE
+
+
+def find_stream_dir(stream_key, stream_id):
+    stream_dir = os.path.join(BASE_SEGMENTS_DIR, f"{stream_key}_{stream_id}")
+    if os.path.isdir(stream_dir):
+        return stream_dir
+    return None
+
+
+def parse_targets(target_header, stream_key):
+    """Parse a Target header into a list of (target, key) relay destinations.
+
+    Passive entries are dropped, so an empty list means passive mode. Returns None if the
+    header names an unsupported target, repeats one, or carries an invalid key.
+    """
+    relay_targets = []
+    for entry in target_header.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        target, _, target_key = entry.partition("=")
+        target = target.strip().lower()
+        target_key = target_key.strip() or stream_key
+        if target in PASSIVE_TARGETS:
+            continue
+        if target not in RELAY_TARGETS or not is_valid_stream_key(target_key):
+            return None
+        if any(existing == target for existing, _ in relay_targets):
+            return None
+        relay_targets.append((target, target_key))
+    return relay_targets
+
+
+def content_digest():
+    """Hash object used to recognise retransmitted segments"""
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(path):
+    digest = content_digest()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def segment_sequence(segment_name):
+    """Upload sequence number encoded in a segment name like p0_segment_000042.m4s"""
+    try:
+        return int(segment_name.rsplit("_", 1)[-1].split(".")[0])
+    except ValueError:
+        return -1
+
+
+def current_stream(stream_key):
+    with stream_creation_lock:
+        return streams.get(stream_key)
+
+
+class HotTier:
+    """Segments kept in HOT_TIER_DIR while relays may still read them, mirroring BASE_SEGMENTS_DIR's layout"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.used_bytes = 0
+        self.reserved_during_pass = 0
+        self.spill_needed = 0  # bytes the mover should free by spilling, asked for by store()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stats = {"moved": 0, "spilled": 0, "written_to_disk": 0}
+
+    def path(self, stream_dir, segment_name):
+        return os.path.join(HOT_TIER_DIR, os.path.relpath(stream_dir, BASE_SEGMENTS_DIR), segment_name)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.spill()
+                self.move_consumed()
+            except Exception as e:
+                log(f"Error moving segments out of the hot tier: {e}", level="error")
+            self.wakeup.wait(HOT_TIER_MOVE_INTERVAL)
+            self.wakeup.clear()
+
+    def store(self, stream_dir, segment_name, size, write_segment):
+        """Write a new segment with write_segment(path), to the hot tier while it has room; returns the path"""
+        cold_path = os.path.join(stream_dir, segment_name)
+        if HOT_TIER_DIR is None:
+            self._write_to_disk(cold_path, write_segment)
+            return cold_path
+        self.start()
+        hot_path = self.path(stream_dir, segment_name)
+        if self._reserve(size):
+            try:
+                os.makedirs(os.path.dirname(hot_path), exist_ok=True)
+                write_segment(hot_path)
+                return hot_path
+            except OSError as e:
+                # e.g. the tmpfs is smaller than HOT_TIER_MAX_BYTES
+                log(f"Hot tier write of {segment_name} failed, writing it to {stream_dir}: {e}", level="warning")
+                with self.lock:
+                    self.used_bytes -= size
+        with self.lock:
+            self.stats["written_to_disk"] += 1
+        self._write_to_disk(cold_path, write_segment)
+        try:
+            # An earlier payload in the hot tier would otherwise still be served
+            os.remove(hot_path)
+        except FileNotFoundError:
+            pass
+        return cold_path
+
+    @staticmethod
+    def _write_to_disk(path, write_segment):
+        started = time.monotonic()
+        write_segment(path)
+        disk_health.record("segment_write", time.monotonic() - started)
+
+    def _reserve(self, size):
+        with self.lock:
+            if self.used_bytes + size > HOT_TIER_MAX_BYTES:
+                if HOT_TIER_OVERFLOW == "spill":
+                    # Copying is left to the mover; this segment goes to disk rather than wait for it
+                    self.spill_needed = max(self.spill_needed, self.used_bytes + size - HOT_TIER_MAX_BYTES)
+                    self.wakeup.set()
+                return False
+            self.used_bytes += size
+            self.reserved_during_pass += size
+            return True
+
+    def spill(self):
+        """Move the oldest hot segments to disk, read or not, until the room store() asked for is free"""
+        with self.lock:
+            needed, self.spill_needed = self.spill_needed, 0
+        spilled = 0
+        if needed <= 0:
+            return spilled
+        for hot_path, cold_dir, stat in sorted(self._files(), key=lambda item: item[2].st_mtime):
+            if needed <= 0:
+                break
+            if self._move(hot_path, cold_dir):
+                with self.lock:
+                    self.used_bytes -= stat.st_size
+                    self.stats["spilled"] += 1
+                needed -= stat.st_size
+                spilled += 1
+        return spilled
+
+    def _files(self):
+        """(hot path, directory it moves to, stat) of every hot segment"""
+        for directory, _, names in os.walk(HOT_TIER_DIR):
+            cold_dir = os.path.normpath(os.path.join(BASE_SEGMENTS_DIR, os.path.relpath(directory, HOT_TIER_DIR)))
+            for name in names:
+                hot_path = os.path.join(directory, name)
+                try:
+                    yield hot_path, cold_dir, os.stat(hot_path)
+                except FileNotFoundError:
+                    continue
+
+    def _move(self, hot_path, cold_dir):
+        """Copy a hot segment to cold_dir and remove it from the hot tier, unless it was rewritten meanwhile"""
+        cold_path = os.path.join(cold_dir, os.path.basename(hot_path))
+        temp_path = f"{cold_path}.{os.getpid()}.tmp"
+        try:
+            before = os.stat(hot_path)
+            os.makedirs(cold_dir, exist_ok=True)
+            shutil.copyfile(hot_path, temp_path)
+            os.replace(temp_path, cold_path)
+            after = os.stat(hot_path)
+            if (before.st_ino, before.st_size, before.st_mtime_ns) != (after.st_ino, after.st_size, after.st_mtime_ns):
+                # A retransmit replaced it while it was copied; the next pass moves the new payload
+                return False
+            os.remove(hot_path)
+        except FileNotFoundError:
+            # Already moved, e.g. by another worker process
+            return False
+        except OSError as e:
+            log(f"Error moving {hot_path} to {cold_dir}: {e}", level="error")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
+
+    @staticmethod
+    def _consumed(media, segment_name, stat, now):
+        """Whether a hot segment can move: fetched by every running relay of its stream, or old enough"""
+        if now - stat.st_mtime >= HOT_TIER_MAX_HOLD:
+            return True
+        if media is not None:
+            relays = [relay for relay in list((media.parent or media).relays.values()) if relay.source is media and relay.is_running()]
+            position = media.segment_positions.get(segment_name)
+            if relays and position is not None:
+                return all(relay.position is not None and relay.position[0] >= position[0] for relay in relays)
+        return now - stat.st_mtime >= HOT_TIER_HOLD
+
+    def move_consumed(self, now=None):
+        """Move the hot segments that relays no longer need to BASE_SEGMENTS_DIR; returns how many moved"""
+        if HOT_TIER_DIR is None or disk_health.active("memory_tier"):
+            return 0
+        now = time.time() if now is None else now
+        with self.lock:
+            self.reserved_during_pass = 0
+        with stream_creation_lock:
+            stream_list = list(streams.values())
+        media_by_dir = {
+            os.path.normpath(media.stream_dir): media
+            for stream in stream_list for media in [stream] + list(stream.renditions.values())
+        }
+        moved = 0
+        used = 0
+        for hot_path, cold_dir, stat in list(self._files()):
+            media = media_by_dir.get(cold_dir)
+            if self._consumed(media, os.path.basename(hot_path), stat, now) and self._move(hot_path, cold_dir):
+                moved += 1
+            else:
+                used += stat.st_size
+        for directory, subdirectories, names in os.walk(HOT_TIER_DIR, topdown=False):
+            cold_dir = os.path.normpath(os.path.join(BASE_SEGMENTS_DIR, os.path.relpath(directory, HOT_TIER_DIR)))
+            if directory != HOT_TIER_DIR and not names and not subdirectories and cold_dir not in media_by_dir:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+        with self.lock:
+            # Segments stored during the pass may have been counted already; the estimate errs on the full side
+            self.used_bytes = used + self.reserved_during_pass
+            self.stats["moved"] += moved
+        return moved
+
+    def evict(self, stream_dir, destination):
+        """Move the hot segments of a stream directory that was moved to destination after them"""
+        hot_dir = os.path.join(HOT_TIER_DIR, os.path.relpath(stream_dir, BASE_SEGMENTS_DIR))
+        for directory, _, names in os.walk(hot_dir):
+            target_dir = os.path.normpath(os.path.join(destination, os.path.relpath(directory, hot_dir)))
+            for name in names:
+                self._move(os.path.join(directory, name), target_dir)
+        shutil.rmtree(hot_dir, ignore_errors=True)
+
+    def status(self):
+        with self.lock:
+            return {"dir": HOT_TIER_DIR, "used_bytes": self.used_bytes, "max_bytes": HOT_TIER_MAX_BYTES, **self.stats}
+
+
+hot_tier = HotTier()
+
+
+def locate_segment(stream_dir, segment_name):
+    """Path of a stored segment: in the hot tier until it has been moved to stream_dir"""
+    if HOT_TIER_DIR is not None:
+        hot_path = hot_tier.path(stream_dir, segment_name)
+        if os.path.exists(hot_path):
+            return hot_path
+    return os.path.join(stream_dir, segment_name)
+
+
+def open_segment(stream_dir, segment_name):
+    """Open a stored segment for reading wherever it is; raises OSError like open()"""
+    path = locate_segment(stream_dir, segment_name)
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        cold_path = os.path.join(stream_dir, segment_name)
+        if path == cold_path:
+            raise
+        # Moved out of the hot tier since it was located
+        return open(cold_path, "rb")
+
+
+class RetentionManager:
+    """Removes or archives the stream directories the RETENTION_* policies no longer keep"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stats = {"reclaimed_bytes": 0, "removed_dirs": 0, "archived_dirs": 0}
+        self.usage = {"used_bytes": None, "stream_dirs": None, "last_pass": None}
+
+    @staticmethod
+    def enabled():
+        return any(limit is not None for limit in (RETENTION_MAX_AGE, RETENTION_MAX_BYTES, RETENTION_MAX_SESSIONS_PER_KEY))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_pass()
+            except Exception as e:
+                log(f"Error applying retention: {e}", level="error")
+            time.sleep(RETENTION_INTERVAL)
+
+    @staticmethod
+    def trash_dir():
+        # Each worker process empties its own
+        suffix = "" if current_worker is None else f".{current_worker.index}"
+        return os.path.join(BASE_SEGMENTS_DIR, RETENTION_TRASH_DIR + suffix)
+
+    @staticmethod
+    def scan():
+        """Stream directories under BASE_SEGMENTS_DIR, with their key, last change, size and finalization"""
+        entries = []
+        try:
+            names = os.listdir(BASE_SEGMENTS_DIR)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(BASE_SEGMENTS_DIR, name)
+            # Also skips RESUMABLE_UPLOADS_DIR and the trash
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            playlist_file = os.path.join(path, "playlist.m3u8")
+            try:
+                modified = os.path.getmtime(playlist_file if os.path.exists(playlist_file) else path)
+                size = directory_size(path)
+            except OSError:
+                continue
+            entries.append({
+                "name": name,
+                "path": path,
+                "stream_key": stream_dir_key(path),
+                "modified": modified,
+                "bytes": size,
+                "finalized": playlist_is_finalized(playlist_file),
+            })
+        return entries
+
+    @staticmethod
+    def select(entries, live_ids, now, reclaim_bytes=0):
+        """(entry, reason) of each directory to remove, oldest first, freeing at least reclaim_bytes"""
+        def removable(entry):
+            if entry["name"] in live_ids:
+                return False
+            if not entry["finalized"] and now - entry["modified"] <= RECOVERY_MAX_AGE:
+                # May still be recovered, or be live in another worker process
+                return False
+            owner = stream_worker(entry["stream_key"]) if entry["stream_key"] else 0
+            return current_worker is None or owner == current_worker.index
+
+        chosen = {}
+        candidates = sorted((entry for entry in entries if removable(entry)), key=lambda entry: entry["modified"])
+        if RETENTION_MAX_AGE is not None:
+            for entry in candidates:
+                if now - entry["modified"] > RETENTION_MAX_AGE:
+                    chosen[entry["name"]] = "older than RETENTION_MAX_AGE"
+        if RETENTION_MAX_SESSIONS_PER_KEY is not None:
+            sessions = {}
+            for entry in entries:
+                if entry["stream_key"] is not None:
+                    sessions.setdefault(entry["stream_key"], []).append(entry)
+            excess = {
+                entry["name"]
+                for key_entries in sessions.values()
+                for entry in sorted(key_entries, key=lambda entry: entry["modified"], reverse=True)[RETENTION_MAX_SESSIONS_PER_KEY:]
+            }
+            for entry in candidates:
+                if entry["name"] in excess:
+                    chosen.setdefault(entry["name"], "more than RETENTION_MAX_SESSIONS_PER_KEY sessions")
+        total = sum(entry["bytes"] for entry in entries if entry["name"] not in chosen)
+        quotas = [(RETENTION_MAX_BYTES, "over RETENTION_MAX_BYTES")] if RETENTION_MAX_BYTES is not None else []
+        if reclaim_bytes:
+            quotas.append((total - reclaim_bytes, "disk space low"))
+        for quota, reason in quotas:
+            for entry in candidates:
+                if total <= quota:
+                    break
+                if entry["name"] not in chosen:
+                    chosen[entry["name"]] = reason
+                    total -= entry["bytes"]
+        return [(entry, chosen[entry["name"]]) for entry in candidates if entry["name"] in chosen]
+
+    def run_pass(self, now=None, reclaim_bytes=0):
+        """Apply the policies once, also freeing at least reclaim_bytes if given; returns the bytes reclaimed"""
+        now = time.time() if now is None else now
+        # Directories a previous pass or run did not finish
+        reclaimed = self._empty_trash()
+        entries = self.scan()
+        with stream_creation_lock:
+            live_ids = {stream.stream_id for stream in streams.values()}
+        removed = set()
+        for entry, reason in self.select(entries, live_ids, now, reclaim_bytes):
+            if self._retire(entry):
+                log(f"Retention: removing stream directory {entry['name']} ({reason})")
+                removed.add(entry["name"])
+        reclaimed += self._empty_trash()
+        kept = [entry for entry in entries if entry["name"] not in removed]
+        with self.lock:
+            self.usage = {"used_bytes": sum(entry["bytes"] for entry in kept), "stream_dirs": len(kept), "last_pass": now}
+        return reclaimed
+
+    def _retire(self, entry):
+        """Rename a stream directory into the trash, unless its stream came back meanwhile"""
+        with stream_key_lock(entry["stream_key"]) if entry["stream_key"] else contextlib.nullcontext():
+            with stream_creation_lock:
+                if any(stream.stream_id == entry["name"] for stream in streams.values()):
+                    return False
+            trash_path = os.path.join(self.trash_dir(), entry["name"])
+            try:
+                os.makedirs(self.trash_dir(), exist_ok=True)
+                os.rename(entry["path"], trash_path)
+            except OSError as e:
+                log(f"Retention: could not remove {entry['path']}: {e}", level="error")
+                return False
+        if HOT_TIER_DIR is not None:
+            hot_tier.evict(entry["path"], trash_path)
+        return True
+
+    def _empty_trash(self):
+        try:
+            names = sorted(os.listdir(self.trash_dir()))
+        except FileNotFoundError:
+            return 0
+        reclaimed = 0
+        for name in names:
+            archive = RETENTION_ARCHIVE_DIR is not None and not disk_health.active("drop_archive")
+            destination = os.path.join(RETENTION_ARCHIVE_DIR, name) if archive else None
+            try:
+                reclaimed += self._remove_tree(os.path.join(self.trash_dir(), name), destination)
+            except OSError as e:
+                log(f"Retention: error removing {name}: {e}", level="error")
+                continue
+            with self.lock:
+                self.stats["removed_dirs" if destination is None else "archived_dirs"] += 1
+        return reclaimed
+
+    def _remove_tree(self, path, destination):
+        """Delete a directory tree, or move it to destination, file by file at the paced rate"""
+        reclaimed = 0
+        batch_files = batch_bytes = 0
+        batch_start = time.monotonic()
+        for directory, _, names in os.walk(path, topdown=False):
+            for name in names:
+                file_path = os.path.join(directory, name)
+                size = os.lstat(file_path).st_size
+                if destination is None:
+                    os.remove(file_path)
+                else:
+                    target_dir = os.path.join(destination, os.path.relpath(directory, path))
+                    os.makedirs(target_dir, exist_ok=True)
+                    shutil.move(file_path, os.path.join(target_dir, name))
+                reclaimed += size
+                batch_files += 1
+                batch_bytes += size
+                if batch_files >= RETENTION_BATCH_FILES:
+                    self._pace(batch_bytes, batch_start)
+                    batch_files = batch_bytes = 0
+                    batch_start = time.monotonic()
+                    with self.lock:
+                        self.stats["reclaimed_bytes"] += reclaimed
+                    reclaimed = 0
+            os.rmdir(directory)
+        self._pace(batch_bytes, batch_start)
+        with self.lock:
+            self.stats["reclaimed_bytes"] += reclaimed
+        return reclaimed
+
+    @staticmethod
+    def _pace(batch_bytes, batch_start):
+        if RETENTION_IO_BYTES_PER_SECOND is None:
+            return
+        delay = batch_bytes / RETENTION_IO_BYTES_PER_SECOND - (time.monotonic() - batch_start)
+        if delay > 0:
+            time.sleep(delay)
+
+    def status(self):
+        with self.lock:
+            return {
+                **self.usage,
+                "max_bytes": RETENTION_MAX_BYTES,
+                "max_age": RETENTION_MAX_AGE,
+                "max_sessions_per_key": RETENTION_MAX_SESSIONS_PER_KEY,
+                **self.stats,
+            }
+
+
+retention_manager = RetentionManager()
+
+
+def directory_size(path):
+    """Bytes of the files under a directory"""
+    total = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+
+def stream_dir_key(stream_dir):
+    """Stream key of a stream directory: from its journal, or from a server-generated directory name"""
+    stream_key = StateJournal(stream_dir).stream_key()
+    if is_valid_stream_key(stream_key):
+        return stream_key
+    match = re.fullmatch(r"(.+)_\d{8}_\d{6}_\d{6}", os.path.basename(stream_dir))
+    return match.group(1) if match else None
+
+
+class DiskHealth:
+    """Free space and write latency of the segments disk, and the DISK_HEALTH_ACTIONS of its current level"""
+
+    LEVELS = ("ok", "degraded", "critical")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.emergency_thread = None
+        # metric -> (monotonic time, seconds) of recent operations
+        self.samples = {metric: deque(maxlen=1000) for metric in ("segment_write", "playlist_append", "fsync")}
+        self.level = "ok"
+        self.reasons = []
+        self.free_bytes = None
+        self.actions = set()
+
+    def record(self, metric, seconds):
+        metrics.disk_seconds.observe(seconds, operation=metric)
+        with self.lock:
+            self.samples[metric].append((time.monotonic(), seconds))
+
+    def latency(self, metric):
+        """95th percentile of the metric over the last DISK_LATENCY_WINDOW seconds, or None"""
+        since = time.monotonic() - DISK_LATENCY_WINDOW
+        with self.lock:
+            recent = sorted(seconds for recorded, seconds in self.samples[metric] if recorded >= since)
+        return recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else None
+
+    def active(self, action):
+        with self.lock:
+            return action in self.actions
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                log(f"Error checking disk health: {e}", level="error")
+            time.sleep(DISK_HEALTH_INTERVAL)
+
+    def probe(self):
+        """Write and fsync a small file next to the streams; returns the error, or None"""
+        suffix = "" if current_worker is None else f".{current_worker.index}"
+        path = os.path.join(BASE_SEGMENTS_DIR, DISK_PROBE_FILE + suffix)
+        started = time.monotonic()
+        try:
+            with open(path, "wb") as f:
+                f.write(b"\0" * 4096)
+                f.flush()
+                fsync_started = time.monotonic()
+                os.fsync(f.fileno())
+        except OSError as e:
+            return e
+        finished = time.monotonic()
+        self.record("fsync", finished - fsync_started)
+        self.record("segment_write", finished - started)
+        return None
+
+    def assess(self, free_bytes, error):
+        """(level, reasons) for the given free space and probe error, and the recent latencies"""
+        level, reasons = "ok", []
+
+        def worsen(to, reason):
+            nonlocal level
+            if self.LEVELS.index(to) > self.LEVELS.index(level):
+                level = to
+            reasons.append(reason)
+
+        if error is not None:
+            worsen("critical", f"probe write failed: {error}")
+        if free_bytes is not None:
+            if DISK_FREE_CRITICAL_BYTES is not None and free_bytes < DISK_FREE_CRITICAL_BYTES:
+                worsen("critical", f"{free_bytes} bytes free")
+            elif DISK_FREE_DEGRADED_BYTES is not None and free_bytes < DISK_FREE_DEGRADED_BYTES:
+                worsen("degraded", f"{free_bytes} bytes free")
+        for metric in self.samples:
+            latency = self.latency(metric)
+            if latency is None:
+                continue
+            if DISK_LATENCY_CRITICAL is not None and latency > DISK_LATENCY_CRITICAL:
+                worsen("critical", f"{metric} p95 {latency:.3f}s")
+            elif DISK_LATENCY_DEGRADED is not None and latency > DISK_LATENCY_DEGRADED:
+                worsen("degraded", f"{metric} p95 {latency:.3f}s")
+        return level, reasons
+
+    def check(self):
+        os.makedirs(BASE_SEGMENTS_DIR, exist_ok=True)
+        error = self.probe()
+        try:
+            free_bytes = shutil.disk_usage(BASE_SEGMENTS_DIR).free
+        except OSError:
+            free_bytes = None
+        level, reasons = self.assess(free_bytes, error)
+        self.apply(level, reasons, free_bytes)
+
+    def apply(self, level, reasons, free_bytes):
+        """Switch to the actions of a level, logging the change to every stream, and keep reclaiming space"""
+        actions = set(DISK_HEALTH_ACTIONS.get(level, []))
+        with self.lock:
+            changed = level != self.level
+            started = sorted(actions - self.actions)
+            stopped = sorted(self.actions - actions)
+            self.level, self.reasons, self.free_bytes, self.actions = level, reasons, free_bytes, actions
+        if changed:
+            message = f"Disk {level}" + (f" ({'; '.join(reasons)})" if reasons else "")
+            if started:
+                message += f"; started {', '.join(started)}"
+            if stopped:
+                message += f"; stopped {', '.join(stopped)}"
+            log(message, level="info" if level == "ok" else "warning")
+            with stream_creation_lock:
+                stream_list = list(streams.values())
+            for stream in stream_list:
+                stream.add_event(message)
+        if "emergency_retention" in actions and free_bytes is not None and DISK_FREE_DEGRADED_BYTES is not None and free_bytes < DISK_FREE_DEGRADED_BYTES:
+            self._reclaim(DISK_FREE_DEGRADED_BYTES - free_bytes)
+
+    def _reclaim(self, needed):
+        if not retention_manager.enabled():
+            # Recordings are only ever deleted under a retention policy the operator set
+            return
+        with self.lock:
+            if self.emergency_thread is not None and self.emergency_thread.is_alive():
+                return
+            log(f"Emergency retention: reclaiming {needed} bytes")
+            self.emergency_thread = threading.Thread(target=retention_manager.run_pass, kwargs={"reclaim_bytes": needed}, daemon=True)
+            self.emergency_thread.start()
+
+    def status(self):
+        latencies = {metric: self.latency(metric) for metric in self.samples}
+        with self.lock:
+            return {
+                "level": self.level,
+                "reasons": list(self.reasons),
+                "free_bytes": self.free_bytes,
+                "latency_p95": latencies,
+                "actions": sorted(self.actions),
+            }
+
+
+disk_health = DiskHealth()
+
+
+class AdmissionError(Exception):
+    """A request refused by the ResourceGovernor; answered with 503 and Retry-After"""
+
+    def __init__(self, resource, message):
+        super().__init__(message)
+        self.resource = resource
+
+
+class RelayLimitReached(RuntimeError):
+    """Raised instead of starting FFmpeg while MAX_FFMPEG_RELAYS are running"""
+
+
+class ResourceGovernor:
+    """Global limits on active streams, FFmpeg relays, reorder-buffer bytes and upload bytes in flight"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight_upload_bytes = 0
+        self.ffmpeg_processes = []
+        # New streams admitted but not yet in the stream table (still being restored or created)
+        self.pending_streams = 0
+        self.rejections = {"streams": 0, "ffmpeg_relays": 0, "pending_bytes": 0, "upload_bytes": 0, "disk": 0}
+
+    def _refuse(self, resource, message):
+        with self.lock:
+            self.rejections[resource] += 1
+        log(f"Admission control: {message}", level="warning")
+        raise AdmissionError(resource, message)
+
+    def begin_upload(self, size):
+        with self.lock:
+            # A single upload larger than the limit is still let through when nothing else is in flight
+            if MAX_INFLIGHT_UPLOAD_BYTES is None or not self.inflight_upload_bytes or self.inflight_upload_bytes + size <= MAX_INFLIGHT_UPLOAD_BYTES:
+                self.inflight_upload_bytes += size
+                return
+        self._refuse("upload_bytes", f"{self.inflight_upload_bytes} upload bytes in flight, limit {MAX_INFLIGHT_UPLOAD_BYTES}")
+
+    def end_upload(self, size):
+        with self.lock:
+            self.inflight_upload_bytes -= size
+
+    def admit_stream(self, active_streams):
+        """Called with stream_creation_lock held before a stream is added; reserves a slot for it
+        until release_stream, so streams admitted concurrently count against the limit too"""
+        if disk_health.active("refuse_streams"):
+            self._refuse("disk", f"segments disk {disk_health.level}, not accepting new streams")
+        with self.lock:
+            active_streams += self.pending_streams
+        if MAX_ACTIVE_STREAMS is not None and active_streams >= MAX_ACTIVE_STREAMS:
+            self._refuse("streams", f"{active_streams} active streams, limit {MAX_ACTIVE_STREAMS}")
+        with self.lock:
+            self.pending_streams += 1
+
+    def release_stream(self):
+        """Give back the slot of admit_stream once the stream is in the stream table, or failed to open"""
+        with self.lock:
+            self.pending_streams -= 1
+
+    def admit_pending_bytes(self, size):
+        """Refuse a segment that would grow the reorder buffers of all streams beyond the limit"""
+        if MAX_PENDING_REORDER_BYTES is None:
+            return
+        pending = pending_reorder_bytes()
+        if pending + size > MAX_PENDING_REORDER_BYTES:
+            self._refuse("pending_bytes", f"{pending} bytes waiting in reorder buffers, limit {MAX_PENDING_REORDER_BYTES}")
+
+    def running_ffmpeg_relays(self):
+        with self.lock:
+            self.ffmpeg_processes = [process for process in self.ffmpeg_processes if process.poll() is None]
+            return len(self.ffmpeg_processes)
+
+    def admit_ffmpeg_relay(self):
+        running = self.running_ffmpeg_relays()
+        if MAX_FFMPEG_RELAYS is not None and running >= MAX_FFMPEG_RELAYS:
+            with self.lock:
+                self.rejections["ffmpeg_relays"] += 1
+            raise RelayLimitReached(f"{running} FFmpeg relays running, limit {MAX_FFMPEG_RELAYS}")
+
+    def register_ffmpeg(self, process):
+        with self.lock:
+            self.ffmpeg_processes.append(process)
+
+    def usage(self):
+        with stream_creation_lock:
+            stream_list = list(streams.values())
+        running = self.running_ffmpeg_relays()
+        with self.lock:
+            inflight = self.inflight_upload_bytes
+            rejections = dict(self.rejections)
+        return {
+            "active_streams": {"used": sum(1 for stream in stream_list if not stream.finalized), "limit": MAX_ACTIVE_STREAMS},
+            "ffmpeg_relays": {"used": running, "limit": MAX_FFMPEG_RELAYS},
+            "pending_reorder_bytes": {"used": sum(stream.pending_bytes() for stream in stream_list), "limit": MAX_PENDING_REORDER_BYTES},
+            "inflight_upload_bytes": {"used": inflight, "limit": MAX_INFLIGHT_UPLOAD_BYTES},
+            "rejections": rejections,
+            "retry_after": ADMISSION_RETRY_AFTER,
+        }
+
+
+resource_governor = ResourceGovernor()
+
+
+def pending_reorder_bytes():
+    with stream_creation_lock:
+        stream_list = list(streams.values())
+    return sum(stream.pending_bytes() for stream in stream_list)
+
+
+def find_active_stream(stream_id):
+    with stream_creation_lock:
+        for stream in streams.values():
+            if stream.stream_id == stream_id:
+                return stream
+    return None
+
+
+def generate_server_stream_id():
+    return datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+
+
+class HttpConnectionPool:
+    """Keep-alive HTTP(S) connections reused across requests, keyed by scheme and host"""
+
+    def __init__(self, max_idle_per_host=4):
+        self.lock = threading.Lock()
+        self.idle = {}  # (scheme, netloc) -> [connection]
+        self.max_idle_per_host = max_idle_per_host
+
+    def _acquire(self, scheme, netloc, timeout):
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                connection = connections.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connection_class(netloc, timeout=timeout), False
+
+    def _release(self, scheme, netloc, connection):
+        with self.lock:
+            connections = self.idle.setdefault((scheme, netloc), [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=30):
+        """Send one request and return (status, response body); raises OSError or HTTPException"""
+        status, _, data = self.exchange(method, url, body, headers, timeout)
+        return status, data
+
+    def exchange(self, method, url, body=None, headers=None, timeout=30):
+        """Like request(), also returning the response headers as a list of (name, value)"""
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        connection, reused = self._acquire(parsed.scheme, parsed.netloc, timeout)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if reused:
+                # The server closed the idle connection, so the request did not reach it in full
+                return self.exchange(method, url, body, headers, timeout)
+            raise
+        try:
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            # A connection closed without a response line is an idle connection the server had
+            # closed. After any other failure, e.g. a read timeout, the server may have applied the
+            # request, so only requests without side effects are sent again
+            if reused and (isinstance(e, http.client.RemoteDisconnected) or method in ("GET", "HEAD")):
+                return self.exchange(method, url, body, headers, timeout)
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(parsed.scheme, parsed.netloc, connection)
+        return response.status, response.getheaders(), data
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+upload_pool = HttpConnectionPool()
+# Loopback connections to the other worker processes
+worker_pool = HttpConnectionPool(max_idle_per_host=16)
+
+
+class _UploadStopped(Exception):
+    pass
+
+
+class NativeHlsUploader:
+    """Uploads a stream's fMP4 segments and generated playlists to YouTube's HLS ingest without ffmpeg.
+
+    Provides the parts of the subprocess.Popen interface that Relay uses (poll, wait, terminate, kill,
+    returncode, pid), so it takes the place of an ffmpeg process. Exits with 0 after uploading the
+    final playlist of a finalized stream, 1 when an upload keeps failing and -15 when terminated.
+    """
+
+    pid = None
+    stdout = None
+    segment_content_type = "video/mp4"
+    playlist_version = 7
+    uses_init_segments = True
+
+    def __init__(self, relay, start_index=None, previous=None):
+        self.relay = relay
+        self.stream = relay.stream
+        # Rendition whose playlist is uploaded; its files get a rendition prefix on the remote side
+        self.source = relay.source
+        self.file_prefix = "" if self.source.rendition is None else f"{self.source.rendition}_"
+        entries = self.source.playlist_entries
+        if start_index is None:
+            # Same default as ffmpeg's live_start_index: three segments back from the live edge
+            start_index = max(0, len(entries) - 3)
+        self.next_index = start_index
+        self.window = deque()  # (media sequence, entry) listed in the uploaded media playlist
+        if previous is not None:
+            # Continue the remote playlist of the upload this one replaces (e.g. after a rendition switch)
+            self.sequence_offset = previous.next_media_sequence() - start_index
+            self.window = deque(previous.window)
+            self.discontinuity_sequence = previous.discontinuity_sequence
+            self.uploaded_maps = set(previous.uploaded_maps)
+            self.master_uploaded = previous.master_uploaded
+        else:
+            self.sequence_offset = 0
+            # Discontinuities up to and including the first listed segment have scrolled out of the window
+            self.discontinuity_sequence = entries[min(start_index, len(entries) - 1)]["discontinuity_sequence"] if len(entries) else 0
+            self.uploaded_maps = set()
+            self.master_uploaded = False
+        # A continued remote playlist gets a discontinuity where the source rendition changes or
+        # segments are skipped (a catch-up jump to the live edge)
+        self.force_discontinuity = bool(self.window) and (previous.source is not self.source or start_index != previous.next_index)
+        self.returncode = None
+        self.error = None
+        self.bytes_uploaded = 0
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _is_discontinuity(previous, entry):
+        return entry["discontinuity"] or entry["map"] != previous["map"]
+
+    def start(self):
+        self.thread.start()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise subprocess.TimeoutExpired("native HLS upload", timeout)
+        return self.returncode
+
+    def terminate(self):
+        self.stop_event.set()
+        self.wakeup.set()
+
+    kill = terminate
+
+    def notify(self):
+        """Wake the upload thread after a segment was added to the playlist"""
+        self.wakeup.set()
+
+    def next_media_sequence(self):
+        if self.window:
+            return self.window[-1][0] + 1
+        return self.next_index + self.sequence_offset
+
+    def _run(self):
+        try:
+            while True:
+                self.wakeup.clear()
+                if self.stop_event.is_set():
+                    raise _UploadStopped()
+                entries = self.source.playlist_entries
+                if self.next_index < len(entries):
+                    self._upload_entry(self.next_index, entries[self.next_index])
+                    self.next_index += 1
+                elif self.stream.finalized:
+                    if self.window:
+                        self._upload_media_playlist(final=True)
+                    self.returncode = 0
+                    return
+                else:
+                    self.wakeup.wait(1.0)
+        except _UploadStopped:
+            self.returncode = -15
+        except Exception as e:
+            self.error = str(e)
+            log(str(e), level="error", stream=self.stream.stream_id, source="native", target=self.relay.target)
+            self.returncode = 1
+
+    def _url(self, file_name):
+        return YOUTUBE_UPLOAD_URL.format(
+            stream_key=urllib.parse.quote(self.relay.target_key, safe=""),
+            file=urllib.parse.quote(file_name, safe=""),
+        )
+
+    def _upload(self, file_name, body, content_type):
+        delay = NATIVE_UPLOAD_BACKOFF
+        for attempt in range(1, NATIVE_UPLOAD_RETRIES + 1):
+            try:
+                status, _ = upload_pool.request(
+                    "POST", self._url(file_name), body,
+                    {"Content-Type": content_type}, timeout=NATIVE_UPLOAD_TIMEOUT,
+                )
+                if 200 <= status < 300:
+                    self.bytes_uploaded += len(body)
+                    return
+                error = f"HTTP {status}"
+            except (http.client.HTTPException, OSError) as e:
+                error = str(e) or type(e).__name__
+            if attempt == NATIVE_UPLOAD_RETRIES:
+                raise RuntimeError(f"upload of {file_name} failed after {attempt} attempts: {error}")
+            log(f"Upload of {file_name} failed ({error}); retrying in {delay:.1f}s", level="warning", stream=self.stream.stream_id, source="native", target=self.relay.target)
+            if self.stop_event.wait(delay):
+                raise _UploadStopped()
+            delay = min(delay * 2, NATIVE_UPLOAD_BACKOFF_MAX)
+
+    def _read(self, name):
+        with open_segment(self.source.stream_dir, name) as f:
+            return f.read()
+
+    def _segment_file(self, entry):
+        """Return (file name, bytes) to upload for a playlist entry, uploading its init segment first if new"""
+        map_name = self.file_prefix + entry["map"] if entry["map"] else None
+        if map_name and map_name not in self.uploaded_maps:
+            self._upload(map_name, self._read(entry["map"]), "video/mp4")
+            self.uploaded_maps.add(map_name)
+        return self.file_prefix + entry["name"], self._read(entry["name"])
+
+    def _upload_entry(self, index, entry):
+        file_name, data = self._segment_file(entry)
+        self._upload(file_name, data, self.segment_content_type)
+        remote_entry = dict(entry, file=file_name, size=len(data), map=self.file_prefix + entry["map"] if entry["map"] else None)
+        if self.force_discontinuity:
+            remote_entry["discontinuity"] = True
+            self.force_discontinuity = False
+        self.window.append((index + self.sequence_offset, remote_entry))
+        while len(self.window) > NATIVE_PLAYLIST_WINDOW:
+            _, dropped = self.window.popleft()
+            if self._is_discontinuity(dropped, self.window[0][1]):
+                self.discontinuity_sequence += 1
+        self.relay.note_fetch(entry["name"])
+        self._upload_media_playlist()
+        if not self.master_uploaded:
+            self._upload(NATIVE_MASTER_PLAYLIST, self.master_playlist().encode(), "application/vnd.apple.mpegurl")
+            self.master_uploaded = True
+
+    def _upload_media_playlist(self, final=False):
+        self._upload(NATIVE_MEDIA_PLAYLIST, self.media_playlist(final).encode(), "application/vnd.apple.mpegurl")
+
+    def media_playlist(self, final=False):
+        entries = [entry for _, entry in self.window]
+        target_duration = max(1, math.ceil(max(entry["duration"] for entry in entries)))
+        lines = [
+            "#EXTM3U",
+            f"#EXT-X-VERSION:{self.playlist_version}",
+            f"#EXT-X-TARGETDURATION:{target_duration}",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.window[0][0]}",
+            f"#EXT-X-DISCONTINUITY-SEQUENCE:{self.discontinuity_sequence}",
+        ]
+        previous = None
+        for entry in entries:
+            if previous is not None and self._is_discontinuity(previous, entry):
+                lines.append("#EXT-X-DISCONTINUITY")
+            if self.uses_init_segments and entry["map"] and (previous is None or entry["map"] != previous["map"]):
+                lines.append(f'#EXT-X-MAP:URI="{entry["map"]}"')
+            lines.append(f"#EXTINF:{entry['duration']:.6f},")
+            lines.append(entry["file"])
+            previous = entry
+        if final:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def master_playlist(self):
+        # Peak bitrate of the segments uploaded so far, with some margin for later variation
+        peak = max((entry["size"] * 8 / entry["duration"] for _, entry in self.window if entry["duration"] > 0), default=0)
+        attributes = [f"BANDWIDTH={max(1, int(peak * 1.2))}"]
+        info = self.source.probe_video()
+        if info and info.get("width") and info.get("height"):
+            attributes.append(f"RESOLUTION={info['width']}x{info['height']}")
+        return (
+            "#EXTM3U\n"
+            f"#EXT-X-VERSION:{self.playlist_version}\n"
+            "#EXT-X-INDEPENDENT-SEGMENTS\n"
+            f"#EXT-X-STREAM-INF:{','.join(attributes)}\n"
+            f"{NATIVE_MEDIA_PLAYLIST}\n"
+        )
+
+    def status(self):
+        return {
+            "next_index": self.next_index,
+            "media_sequence": self.next_media_sequence(),
+            "bytes_uploaded": self.bytes_uploaded,
+            "error": self.error,
+        }
+
+    def handover_state(self):
+        """Remote playlist state of a stopped upload, continued through HandedOverUpload"""
+        return {
+            "next_index": self.next_index,
+            "media_sequence": self.next_media_sequence(),
+            "window": list(self.window),
+            "discontinuity_sequence": self.discontinuity_sequence,
+            "uploaded_maps": sorted(self.uploaded_maps),
+            "master_uploaded": self.master_uploaded,
+        }
+
+
+class RemuxHlsUploader(NativeHlsUploader):
+    """Native upload of MPEG-TS segments remuxed in-process from the client's fMP4 segments"""
+
+    segment_content_type = "video/mp2t"
+    playlist_version = 3
+    uses_init_segments = False
+
+    def __init__(self, relay, start_index=None, previous=None):
+        super().__init__(relay, start_index, previous)
+        self.remuxer = None
+        self.remuxer_map = None
+
+    def _segment_file(self, entry):
+        if self.remuxer is None or entry["map"] != self.remuxer_map:
+            if not entry["map"]:
+                raise ValueError(f"segment {entry['name']} has no init segment to remux with")
+            self.remuxer = TsRemuxer(self._read(entry["map"]))
+            self.remuxer_map = entry["map"]
+        file_name = self.file_prefix + os.path.splitext(entry["name"])[0] + ".ts"
+        return file_name, self.remuxer.remux_segment(self._read(entry["name"]))
+
+
+NATIVE_UPLOADERS = {"native": NativeHlsUploader, "remux": RemuxHlsUploader}
+
+
+class HandedOverUpload:
+    """Remote playlist of a native upload stopped by a handover, continued like a replaced upload"""
+
+    def __init__(self, source, state):
+        self.source = source
+        self.window = deque((sequence, entry) for sequence, entry in state["window"])
+        self.discontinuity_sequence = state["discontinuity_sequence"]
+        self.uploaded_maps = set(state["uploaded_maps"])
+        self.master_uploaded = state["master_uploaded"]
+        self.media_sequence = state["media_sequence"]
+        self.next_index = state["next_index"]
+
+    def next_media_sequence(self):
+        return self.media_sequence
+
+
+class AdoptedProcess:
+    """An ffmpeg relay started by the process this one was re-executed from (see hand_over).
+
+    It is still a child of this process, so it is polled and reaped with waitpid. Provides the parts
+    of the subprocess.Popen interface that Relay uses.
+    """
+
+    def __init__(self, pid, stdout_fd=None):
+        self.pid = pid
+        self.returncode = None
+        self.stdout = None if stdout_fd is None else open(stdout_fd, "r", buffering=1, errors="replace")
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                # Already reaped, so the exit status is unknown
+                self.returncode = -1
+                return self.returncode
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(f"ffmpeg (pid {self.pid})", timeout)
+            time.sleep(0.05)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class Relay:
+    """One upstream destination of a stream, with its own ffmpeg process (or native uploader), restart backoff and lag"""
+
+    def __init__(self, stream, target, target_key):
+        self.stream = stream
+        self.target = target
+        self.target_key = target_key
+        self.engine = RELAY_ENGINES.get(target, "ffmpeg")
+        self.process = None  # subprocess.Popen, or NativeHlsUploader for the native engine
+        self.last_exit = None
+        self.log_thread = None
+        self.drain_thread = None
+        self.restart_not_before = 0.0
+        self.restart_suppressed = False
+        self.restart_count = 0
+        # Position (playlist index, media time at segment end) of the last segment this relay fetched
+        self.position = None
+        self.realtime = True
+        self.catchup_active = False
+        self.catchup_not_before = 0.0
+        # Twitch only: whether the running process copies or transcodes video
+        self.video_mode = None
+        self.video_reason = None
+        self.encoder = EncoderController() if target == "twitch" else None
+        # Rendition (StreamState) this relay reads; the stream itself unless switched to another rendition
+        self.source = stream
+        # Native engines: upload replaced by a rendition switch, whose remote playlist the next one continues
+        self.continue_upload = None
+        # (reason, playlist index, source) of a restart to apply once that segment is in the source's playlist
+        self.restart_request = None
+        # Last /proc sample of the running process: (monotonic time, cpu seconds)
+        self.usage_sample = None
+        self.cpu_percent = None
+        self.rss_bytes = None
+
+    @property
+    def engine_label(self):
+        return "ffmpeg" if self.engine == "ffmpeg" else f"{self.engine} upload"
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def notify_segment(self):
+        """Called under the playlist lock when a media segment was added to the playlist"""
+        notify = getattr(self.process, "notify", None)
+        if notify is not None:
+            notify()
+
+    def build_command(self, live_start_index=None, realtime=True):
+        input_args = [
+            "ffmpeg",
+            "-reconnect", "1",
+            "-reconnect_at_eof", "1",
+            "-reconnect_streamed", "1",
+            "-reconnect_on_network_error", "1",
+            "-reconnect_on_http_error", "4xx,5xx",
+            "-reconnect_delay_max", f"{MISSING_SEGMENT_TIMEOUT}",
+            "-max_reload", f"{MISSING_SEGMENT_TIMEOUT}",
+            "-m3u8_hold_counters", f"{MISSING_SEGMENT_TIMEOUT}",
+            "-seg_max_retry", f"{MISSING_SEGMENT_TIMEOUT}",
+            # Lets the segment endpoint attribute fetches to this relay
+            "-user_agent", f"{RELAY_USER_AGENT_PREFIX}{self.target}",
+        ] + ([] if live_start_index is None else [
+            "-live_start_index", str(live_start_index)
+        ]) + [
+            "-copyts",
+            "-fflags", "+igndts",
+        ] + (["-re"] if realtime else []) + [
+            "-i", f"http://127.0.0.1:{relay_input_port()}/segments/{self.source.relative_dir()}playlist.m3u8",
+        ]
+
+        if self.target == "youtube":
+            return input_args + [
+                "-c", "copy",
+                "-fps_mode", "passthrough",
+                "-master_pl_name", "master.m3u8",
+                "-http_persistent", "1",
+                "-f", "hls",
+                "-hls_playlist_type", "event",
+                "-hls_allow_cache", "1",
+                "-method", "POST",
+                f"https://a.upload.youtube.com/http_upload_hls?cid={self.target_key}&copy=0&file=master.m3u8"
+            ]
+        if self.target == "twitch":
+            video_args = ["-c:v", "copy"] if self.video_mode == "copy" else self.encoder.video_args()
+            return input_args + video_args + [
+                "-c:a", "copy",
+                "-fps_mode", "passthrough",
+                "-f", "flv",
+                "-rtmp_buffer", "10000",
+                f"rtmp://ingest.global-contribute.live-video.net/app/{self.target_key}"
+            ]
+        raise ValueError(f"Unsupported target: {self.target}")
+
+    def video_decision(self):
+        """Return ("copy" | "transcode", reason) for the stream's current init segment"""
+        if TWITCH_VIDEO_MODE in ("copy", "transcode"):
+            return TWITCH_VIDEO_MODE, "forced by TWITCH_VIDEO_MODE"
+        copy_ok, reason = twitch_copy_decision(self.source.probe_video())
+        return ("copy" if copy_ok else "transcode"), reason
+
+    def start(self, live_start_index=None, realtime=True):
+        self.engine = RELAY_ENGINES.get(self.target, "ffmpeg")
+        if self.engine in NATIVE_UPLOADERS:
+            self._start_native(live_start_index)
+            return
+        if self.engine != "ffmpeg":
+            raise ValueError(f"Unsupported relay engine for {self.target}: {self.engine}")
+        resource_governor.admit_ffmpeg_relay()
+        if self.target == "twitch":
+            video_mode, reason = self.video_decision()
+            if (video_mode, reason) != (self.video_mode, self.video_reason):
+                log(f"Twitch video for stream {self.stream.stream_id}: {video_mode} ({reason})")
+                self.stream.add_event(f"Twitch video: {video_mode} ({reason})")
+            self.video_mode, self.video_reason = video_mode, reason
+        ffmpeg_command = self.build_command(live_start_index, realtime)
+
+        start_desc = "edge" if live_start_index is None else str(live_start_index)
+        pace_desc = "" if realtime else " without -re"
+        log(f"Starting ffmpeg relay for stream {self.target_key} to target {self.target} with live_start_index {start_desc}{pace_desc}")
+        ffmpeg_command = ffmpeg_placement_prefix() + ffmpeg_command
+        try:
+            self.process = subprocess.Popen(
+                ffmpeg_command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+            )
+        except OSError as e:
+            self.process = None
+            self.stream.add_event(f"ffmpeg failed to start for {self.target}: {e}")
+            raise RuntimeError(f"ffmpeg failed to start: {e}") from e
+        resource_governor.register_ffmpeg(self.process)
+        assign_ffmpeg_cgroup(self.process.pid)
+        self.usage_sample = (time.monotonic(), 0.0)
+        self.cpu_percent = None
+        self.rss_bytes = None
+        self._start_logger()
+        self.restart_not_before = 0.0
+        self.restart_suppressed = False
+        self.position = None
+        self.realtime = realtime
+        self.catchup_active = not realtime
+        self.restart_request = None
+        if self.encoder is not None:
+            self.encoder.reset()
+        self.stream.journal.append("relay_start", target=self.target, stream_key_target=self.target_key == self.stream.stream_key, engine=self.engine, start_index=live_start_index)
+        self.stream.add_event(f"ffmpeg started for {self.target} (start_index={start_desc}{pace_desc})")
+
+    def _start_native(self, live_start_index):
+        if self.target not in NATIVE_ENGINE_TARGETS:
+            raise ValueError(f"Relay engine {self.engine} does not support target {self.target}")
+        start_desc = "edge" if live_start_index is None else str(live_start_index)
+        log(f"Starting {self.engine} HLS upload for stream {self.target_key} to target {self.target} with start index {start_desc}")
+        previous, self.continue_upload = self.continue_upload, None
+        self.process = NATIVE_UPLOADERS[self.engine](self, live_start_index, previous)
+        self.usage_sample = None
+        self.cpu_percent = None
+        self.rss_bytes = None
+        self.restart_not_before = 0.0
+        self.restart_suppressed = False
+        self.position = None
+        # Uploads run as fast as the network allows, so there is no pacing to catch up from
+        self.realtime = False
+        self.catchup_active = False
+        self.restart_request = None
+        # Start uploading only after the reset above, so the first uploaded segment's position is kept
+        self.process.start()
+        self.stream.journal.append("relay_start", target=self.target, stream_key_target=self.target_key == self.stream.stream_key, engine=self.engine, start_index=live_start_index)
+        self.stream.add_event(f"{self.engine_label} started for {self.target} (start_index={start_desc})")
+
+    def note_fetch(self, segment_name):
+        position = self.source.segment_positions.get(segment_name)
+        if position is not None:
+            self.position = position
+
+    def lag(self):
+        """Seconds of media in the playlist that this relay has not fetched yet"""
+        if self.position is None or not self.is_running():
+            return None
+        return max(0.0, self.source.written_media_duration - self.position[1])
+
+    def check_catchup(self):
+        lag = self.lag()
+        catchup_mode = self.stream.catchup_mode
+        if lag is None or catchup_mode == "off":
+            return
+        if self.engine in NATIVE_UPLOADERS and catchup_mode == "restart":
+            # Native uploads are not paced, so relaunching without -re would not make them faster
+            return
+
+        if self.catchup_active:
+            if lag <= CATCHUP_LAG_TARGET:
+                self.catchup_active = False
+                self.stream.add_event(f"Relay to {self.target} caught up with live edge (lag {lag:.1f}s)")
+            return
+
+        now = time.time()
+        if lag < CATCHUP_LAG_THRESHOLD or now < self.catchup_not_before:
+            return
+        self.catchup_not_before = now + CATCHUP_COOLDOWN
+
+        stream = self.stream
+        if catchup_mode == "jump":
+            start_index = max(0, self.source.written_segment_count - 1)
+            log(f"Relay to {self.target} for stream {stream.stream_id} is {lag:.1f}s behind; jumping to live edge at index {start_index}", stream=stream.stream_id)
+            stream.add_event(f"Relay to {self.target} lag {lag:.1f}s; jumping to live edge (skipping {lag:.1f}s)")
+            if isinstance(self.process, NativeHlsUploader):
+                # Continue the remote playlist, with a discontinuity where the backlog is skipped
+                self.continue_upload = self.process
+            self.stop()
+            stream.start_ffmpeg_relay(self.target, self.target_key, live_start_index=start_index)
+        else:
+            # Resume from the segment the relay was reading so nothing is skipped
+            start_index = self.position[0]
+            log(f"Relay to {self.target} for stream {stream.stream_id} is {lag:.1f}s behind; restarting without -re at index {start_index}", stream=stream.stream_id)
+            stream.add_event(f"Relay to {self.target} lag {lag:.1f}s; catching up without -re from index {start_index}")
+            self.stop()
+            stream.start_ffmpeg_relay(self.target, self.target_key, live_start_index=start_index, realtime=False)
+
+    def _start_logger(self):
+        if not self.process or self.process.stdout is None:
+            return
+        proc = self.process
+        stream_id = self.stream.stream_id
+        target = self.target
+
+        encoder = self.encoder if self.video_mode == "transcode" else None
+
+        def _pump():
+            for line in proc.stdout:
+                log(line.rstrip(), stream=stream_id, source="ffmpeg", target=target)
+                if encoder is not None:
+                    match = FFMPEG_SPEED_RE.search(line)
+                    if match:
+                        try:
+                            encoder.record_speed(float(match.group(1)))
+                        except ValueError:
+                            pass
+            try:
+                proc.stdout.close()
+            except Exception:
+                pass
+
+        self.log_thread = threading.Thread(target=_pump, daemon=True)
+        self.log_thread.start()
+
+    def _stop_logger(self):
+        if self.log_thread:
+            self.log_thread.join(timeout=1)
+        self.log_thread = None
+
+    def stop(self):
+        if not self.process:
+            return
+
+        proc = self.process
+        stream_id = self.stream.stream_id
+        try:
+            proc.terminate()
+            proc.wait(timeout=5)
+            self.stream.add_event(f"{self.engine_label} for {self.target} exited with code {proc.returncode}")
+            self._set_exit(proc.returncode, None)
+        except subprocess.TimeoutExpired:
+            log(f"{self.engine_label} for {self.target} did not exit in time for {stream_id}; killing", level="warning")
+            proc.kill()
+            proc.wait()
+            self.stream.add_event(f"{self.engine_label} for {self.target} killed after timeout")
+            self._set_exit(None, "SIGKILL")
+        except Exception as e:
+            log(f"Failed to terminate {self.engine_label} for {self.target} on {stream_id}: {e}", level="warning")
+            self.stream.add_event(f"{self.engine_label} termination failed for {self.target}: {e}")
+            self._set_exit(None, str(e))
+        finally:
+            self.process = None
+            self._stop_logger()
+
+    def detach(self):
+        """Prepare this relay for a handover and return the state the new process takes it over with.
+
+        A running ffmpeg child is left running, with its output pipe kept open across the re-exec; a
+        native upload, stopped beforehand by stop_native_uploads(), is continued by the new process.
+        """
+        state = {
+            "target": self.target,
+            "target_key": self.target_key,
+            "engine": self.engine,
+            "source": self.source.rendition,
+            "last_exit": self.last_exit,
+            "restart_count": self.restart_count,
+            "realtime": self.realtime,
+            "catchup_active": self.catchup_active,
+            "video_mode": self.video_mode,
+            "video_reason": self.video_reason,
+            "encoder": None if self.encoder is None else [self.encoder.preset_index, self.encoder.bitrate_kbps],
+        }
+        if isinstance(self.process, NativeHlsUploader):
+            # An upload still running after stop_native_uploads() has its current file uploaded again
+            self.process.terminate()
+            state["upload"] = self.process.handover_state()
+        elif self.is_running():
+            state["pid"] = self.process.pid
+            if self.process.stdout is not None:
+                state["stdout_fd"] = self.process.stdout.fileno()
+                os.set_inheritable(state["stdout_fd"], True)
+        return state
+
+    @classmethod
+    def adopt(cls, stream, state):
+        """Take over a relay detached by the process this one was re-executed from"""
+        relay = cls(stream, state["target"], state["target_key"])
+        relay.engine = state["engine"]
+        if state["source"] is not None:
+            relay.source = stream.get_rendition(state["source"])
+        relay.last_exit = state["last_exit"]
+        relay.restart_count = state["restart_count"]
+        relay.realtime = state["realtime"]
+        relay.catchup_active = state["catchup_active"]
+        relay.video_mode = state["video_mode"]
+        relay.video_reason = state["video_reason"]
+        if relay.encoder is not None and state["encoder"] is not None:
+            relay.encoder.preset_index, relay.encoder.bitrate_kbps = state["encoder"]
+            relay.encoder.reset()
+        stream.relays[relay.target] = relay
+        if "pid" in state:
+            relay.process = AdoptedProcess(state["pid"], state.get("stdout_fd"))
+            resource_governor.register_ffmpeg(relay.process)
+            relay._start_logger()
+            stream.add_event(f"ffmpeg for {relay.target} (pid {relay.process.pid}) taken over")
+        elif "upload" in state and relay.engine in NATIVE_UPLOADERS:
+            relay.continue_upload = HandedOverUpload(relay.source, state["upload"])
+            relay._start_native(state["upload"]["next_index"])
+        return relay
+
+    def _set_exit(self, code, signal):
+        metrics.record_exit(self.target, code, signal)
+        self.last_exit = {"code": code, "signal": signal}
+        self.stream.last_ffmpeg_exit = {"target": self.target, **self.last_exit}
+        self.stream.journal.append("relay_exit", exit=self.stream.last_ffmpeg_exit)
+
+    def record_exit(self, exit_code):
+        self.stream.add_event(f"{self.engine_label} for {self.target} exited with code {exit_code}")
+        self._set_exit(exit_code, None)
+        self.process = None
+        self._stop_logger()
+
+    def begin_drain(self):
+        if not self.process:
+            return
+        if self.drain_thread and self.drain_thread.is_alive():
+            return
+
+        proc = self.process
+        if proc.poll() is not None:
+            self.record_exit(proc.returncode)
+            return
+
+        stream_id = self.stream.stream_id
+        timeout = FFMPEG_FINAL_DRAIN_TIMEOUT
+        self.stream.add_event(f"{self.engine_label} drain started for {self.target} (timeout={timeout}s)")
+        log(f"Allowing {self.engine_label} to drain naturally for stream {stream_id} to {self.target} for up to {timeout}s before forced shutdown")
+
+        def _drain():
+            try:
+                exit_code = proc.wait(timeout=timeout)
+                log(f"{self.engine_label} drained naturally for stream {stream_id} to {self.target} with exit code {exit_code}")
+                self.record_exit(exit_code)
+            except subprocess.TimeoutExpired:
+                log(f"{self.engine_label} drain timeout reached for stream {stream_id} to {self.target}; forcing shutdown")
+                self.stream.add_event(f"{self.engine_label} drain timeout for {self.target} after {timeout}s")
+                self.stop()
+
+        self.drain_thread = threading.Thread(target=_drain, daemon=True)
+        self.drain_thread.start()
+
+    def request_restart(self, reason, start_index, source=None):
+        """Restart this relay at start_index once that segment has been written to the source's playlist"""
+        self.restart_request = (reason, start_index, source or self.source)
+        self.stream.add_event(f"Relay to {self.target} will restart at index {start_index}: {reason}")
+
+    def switch_source(self, source, reason):
+        """Continue this relay from another rendition, starting with the segment after the last one it read"""
+        if not self.is_running():
+            self.source = source
+            return
+        if self.position is not None and self.position[0] < len(self.source.playlist_entries):
+            next_sequence = self.source.playlist_entries[self.position[0]]["sequence"] + 1
+        else:
+            next_sequence = self.source.last_playlist_sequence + 1
+        self.request_restart(reason, source.index_for_sequence(next_sequence), source)
+
+    def ensure_running(self, written_segment_count, just_restored):
+        """Start, resume or restart (with backoff) this relay; raises RuntimeError if ffmpeg cannot be spawned"""
+        stream = self.stream
+        if self.restart_request and self.is_running():
+            reason, start_index, source = self.restart_request
+            available = written_segment_count if source is stream else source.written_segment_count
+            if available <= start_index:
+                return
+            log(f"Restarting {self.engine_label} for stream {stream.stream_id} at index {start_index} (target={self.target}): {reason}")
+            if source is not self.source and isinstance(self.process, NativeHlsUploader):
+                self.continue_upload = self.process
+            metrics.relay_restarts.inc(target=self.target, cause="requested")
+            self.stop()
+            self.source = source
+            stream.start_ffmpeg_relay(self.target, self.target_key, live_start_index=start_index, realtime=self.realtime)
+            return
+        self.restart_request = None
+        if written_segment_count == SEGMENTS_BEFORE_RELAY and not self.is_running():
+            log(f"Starting ffmpeg for stream {stream.stream_id} with {SEGMENTS_BEFORE_RELAY} buffered segments (target={self.target})")
+            stream.start_ffmpeg_relay(self.target, self.target_key, live_start_index=0)
+        elif just_restored:
+            # Resume from the segment that triggered the restore (the current one)
+            # live_start_index is 0-based index of the segment in the playlist.
+            # written_segment_count includes the current segment.
+            # So index = count - 1.
+            start_index = max(0, written_segment_count - 1)
+            log(f"Resuming ffmpeg for stream {stream.stream_id} at index {start_index} (target={self.target})")
+            stream.start_ffmpeg_relay(self.target, self.target_key, live_start_index=start_index)
+        elif not self.is_running():
+            now = time.time()
+            if self.process and self.process.poll() is not None:
+                self.record_exit(self.process.returncode)
+                self.restart_not_before = now + FFMPEG_RESTART_COOLDOWN
+            if now < self.restart_not_before:
+                if not self.restart_suppressed:
+                    wait_seconds = max(0.0, self.restart_not_before - now)
+                    stream.add_event(f"ffmpeg restart suppressed for {wait_seconds:.1f}s after {self.target} failure")
+                    self.restart_suppressed = True
+            else:
+                log(f"Restarting ffmpeg for stream {stream.stream_id} at live edge (target={self.target})")
+                self.restart_count += 1
+                metrics.relay_restarts.inc(target=self.target, cause="exit")
+                stream.start_ffmpeg_relay(self.target, self.target_key, live_start_index=None)
+        else:
+            self.check_catchup()
+            if self.is_running() and not self.restart_request:
+                self.check_encoder()
+
+    def check_encoder(self):
+        """Let the encoder controller step settings, applied by a restart at the next segment boundary"""
+        if self.encoder is None or self.video_mode != "transcode":
+            return
+        change = self.encoder.decide(cpu_monitor.headroom())
+        if change is None:
+            return
+        # Continue with the first segment this relay has not fetched yet
+        start_index = self.source.written_segment_count if self.position is None else self.position[0] + 1
+        self.request_restart(change, start_index)
+
+    def sample_usage(self):
+        """Refresh CPU share (100 = one full CPU) and RSS of the running process from /proc"""
+        if not self.is_running() or not isinstance(self.process.pid, int):
+            self.cpu_percent = None
+            self.rss_bytes = None
+            return
+        usage = read_process_usage(self.process.pid)
+        if usage is None:
+            return
+        now = time.monotonic()
+        cpu_seconds, self.rss_bytes = usage
+        if self.usage_sample is not None and now > self.usage_sample[0]:
+            self.cpu_percent = 100.0 * (cpu_seconds - self.usage_sample[1]) / (now - self.usage_sample[0])
+        self.usage_sample = (now, cpu_seconds)
+
+    def status(self, now):
+        self.sample_usage()
+        return {
+            "target": self.target,
+            "running": self.is_running(),
+            "pid": self.process.pid if self.is_running() else None,
+            "last_exit": self.last_exit,
+            "restart_count": self.restart_count,
+            "restart_backoff": max(0.0, self.restart_not_before - now) if self.restart_not_before else 0.0,
+            "lag": self.lag(),
+            "realtime": self.realtime,
+            "catchup_active": self.catchup_active,
+            "cpu_percent": None if self.cpu_percent is None else round(self.cpu_percent, 1),
+            "rss_bytes": self.rss_bytes,
+            "engine": self.engine,
+            "rendition": self.source.rendition_label(),
+            "upload": self.process.status() if isinstance(self.process, NativeHlsUploader) else None,
+            "video_mode": self.video_mode,
+            "video_reason": self.video_reason,
+            "encoder": self.encoder.status() if self.encoder is not None and self.video_mode == "transcode" else None,
+        }
+
+
+def playlist_entry(previous, segment_name, duration, discontinuity, map_name):
+    """Playlist entry for a media segment listed after previous (None for the first segment).
+
+    discontinuity_sequence counts the discontinuity boundaries up to this entry, which is the
+    EXT-X-DISCONTINUITY-SEQUENCE of a playlist window starting here.
+    """
+    boundaries = 0
+    if previous is not None:
+        boundaries = previous["discontinuity_sequence"]
+        if discontinuity or map_name != previous["map"]:
+            boundaries += 1
+    return {
+        "name": segment_name,
+        "sequence": segment_sequence(segment_name),
+        "duration": duration,
+        "discontinuity": discontinuity,
+        "map": map_name,
+        "discontinuity_sequence": boundaries,
+    }
+
+
+def period_of(segment_name):
+    """Period index encoded in a segment name like p1_segment_000042.mp4"""
+    try:
+        return int(segment_name.split("_", 1)[0][1:])
+    except (ValueError, AttributeError):
+        return 0
+
+
+ENDLIST_TAG = b"#EXT-X-ENDLIST\n"
+
+
+def playlist_is_finalized(playlist_file):
+    """Whether a playlist ends with #EXT-X-ENDLIST"""
+    try:
+        with open(playlist_file, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - len(ENDLIST_TAG)))
+            return f.read() == ENDLIST_TAG
+    except OSError:
+        return False
+
+
+class PlaylistEntries:
+    """A stream's media segments in playlist order, of which only the newest may be held in memory.
+
+    A stream restored from a checkpoint starts with the checkpoint's entries; the entries before
+    them are read back from the journal the first time something asks for one.
+    """
+
+    def __init__(self, base=0, entries=(), load_older=None):
+        self.base = base  # playlist index of the first entry held in memory
+        self._entries = list(entries)
+        self._older = [] if base == 0 else None
+        self._load_older = load_older
+
+    def __len__(self):
+        return self.base + len(self._entries)
+
+    def _older_entries(self):
+        if self._older is None:
+            self._older = self._load_older(self.base)
+        return self._older
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("playlist entry index out of range")
+        if index < self.base:
+            return self._older_entries()[index]
+        return self._entries[index - self.base]
+
+    def __iter__(self):
+        if self.base:
+            yield from self._older_entries()
+        yield from self._entries
+
+    def append(self, entry):
+        self._entries.append(entry)
+
+    def load(self):
+        """Read the older entries now, e.g. before the journal they come from is removed"""
+        if self.base:
+            self._older_entries()
+
+
+class StateJournal:
+    """Append-only record of the playlist state changes of one stream (or rendition) directory.
+
+    Records are JSON lines written before the matching playlist change. A checkpoint holds the
+    state at a journal offset, so a restore replays at most STATE_CHECKPOINT_INTERVAL records.
+
+    Each record is flushed to the OS, so it survives a crash of this process. The journal is only
+    fsynced when a checkpoint is written (and when it is closed), so a power loss can lose the
+    records since the last checkpoint; the playlist file is not fsynced either.
+    """
+
+    def __init__(self, stream_dir):
+        self.path = os.path.join(stream_dir, STATE_JOURNAL_FILE)
+        self.checkpoint_path = os.path.join(stream_dir, STATE_CHECKPOINT_FILE)
+        self.lock = threading.Lock()
+        self.records_since_checkpoint = 0
+        self.failed = False
+        self._file = None
+        # Called before a failed journal's files are removed, to read what is still needed from them
+        self.before_abandon = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def stream_key(self):
+        """Stream key written as the first record of a main stream's journal, or None"""
+        try:
+            with open(self.path, "rb") as f:
+                record = json.loads(f.readline())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(record, dict) or record.get("op") != "stream":
+            return None
+        return record.get("stream_key")
+
+    def append(self, op, **fields):
+        line = json.dumps({"op": op, **fields}, separators=(",", ":")).encode() + b"\n"
+        with self.lock:
+            if self.failed:
+                return
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "ab")
+                self._file.write(line)
+                self._file.flush()
+            except OSError as e:
+                self._abandon(e)
+                return
+            self.records_since_checkpoint += 1
+
+    def _abandon(self, error):
+        # A journal with a missing record would restore the wrong state; without one, the next
+        # restore parses the playlist instead
+        log(f"Error writing state journal {self.path}, no longer journaling: {error}", level="error")
+        self.failed = True
+        if self.before_abandon is not None:
+            try:
+                self.before_abandon()
+            except (OSError, ValueError) as e:
+                log(f"Error reading state journal {self.path} before removing it: {e}", level="error")
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+        for path in (self.path, self.checkpoint_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
+    def size(self):
+        with self.lock:
+            if self._file is not None:
+                return self._file.tell()
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
 
-def is_valid_stream_key(stream_key):
-    if not stream_key:
-        return False
-    return re.fullmatch(r"[A-Za-z0-9_-]+", stream_key) is not None
+    def write_checkpoint(self, offset, state):
+        """Save state as of journal offset; records appended after offset are replayed on top of it"""
+        if self.failed:
+            return
+        self.sync()
+        data = {"offset": offset, "state": state}
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+        self.records_since_checkpoint = 0
 
+    def sync(self):
+        """Make the records appended so far durable"""
+        with self.lock:
+            if self._file is not None:
+                self._file.flush()
+                started = time.monotonic()
+                os.fsync(self._file.fileno())
+                disk_health.record("fsync", time.monotonic() - started)
 
-def is_valid_stream_id(stream_id):
-    if not stream_id:
-        return False
-    return re.fullmatch(r"[A-Za-z0-9_-]+", stream_id) is not None
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log(f"Ignoring unreadable checkpoint {self.checkpoint_path}: {e}", level="error")
+            return None
+        if not isinstance(data, dict) or not isinstance(data.get("offset"), int) or data["offset"] > self.size():
+            return None
+        return data
 
+    def records(self, offset=0):
+        """Yield (record, end offset) from offset on, stopping at a torn record left by a crash"""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return
+                offset += len(line)
+                yield record, offset
 
-def validate_path_component(component, component_name="path component"):
-    if not component or component in {".", ".."}:
-        return False, f"Invalid {component_name}", 400
-    if "/" in component or "\\" in component or ".." in component:
-        return False, f"Invalid {component_name}", 400
-    return True, None, None
+    def truncate(self, offset):
+        with self.lock:
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
 
-def find_stream_dir(stream_key, stream_id):
-    stream_dir = os.path.join(BASE_SEGMENTS_DIR, f"{stream_key}_{stream_id}")
-    if os.path.isdir(stream_dir):
-        return stream_dir
-    return None
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                try:
+                    os.fsync(self._file.fileno())
+                except OSError as e:
+                    log(f"Error syncing state journal {self.path}: {e}", level="error")
+                self._file.close()
+                self._file = None
 
 
-def generate_server_stream_id():
-    return datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+def journal_playlist_entries(journal, count):
+    """The first count playlist entries of a stream, rebuilt from its journal"""
+    entries = []
+    map_name = None
+    for record, _ in journal.records():
+        if len(entries) >= count:
+            break
+        if record["op"] in ("init", "period"):
+            map_name = record["map"]
+        elif record["op"] == "media":
+            previous = entries[-1] if entries else None
+            entries.append(playlist_entry(previous, record["name"], record["duration"], record["discontinuity"], map_name))
+    return entries
 
 
 class StreamState:
-    def __init__(self, stream_key, stream_dir=None, is_restore=False, stream_id=None):
+    def __init__(self, stream_key, stream_dir=None, is_restore=False, stream_id=None, rendition=None, parent=None):
         self.stream_key = stream_key
-        self.playlist_lock = threading.RLock()
+        # Renditions uploaded with a Rendition header are child states of the main stream, sharing its lock
+        self.rendition = rendition
+        self.parent = parent
+        self.renditions = {}  # rendition name -> StreamState
+        self.playlist_lock = parent.playlist_lock if parent is not None else threading.RLock()
         self.arrived_segments = {}  # Dictionary to store arrived segments, key=sequence
         self.last_playlist_sequence = -1 # Track the last sequence added to the playlist
         self.map_written = False
+        self.init_segment_name = None  # initialization segment of the current period
+        self._video_info = (None, None)
         self.written_segment_count = 0
-        self.ffmpeg_process = None
+        self.relays = {}  # target -> Relay
         self.last_upload_time = time.time()
         self.last_add_time = time.time()
         self.check_missing_segments_started = False
@@ -109,15 +3593,41 @@ class StreamState:
         self._gap_wait_start = None
         self.finalized = False
         self.upload_history = deque()
+        self.ingest_history = deque()  # (time, bytes) of segments received within UPLOAD_UTIL_WINDOW
+        self.segment_hashes = {}  # segment name -> content digest of the stored file, newest last
+        self.dedup_stats = {"duplicates": 0, "bytes_saved": 0, "conflicts": 0}
+        self.first_ingest_time = None
         self.events = deque(maxlen=MAX_EVENT_HISTORY)
         self.last_ffmpeg_exit = None
-        self.ffmpeg_log_thread = None
-        self.ffmpeg_drain_thread = None
-        self.ffmpeg_restart_not_before = 0.0
-        self.ffmpeg_restart_suppressed = False
+        # target -> target key of the relays a restored stream was running. Destination keys are never
+        # persisted, so only relays that used the stream key itself can be restored.
+        self.restored_relay_targets = {}
         self.just_restored = False
+        # Media time written to the playlist, used to measure how far each relay lags behind
+        self.written_media_duration = 0.0
+        self.segment_positions = {}  # segment name -> (playlist index, media time at segment end)
+        # Media segments in playlist order, as dicts with name, duration, discontinuity and map (init segment)
+        self.playlist_entries = PlaylistEntries()
+        self.journal = None
+        self.catchup_mode = CATCHUP_MODE
+        # Rendition the relays read (self or a child), and when they may next try a higher one
+        self.relay_source = self
+        self.upswitch_hold = RENDITION_UPSWITCH_HOLD
+        self.upswitch_not_before = 0.0
+        self.last_upswitch_time = None
+        self._master_playlist = None
+        self._bitrate_cache = (None, None)
 
-        if is_restore and stream_dir:
+        if parent is not None:
+            self.stream_id = parent.stream_id
+            self.timestamp = parent.timestamp
+            self.stream_dir = os.path.join(parent.stream_dir, rendition)
+            os.makedirs(self.stream_dir, exist_ok=True)
+            self.playlist_file = os.path.join(self.stream_dir, "playlist.m3u8")
+            self.journal = StateJournal(self.stream_dir)
+            if is_restore:
+                self._restore_state()
+        elif is_restore and stream_dir:
             self.stream_dir = stream_dir
             self.stream_id = os.path.basename(stream_dir)
             prefix = f"{self.stream_key}_"
@@ -126,7 +3636,9 @@ class StreamState:
             else:
                 self.timestamp = generate_server_stream_id()
             self.playlist_file = os.path.join(self.stream_dir, "playlist.m3u8")
+            self.journal = StateJournal(self.stream_dir)
             self._restore_state()
+            self._restore_renditions()
             self.add_event("Stream state restored")
         else:
             self.timestamp = stream_id or generate_server_stream_id()
@@ -134,12 +3646,135 @@ class StreamState:
             self.stream_dir = os.path.join(BASE_SEGMENTS_DIR, f"{self.stream_id}")
             os.makedirs(self.stream_dir, exist_ok=True)
             self.playlist_file = os.path.join(self.stream_dir, "playlist.m3u8")
+            self.journal = StateJournal(self.stream_dir)
+            self.journal.append("stream", stream_key=stream_key)
             self.add_event("Stream state created")
 
     def _restore_state(self):
+        if self.journal.exists():
+            self._restore_from_journal()
+        else:
+            self._restore_from_playlist()
+            # Journal the parsed state, so the next restore does not have to parse the playlist again
+            self._journal_restored_state()
+        self.map_written = True
+        self.just_restored = True
+        self.add_event(f"Restored stream state. Last seq: {self.last_playlist_sequence}")
+
+    def _restore_from_journal(self):
+        offset = 0
+        checkpoint = self.journal.read_checkpoint()
+        if checkpoint is not None:
+            self._load_checkpoint(checkpoint["state"])
+            offset = checkpoint["offset"]
+        replayed = 0
+        for record, offset in self.journal.records(offset):
+            self._replay(record)
+            replayed += 1
+        if offset < self.journal.size():
+            self.journal.truncate(offset)
+            self.add_event("Dropped an incomplete journal record")
+        self._remove_endlist()
+        log(f"Restored stream {self.stream_id} from journal ({replayed} records after checkpoint)", stream=self.stream_id)
+
+    def _load_checkpoint(self, state):
+        self.last_playlist_sequence = state["last_playlist_sequence"]
+        self.period_index = state["period_index"]
+        self.map_written = state["map_written"]
+        self.init_segment_name = state["init_segment_name"]
+        self.written_segment_count = state["written_segment_count"]
+        self.written_media_duration = state["written_media_duration"]
+        self.last_ffmpeg_exit = state["last_ffmpeg_exit"]
+        self.restored_relay_targets = {target: self.stream_key for target in state.get("relay_targets", [])}
+        entries = state["entries"]
+        self.playlist_entries = PlaylistEntries(
+            self.written_segment_count - len(entries),
+            entries,
+            lambda count: journal_playlist_entries(self.journal, count),
+        )
+        # Once journaling fails the journal is removed, so the older entries are read before that
+        self.journal.before_abandon = self.playlist_entries.load
+        self.segment_positions = {
+            entry["name"]: tuple(position) for entry, position in zip(entries, state["positions"])
+        }
+
+    def _checkpoint_state(self):
+        entries = self.playlist_entries[-STATE_CHECKPOINT_ENTRIES:]
+        return {
+            "last_playlist_sequence": self.last_playlist_sequence,
+            "period_index": self.period_index,
+            "map_written": self.map_written,
+            "init_segment_name": self.init_segment_name,
+            "written_segment_count": self.written_segment_count,
+            "written_media_duration": self.written_media_duration,
+            "last_ffmpeg_exit": self.last_ffmpeg_exit,
+            "relay_targets": self._restorable_relay_targets(),
+            "entries": entries,
+            "positions": [self.segment_positions.get(entry["name"]) for entry in entries],
+        }
+
+    def _restorable_relay_targets(self):
+        relays = dict(self.relays)
+        targets = {target for target in self.restored_relay_targets if target not in relays}
+        targets.update(target for target, relay in relays.items() if relay.target_key == self.stream_key)
+        return sorted(targets)
+
+    def _replay(self, record):
+        op = record["op"]
+        if op in ("init", "period"):
+            self.map_written = True
+            self.init_segment_name = record["map"]
+            self.last_playlist_sequence = record["sequence"] - 1
+            if op == "period":
+                self.period_index = record["period"]
+        elif op == "media":
+            self._record_media_written(record["name"], record["duration"], record["discontinuity"])
+            self.last_playlist_sequence = record["sequence"]
+        elif op == "advance":
+            self.last_playlist_sequence = record["sequence"]
+        elif op == "relay_start":
+            if record.get("stream_key_target"):
+                self.restored_relay_targets[record["target"]] = self.stream_key
+            else:
+                self.restored_relay_targets.pop(record["target"], None)
+        elif op == "relay_remove":
+            self.restored_relay_targets.pop(record["target"], None)
+        elif op == "relay_exit":
+            self.last_ffmpeg_exit = record["exit"]
+
+    def _journal_restored_state(self):
+        if self.parent is None:
+            self.journal.append("stream", stream_key=self.stream_key)
+        map_name = None
+        for entry in self.playlist_entries:
+            if entry["map"] != map_name:
+                map_name = entry["map"]
+                self.journal.append("period", sequence=segment_sequence(map_name or ""), map=map_name, period=period_of(map_name))
+            self.journal.append("media", sequence=entry["sequence"], name=entry["name"], duration=entry["duration"], discontinuity=entry["discontinuity"])
+        if self.init_segment_name is not None and self.init_segment_name != map_name:
+            self.journal.append("period", sequence=segment_sequence(self.init_segment_name), map=self.init_segment_name, period=self.period_index)
+        self.journal.append("advance", sequence=self.last_playlist_sequence)
+        self.write_checkpoint()
+
+    def write_checkpoint(self):
+        # Take the offset first: relay records appended meanwhile are replayed again, which is harmless
+        offset = self.journal.size()
+        try:
+            self.journal.write_checkpoint(offset, self._checkpoint_state())
+        except OSError as e:
+            log(f"Error writing checkpoint for stream {self.stream_id}: {e}", level="error")
+
+    def _remove_endlist(self):
+        if playlist_is_finalized(self.playlist_file):
+            with open(self.playlist_file, "r+b") as f:
+                f.truncate(os.path.getsize(self.playlist_file) - len(ENDLIST_TAG))
+            self.add_event("Removed #EXT-X-ENDLIST to resume stream")
+
+    def _restore_from_playlist(self):
         max_seq = -1
         period_index = 0
-        segment_count = 0
+        segment_duration = 0.0
+        discontinuity = False
 
         if os.path.exists(self.playlist_file):
             with open(self.playlist_file, "r") as f:
@@ -153,7 +3788,18 @@ class StreamState:
 
             for line in lines:
                 line = line.strip()
-                if line.endswith(".mp4") or line.endswith(".m4s"):
+                if line.startswith("#EXTINF:"):
+                    try:
+                        segment_duration = float(line[len("#EXTINF:"):].split(',')[0])
+                    except ValueError:
+                        segment_duration = 0.0
+                elif line == "#EXT-X-DISCONTINUITY":
+                    discontinuity = True
+                elif line.startswith("#EXT-X-MAP:"):
+                    match = re.search(r'URI="([^"]+)"', line)
+                    if match:
+                        self.init_segment_name = match.group(1)
+                elif line.endswith(".mp4") or line.endswith(".m4s"):
                     try:
                         parts = line.split('_')
                         if len(parts) >= 3 and parts[0].startswith('p'):
@@ -165,19 +3811,24 @@ class StreamState:
                             max_seq = max(max_seq, seq)
 
                             if not line.endswith(".mp4"):
-                                segment_count += 1
+                                self._record_media_written(line, segment_duration, discontinuity)
+                                discontinuity = False
                     except (ValueError, IndexError):
                         pass
 
         self.last_playlist_sequence = max_seq
         self.period_index = period_index
-        self.written_segment_count = segment_count
-        self.map_written = True
-        self.just_restored = True
-        self.add_event(f"Restored stream state. Last seq: {max_seq}")
+
+    def _restore_renditions(self):
+        for name in sorted(os.listdir(self.stream_dir)):
+            if is_valid_stream_id(name) and os.path.isfile(os.path.join(self.stream_dir, name, "playlist.m3u8")):
+                self.renditions[name] = StreamState(self.stream_key, is_restore=True, rendition=name, parent=self)
+        if self.renditions:
+            self.add_event(f"Restored renditions: {', '.join(self.renditions)}")
 
     def initialize_playlist(self, init_sequence, init_segment_name):
-        print(f"Initializing playlist for stream {self.stream_id}", flush=True)
+        log(f"Initializing playlist for stream {self.stream_id}", stream=self.stream_id)
+        self.journal.append("init", sequence=init_sequence, map=init_segment_name)
         with open(self.playlist_file, "w") as f:
             f.write("#EXTM3U\n")
             f.write("#EXT-X-VERSION:7\n")
@@ -186,23 +3837,39 @@ class StreamState:
             f.write("#EXT-X-PLAYLIST-TYPE:EVENT\n")
             f.write(f"#EXT-X-MAP:URI=\"{init_segment_name}\"\n")
         self.map_written = True
+        self.init_segment_name = init_segment_name
         self.last_playlist_sequence = init_sequence - 1
         self.add_event(f"Playlist initialized at sequence {init_sequence}")
 
+    def start_period(self, sequence, init_segment_name, period_index):
+        """Append a new period with its own init segment, without truncating the playlist"""
+        self.journal.append("period", sequence=sequence, map=init_segment_name, period=period_index)
+        self.period_index = period_index
+        with open(self.playlist_file, "a") as f:
+            f.write("#EXT-X-DISCONTINUITY\n")
+            f.write(f"#EXT-X-MAP:URI=\"{init_segment_name}\"\n")
+        self.init_segment_name = init_segment_name
+        self.last_playlist_sequence = sequence - 1
+
     def finalize_playlist(self, stop_ffmpeg_immediately=False):
-        print(f"Finalizing playlist for stream {self.stream_id}", flush=True)
+        log(f"Finalizing playlist for stream {self.stream_id}", stream=self.stream_id)
         with self.playlist_lock:
             if self.finalized:
                 return
             self.finalized = True
             self.add_event("Playlist finalized")
             try:
+                self.journal.append("final")
                 with open(self.playlist_file, "a") as f:
                     f.write("#EXT-X-ENDLIST\n")
             except Exception as e:
-                print(f"Error in finalize_playlist: {e}", flush=True)
+                log(f"Error in finalize_playlist: {e}", level="error")
+            self.write_checkpoint()
+            self.journal.close()
         self.check_missing_segments_stop_event.set()
         self.check_missing_segments_started = False
+        for child in list(self.renditions.values()):
+            child.finalize_playlist()
         if stop_ffmpeg_immediately:
             self._stop_ffmpeg()
         else:
@@ -215,98 +3882,207 @@ class StreamState:
             if streams.get(self.stream_key) is self:
                 del streams[self.stream_key]
 
+    def watch_missing_segments(self):
+        """Start the thread that finalizes this stream once uploads stop for MISSING_SEGMENT_TIMEOUT"""
+        if not self.check_missing_segments_started:
+            self.check_missing_segments_stop_event.clear()
+            threading.Thread(target=self.check_missing_segments, daemon=True).start()
+            self.check_missing_segments_started = True
+
     def check_missing_segments(self):
         while not self.check_missing_segments_stop_event.is_set():
             time.sleep(1)
             if time.time() - self.last_upload_time > MISSING_SEGMENT_TIMEOUT or time.time() - self.last_add_time > MISSING_SEGMENT_TIMEOUT:
-                print(f"Timeout for missing segments in stream {self.stream_dir}", flush=True)
+                log(f"Timeout for missing segments in stream {self.stream_dir}", level="warning", stream=self.stream_id)
                 self.finalize_playlist()
                 break
 
-    def start_ffmpeg_relay(self, target, stream_key, live_start_index=None):
-        if target == "youtube":
-            ffmpeg_command = [
-                "ffmpeg",
-                "-reconnect", "1",
-                "-reconnect_at_eof", "1",
-                "-reconnect_streamed", "1",
-                "-reconnect_on_network_error", "1",
-                "-reconnect_on_http_error", "4xx,5xx",
-                "-reconnect_delay_max", f"{MISSING_SEGMENT_TIMEOUT}",
-                "-max_reload", f"{MISSING_SEGMENT_TIMEOUT}",
-                "-m3u8_hold_counters", f"{MISSING_SEGMENT_TIMEOUT}",
-                "-seg_max_retry", f"{MISSING_SEGMENT_TIMEOUT}",
-            ] + ([] if live_start_index is None else [
-                "-live_start_index", str(live_start_index)
-            ]) + [
-                "-copyts",
-                "-fflags", "+igndts",
-                "-re",
-                "-i", f"http://127.0.0.1:{PORT}/segments/{self.stream_id}/playlist.m3u8",
-                "-c", "copy",
-                "-fps_mode", "passthrough",
-                "-master_pl_name", "master.m3u8",
-                "-http_persistent", "1",
-                "-f", "hls",
-                "-hls_playlist_type", "event",
-                "-hls_allow_cache", "1",
-                "-method", "POST",
-                f"https://a.upload.youtube.com/http_upload_hls?cid={stream_key}&copy=0&file=master.m3u8"
-            ]
-        elif target == "twitch":
-            ffmpeg_command = [
-                "ffmpeg",
-                "-reconnect", "1",
-                "-reconnect_at_eof", "1",
-                "-reconnect_streamed", "1",
-                "-reconnect_on_network_error", "1",
-                "-reconnect_on_http_error", "4xx,5xx",
-                "-reconnect_delay_max", f"{MISSING_SEGMENT_TIMEOUT}",
-                "-max_reload", f"{MISSING_SEGMENT_TIMEOUT}",
-                "-m3u8_hold_counters", f"{MISSING_SEGMENT_TIMEOUT}",
-                "-seg_max_retry", f"{MISSING_SEGMENT_TIMEOUT}",
-            ] + ([] if live_start_index is None else [
-                "-live_start_index", str(live_start_index)
-            ]) + [
-                "-copyts",
-                "-fflags", "+igndts",
-                "-re",
-                "-i", f"http://127.0.0.1:{PORT}/segments/{self.stream_id}/playlist.m3u8",
-                "-c:v", "libx264",
-                "-preset", "veryfast",
-                "-b:v", "8M",
-                "-pix_fmt", "yuv420p",
-                "-bufsize", "16000k",
-                "-g", "60",
-                "-c:a", "copy",
-                "-fps_mode", "passthrough",
-                "-f", "flv",
-                "-rtmp_buffer", "10000",
-                f"rtmp://ingest.global-contribute.live-video.net/app/{stream_key}"
-            ]
-        else:
-            raise ValueError(f"Unsupported target: {target}")
+    def start_ffmpeg_relay(self, target, stream_key, live_start_index=None, realtime=True):
+        self.get_relay(target, stream_key).start(live_start_index, realtime)
+
+    def get_relay(self, target, target_key):
+        relay = self.relays.get(target)
+        if relay is None:
+            relay = Relay(self, target, target_key)
+            relay.source = self.relay_source
+            self.relays[target] = relay
+        elif relay.target_key != target_key:
+            relay.target_key = target_key
+            self.add_event(f"Destination key for {target} changed; used on next relay start")
+        return relay
+
+    def sync_relays(self, relay_targets):
+        """Create relays for the requested destinations and stop the ones no longer requested"""
+        wanted = dict(relay_targets)
+        for target in list(self.relays):
+            if target not in wanted:
+                relay = self.relays.pop(target)
+                relay.stop()
+                self.restored_relay_targets.pop(target, None)
+                self.journal.append("relay_remove", target=target)
+                self.add_event(f"Relay to {target} removed from targets")
+        return [self.get_relay(target, target_key) for target, target_key in relay_targets]
+
+    def probe_video(self):
+        """Parsed video track of the current init segment (cached per init segment)"""
+        name = self.init_segment_name
+        if name is None:
+            return None
+        if self._video_info[0] != name:
+            try:
+                with open_segment(self.stream_dir, name) as f:
+                    info = probe_init_segment(f.read())
+            except OSError as e:
+                log(f"Could not read init segment {name} for stream {self.stream_id}: {e}", level="error")
+                info = None
+            self._video_info = (name, info)
+        return self._video_info[1]
+
+    def check_relay_video_modes(self):
+        """Schedule a restart for relays whose copy/transcode decision no longer fits a new init segment"""
+        owner = self.parent or self
+        for relay in list(owner.relays.values()):
+            if relay.source is not self or relay.video_mode is None or not relay.is_running():
+                continue
+            video_mode, reason = relay.video_decision()
+            if video_mode != relay.video_mode:
+                # The first media segment of the new period becomes the next playlist entry
+                relay.request_restart(f"video input changed, now {video_mode} ({reason})", self.written_segment_count)
+
+    def is_ffmpeg_running(self):
+        return any(relay.is_running() for relay in list(self.relays.values()))
+
+    def note_relay_fetch(self, segment_name, target=None, rendition=None):
+        relays = [relay for relay in list(self.relays.values()) if relay.source.rendition == rendition]
+        if target in self.relays:
+            if self.relays[target].source.rendition == rendition:
+                self.relays[target].note_fetch(segment_name)
+        elif len(relays) == 1:
+            relays[0].note_fetch(segment_name)
+
+    def rendition_label(self):
+        return self.rendition or MAIN_RENDITION
+
+    def relative_dir(self):
+        """Path of this rendition below /segments/, ending with a slash"""
+        return f"{self.stream_id}/" if self.rendition is None else f"{self.stream_id}/{self.rendition}/"
+
+    def get_rendition(self, name):
+        """Child state for a named rendition of this stream, created on first use"""
+        child = self.renditions.get(name)
+        if child is None:
+            child = StreamState(self.stream_key, rendition=name, parent=self)
+            self.renditions[name] = child
+            self.add_event(f"Rendition {name} added")
+        return child
+
+    def index_for_sequence(self, sequence):
+        """Playlist index of the first media segment with at least this sequence number"""
+        index = len(self.playlist_entries)
+        while index > 0 and self.playlist_entries[index - 1]["sequence"] >= sequence:
+            index -= 1
+        return index
+
+    def bitrate(self):
+        """Average bits per second of the last few media segments, or None before any were written"""
+        if self._bitrate_cache[0] == self.written_segment_count:
+            return self._bitrate_cache[1]
+        total_bytes = 0
+        total_duration = 0.0
+        for entry in self.playlist_entries[-RENDITION_BITRATE_SEGMENTS:]:
+            try:
+                total_bytes += os.path.getsize(locate_segment(self.stream_dir, entry["name"]))
+            except OSError:
+                continue
+            total_duration += entry["duration"]
+        bitrate = total_bytes * 8 / total_duration if total_duration > 0 else None
+        self._bitrate_cache = (self.written_segment_count, bitrate)
+        return bitrate
+
+    def rendition_ladder(self):
+        """Renditions that can be relayed, main first, then the others from highest to lowest bitrate"""
+        others = [child for child in list(self.renditions.values()) if not child.finalized and child.bitrate() is not None]
+        others.sort(key=lambda child: child.bitrate(), reverse=True)
+        return [self] + others
+
+    def write_master_playlist(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-INDEPENDENT-SEGMENTS"]
+        for source in [self] + list(self.renditions.values()):
+            attributes = [f"BANDWIDTH={max(1, int(source.bitrate() or 0))}"]
+            info = source.probe_video()
+            if info and info.get("width") and info.get("height"):
+                attributes.append(f"RESOLUTION={info['width']}x{info['height']}")
+            lines.append(f"#EXT-X-STREAM-INF:{','.join(attributes)}")
+            lines.append("playlist.m3u8" if source is self else f"{source.rendition}/playlist.m3u8")
+        content = "\n".join(lines) + "\n"
+        if content == self._master_playlist:
+            return
+        master_file = os.path.join(self.stream_dir, "master.m3u8")
+        with open(master_file + ".tmp", "w") as f:
+            f.write(content)
+        os.replace(master_file + ".tmp", master_file)
+        self._master_playlist = content
+
+    def check_renditions(self, now=None):
+        """Switch the relayed rendition at a segment boundary when relays fall behind, or probe a higher one"""
+        if not self.renditions or not self.relays:
+            return
+        now = time.time() if now is None else now
+        relays = [relay for relay in list(self.relays.values()) if relay.is_running()]
+        if not relays or any(relay.restart_request for relay in relays):
+            return
+        ladder = self.rendition_ladder()
+        if self.relay_source not in ladder:
+            # The relayed rendition ended; fall back to the main stream
+            self.switch_rendition(self, "rendition ended")
+            return
+        current = ladder.index(self.relay_source)
+        lag = self.relay_lag()
+        if lag is None:
+            return
+
+        if lag >= RENDITION_DOWNSWITCH_LAG and current < len(ladder) - 1:
+            upstream_bps = upstream_monitor.throughput_bps()
+            choice = ladder[-1]
+            if upstream_bps:
+                budget = upstream_bps * RENDITION_BANDWIDTH_HEADROOM / len(relays)
+                choice = next((source for source in ladder[current + 1:] if source.bitrate() <= budget), ladder[-1])
+            if self.last_upswitch_time is not None and now - self.last_upswitch_time < self.upswitch_hold:
+                # The last attempt at a higher rendition could not be sustained; wait longer next time
+                self.upswitch_hold = min(self.upswitch_hold * 2, RENDITION_UPSWITCH_HOLD_MAX)
+            else:
+                self.upswitch_hold = RENDITION_UPSWITCH_HOLD
+            self.upswitch_not_before = now + self.upswitch_hold
+            upstream = "unknown" if not upstream_bps else f"{upstream_bps / 1e6:.1f} Mbit/s"
+            self.switch_rendition(choice, f"lag {lag:.1f}s, upstream {upstream}")
+        elif current > 0 and lag <= CATCHUP_LAG_TARGET and now >= self.upswitch_not_before:
+            self.last_upswitch_time = now
+            self.upswitch_not_before = now + self.upswitch_hold
+            self.switch_rendition(ladder[current - 1], f"no lag for {self.upswitch_hold}s, trying higher rendition")
+
+    def switch_rendition(self, source, reason):
+        previous = self.relay_source
+        self.relay_source = source
+        log(f"Switching relayed rendition for stream {self.stream_id} from {previous.rendition_label()} to {source.rendition_label()}: {reason}", stream=self.stream_id)
+        self.add_event(f"Relaying rendition {source.rendition_label()} instead of {previous.rendition_label()} ({reason})")
+        for relay in list(self.relays.values()):
+            relay.switch_source(source, f"rendition {source.rendition_label()}: {reason}")
+
+    def relay_lag(self):
+        """Largest lag across running relays, in seconds of media"""
+        lags = [lag for lag in (relay.lag() for relay in list(self.relays.values())) if lag is not None]
+        return max(lags) if lags else None
 
-        start_desc = "edge" if live_start_index is None else str(live_start_index)
-        print(f"Starting ffmpeg relay for stream {stream_key} to target {target} with live_start_index {start_desc}", flush=True)
-        try:
-            self.ffmpeg_process = subprocess.Popen(
-                ffmpeg_command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-            )
-        except OSError as e:
-            self.ffmpeg_process = None
-            self.add_event(f"ffmpeg failed to start: {e}")
-            raise RuntimeError(f"ffmpeg failed to start: {e}") from e
-        self._start_ffmpeg_logger()
-        self.ffmpeg_restart_not_before = 0.0
-        self.ffmpeg_restart_suppressed = False
-        self.add_event(f"ffmpeg started for {target} (start_index={start_desc})")
 
     def update_playlist(self):
+        started = time.monotonic()
+        try:
+            return self._update_playlist()
+        finally:
+            metrics.playlist_update_seconds.observe(time.monotonic() - started)
+            metrics.reorder_depth.observe(sum(1 for sequence in list(self.arrived_segments) if isinstance(sequence, int)))
+
+    def _update_playlist(self):
         added = False
         while True:
             next_sequence = self.last_playlist_sequence + 1
@@ -317,16 +4093,22 @@ class StreamState:
                 is_init = segment_info['is_init']
                 discontinuity = segment_info['discontinuity']
 
+                if is_init:
+                    self.journal.append("advance", sequence=next_sequence)
+                else:
+                    self.journal.append("media", sequence=next_sequence, name=segment_name, duration=duration, discontinuity=discontinuity)
+                append_started = time.monotonic()
                 with open(self.playlist_file, "a") as f:
                     if discontinuity:
                         f.write("#EXT-X-DISCONTINUITY\n")
                     if not is_init:
                         f.write(f"#EXTINF:{duration:.6f},\n")
                         f.write(f"{segment_name}\n")
+                disk_health.record("playlist_append", time.monotonic() - append_started)
 
                 # Only count media segments toward the buffer threshold
                 if not is_init:
-                    self.written_segment_count += 1
+                    self._record_media_written(segment_name, duration, discontinuity)
                 self.last_playlist_sequence = next_sequence
                 added = True
                 # Reset any gap wait state
@@ -355,18 +4137,26 @@ class StreamState:
                 duration = segment_info['duration']
                 is_init = segment_info['is_init']
 
+                self.journal.append("skip", missing=next_sequence, sequence=next_seq)
+                if is_init:
+                    self.journal.append("advance", sequence=next_seq)
+                else:
+                    self.journal.append("media", sequence=next_seq, name=segment_name, duration=duration, discontinuity=True)
+                append_started = time.monotonic()
                 with open(self.playlist_file, "a") as f:
                     # Only write discontinuity for media segments, never for init segments
                     if not is_init:
                         f.write("#EXT-X-DISCONTINUITY\n")
                         f.write(f"#EXTINF:{duration:.6f},\n")
                         f.write(f"{segment_name}\n")
+                disk_health.record("playlist_append", time.monotonic() - append_started)
 
                 if not is_init:
-                    self.written_segment_count += 1
+                    self._record_media_written(segment_name, duration, discontinuity=True)
                 self.last_playlist_sequence = next_seq
                 added = True
                 self.add_event(f"Skipped sequence {next_sequence}; resumed at {next_seq}")
+                metrics.gap_skips.inc()
                 # Reset or continue loop to handle more available sequences
                 self._gap_wait_seq = None
                 self._gap_wait_start = None
@@ -377,11 +4167,38 @@ class StreamState:
 
         if added:
             self.last_add_time = time.time()
+            if self.journal.records_since_checkpoint >= STATE_CHECKPOINT_INTERVAL:
+                self.write_checkpoint()
         # Finalization flag
         if 'final' in self.arrived_segments:
             self.finalize_playlist()
             del self.arrived_segments['final']
 
+    def _record_media_written(self, segment_name, duration, discontinuity=False):
+        self.written_segment_count += 1
+        self.written_media_duration += duration
+        self.segment_positions[segment_name] = (self.written_segment_count - 1, self.written_media_duration)
+        self._prune_segment_positions()
+        previous = self.playlist_entries[-1] if len(self.playlist_entries) else None
+        self.playlist_entries.append(playlist_entry(previous, segment_name, duration, discontinuity, self.init_segment_name))
+        owner = self.parent or self
+        for relay in list(owner.relays.values()):
+            if relay.source is self:
+                relay.notify_segment()
+
+    def _prune_segment_positions(self):
+        """Forget the positions behind the slowest running relay, keeping those a checkpoint stores"""
+        floor = self.written_segment_count - STATE_CHECKPOINT_ENTRIES
+        for relay in list((self.parent or self).relays.values()):
+            if relay.source is self and relay.position is not None and relay.is_running():
+                floor = min(floor, relay.position[0])
+        # Positions are recorded in playlist order
+        while self.segment_positions:
+            name = next(iter(self.segment_positions))
+            if self.segment_positions[name][0] >= floor:
+                break
+            del self.segment_positions[name]
+
     def record_upload_duration(self, duration):
         now = time.time()
         self.upload_history.append((now, duration))
@@ -389,101 +4206,145 @@ class StreamState:
         while self.upload_history and self.upload_history[0][0] < cutoff:
             self.upload_history.popleft()
 
-    def add_event(self, message):
-        timestamp = datetime.now().isoformat(timespec="seconds")
-        self.events.append({"time": timestamp, "message": message})
+    def record_ingest(self, size, now=None):
+        now = time.time() if now is None else now
+        if self.first_ingest_time is None:
+            self.first_ingest_time = now
+        self.ingest_history.append((now, size))
+        cutoff = now - UPLOAD_UTIL_WINDOW
+        while self.ingest_history and self.ingest_history[0][0] < cutoff:
+            self.ingest_history.popleft()
 
-    def _start_ffmpeg_logger(self):
-        if not self.ffmpeg_process or self.ffmpeg_process.stdout is None:
-            return
-        prefix = f"[ffmpeg {self.stream_id}] "
+    def ingest_bps(self, now=None):
+        """Bits per second received from the client over the last UPLOAD_UTIL_WINDOW seconds"""
+        now = time.time() if now is None else now
+        if self.first_ingest_time is None:
+            return None
+        span = min(UPLOAD_UTIL_WINDOW, now - self.first_ingest_time)
+        if span < 1:
+            return None
+        cutoff = now - UPLOAD_UTIL_WINDOW
+        return sum(size for ts, size in list(self.ingest_history) if ts >= cutoff) * 8 / span
 
-        def _pump():
-            for line in self.ffmpeg_process.stdout:
-                print(prefix + line.rstrip(), flush=True)
-            try:
-                self.ffmpeg_process.stdout.close()
-            except Exception:
-                pass
+    def pending_bytes(self):
+        """Bytes of segments (this stream's and its renditions') waiting in reorder buffers"""
+        total = sum(entry.get("size", 0) for entry in list(self.arrived_segments.values()) if isinstance(entry, dict))
+        return total + sum(child.pending_bytes() for child in list(self.renditions.values()))
 
-        self.ffmpeg_log_thread = threading.Thread(target=_pump, daemon=True)
-        self.ffmpeg_log_thread.start()
+    def remember_digest(self, segment_name, digest):
+        """Keep a stored segment's digest; only the DEDUP_WINDOW_SEGMENTS newest are kept"""
+        self.segment_hashes.pop(segment_name, None)
+        self.segment_hashes[segment_name] = digest
+        while len(self.segment_hashes) > DEDUP_WINDOW_SEGMENTS:
+            del self.segment_hashes[next(iter(self.segment_hashes))]
 
-    @classmethod
-    def restore(cls, stream_key, stream_dir):
-        return cls(stream_key, stream_dir=stream_dir, is_restore=True)
+    def stored_segment_name(self, sequence):
+        """Name a media segment was stored under while queued or listed in the dedup window, else None.
 
-    def _stop_ffmpeg_logger(self):
-        if self.ffmpeg_log_thread:
-            self.ffmpeg_log_thread.join(timeout=1)
-        self.ffmpeg_log_thread = None
+        The name carries the period, so a retransmit arriving after a new init segment is named differently.
+        """
+        queued = self.arrived_segments.get(sequence)
+        if queued is not None:
+            return None if queued["is_init"] else queued["filename"]
+        if sequence <= self.last_playlist_sequence:
+            for entry in reversed(self.playlist_entries[-DEDUP_WINDOW_SEGMENTS:]):
+                if entry["sequence"] == sequence:
+                    return entry["name"]
+        return None
 
-    def _stop_ffmpeg(self):
-        if not self.ffmpeg_process:
-            return
+    def known_digest(self, segment_name):
+        """Content digest of a stored segment, hashing files written before a restart on first use.
 
-        proc = self.ffmpeg_process
-        try:
-            proc.terminate()
-            proc.wait(timeout=5)
-            self.add_event(f"ffmpeg exited with code {proc.returncode}")
-            self.last_ffmpeg_exit = {"code": proc.returncode, "signal": None}
-        except subprocess.TimeoutExpired:
-            print(f"Warning: ffmpeg did not exit in time for {self.stream_id}; killing", flush=True)
-            proc.kill()
-            proc.wait()
-            self.add_event("ffmpeg killed after timeout")
-            self.last_ffmpeg_exit = {"code": None, "signal": "SIGKILL"}
-        except Exception as e:
-            print(f"Warning: failed to terminate ffmpeg for {self.stream_id}: {e}", flush=True)
-            self.add_event(f"ffmpeg termination failed: {e}")
-            self.last_ffmpeg_exit = {"code": None, "signal": str(e)}
-        finally:
-            self.ffmpeg_process = None
-            self._stop_ffmpeg_logger()
+        Only the current init segment and segments inside the dedup window are hashed from disk.
+        """
+        digest = self.segment_hashes.get(segment_name)
+        sequence = segment_sequence(segment_name or "")
+        in_window = sequence > self.last_playlist_sequence - DEDUP_WINDOW_SEGMENTS
+        # A sequence past the playlist that is not queued either was never stored
+        never_stored = sequence > self.last_playlist_sequence and sequence not in self.arrived_segments
+        if digest is None and segment_name and ((in_window and not never_stored) or segment_name == self.init_segment_name):
+            try:
+                digest = file_digest(locate_segment(self.stream_dir, segment_name))
+            except FileNotFoundError:
+                return None
+            except OSError as e:
+                log(f"Error hashing segment {segment_name} of stream {self.stream_id}: {e}", level="error", stream=self.stream_id)
+                return None
+            self.remember_digest(segment_name, digest)
+        return digest
 
-    def _record_ffmpeg_exit(self, exit_code):
-        self.add_event(f"ffmpeg exited with code {exit_code}")
-        self.last_ffmpeg_exit = {"code": exit_code, "signal": None}
-        self.ffmpeg_process = None
-        self._stop_ffmpeg_logger()
+    def backpressure_hints(self, now=None):
+        """Load figures returned to the client with every upload, so it can adapt its encoder"""
+        with self.playlist_lock:
+            pending = sum(1 for seq in self.arrived_segments if isinstance(seq, int))
+        lag = self.relay_lag()
+        upstream_bps = upstream_monitor.throughput_bps()
+        max_bitrate = None
+        running = sum(1 for relay in list(self.relays.values()) if relay.is_running())
+        if running and upstream_bps and lag is not None and lag > CATCHUP_LAG_TARGET:
+            # Relays are falling behind: the client should not send more than the upstream delivers
+            max_bitrate = upstream_bps * RENDITION_BANDWIDTH_HEADROOM / running
+        return {
+            "pending_segments": pending,
+            "relay_lag": lag,
+            "upstream_bps": upstream_bps,
+            "ingest_bps": self.ingest_bps(now),
+            "max_bitrate_bps": max_bitrate,
+        }
 
-    def _begin_ffmpeg_drain(self):
-        if not self.ffmpeg_process:
-            return
-        if self.ffmpeg_drain_thread and self.ffmpeg_drain_thread.is_alive():
+    def add_event(self, message):
+        if self.parent is not None:
+            self.parent.add_event(f"[{self.rendition}] {message}")
             return
+        timestamp = datetime.now().isoformat(timespec="seconds")
+        self.events.append({"time": timestamp, "message": message})
 
-        proc = self.ffmpeg_process
-        if proc.poll() is not None:
-            self._record_ffmpeg_exit(proc.returncode)
-            return
+    @classmethod
+    def restore(cls, stream_key, stream_dir):
+        return cls(stream_key, stream_dir=stream_dir, is_restore=True)
 
-        timeout = FFMPEG_FINAL_DRAIN_TIMEOUT
-        self.add_event(f"ffmpeg drain started (timeout={timeout}s)")
-        print(
-            f"Allowing ffmpeg to drain naturally for stream {self.stream_id} for up to {timeout}s before forced shutdown",
-            flush=True,
-        )
+    def handover_state(self):
+        """What the journal does not hold about this stream, for the process taking it over"""
+        return {
+            "stream_key": self.stream_key,
+            "stream_dir": self.stream_dir,
+            "catchup_mode": self.catchup_mode,
+            "just_restored": self.just_restored,
+            "relay_source": self.relay_source.rendition,
+            "events": list(self.events),
+            # Segments stored but still waiting for the playlist, per rendition ("" for the main one)
+            "pending": {
+                media.rendition or "": list(media.arrived_segments.items())
+                for media in [self] + list(self.renditions.values())
+            },
+            "relays": [relay.detach() for relay in list(self.relays.values())],
+        }
 
-        def _drain():
-            try:
-                exit_code = proc.wait(timeout=timeout)
-                print(
-                    f"ffmpeg drained naturally for stream {self.stream_id} with exit code {exit_code}",
-                    flush=True,
-                )
-                self._record_ffmpeg_exit(exit_code)
-            except subprocess.TimeoutExpired:
-                print(
-                    f"ffmpeg drain timeout reached for stream {self.stream_id}; forcing shutdown",
-                    flush=True,
-                )
-                self.add_event(f"ffmpeg drain timeout after {timeout}s")
-                self._stop_ffmpeg()
+    @classmethod
+    def take_over(cls, state):
+        """Restore a stream handed over by the process this one was re-executed from"""
+        stream = cls.restore(state["stream_key"], state["stream_dir"])
+        stream.events = deque(state["events"], maxlen=MAX_EVENT_HISTORY)
+        stream.catchup_mode = state["catchup_mode"]
+        stream.just_restored = state["just_restored"]
+        for rendition, pending in state["pending"].items():
+            media = stream.get_rendition(rendition) if rendition else stream
+            media.arrived_segments.update(pending)
+        if state["relay_source"] is not None:
+            stream.relay_source = stream.get_rendition(state["relay_source"])
+        for relay_state in state["relays"]:
+            Relay.adopt(stream, relay_state)
+        stream.add_event("Stream taken over from the previous relay process")
+        return stream
+
+    def _stop_ffmpeg(self):
+        for relay in list(self.relays.values()):
+            relay.stop()
+
+    def _begin_ffmpeg_drain(self):
+        for relay in list(self.relays.values()):
+            relay.begin_drain()
 
-        self.ffmpeg_drain_thread = threading.Thread(target=_drain, daemon=True)
-        self.ffmpeg_drain_thread.start()
 
 # Rest of the authentication code remains the same
 def check_auth(username, password):
@@ -504,195 +4365,841 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return decorated
 
+def parse_segment_headers(headers, default_rendition=None):
+    """Read the per-segment upload headers; returns (segment, None) or (None, (message, status))"""
+    try:
+        segment_type = headers.get("Segment-Type")
+        segment = {
+            "is_init": segment_type == "Initialization",
+            "is_final": segment_type == "Finalization",
+            "discontinuity": headers.get("Discontinuity").lower() == "true",
+            "duration": float(headers.get("Duration")),
+            "sequence": int(headers.get("Sequence")),
+        }
+    except ValueError as e:
+        return None, (f"Invalid header data: {e}", 400)
+    rendition = headers.get("Rendition", default_rendition)
+    if rendition is not None:
+        rendition = rendition.strip()
+        if not is_valid_stream_id(rendition):
+            return None, ("Invalid Rendition", 400)
+        if rendition == MAIN_RENDITION:
+            rendition = None
+    segment["rendition"] = rendition
+    return segment, None
+
+
+def open_upload_stream(stream_key, stream_id, sequence, catchup):
+    """Find, restore or create the stream an upload belongs to, finalizing a stream it replaces"""
+    old_stream = None
+    with stream_key_lock(stream_key):
+        reserved = False
+        with stream_creation_lock:
+            stream = streams.get(stream_key)
+            need_new_stream = False
+            if stream is None or stream.finalized:
+                need_new_stream = True
+            elif stream_id and stream.timestamp != stream_id:
+                need_new_stream = True
+            if need_new_stream and (stream is None or stream.finalized):
+                resource_governor.admit_stream(sum(1 for existing in streams.values() if not existing.finalized))
+                reserved = True
+
+        try:
+            if need_new_stream:
+                old_stream = stream
+
+                # Reading (and possibly repairing) a playlist from disk only holds up this key's uploads
+                restored = False
+                if stream_id:
+                    stream_dir = find_stream_dir(stream_key, stream_id)
+                    if stream_dir:
+                        candidate_stream = StreamState.restore(stream_key, stream_dir)
+                        if sequence > candidate_stream.last_playlist_sequence:
+                            stream = candidate_stream
+                            restored = True
+
+                if not restored:
+                    stream = StreamState(stream_key, stream_id=stream_id)
+
+                with stream_creation_lock:
+                    streams[stream_key] = stream
+                    if reserved:
+                        # The stream now counts as active itself
+                        resource_governor.release_stream()
+                        reserved = False
+        finally:
+            if reserved:
+                resource_governor.release_stream()
+
+        stream.last_upload_time = time.time()
+        if catchup is not None and catchup != stream.catchup_mode:
+            stream.catchup_mode = catchup
+            stream.add_event(f"Catch-up mode set to {catchup}")
+        stream.watch_missing_segments()
+
+    if old_stream is not None:
+        old_stream.check_missing_segments_stop_event.set()
+        if not old_stream.finalized:
+            old_stream.finalize_playlist(stop_ffmpeg_immediately=True)
+
+    return stream
+
+
+def store_segment(media, segment, write_segment):
+    """Save one segment into a stream's (or rendition's) directory and queue it for the playlist.
+
+    write_segment(path) puts the segment's bytes at path. segment carries the payload's size and
+    content digest; a retransmit identical to the stored segment is acknowledged without writing it
+    again. Must be called with the playlist lock held; the caller runs update_playlist afterwards.
+    Returns an error (message, status) or None.
+    """
+    is_init = segment["is_init"]
+    sequence = segment["sequence"]
+    owner = media.parent or media
+    owner.record_ingest(segment["size"])
+    segment_period_index = media.period_index
+    if is_init and media.map_written:
+        segment_period_index += 1
+
+    segment_name = f"p{segment_period_index}_segment_{sequence:06d}.{'mp4' if is_init else 'm4s'}"
+
+    stored_name = segment_name
+    if is_init and media.map_written and segment_sequence(media.init_segment_name) == sequence and media.last_playlist_sequence <= sequence:
+        # A retry of the current init segment would otherwise start a new period
+        stored_name = media.init_segment_name
+    elif not is_init:
+        stored_name = media.stored_segment_name(sequence) or segment_name
+    stored_digest = media.known_digest(stored_name)
+    if stored_digest is not None and stored_digest == segment["digest"]:
+        owner.dedup_stats["duplicates"] += 1
+        owner.dedup_stats["bytes_saved"] += segment["size"]
+        log(f"Duplicate segment ignored: {stored_name} for stream: {media.stream_id}", stream=media.stream_id)
+        return None
+    is_stale = (not is_init) and sequence <= media.last_playlist_sequence
+    if stored_digest is not None and (stored_name == segment_name or not is_init):
+        owner.dedup_stats["conflicts"] += 1
+        action = "kept the listed segment" if is_stale else "replaced the queued segment"
+        log(f"Conflicting payload for {segment_name} in stream {media.stream_id}; {action}", stream=media.stream_id)
+        media.add_event(f"Conflicting payload for sequence {sequence}; {action}")
+        if is_stale:
+            return None
+    if not is_init and sequence > media.last_playlist_sequence + 1:
+        # Only segments that have to wait behind a gap grow the reorder buffer
+        resource_governor.admit_pending_bytes(segment["size"])
+
+    try:
+        hot_tier.store(media.stream_dir, segment_name, segment["size"], write_segment)
+    except Exception as e:
+        return f"Error saving segment: {e}", 500
+    if segment["digest"] is not None:
+        media.remember_digest(segment_name, segment["digest"])
+
+    log(f"Saved segment: {segment_name} for stream: {media.stream_id}", stream=media.stream_id)
+
+    if is_init:
+        if not media.map_written:
+            # First init: start playlist fresh
+            media.initialize_playlist(sequence, segment_name)
+            log(f"Initialization segment processed: stream={media.stream_id} sequence={sequence} action=playlist_initialized", stream=media.stream_id)
+        else:
+            # Subsequent init: append new period without truncating playlist
+            media.start_period(sequence, segment_name, segment_period_index)
+            media.check_relay_video_modes()
+            media._gap_wait_seq = None
+            media._gap_wait_start = None
+            media.add_event(f"New init segment (period {media.period_index}) sequence {sequence}")
+            log(f"Initialization segment processed: stream={media.stream_id} sequence={sequence} action=period_map_updated period={media.period_index}", stream=media.stream_id)
+    # Drop stale media segments from queue (but keep file on disk)
+    if is_stale:
+        log(f"Stale segment ignored for playlist: seq={sequence} (last={media.last_playlist_sequence}) stream={media.stream_id}", stream=media.stream_id)
+        media.add_event(f"Stale segment ignored: seq={sequence}")
+    else:
+        media.arrived_segments[sequence] = {
+            "filename": segment_name,
+            "duration": segment["duration"],
+            "is_init": is_init,
+            "discontinuity": segment["discontinuity"],
+            "size": segment["size"],
+        }
+    if segment["is_final"]:
+        media.arrived_segments['final'] = True # Use a simple flag for finalization
+        log(f"Finalization segment processed: stream={media.stream_id} sequence={sequence} action=finalize_requested", stream=media.stream_id)
+    return None
+
+
+def update_relays(stream, relay_targets, effective_target, main_updated):
+    """Start or restart relays after new segments were added; called with the playlist lock held.
+
+    Returns an error (message, status) if a relay could not be started, otherwise None.
+    """
+    if FORCE_TARGET and not hasattr(stream, "_force_target_logged"):
+        stream.add_event(f"Force target override active: {FORCE_TARGET}")
+        setattr(stream, "_force_target_logged", True)
+
+    if (not stream.finalized) and relay_targets:
+        relays = stream.sync_relays(relay_targets)
+        if stream.written_segment_count >= SEGMENTS_BEFORE_RELAY:
+            # Each destination starts, restarts and backs off on its own so one failing
+            # platform does not disturb the others
+            relay_errors = []
+            just_restored = stream.just_restored
+            for relay in relays:
+                try:
+                    relay.ensure_running(stream.written_segment_count, just_restored)
+                except RelayLimitReached as e:
+                    # Shed load by starting this relay later; the upload itself is still accepted
+                    relay.restart_not_before = time.time() + ADMISSION_RETRY_AFTER
+                    if not relay.restart_suppressed:
+                        stream.add_event(f"ffmpeg start for {relay.target} deferred: {e}")
+                        relay.restart_suppressed = True
+                except RuntimeError as e:
+                    relay.restart_not_before = time.time() + FFMPEG_RESTART_COOLDOWN
+                    relay.restart_suppressed = False
+                    relay_errors.append(str(e) if len(relays) == 1 else f"{relay.target}: {e}")
+            stream.just_restored = False
+            if relay_errors:
+                return f"Error starting ffmpeg relay: {'; '.join(relay_errors)}", 500
+            stream.check_renditions()
+    elif main_updated:
+        if stream.written_segment_count == SEGMENTS_BEFORE_RELAY:
+            stream.add_event(f"Passive mode: playlist building only (no relay). Target={effective_target}")
+
+    if stream.renditions:
+        try:
+            stream.write_master_playlist()
+        except OSError as e:
+            log(f"Error writing master playlist for stream {stream.stream_id}: {e}", level="error")
+    return None
+
+
+def recovery_candidate(stream_dir, now):
+    """(stream key, playlist mtime) of an unfinalized stream directory changed recently, else None"""
+    playlist_file = os.path.join(stream_dir, "playlist.m3u8")
+    try:
+        modified = os.path.getmtime(playlist_file)
+    except OSError:
+        return None
+    if now - modified > RECOVERY_MAX_AGE or playlist_is_finalized(playlist_file):
+        return None
+    # Only journaled streams record their key; older directories are still restored on upload
+    stream_key = StateJournal(stream_dir).stream_key()
+    if not is_valid_stream_key(stream_key):
+        return None
+    if current_worker is not None and stream_worker(stream_key) != current_worker.index:
+        return None
+    return stream_key, modified
+
+
+def recover_stream(stream_key, stream_dir):
+    """Restore a stream left unfinalized by a previous run, unless its client has already reconnected"""
+    try:
+        with stream_key_lock(stream_key):
+            with stream_creation_lock:
+                if stream_key in streams:
+                    return None
+                resource_governor.admit_stream(sum(1 for existing in streams.values() if not existing.finalized))
+            stream = StreamState.restore(stream_key, stream_dir)
+            stream.add_event("Stream recovered at startup")
+            with stream_creation_lock:
+                streams[stream_key] = stream
+            # A session whose client does not come back is finalized after the usual timeout
+            stream.watch_missing_segments()
+    except AdmissionError as e:
+        log(f"Not recovering stream {stream_dir}: {e}", level="warning")
+        return None
+    except Exception as e:
+        log(f"Error recovering stream {stream_dir}: {e}", level="error")
+        return None
+    if RECOVERY_PRELAUNCH_RELAYS:
+        prelaunch_relays(stream)
+    return stream
+
+
+def prelaunch_relays(stream):
+    """Start the relays a recovered stream was running, so its next upload does not wait for them"""
+    relay_targets = parse_targets(FORCE_TARGET, stream.stream_key) if FORCE_TARGET else list(stream.restored_relay_targets.items())
+    if not relay_targets:
+        return
+    with stream.playlist_lock:
+        if stream.written_segment_count < SEGMENTS_BEFORE_RELAY:
+            return
+        error = update_relays(stream, relay_targets, FORCE_TARGET, False)
+    if error is not None:
+        log(f"Pre-launching relays for stream {stream.stream_id} failed: {error[0]}", level="warning")
+        stream.add_event(f"Relay pre-launch failed: {error[0]}")
+    else:
+        stream.add_event(f"Relays pre-launched: {', '.join(target for target, _ in relay_targets)}")
+
+
+def recover_streams(now=None):
+    """Find and restore, in parallel, the newest unfinalized stream of each key under BASE_SEGMENTS_DIR"""
+    started = time.monotonic()
+    now = time.time() if now is None else now
+    try:
+        stream_dirs = [os.path.join(BASE_SEGMENTS_DIR, name) for name in os.listdir(BASE_SEGMENTS_DIR)]
+    except FileNotFoundError:
+        return []
+    with ThreadPoolExecutor(max_workers=RECOVERY_WORKERS) as pool:
+        newest = {}  # stream key -> (playlist mtime, directory)
+        for stream_dir, candidate in zip(stream_dirs, pool.map(lambda path: recovery_candidate(path, now), stream_dirs)):
+            if candidate is not None:
+                stream_key, modified = candidate
+                if stream_key not in newest or modified > newest[stream_key][0]:
+                    newest[stream_key] = (modified, stream_dir)
+        recovered = [
+            stream for stream in pool.map(lambda item: recover_stream(item[0], item[1][1]), newest.items())
+            if stream is not None
+        ]
+    log(f"Recovered {len(recovered)} unfinalized streams in {time.monotonic() - started:.2f}s")
+    return recovered
+
+
+# Response headers carrying StreamState.backpressure_hints(), with the number format of each
+BACKPRESSURE_HEADERS = {
+    "pending_segments": ("Relay-Pending-Segments", "{:d}"),
+    "relay_lag": ("Relay-Lag", "{:.1f}"),
+    "upstream_bps": ("Relay-Upstream-Bps", "{:.0f}"),
+    "ingest_bps": ("Relay-Ingest-Bps", "{:.0f}"),
+    "max_bitrate_bps": ("Relay-Max-Bitrate", "{:.0f}"),
+}
+
+
+def with_backpressure_hints(response, stream):
+    """Add the stream's backpressure hints to a (body, status) view result; unknown values are left out"""
+    if stream is None:
+        return response
+    body, status = response[:2]
+    headers = dict(response[2]) if len(response) > 2 else {}
+    for key, value in stream.backpressure_hints().items():
+        if value is not None:
+            header, value_format = BACKPRESSURE_HEADERS[key]
+            headers[header] = value_format.format(value)
+    return body, status, headers
+
+
+def parse_stream_headers():
+    """Read the stream-level upload headers; returns (fields, None) or (None, (message, status))"""
+    stream_key = request.headers.get("Stream-Key")
+    stream_id = request.headers.get("Stream-ID")
+    if not is_valid_stream_key(stream_key):
+        return None, ("Invalid Stream-Key", 400)
+    if stream_id is not None and not is_valid_stream_id(stream_id):
+        return None, ("Invalid Stream-ID", 400)
+    # Apply forced target override if configured
+    effective_target = FORCE_TARGET if FORCE_TARGET else request.headers.get("Target")
+    relay_targets = parse_targets(effective_target, stream_key)
+    if relay_targets is None:
+        return None, ("Invalid Target", 400)
+    catchup = request.headers.get("Catch-Up")
+    if catchup is not None:
+        catchup = catchup.strip().lower()
+        if catchup not in CATCHUP_MODES:
+            return None, ("Invalid Catch-Up", 400)
+    return {
+        "stream_key": stream_key,
+        "stream_id": stream_id,
+        "effective_target": effective_target,
+        "relay_targets": relay_targets,
+        "catchup": catchup,
+    }, None
+
+
+def admits_upload(f):
+    """Count the request body against MAX_INFLIGHT_UPLOAD_BYTES while the upload is handled"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        size = request.content_length or 0
+        resource_governor.begin_upload(size)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            resource_governor.end_upload(size)
+    return decorated
+
+
+def measured_upload(endpoint):
+    """Record the duration, body size and status of an upload request in /metrics"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = app.make_response(f(*args, **kwargs))
+                status = response.status_code
+                return response
+            except AdmissionError:
+                status = 503
+                raise
+            finally:
+                metrics.upload_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+                metrics.upload_bytes.observe(request.content_length or 0, endpoint=endpoint)
+                metrics.upload_requests.inc(endpoint=endpoint, status=f"{status // 100}xx")
+        return decorated
+    return decorator
+
+
+# Headers that apply to one connection only, or that are set again for the forwarded body
+FORWARD_SKIPPED_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", WORKER_TOKEN_HEADER.lower()}
+# Endpoints whose requests are passed on to the worker owning the stream key. Segments are never
+# passed on, as their loopback-only check would see the forwarding worker's address.
+FORWARDED_ENDPOINTS = {
+    "upload_segment", "upload_segments", "resumable_upload_offset", "resumable_upload_chunk",
+    "stream_status", "stream_status_html",
+}
+
+
+def is_from_worker():
+    """Whether the current request was passed on by another worker of this supervisor"""
+    token = os.environ.get(WORKER_TOKEN_ENV)
+    return bool(token) and hmac.compare_digest(request.headers.get(WORKER_TOKEN_HEADER, ""), token)
+
+
+def forward_to_worker(index):
+    """Pass the current request on to worker index over loopback and return its response"""
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in FORWARD_SKIPPED_HEADERS}
+    headers[WORKER_TOKEN_HEADER] = os.environ.get(WORKER_TOKEN_ENV, "")
+    path = request.full_path if request.query_string else request.path
+    try:
+        status, response_headers, data = worker_pool.exchange(
+            request.method, f"http://127.0.0.1:{worker_port(index)}{path}",
+            body=request.get_data(), headers=headers, timeout=WORKER_FORWARD_TIMEOUT,
+        )
+    except (OSError, http.client.HTTPException) as e:
+        log(f"Passing {request.method} {request.path} on to worker {index} failed: {e}", level="error")
+        return f"Worker {index} unavailable: {e}", 503, {"Retry-After": str(WORKER_RESTART_COOLDOWN)}
+    return Response(data, status=status, headers=[
+        (name, value) for name, value in response_headers if name.lower() not in FORWARD_SKIPPED_HEADERS
+    ])
+
+
+@app.before_request
+def route_to_stream_worker():
+    """In a worker process, hand uploads and status queries for another worker's stream key to that worker"""
+    if current_worker is None or request.endpoint not in FORWARDED_ENDPOINTS:
+        return None
+    if on_worker_port():
+        return None if is_from_worker() else ("Access denied", 403)
+    stream_key = request.headers.get("Stream-Key") or (request.view_args or {}).get("stream_key")
+    if not is_valid_stream_key(stream_key):
+        return None
+    owner = stream_worker(stream_key)
+    if owner == current_worker.index:
+        return None
+    return forward_to_worker(owner)
+
+
+@app.errorhandler(AdmissionError)
+def admission_refused(error):
+    return f"Server busy: {error}", 503, {"Retry-After": str(ADMISSION_RETRY_AFTER)}
+
+
 @app.route("/upload_segment", methods=["POST"])
+@measured_upload("segment")
 @requires_auth
+@admits_upload
 def upload_segment():
     request_start = time.perf_counter()
     required_headers = ["Target", "Stream-Key", "Segment-Type", "Discontinuity", "Duration", "Sequence"]
     missing_headers = [header for header in required_headers if request.headers.get(header) is None]
     if missing_headers:
-        print(f"Missing headers: {', '.join(missing_headers)}", flush=True)
+        log(f"Missing headers: {', '.join(missing_headers)}", level="warning")
         return f"Missing headers: {', '.join(missing_headers)}", 400
 
-    try:
-        header_target = request.headers.get("Target").lower()
-        header_stream_key = request.headers.get("Stream-Key")
-        header_stream_id = request.headers.get("Stream-ID")
-        header_segment_type = request.headers.get("Segment-Type")
-        header_discontinuity = request.headers.get("Discontinuity").lower() == "true"
-        header_duration = float(request.headers.get("Duration"))
-        header_sequence = int(request.headers.get("Sequence"))
-    except ValueError as e:
-        return f"Invalid header data: {e}", 400
+    segment, error = parse_segment_headers(request.headers)
+    if error:
+        return error
+    fields, error = parse_stream_headers()
+    if error:
+        return error
 
-    if not is_valid_stream_key(header_stream_key):
-        return "Invalid Stream-Key", 400
-    if header_stream_id is not None and not is_valid_stream_id(header_stream_id):
-        return "Invalid Stream-ID", 400
+    data = request.data
+    digest = content_digest()
+    digest.update(data)
+    segment["size"] = len(data)
+    segment["digest"] = digest.hexdigest()
 
-    is_init = header_segment_type == "Initialization"
-    is_final = header_segment_type == "Finalization"
+    def write_segment(segment_path):
+        with open(segment_path, "wb") as f:
+            f.write(data)
 
-    if is_init:
-        print(
-            f"Initialization segment received: stream_key={header_stream_key} sequence={header_sequence}",
-            flush=True,
-        )
-    elif is_final:
-        print(
-            f"Finalization segment received: stream_key={header_stream_key} sequence={header_sequence}",
-            flush=True,
-        )
+    return ingest_segment(segment, fields, write_segment, request_start)
 
-    if header_duration <= 0 and not (is_init or is_final):
-        return "Non-positive duration segment ignored.", 200
 
-    old_stream = None
-    with stream_creation_lock:
-        stream = streams.get(header_stream_key)
-        need_new_stream = False
-        if stream is None or stream.finalized:
-            need_new_stream = True
-        elif header_stream_id and stream.timestamp != header_stream_id:
-            need_new_stream = True
-        if need_new_stream:
-            old_stream = stream
-            
-            restored = False
-            if header_stream_id:
-                stream_dir = find_stream_dir(header_stream_key, header_stream_id)
-                if stream_dir:
-                    candidate_stream = StreamState.restore(header_stream_key, stream_dir)
-                    if header_sequence > candidate_stream.last_playlist_sequence:
-                        stream = candidate_stream
-                        restored = True
-            
-            if not restored:
-                stream = StreamState(header_stream_key, stream_id=header_stream_id)
-            
-            streams[header_stream_key] = stream
-        else:
-            streams[header_stream_key] = stream
+def ingest_segment(segment, fields, write_segment, request_start):
+    """Add one uploaded segment to its stream and update the relays; returns the response"""
+    header_stream_key = fields["stream_key"]
+    header_sequence = segment["sequence"]
+    if segment["is_init"]:
+        log(f"Initialization segment received: stream_key={header_stream_key} sequence={header_sequence}")
+    elif segment["is_final"]:
+        log(f"Finalization segment received: stream_key={header_stream_key} sequence={header_sequence}")
 
-    if old_stream is not None:
-        old_stream.check_missing_segments_stop_event.set()
-        if not old_stream.finalized:
-            old_stream.finalize_playlist(stop_ffmpeg_immediately=True)
+    if segment["duration"] <= 0 and not (segment["is_init"] or segment["is_final"]):
+        return with_backpressure_hints(("Non-positive duration segment ignored.", 200), current_stream(header_stream_key))
 
-    stream.last_upload_time = time.time()
-    # Start missing segments check thread
-    if not stream.check_missing_segments_started:
-        stream.check_missing_segments_stop_event.clear()
-        threading.Thread(target=stream.check_missing_segments, daemon=True).start()
-        stream.check_missing_segments_started = True
+    stream = open_upload_stream(header_stream_key, fields["stream_id"], header_sequence, fields["catchup"])
 
     with stream.playlist_lock:
-        segment_period_index = stream.period_index
-        if is_init and stream.map_written:
-            segment_period_index += 1
+        # Segments of a named rendition go to its own playlist; relays are managed by the main stream
+        media = stream if segment["rendition"] is None else stream.get_rendition(segment["rendition"])
+        response = store_segment(media, segment, write_segment)
+        if response is None:
+            media.update_playlist()
+            response = update_relays(stream, fields["relay_targets"], fields["effective_target"], media is stream)
+        if response is None:
+            stream.record_upload_duration(time.perf_counter() - request_start)
+            response = ("Segment uploaded", 200)
+
+    return with_backpressure_hints(response, stream)
+
+
+def read_batch_part_headers(body):
+    """Read the headers of the next part of a batch upload body.
+
+    Each part is a block of header lines (the per-segment headers of /upload_segment plus
+    Content-Length), an empty line, and Content-Length bytes of segment data, read with
+    read_batch_part_data. Returns the headers, None at the end of the body, or raises ValueError.
+    """
+    headers = Headers()
+    while True:
+        line = body.readline(8192)
+        if not line:
+            if headers:
+                raise ValueError("Batch part ends inside its headers")
+            return None
+        line = line.rstrip(b"\r\n")
+        if not line:
+            if headers:
+                break
+            # Blank lines between parts are allowed
+            continue
+        name, separator, value = line.decode("latin-1").partition(":")
+        if not separator:
+            raise ValueError(f"Malformed batch part header: {name[:64]}")
+        headers.add(name.strip(), value.strip())
+    return headers
+
+
+def read_batch_part_data(body, headers):
+    """Read the data of a batch part into a temporary file; returns (path, size, content digest)"""
+    try:
+        remaining = int(headers.get("Content-Length", ""))
+    except ValueError:
+        raise ValueError("Batch part without a valid Content-Length")
+    if remaining < 0:
+        raise ValueError("Batch part without a valid Content-Length")
+    size = remaining
+    digest = content_digest()
+    fd, temp_path = tempfile.mkstemp(prefix=".batch_", suffix=".part", dir=BASE_SEGMENTS_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while remaining:
+                chunk = body.read(min(remaining, 65536))
+                if not chunk:
+                    raise ValueError("Batch body ends inside a segment")
+                f.write(chunk)
+                digest.update(chunk)
+                remaining -= len(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, size, digest.hexdigest()
+
+
+@app.route("/upload_segments", methods=["POST"])
+@measured_upload("batch")
+@requires_auth
+@admits_upload
+def upload_segments():
+    """Upload many segments of one stream at once, e.g. a backlog queued during a network outage"""
+    request_start = time.perf_counter()
+    missing_headers = [header for header in ("Target", "Stream-Key") if request.headers.get(header) is None]
+    if missing_headers:
+        log(f"Missing headers: {', '.join(missing_headers)}", level="warning")
+        return f"Missing headers: {', '.join(missing_headers)}", 400
+    fields, error = parse_stream_headers()
+    if error:
+        return error
+
+    # Stream every part to disk before touching the stream, so the playlist lock is held
+    # only while the segments are moved into place
+    parts = []  # (segment, temporary file path)
+    try:
+        while True:
+            try:
+                headers = read_batch_part_headers(request.stream)
+            except ValueError as e:
+                return f"Invalid batch body: {e}", 400
+            if headers is None:
+                break
+            # Checked before the part's data is written to disk
+            if len(parts) >= BATCH_MAX_SEGMENTS:
+                return f"Batch exceeds {BATCH_MAX_SEGMENTS} segments", 413
+            missing_headers = [header for header in ("Segment-Type", "Discontinuity", "Duration", "Sequence") if headers.get(header) is None]
+            if missing_headers:
+                return f"Missing headers in batch part {len(parts) + 1}: {', '.join(missing_headers)}", 400
+            segment, error = parse_segment_headers(headers, request.headers.get("Rendition"))
+            if error:
+                return error
+            try:
+                temp_path, segment["size"], segment["digest"] = read_batch_part_data(request.stream, headers)
+            except ValueError as e:
+                return f"Invalid batch body: {e}", 400
+            parts.append((segment, temp_path))
+        if not parts:
+            return "Empty batch", 400
+
+        first_sequence = min(segment["sequence"] for segment, _ in parts)
+        log(f"Batch of {len(parts)} segments received: stream_key={fields['stream_key']} first_sequence={first_sequence}")
+        stream = open_upload_stream(fields["stream_key"], fields["stream_id"], first_sequence, fields["catchup"])
+
+        stored = 0
+        # (index of the part, error or AdmissionError) of the part the batch stopped at
+        failure = None
+        with stream.playlist_lock:
+            touched = []
+            for index, (segment, temp_path) in enumerate(parts):
+                if segment["duration"] <= 0 and not (segment["is_init"] or segment["is_final"]):
+                    continue
+                media = stream if segment["rendition"] is None else stream.get_rendition(segment["rendition"])
+                if segment["is_init"] and media.map_written:
+                    # A new period resets the playlist position; flush the segments queued before it
+                    media.update_playlist()
+                try:
+                    error = store_segment(media, segment, lambda segment_path: shutil.move(temp_path, segment_path))
+                except AdmissionError as e:
+                    error = e
+                if error:
+                    failure = (index, error)
+                    break
+                stored += 1
+                if media not in touched:
+                    touched.append(media)
+
+            # One playlist update per rendition for the whole batch, including the parts stored
+            # before a failed one
+            for media in touched:
+                media.update_playlist()
+
+            if failure is not None and not touched:
+                index, error = failure
+                if isinstance(error, AdmissionError):
+                    raise error
+                return with_backpressure_hints(error, stream)
+
+            relay_error = update_relays(stream, fields["relay_targets"], fields["effective_target"], stream in touched)
+            if relay_error and not touched:
+                return with_backpressure_hints(relay_error, stream)
+
+            stream.record_upload_duration(time.perf_counter() - request_start)
+    finally:
+        for _, temp_path in parts:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    if failure is None and relay_error is None:
+        return with_backpressure_hints((f"{stored} segments uploaded", 200), stream)
+    # The parts before Parts-Consumed are applied (or skipped for their duration), so the client
+    # resends the batch from there; with only a relay error every part was applied
+    consumed = len(parts) if failure is None else failure[0]
+    problems = []
+    headers = {"Parts-Consumed": str(consumed)}
+    if failure is not None:
+        index, error = failure
+        message, status = (f"Server busy: {error}", 503) if isinstance(error, AdmissionError) else error
+        log(f"Batch for stream_key={fields['stream_key']} stopped at part {index + 1} of {len(parts)}: {message}", level="warning", stream=stream.stream_id)
+        problems.append(f"part {index + 1} failed with {status}: {message}")
+        headers["Failed-Status"] = str(status)
+    if relay_error is not None:
+        message, status = relay_error
+        problems.append(f"relays failed with {status}: {message}")
+        headers["Relay-Status"] = str(status)
+    return with_backpressure_hints((
+        f"{stored} segments uploaded from the first {consumed} parts; {'; '.join(problems)}",
+        207,
+        headers,
+    ), stream)
+
+
+def resumable_upload_path(stream_key, sequence, upload_id):
+    return os.path.join(BASE_SEGMENTS_DIR, RESUMABLE_UPLOADS_DIR, stream_key, f"{sequence}_{upload_id}.part")
+
+
+@contextlib.contextmanager
+def _resumable_upload_lock(path):
+    """Hold the lock of one partial upload; its entry is dropped once no request holds or waits on it"""
+    with resumable_upload_locks_guard:
+        entry = resumable_upload_locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with resumable_upload_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del resumable_upload_locks[path]
+
+
+def expire_resumable_uploads(directory, now=None):
+    """Delete partial uploads in directory that have not received data for RESUMABLE_UPLOAD_TTL seconds"""
+    now = time.time() if now is None else now
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) <= RESUMABLE_UPLOAD_TTL:
+                continue
+            os.remove(path)
+        except OSError:
+            continue
+        log(f"Expired partial upload: {path}")
+
+
+def sweep_resumable_uploads(now=None):
+    """Expire the partial uploads of every stream key, also those of clients that never came back"""
+    now = time.time() if now is None else now
+    uploads_dir = os.path.join(BASE_SEGMENTS_DIR, RESUMABLE_UPLOADS_DIR)
+    try:
+        names = os.listdir(uploads_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        directory = os.path.join(uploads_dir, name)
+        try:
+            # Before expiring, which changes the directory's mtime
+            idle = now - os.path.getmtime(directory) > RESUMABLE_UPLOAD_TTL
+        except OSError:
+            continue
+        expire_resumable_uploads(directory, now)
+        if idle:
+            try:
+                # Fails while the directory still holds an upload
+                os.rmdir(directory)
+            except OSError:
+                pass
 
-        segment_name = f"p{segment_period_index}_segment_{header_sequence:06d}.{'mp4' if is_init else 'm4s'}"
-        segment_path = os.path.join(stream.stream_dir, segment_name)
 
+def _sweep_resumable_uploads_forever():
+    while True:
+        time.sleep(RESUMABLE_UPLOAD_SWEEP_INTERVAL)
         try:
-            with open(segment_path, "wb") as f:
-                f.write(request.data)
+            sweep_resumable_uploads()
         except Exception as e:
-            return f"Error saving segment: {e}", 500
+            log(f"Error expiring partial uploads: {e}", level="error")
 
-        print(f"Saved segment: {segment_name} for stream: {stream.stream_id}", flush=True)
 
-        if is_init:
-            if not stream.map_written:
-                # First init: start playlist fresh
-                stream.initialize_playlist(header_sequence, segment_name)
-                print(
-                    f"Initialization segment processed: stream={stream.stream_id} sequence={header_sequence} action=playlist_initialized",
-                    flush=True,
-                )
-            else:
-                # Subsequent init: append new period without truncating playlist
-                stream.period_index = segment_period_index
-                with open(stream.playlist_file, "a") as f:
-                    f.write("#EXT-X-DISCONTINUITY\n")
-                    f.write(f"#EXT-X-MAP:URI=\"{segment_name}\"\n")
-                stream.last_playlist_sequence = header_sequence - 1
-                stream._gap_wait_seq = None
-                stream._gap_wait_start = None
-                stream.add_event(f"New init segment (period {stream.period_index}) sequence {header_sequence}")
-                print(
-                    f"Initialization segment processed: stream={stream.stream_id} sequence={header_sequence} action=period_map_updated period={stream.period_index}",
-                    flush=True,
-                )
-        # Drop stale media segments from queue (but keep file on disk)
-        if (not is_init) and header_sequence <= stream.last_playlist_sequence:
-            print(f"Stale segment ignored for playlist: seq={header_sequence} (last={stream.last_playlist_sequence}) stream={stream.stream_id}", flush=True)
-            stream.add_event(f"Stale segment ignored: seq={header_sequence}")
-        else:
-            stream.arrived_segments[header_sequence] = {
-                "filename": segment_name,
-                "duration": header_duration,
-                "is_init": is_init,
-                "discontinuity": header_discontinuity
-            }
-        if is_final:
-            stream.arrived_segments['final'] = True # Use a simple flag for finalization
-            print(
-                f"Finalization segment processed: stream={stream.stream_id} sequence={header_sequence} action=finalize_requested",
-                flush=True,
-            )
+def _resumable_upload_target(upload_id):
+    """Partial file for an upload ID and the Stream-Key and Sequence headers; returns (path, None) or (None, error)"""
+    if not is_valid_stream_id(upload_id):
+        return None, ("Invalid upload ID", 400)
+    stream_key = request.headers.get("Stream-Key")
+    if not is_valid_stream_key(stream_key):
+        return None, ("Invalid Stream-Key", 400)
+    try:
+        sequence = int(request.headers.get("Sequence", ""))
+    except ValueError:
+        return None, ("Invalid Sequence", 400)
+    return resumable_upload_path(stream_key, sequence, upload_id), None
 
-        stream.update_playlist()
 
-        # Apply forced target override if configured
-        effective_target = FORCE_TARGET if FORCE_TARGET else header_target
-        if FORCE_TARGET and not hasattr(stream, "_force_target_logged"):
-            stream.add_event(f"Force target override active: {FORCE_TARGET}")
-            setattr(stream, "_force_target_logged", True)
+@app.route("/upload_segment/<upload_id>", methods=["HEAD"])
+@requires_auth
+def resumable_upload_offset(upload_id):
+    """Report in Upload-Offset how many bytes of a resumable upload are stored"""
+    path, error = _resumable_upload_target(upload_id)
+    if error:
+        return error
+    try:
+        offset = os.path.getsize(path)
+    except FileNotFoundError:
+        return "Upload not found", 404
+    return "", 200, {"Upload-Offset": str(offset)}
 
-        if (not stream.finalized) and effective_target not in PASSIVE_TARGETS:
-            if stream.written_segment_count >= SEGMENTS_BEFORE_RELAY:
-                try:
-                    if stream.written_segment_count == SEGMENTS_BEFORE_RELAY:
-                        print(f"Starting ffmpeg for stream {stream.stream_id} with {SEGMENTS_BEFORE_RELAY} buffered segments (target={effective_target})", flush=True)
-                        stream.start_ffmpeg_relay(effective_target, header_stream_key, live_start_index=0)
-                    elif getattr(stream, 'just_restored', False):
-                        # Resume from the segment that triggered the restore (the current one)
-                        # live_start_index is 0-based index of the segment in the playlist.
-                        # written_segment_count includes the current segment.
-                        # So index = count - 1.
-                        start_index = max(0, stream.written_segment_count - 1)
-                        print(f"Resuming ffmpeg for stream {stream.stream_id} at index {start_index} (target={effective_target})", flush=True)
-                        stream.start_ffmpeg_relay(effective_target, header_stream_key, live_start_index=start_index)
-                        stream.just_restored = False
-                    elif stream.ffmpeg_process is None or stream.ffmpeg_process.poll() is not None:
-                        now = time.time()
-                        if stream.ffmpeg_process and stream.ffmpeg_process.poll() is not None:
-                            exit_code = stream.ffmpeg_process.returncode
-                            stream.add_event(f"ffmpeg exited with code {exit_code}")
-                            stream.last_ffmpeg_exit = {"code": exit_code, "signal": None}
-                            stream.ffmpeg_process = None
-                            stream._stop_ffmpeg_logger()
-                            stream.ffmpeg_restart_not_before = now + FFMPEG_RESTART_COOLDOWN
-                        if now < stream.ffmpeg_restart_not_before:
-                            if not stream.ffmpeg_restart_suppressed:
-                                wait_seconds = max(0.0, stream.ffmpeg_restart_not_before - now)
-                                stream.add_event(f"ffmpeg restart suppressed for {wait_seconds:.1f}s after failure")
-                                stream.ffmpeg_restart_suppressed = True
-                        else:
-                            print(f"Restarting ffmpeg for stream {stream.stream_id} at live edge (target={effective_target})", flush=True)
-                            stream.start_ffmpeg_relay(effective_target, header_stream_key, live_start_index=None)
-                except RuntimeError as e:
-                    stream.ffmpeg_restart_not_before = time.time() + FFMPEG_RESTART_COOLDOWN
-                    stream.ffmpeg_restart_suppressed = False
-                    return f"Error starting ffmpeg relay: {e}", 500
-        else:
-            if stream.written_segment_count == SEGMENTS_BEFORE_RELAY:
-                stream.add_event(f"Passive mode: playlist building only (no relay). Target={effective_target}")
 
-        stream.record_upload_duration(time.perf_counter() - request_start)
+@app.route("/upload_segment/<upload_id>", methods=["PUT"])
+@measured_upload("resumable")
+@requires_auth
+@admits_upload
+def resumable_upload_chunk(upload_id):
+    """Append one Content-Range chunk to a resumable upload; the segment is added once all bytes arrived"""
+    request_start = time.perf_counter()
+    required_headers = ["Target", "Stream-Key", "Segment-Type", "Discontinuity", "Duration", "Sequence", "Content-Range"]
+    missing_headers = [header for header in required_headers if request.headers.get(header) is None]
+    if missing_headers:
+        log(f"Missing headers: {', '.join(missing_headers)}", level="warning")
+        return f"Missing headers: {', '.join(missing_headers)}", 400
+
+    match = CONTENT_RANGE_RE.fullmatch(request.headers.get("Content-Range").strip())
+    if not match:
+        return "Invalid Content-Range", 400
+    start, end, total = (int(value) for value in match.groups())
+    if end < start or end >= total:
+        return "Invalid Content-Range", 400
+    if total > RESUMABLE_UPLOAD_MAX_BYTES:
+        return f"Segment exceeds {RESUMABLE_UPLOAD_MAX_BYTES} bytes", 413
+    segment, error = parse_segment_headers(request.headers)
+    if error:
+        return error
+    fields, error = parse_stream_headers()
+    if error:
+        return error
+    path, error = _resumable_upload_target(upload_id)
+    if error:
+        return error
+
+    with _resumable_upload_lock(path):
+        try:
+            offset = os.path.getsize(path)
+        except FileNotFoundError:
+            offset = 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            expire_resumable_uploads(os.path.dirname(path))
+        # A complete file means the segment was refused earlier (e.g. with 503); the retried chunk adds it
+        if start != offset and offset != total:
+            response = ("Content-Range does not start at the stored offset", 409, {"Upload-Offset": str(offset)})
+            return with_backpressure_hints(response, current_stream(fields["stream_key"]))
+
+        # Keep whatever part of the chunk arrives, so a dropped connection only costs the unsent rest
+        remaining = 0 if offset == total else end - start + 1
+        try:
+            with open(path, "ab") as f:
+                while remaining:
+                    chunk = request.stream.read(min(remaining, 65536))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    offset += len(chunk)
+                    remaining -= len(chunk)
+                f.flush()
+                fsync_started = time.monotonic()
+                os.fsync(f.fileno())
+                disk_health.record("fsync", time.monotonic() - fsync_started)
+        except OSError as e:
+            return f"Error saving upload chunk: {e}", 500
+        if offset < total:
+            headers = {"Upload-Offset": str(offset)}
+            if offset:
+                headers["Range"] = f"bytes=0-{offset - 1}"
+            response = ("Upload incomplete", 308, headers)
+            return with_backpressure_hints(response, current_stream(fields["stream_key"]))
 
-    return "Segment uploaded", 200
+        log(f"Resumable upload complete: stream_key={fields['stream_key']} sequence={segment['sequence']} bytes={total}")
+        # The chunks arrived in separate requests, so the digest is taken from the assembled file
+        segment["size"] = total
+        try:
+            segment["digest"] = file_digest(path)
+        except OSError as e:
+            return f"Error reading upload: {e}", 500
+        response = ingest_segment(segment, fields, lambda segment_path: shutil.move(path, segment_path), request_start)
+        if os.path.exists(path):
+            os.remove(path)
+    return response
 
 @app.route("/segments/<stream_id>/playlist.m3u8")
 def serve_playlist(stream_id):
@@ -726,20 +5233,63 @@ def serve_segment(stream_id, segment_name):
     if not is_valid:
         return error_msg, status_code
 
-    segment_path = os.path.join(BASE_SEGMENTS_DIR, stream_id, segment_name)
+    try:
+        segment_file = open_segment(os.path.join(BASE_SEGMENTS_DIR, stream_id), segment_name)
+    except (FileNotFoundError, IsADirectoryError):
+        return "Segment not found", 404
+
+    stream = find_active_stream(stream_id)
+    if stream is not None:
+        user_agent = request.headers.get("User-Agent", "")
+        target = user_agent[len(RELAY_USER_AGENT_PREFIX):] if user_agent.startswith(RELAY_USER_AGENT_PREFIX) else None
+        stream.note_relay_fetch(segment_name, target)
+
+    return _stream_file(segment_file, segment_name)
+
+
+@app.route("/segments/<stream_id>/<rendition>/<file_name>")
+def serve_rendition_file(stream_id, rendition, file_name):
+    """Playlist and segments of a named rendition, stored in a subdirectory of the stream"""
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return "Access denied", 403
 
-    if not os.path.exists(segment_path):
+    for component, component_name in ((stream_id, "stream ID"), (rendition, "rendition"), (file_name, "segment name")):
+        is_valid, error_msg, status_code = validate_path_component(component, component_name)
+        if not is_valid:
+            return error_msg, status_code
+
+    rendition_dir = os.path.join(BASE_SEGMENTS_DIR, stream_id, rendition)
+    try:
+        # Playlists are never in the hot tier
+        file = open(os.path.join(rendition_dir, file_name), "rb") if file_name == "playlist.m3u8" else open_segment(rendition_dir, file_name)
+    except (FileNotFoundError, IsADirectoryError):
         return "Segment not found", 404
 
-    def generate_segment():
-        with open(segment_path, "rb") as f:
+    if file_name != "playlist.m3u8":
+        stream = find_active_stream(stream_id)
+        if stream is not None:
+            user_agent = request.headers.get("User-Agent", "")
+            target = user_agent[len(RELAY_USER_AGENT_PREFIX):] if user_agent.startswith(RELAY_USER_AGENT_PREFIX) else None
+            stream.note_relay_fetch(file_name, target, rendition)
+
+    return _stream_file(file, file_name)
+
+
+def _stream_file(file, file_name):
+    """Response streaming an open file, which it closes"""
+    def generate_file():
+        with file as f:
             while True:
                 chunk = f.read(8192)
                 if not chunk:
                     break
                 yield chunk
 
-    return Response(generate_segment(), mimetype="video/mp4")
+    mimetype = "application/vnd.apple.mpegurl" if file_name.endswith(".m3u8") else "video/mp4"
+    response = Response(generate_file(), mimetype=mimetype)
+    # Also when the body is never read, as for HEAD requests
+    response.call_on_close(file.close)
+    return response
 
 
 def get_stream_status_data(stream_key):
@@ -791,10 +5341,29 @@ def get_stream_status_data(stream_key):
             "last_ffmpeg_exit": stream.last_ffmpeg_exit
         }
 
+    relays = list(stream.relays.values())
     info.update({
         "last_upload_age": max(0.0, now - stream.last_upload_time),
         "last_playlist_update_age": max(0.0, now - stream.last_add_time),
-        "ffmpeg_running": stream.ffmpeg_process is not None and stream.ffmpeg_process.poll() is None,
+        "ffmpeg_running": stream.is_ffmpeg_running(),
+        "relay_lag": stream.relay_lag(),
+        "catchup_mode": stream.catchup_mode,
+        "catchup_active": any(relay.catchup_active for relay in relays),
+        "relays": [relay.status(now) for relay in relays],
+        "relay_rendition": stream.relay_source.rendition_label(),
+        "renditions": [
+            {
+                "name": source.rendition_label(),
+                "written_media_segments": source.written_segment_count,
+                "last_playlist_sequence": source.last_playlist_sequence,
+                "bitrate_bps": None if source.bitrate() is None else int(source.bitrate()),
+                "finalized": source.finalized,
+            }
+            for source in [stream] + list(stream.renditions.values())
+        ],
+        "upstream_bps": upstream_monitor.throughput_bps(),
+        "backpressure": stream.backpressure_hints(now),
+        "dedup": dict(stream.dedup_stats),
         "segments_dir": stream.stream_dir,
     })
 
@@ -807,6 +5376,136 @@ def stream_status(stream_key):
     return jsonify(get_stream_status_data(stream_key))
 
 
+@app.route("/admin/status")
+@requires_auth
+def admin_status():
+    """Usage of the global resource limits, and each stream's share of it"""
+    usage = local_admin_status()
+    if current_worker is not None and not on_worker_port():
+        usage = merge_worker_status(worker_admin_statuses(usage))
+    return jsonify(usage)
+
+
+@app.route("/metrics")
+@requires_auth
+def metrics_endpoint():
+    """Counters, gauges and histograms in the Prometheus text format"""
+    text = metrics.render()
+    if current_worker is not None and not on_worker_port():
+        text = merge_worker_metrics(worker_metrics(text))
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+def worker_metrics(local):
+    """/metrics text of every worker process, given this one's; a worker that cannot be asked is left out"""
+    texts = []
+    for index in range(WORKER_PROCESSES):
+        if index == current_worker.index:
+            texts.append((index, local))
+            continue
+        try:
+            code, data = worker_pool.request(
+                "GET", f"http://127.0.0.1:{worker_port(index)}/metrics",
+                headers={"Authorization": request.headers.get("Authorization", "")}, timeout=WORKER_FORWARD_TIMEOUT,
+            )
+        except (OSError, http.client.HTTPException) as e:
+            log(f"Collecting metrics of worker {index} failed: {e}", level="warning")
+            continue
+        if code == 200:
+            texts.append((index, data.decode()))
+    return texts
+
+
+METRIC_SAMPLE_RE = re.compile(r'^([A-Za-z_:][\w:]*)(?:\{(.*)\})? (\S+)$')
+
+
+def merge_worker_metrics(texts):
+    """One exposition of the workers' /metrics, each sample labelled with its worker"""
+    families = {}  # name -> (kind, help, samples), in the order first seen
+    for index, text in texts:
+        name = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name, _, help_text = line[len("# HELP "):].partition(" ")
+                families.setdefault(name, ["untyped", help_text, []])
+            elif line.startswith("# TYPE "):
+                name, _, kind = line[len("# TYPE "):].partition(" ")
+                families.setdefault(name, [kind, "", []])[0] = kind
+            elif name is not None:
+                match = METRIC_SAMPLE_RE.match(line)
+                if match:
+                    sample_name, labels, value = match.groups()
+                    labels = f'worker="{index}"' + (f",{labels}" if labels else "")
+                    families[name][2].append(f"{sample_name}{{{labels}}} {value}")
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + samples
+    return "\n".join(lines) + "\n"
+
+
+def local_admin_status():
+    usage = resource_governor.usage()
+    with stream_creation_lock:
+        stream_list = list(streams.values())
+    usage["lock_waits"] = {
+        "streams": lock_wait_stats([stream_creation_lock]),
+        "stream_keys": lock_wait_stats(stream_key_locks),
+    }
+    usage["streams"] = [
+        {
+            "stream_key": stream.stream_key,
+            "stream_id": stream.stream_id,
+            "active": not stream.finalized,
+            "pending_reorder_bytes": stream.pending_bytes(),
+            "relays_running": sum(1 for relay in list(stream.relays.values()) if relay.is_running()),
+            "ingest_bps": stream.ingest_bps(),
+        }
+        for stream in stream_list
+    ]
+    if HOT_TIER_DIR is not None:
+        usage["hot_tier"] = hot_tier.status()
+    if retention_manager.enabled():
+        usage["retention"] = retention_manager.status()
+    usage["disk"] = disk_health.status()
+    return usage
+
+
+def worker_admin_statuses(local):
+    """/admin/status of every worker process, given this one's; a worker that cannot be asked reports an error"""
+    statuses = []
+    for index in range(WORKER_PROCESSES):
+        if index == current_worker.index:
+            status = local
+        else:
+            try:
+                code, data = worker_pool.request(
+                    "GET", f"http://127.0.0.1:{worker_port(index)}/admin/status",
+                    headers={"Authorization": request.headers.get("Authorization", "")}, timeout=WORKER_FORWARD_TIMEOUT,
+                )
+                status = json.loads(data) if code == 200 else {"error": f"HTTP {code}"}
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                status = {"error": str(e)}
+        statuses.append({"worker": index, **status})
+    return statuses
+
+
+def merge_worker_status(statuses):
+    """Totals over the workers' /admin/status, with the figures of each worker in its "workers" entry"""
+    merged = {"workers": [], "rejections": {}, "retry_after": ADMISSION_RETRY_AFTER, "streams": []}
+    for status in statuses:
+        for name, value in status.items():
+            if isinstance(value, dict) and "used" in value:
+                total = merged.setdefault(name, {"used": 0, "limit": 0})
+                total["used"] += value["used"]
+                # Each worker has its own limit
+                total["limit"] = None if total["limit"] is None or value["limit"] is None else total["limit"] + value["limit"]
+        for resource, count in status.get("rejections", {}).items():
+            merged["rejections"][resource] = merged["rejections"].get(resource, 0) + count
+        merged["streams"].extend({"worker": status["worker"], **stream} for stream in status.get("streams", []))
+        merged["workers"].append({name: value for name, value in status.items() if name != "streams"})
+    return merged
+
+
 @app.route("/status/<stream_key>/html")
 def stream_status_html(stream_key):
     """HTML status page"""
@@ -993,6 +5692,10 @@ def stream_status_html(stream_key):
         util_pct = int((data.get("upload_utilization", 0) or 0) * 100)
         ffmpeg_status = "RUNNING" if data.get("ffmpeg_running") else "STOPPED"
         ffmpeg_class = "status-running" if data.get("ffmpeg_running") else "status-stopped"
+        relay_lag = data.get("relay_lag")
+        relay_lag_display = "N/A" if relay_lag is None else f"{relay_lag:.1f}s"
+        if data.get("catchup_active"):
+            relay_lag_display += f" (catching up, {data.get('catchup_mode')})"
         
         html += f"""
         <div class="status-grid">
@@ -1028,6 +5731,10 @@ def stream_status_html(stream_key):
                 <label>Last Playlist Update</label>
                 <div class="value">{data.get('last_playlist_update_age', 0):.1f}s ago</div>
             </div>
+            <div class="status-item">
+                <label>Relay Lag</label>
+                <div class="value">{relay_lag_display}</div>
+            </div>
         </div>
 
         <h2>Upload Utilization</h2>
@@ -1055,11 +5762,58 @@ def stream_status_html(stream_key):
         </div>
 """
         
+        if data.get("relays"):
+            html += """
+        <h2>Relays</h2>
+        <div class="status-grid">
+"""
+            for relay in data["relays"]:
+                relay_status = "RUNNING" if relay.get("running") else "STOPPED"
+                relay_class = "status-running" if relay.get("running") else "status-stopped"
+                lag = relay.get("lag")
+                lag_display = "N/A" if lag is None else f"{lag:.1f}s"
+                cpu_display = "N/A" if relay.get("cpu_percent") is None else f"{relay['cpu_percent']:.0f}%"
+                rss_display = "N/A" if relay.get("rss_bytes") is None else f"{relay['rss_bytes'] / 1048576:.0f} MiB"
+                html += f"""
+            <div class="status-item">
+                <label>{relay.get('target')}</label>
+                <div class="value"><span class="status-badge {relay_class}">{relay_status}</span></div>
+                <div>Lag: {lag_display} &middot; Restarts: {relay.get('restart_count', 0)}</div>
+                <div>CPU: {cpu_display} &middot; RSS: {rss_display}</div>
+                <div>Engine: {relay.get('engine')} &middot; Rendition: {relay.get('rendition')}</div>
+            </div>
+"""
+            html += """
+        </div>
+"""
+
+        if len(data.get("renditions") or []) > 1:
+            html += """
+        <h2>Renditions</h2>
+        <div class="status-grid">
+"""
+            for rendition in data["renditions"]:
+                bitrate = rendition.get("bitrate_bps")
+                bitrate_display = "N/A" if bitrate is None else f"{bitrate / 1e6:.1f} Mbit/s"
+                relayed = " (relayed)" if rendition.get("name") == data.get("relay_rendition") else ""
+                html += f"""
+            <div class="status-item">
+                <label>{rendition.get('name')}{relayed}</label>
+                <div class="value">{bitrate_display}</div>
+                <div>Segments: {rendition.get('written_media_segments', 0)} &middot; Last seq: {rendition.get('last_playlist_sequence')}</div>
+            </div>
+"""
+            html += """
+        </div>
+"""
+
         if data.get("last_ffmpeg_exit"):
             exit_info = data["last_ffmpeg_exit"]
             exit_code = exit_info.get("code")
             exit_signal = exit_info.get("signal")
             exit_display = f"code {exit_code}" if exit_code is not None else f"signal {exit_signal}"
+            if exit_info.get("target"):
+                exit_display = f"{exit_info['target']}: {exit_display}"
             html += f"""
         <div class="status-item" style="background: #fff3cd; border-left-color: #ffc107;">
             <label>Last FFmpeg Exit</label>
@@ -1090,14 +5844,610 @@ def stream_status_html(stream_key):
     
     return Response(html, mimetype="text/html")
 
+class RequestDrain:
+    """WSGI middleware counting the requests in progress, so a handover can wait for them to finish"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.condition = threading.Condition()
+        self.active = 0
+
+    def __call__(self, environ, start_response):
+        with self.condition:
+            self.active += 1
+        try:
+            # Responses may be streamed, so a request ends when the server closes its response
+            return ClosingIterator(self.wsgi_app(environ, start_response), self._finished)
+        except BaseException:
+            self._finished()
+            raise
+
+    def _finished(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def drain(self, timeout):
+        """Wait until no request is in progress; returns False if some still were after timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.active == 0, timeout)
+
+
+app.wsgi_app = request_drain = RequestDrain(app.wsgi_app)
+
+
+HTTP_REASONS = {code: reason for code, reason in (
+    (400, "Bad Request"), (408, "Request Timeout"), (413, "Payload Too Large"),
+    (431, "Request Header Fields Too Large"), (500, "Internal Server Error"), (501, "Not Implemented"),
+)}
+# Request bytes read, and response bytes pulled from the WSGI app on the executor, at a time
+ASYNC_RESPONSE_BATCH = 256 * 1024
+
+
+class HttpRequestError(Exception):
+    """A request the asyncio server answers itself, with status, before closing the connection"""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class AsyncIngestServer:
+    """HTTP/1.1 server on an asyncio event loop, serving a WSGI app from already-listening sockets.
+
+    Request bodies are read on the event loop into a spooled buffer and the app is only called once the
+    request is complete, on a pool of ASYNC_EXECUTOR_THREADS threads. Responses are pulled from the app
+    on the same pool in batches and written as fast as the client reads them.
+    """
+
+    def __init__(self, wsgi_app, sockets, threads=None):
+        self.wsgi_app = wsgi_app
+        self.sockets = sockets
+        self.executor = ThreadPoolExecutor(max_workers=threads or ASYNC_EXECUTOR_THREADS, thread_name_prefix="async-ingest")
+        self.loop = None
+        self.ready = threading.Event()
+        self.accept_tasks = []
+        self.connections = set()
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.connection_slots = asyncio.Semaphore(ASYNC_MAX_CONNECTIONS)
+        for sock in self.sockets:
+            sock.setblocking(False)
+        self._start_accepting()
+        self.ready.set()
+        await self.stopped.wait()
+        self._stop_accepting()
+        for task in list(self.connections):
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def set_accepting(self, accepting):
+        """Start or stop accepting connections; may be called from any thread"""
+        self.loop.call_soon_threadsafe(self._start_accepting if accepting else self._stop_accepting)
+
+    def _start_accepting(self):
+        if not self.accept_tasks:
+            self.accept_tasks = [self.loop.create_task(self._accept(sock)) for sock in self.sockets]
+
+    def _stop_accepting(self):
+        # Connections that arrive meanwhile wait in the listening socket's backlog
+        for task in self.accept_tasks:
+            task.cancel()
+        self.accept_tasks = []
+
+    async def _accept(self, sock):
+        while True:
+            # Beyond ASYNC_MAX_CONNECTIONS, connections wait in the backlog until one is closed
+            await self.connection_slots.acquire()
+            try:
+                connection, address = await self.loop.sock_accept(sock)
+            except OSError as e:
+                self.connection_slots.release()
+                # e.g. out of file descriptors; the connection stays in the backlog for the next try
+                log(f"Error accepting a connection: {e}", level="error")
+                await asyncio.sleep(0.1)
+                continue
+            except asyncio.CancelledError:
+                self.connection_slots.release()
+                raise
+            task = self.loop.create_task(self._serve_connection(connection, address))
+            self.connections.add(task)
+            task.add_done_callback(self.connections.discard)
+            task.add_done_callback(lambda task: self.connection_slots.release())
+
+    async def _serve_connection(self, connection, address):
+        server_port = connection.getsockname()[1]
+        # As waitress does; small response writes are otherwise held back waiting for the client's ACK
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader, writer = await asyncio.open_connection(sock=connection, limit=ASYNC_MAX_HEADER_BYTES)
+        try:
+            while await self._serve_request(reader, writer, address, server_port):
+                pass
+        except HttpRequestError as e:
+            reason = HTTP_REASONS.get(e.status, "")
+            writer.write(f"HTTP/1.1 {e.status} {reason}\r\nContent-Type: text/plain\r\nContent-Length: {len(reason)}\r\nConnection: close\r\n\r\n{reason}".encode("latin-1"))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            log(f"Error serving a connection from {address[0]}: {e}", level="error")
+        finally:
+            writer.close()
+
+    async def _read(self, operation):
+        return await asyncio.wait_for(operation, ASYNC_IDLE_TIMEOUT)
+
+    async def _read_head(self, reader):
+        """(method, target, version, headers), or None when the client closed the connection between requests"""
+        try:
+            head = await self._read(reader.readuntil(b"\r\n\r\n"))
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise HttpRequestError(400)
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpRequestError(431)
+        except asyncio.TimeoutError:
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        # Tolerate blank lines before the request line, as RFC 9112 asks
+        while lines and not lines[0]:
+            lines.pop(0)
+        parts = lines[0].split(" ") if lines else []
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise HttpRequestError(400)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition(":")
+            if not separator or not name or name != name.strip():
+                raise HttpRequestError(400)
+            name = name.lower()
+            headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+        return parts[0], parts[1], parts[2], headers
+
+    async def _read_body(self, reader, writer, headers):
+        """Spooled request body and its length"""
+        chunked = "transfer-encoding" in headers
+        if chunked:
+            # Other codings are not supported, and a Content-Length next to chunked, which a proxy in
+            # front may have used instead, is how a second request is smuggled into a body
+            if headers["transfer-encoding"].lower() != "chunked":
+                raise HttpRequestError(501)
+            if "content-length" in headers:
+                raise HttpRequestError(400)
+            length = None
+        else:
+            # Repeated Content-Length headers arrive joined with commas and are refused here
+            content_length = headers.get("content-length", "0")
+            if not re.fullmatch(r"[0-9]+", content_length):
+                raise HttpRequestError(400)
+            length = int(content_length)
+            if length > ASYNC_MAX_REQUEST_BYTES:
+                raise HttpRequestError(413)
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        body = tempfile.SpooledTemporaryFile(max_size=ASYNC_BODY_SPOOL_BYTES)
+        received = 0
+        try:
+            if chunked:
+                while True:
+                    size_line = await self._read(reader.readuntil(b"\r\n"))
+                    size_field = size_line.split(b";")[0].strip()
+                    if not re.fullmatch(rb"[0-9A-Fa-f]{1,16}", size_field):
+                        raise HttpRequestError(400)
+                    size = int(size_field, 16)
+                    if size == 0:
+                        # Skip any trailer fields
+                        while await self._read(reader.readuntil(b"\r\n")) != b"\r\n":
+                            pass
+                        break
+                    received += size
+                    if received > ASYNC_MAX_REQUEST_BYTES:
+                        raise HttpRequestError(413)
+                    body.write(await self._read(reader.readexactly(size)))
+                    if await self._read(reader.readexactly(2)) != b"\r\n":
+                        raise HttpRequestError(400)
+            else:
+                while received < length:
+                    data = await self._read(reader.read(min(length - received, ASYNC_RESPONSE_BATCH)))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b"", length - received)
+                    body.write(data)
+                    received += len(data)
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body, received
+
+    def _environ(self, method, target, version, headers, body, length, address, server_port):
+        path, _, query = target.partition("?")
+        if "://" in path:
+            # Absolute form, as sent to proxies
+            path = "/" + path.split("://", 1)[1].partition("/")[2]
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote(path, encoding="latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": headers.get("host", "localhost").rsplit(":", 1)[0],
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": address[0],
+            "REMOTE_PORT": str(address[1]),
+            "CONTENT_LENGTH": str(length),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": WORKER_PROCESSES > 1,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name not in ("content-length", "transfer-encoding"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        return environ
+
+    def _call_app(self, environ):
+        """Run the app up to its first batch of response bytes; called on the executor"""
+        started = {}
+        written = []
+
+        def start_response(status, response_headers, exc_info=None):
+            started["status"], started["headers"] = status, response_headers
+            return written.append
+
+        try:
+            iterator = self.wsgi_app(environ, start_response)
+        except Exception as e:
+            log(f"Error handling {environ['REQUEST_METHOD']} {environ['PATH_INFO']}: {e}", level="error")
+            raise HttpRequestError(500)
+        chunks, done = self._next_batch(iterator)
+        return started["status"], started["headers"], written + chunks, done, iterator
+
+    @staticmethod
+    def _next_batch(iterator):
+        """Response chunks adding up to ASYNC_RESPONSE_BATCH bytes, and whether the response is complete"""
+        chunks = []
+        size = 0
+        for chunk in iterator:
+            if chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+            if size >= ASYNC_RESPONSE_BATCH:
+                return chunks, False
+        return chunks, True
+
+    async def _serve_request(self, reader, writer, address, server_port):
+        """Serve one request; returns whether the connection stays open for another"""
+        request_head = await self._read_head(reader)
+        if request_head is None:
+            return False
+        method, target, version, headers = request_head
+        body, length = await self._read_body(reader, writer, headers)
+        connection = headers.get("connection", "").lower()
+        keep_alive = "keep-alive" in connection if version == "HTTP/1.0" else "close" not in connection
+        iterator = None
+        try:
+            environ = self._environ(method, target, version, headers, body, length, address, server_port)
+            status, response_headers, chunks, done, iterator = await self.loop.run_in_executor(self.executor, self._call_app, environ)
+            has_length = any(name.lower() == "content-length" for name, _ in response_headers)
+            no_body = method == "HEAD" or status[:3] in ("204", "304") or status[:1] == "1"
+            # Without a length, HTTP/1.1 responses are chunked and HTTP/1.0 ones end with the connection
+            chunked = not has_length and not no_body and version != "HTTP/1.0"
+            keep_alive = keep_alive and (has_length or no_body or chunked)
+            lines = [f"HTTP/1.1 {status}"] + [
+                f"{name}: {value}" for name, value in response_headers if name.lower() != "connection"
+            ]
+            if chunked:
+                lines.append("Transfer-Encoding: chunked")
+            lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            while True:
+                if not no_body:
+                    for chunk in chunks:
+                        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                # A slow reader only holds this coroutine
+                await writer.drain()
+                if done:
+                    break
+                chunks, done = await self.loop.run_in_executor(self.executor, self._next_batch, iterator)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        finally:
+            if hasattr(iterator, "close"):
+                # Ends the request for RequestDrain, and may read files, so not on the event loop
+                await self.loop.run_in_executor(self.executor, iterator.close)
+            body.close()
+        return keep_alive
+
+
+def relay_app(environ, start_response):
+    """WSGI app of the relay listener, serving only the playlists and segments that relays read"""
+    if not environ.get("PATH_INFO", "").startswith("/segments/"):
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not found"]
+    return app(environ, start_response)
+
+
+# Loopback socket of the relay listener, when RELAY_LISTENER_PORT is set
+relay_socket = None
+
+
+def create_http_server(wsgi_app, sockets, threads=None):
+    """Server for SERVER_MODE on already-listening sockets; threads defaults to the mode's own"""
+    if SERVER_MODE == "asyncio":
+        return AsyncIngestServer(wsgi_app, sockets, threads)
+    from waitress.server import create_server
+    return create_server(wsgi_app, sockets=sockets, **({} if threads is None else {"threads": threads}))
+
+
+def listening_socket(host="0.0.0.0", port=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, PORT if port is None else port))
+    sock.listen(1024)
+    return sock
+
+
+def start_worker(index):
+    """Fork worker process index; returns its pid in the supervisor, and None in the new worker"""
+    # So the log writer thread is not in the middle of a write to a file the worker inherits
+    log_pipeline.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+    global current_worker
+    for signum in (signal.SIGHUP, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    current_worker = Worker(index, listening_socket("127.0.0.1", worker_port(index)))
+    log(f"Worker {index} started (pid {os.getpid()}), loopback port {current_worker.port}")
+    return None
+
+
+def supervise_workers():
+    """Run WORKER_PROCESSES workers, starting again any that exits; returns only in a worker process.
+
+    Workers inherit the listening socket on PORT. SIGHUP is passed on to every worker, which then hands
+    over to a new version of itself like a single-process relay does.
+    """
+    workers = {}  # pid -> worker index
+    # Inherited by the workers, and kept across their handovers
+    os.environ.setdefault(WORKER_TOKEN_ENV, secrets.token_hex(16))
+    for index in range(WORKER_PROCESSES):
+        pid = start_worker(index)
+        if pid is None:
+            return
+        workers[pid] = index
+
+    def pass_on(signum, frame):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+        if signum == signal.SIGTERM:
+            sys.exit(0)
+
+    signal.signal(signal.SIGHUP, pass_on)
+    signal.signal(signal.SIGTERM, pass_on)
+    log(f"Supervising {WORKER_PROCESSES} worker processes on http://0.0.0.0:{PORT}")
+    while True:
+        pid, status = os.wait()
+        index = workers.pop(pid, None)
+        if index is None:
+            continue
+        log(f"Worker {index} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, restarting in {WORKER_RESTART_COOLDOWN}s", level="warning")
+        time.sleep(WORKER_RESTART_COOLDOWN)
+        pid = start_worker(index)
+        if pid is None:
+            return
+        workers[pid] = index
+
+
+def listeners_of(server):
+    """The listening servers behind what waitress' create_server() returned, which wraps them when there are several sockets"""
+    if hasattr(server, "accepting"):
+        return [server]
+    from waitress.server import BaseWSGIServer
+    return [dispatcher for dispatcher in server.map.values() if isinstance(dispatcher, BaseWSGIServer)]
+
+
+def set_accepting(server, accepting):
+    if isinstance(server, AsyncIngestServer):
+        server.set_accepting(accepting)
+        return
+    for listener in listeners_of(server):
+        listener.accepting = accepting
+        listener.trigger.pull_trigger()
+
+
+def handover_path():
+    path = os.path.join(BASE_SEGMENTS_DIR, HANDOVER_FILE)
+    # Workers share BASE_SEGMENTS_DIR and may hand over at the same time
+    return path if current_worker is None else f"{path}.{current_worker.index}"
+
+
+def stop_native_uploads(stream_list):
+    """Stop the native uploads of these streams after their current file, waiting for all of them at once"""
+    uploaders = [
+        relay.process for stream in stream_list for relay in list(stream.relays.values())
+        if isinstance(relay.process, NativeHlsUploader)
+    ]
+    for uploader in uploaders:
+        uploader.terminate()
+    deadline = time.monotonic() + NATIVE_UPLOAD_TIMEOUT + 1
+    for uploader in uploaders:
+        try:
+            uploader.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def hand_over(server, listen_socket, relay_server=None):
+    """Re-execute this relay in place, handing the listening socket, streams and relays to the new process.
+
+    Connections that arrive meanwhile wait in the socket's backlog. ffmpeg children stay children of
+    this process id across the exec, so their upstream connections are not touched.
+    """
+    log("Handover requested: no longer accepting connections")
+    set_accepting(server, False)
+    if relay_server is not None:
+        set_accepting(relay_server, False)
+    if not request_drain.drain(HANDOVER_DRAIN_TIMEOUT):
+        log(f"Handover: requests still in progress after {HANDOVER_DRAIN_TIMEOUT}s, handing over anyway", level="warning")
+    try:
+        # A version that cannot even be compiled would take every stream down with it
+        with open(sys.argv[0]) as f:
+            compile(f.read(), sys.argv[0], "exec")
+    except (OSError, SyntaxError) as e:
+        log(f"Handover cancelled, {sys.argv[0]} cannot be run: {e}", level="error")
+        set_accepting(server, True)
+        if relay_server is not None:
+            set_accepting(relay_server, True)
+        return
+
+    # Waited for before the playlist locks are taken, so a slow upload does not hold up ingest
+    with stream_creation_lock:
+        stream_list = list(streams.values())
+    stop_native_uploads(stream_list)
+    with stream_creation_lock:
+        stream_list = [stream for stream in streams.values() if not stream.finalized]
+        for stream in stream_list:
+            # Held until the exec, so nothing changes after the state is taken
+            stream.playlist_lock.acquire()
+        state = {
+            "listen_fd": listen_socket.fileno(),
+            "streams": [stream.handover_state() for stream in stream_list],
+            "worker": None if current_worker is None else {"index": current_worker.index, "fd": current_worker.socket.fileno()},
+            "relay_fd": None if relay_socket is None else relay_socket.fileno(),
+        }
+        path = handover_path()
+        # Readable by this user only, as it holds the relays' destination keys until the new process reads it
+        with os.fdopen(os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+        os.set_inheritable(listen_socket.fileno(), True)
+        if current_worker is not None:
+            os.set_inheritable(current_worker.socket.fileno(), True)
+        if relay_socket is not None:
+            os.set_inheritable(relay_socket.fileno(), True)
+        os.environ[HANDOVER_ENV] = os.path.abspath(path)
+        log(f"Handing {len(stream_list)} streams over to a new relay process")
+        log_pipeline.flush()
+        try:
+            os.execv(sys.executable, sys.orig_argv)
+        except OSError as e:
+            log(f"Handover failed, continuing in this process: {e}", level="error")
+            os.remove(path)
+            for stream in stream_list:
+                stream.playlist_lock.release()
+    set_accepting(server, True)
+    if relay_server is not None:
+        set_accepting(relay_server, True)
+
+
+def take_over_from_previous_process():
+    """Adopt what hand_over() passed on; returns the listening socket, or None after a normal start"""
+    global current_worker, relay_socket
+    path = os.environ.pop(HANDOVER_ENV, None)
+    if not path:
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    os.remove(path)
+    if state.get("worker") is not None:
+        current_worker = Worker(state["worker"]["index"], socket.socket(fileno=state["worker"]["fd"]))
+    if state.get("relay_fd") is not None:
+        relay_socket = socket.socket(fileno=state["relay_fd"])
+    taken_over = 0
+    for stream_state in state["streams"]:
+        try:
+            stream = StreamState.take_over(stream_state)
+        except Exception as e:
+            log(f"Error taking over stream {stream_state['stream_dir']}: {e}", level="error")
+            continue
+        with stream_creation_lock:
+            streams[stream.stream_key] = stream
+        stream.watch_missing_segments()
+        taken_over += 1
+    log(f"Took over {taken_over} streams from the previous relay process")
+    return socket.socket(fileno=state["listen_fd"])
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="HLS Relay Server")
     parser.add_argument("--force-target", dest="force_target", help="Override Target header (e.g. youtube, twitch, passive)")
+    parser.add_argument("--port", type=int, help=f"Port to listen on (default: {PORT})")
+    parser.add_argument("--workers", type=int, help=f"Number of worker processes (default: {WORKER_PROCESSES})")
+    parser.add_argument("--server", choices=sorted(SERVER_MODES), help=f"HTTP server (default: {SERVER_MODE})")
+    parser.add_argument("--relay-port", type=int, help="Loopback port of a separate listener for FFmpeg relay reads")
+    parser.add_argument("--log-dir", help="Write the log to a YYYYMMDD.log file per day in this directory instead of stdout")
     args = parser.parse_args()
+    if args.log_dir:
+        LOG_DIR = args.log_dir
+    if args.relay_port:
+        RELAY_LISTENER_PORT = args.relay_port
+    if args.server:
+        SERVER_MODE = args.server
+    if args.port:
+        PORT = args.port
+    if args.workers:
+        WORKER_PROCESSES = args.workers
     if args.force_target:
         FORCE_TARGET = args.force_target.strip().lower()
-        print(f"Force target override set to: {FORCE_TARGET}", flush=True)
+        log(f"Force target override set to: {FORCE_TARGET}")
+
+    if INGEST_CPUS is not None:
+        # Threads started from here on (the waitress workers) inherit this CPU set
+        os.sched_setaffinity(0, INGEST_CPUS)
+        log(f"Ingest server pinned to CPUs {sorted(INGEST_CPUS)}")
+
+    listen_socket = take_over_from_previous_process() or listening_socket()
+    if WORKER_PROCESSES > 1 and current_worker is None:
+        # Before any thread is started, so the workers are forked from a single-threaded process
+        supervise_workers()
+
+    if HOT_TIER_DIR is not None:
+        # Moves the segments left in the hot tier by an earlier run, too
+        hot_tier.start()
+        log(f"Live segments written to {HOT_TIER_DIR} first (up to {HOT_TIER_MAX_BYTES} bytes)")
+
+    if retention_manager.enabled():
+        retention_manager.start()
+    if DISK_HEALTH_INTERVAL is not None:
+        disk_health.start()
+    threading.Thread(target=_sweep_resumable_uploads_forever, daemon=True).start()
+
+    if RECOVER_STREAMS_ON_STARTUP:
+        # In the background, so uploads are served while older streams are still being restored
+        threading.Thread(target=recover_streams, daemon=True).start()
+
+    relay_server = None
+    if RELAY_LISTENER_PORT is not None:
+        if relay_socket is None:
+            relay_socket = listening_socket("127.0.0.1", relay_listener_port())
+        relay_server = create_http_server(relay_app, [relay_socket], RELAY_LISTENER_THREADS)
+        threading.Thread(target=relay_server.run, daemon=True).start()
+        log(f"Relay reads served on http://127.0.0.1:{relay_listener_port()}")
 
-    from waitress import serve
-    print(f"Starting production server with Waitress on http://0.0.0.0:{PORT}", flush=True)
-    serve(app, host="0.0.0.0", port=PORT)
+    server = create_http_server(app, [listen_socket] + ([] if current_worker is None else [current_worker.socket]))
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=hand_over, args=(server, listen_socket, relay_server), daemon=True).start())
+    log(f"Starting production server with {'asyncio' if SERVER_MODE == 'asyncio' else 'Waitress'} on http://0.0.0.0:{PORT}")
+    server.run()
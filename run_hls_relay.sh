@@ -1,13 +1,13 @@
 #!/usr/bin/env bash
 
-# Simple launcher that appends relay output to a YYYYMMDD.log file
+# Simple launcher; the relay itself writes its log to a YYYYMMDD.log file per day in logs/
 set -euo pipefail
 
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 LOG_DIR="${SCRIPT_DIR}/logs"
 mkdir -p "${LOG_DIR}"
 
-LOG_FILE="${LOG_DIR}/$(date +%Y%m%d).log"
-echo "Logging to ${LOG_FILE}"
+echo "Logging to ${LOG_DIR}"
 
-python3 -u "${SCRIPT_DIR}/hls_relay.py" >> "${LOG_FILE}" 2>&1
+# Only what the relay cannot log itself, such as a crash traceback, goes through the shell
+exec python3 "${SCRIPT_DIR}/hls_relay.py" --log-dir "${LOG_DIR}" "$@" 2>> "${LOG_DIR}/stderr.log"
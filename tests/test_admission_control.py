@@ -0,0 +1,146 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from base64 import b64encode
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir),
+            patch('hls_relay.resource_governor', hls_relay.ResourceGovernor()),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, segment_type, sequence, duration, data=b'data', target='passive'):
+        return self.client.post(
+            '/upload_segment',
+            headers={
+                **self.auth_headers,
+                'Target': target,
+                'Stream-Key': stream_key,
+                'Segment-Type': segment_type,
+                'Discontinuity': 'false',
+                'Duration': str(duration),
+                'Sequence': str(sequence),
+            },
+            data=data,
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+    def test_streams_over_the_limit_are_refused_with_retry_after(self):
+        with patch('hls_relay.MAX_ACTIVE_STREAMS', 1):
+            self.assertEqual(self.upload('admit_one', 'Initialization', 0, 0, b'init').status_code, 200)
+            response = self.upload('admit_two', 'Initialization', 0, 0, b'init')
+            # Existing streams keep uploading
+            self.assertEqual(self.upload('admit_one', 'Media', 1, 2.0).status_code, 200)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], str(hls_relay.ADMISSION_RETRY_AFTER))
+        self.assertNotIn('admit_two', hls_relay.streams)
+        self.assertEqual(hls_relay.resource_governor.rejections['streams'], 1)
+
+    def test_streams_being_opened_count_against_the_limit(self):
+        opening = threading.Event()
+        release = threading.Event()
+        stream_state = hls_relay.StreamState
+
+        def slow_stream_state(stream_key, **kwargs):
+            if stream_key == 'admit_slow':
+                opening.set()
+                release.wait(5)
+            return stream_state(stream_key, **kwargs)
+
+        with patch('hls_relay.MAX_ACTIVE_STREAMS', 1), patch('hls_relay.StreamState', side_effect=slow_stream_state):
+            thread = threading.Thread(target=hls_relay.open_upload_stream, args=('admit_slow', None, 0, None))
+            thread.start()
+            self.assertTrue(opening.wait(5))
+            # The first stream is not in the stream table yet, but holds its slot
+            with self.assertRaises(hls_relay.AdmissionError):
+                hls_relay.open_upload_stream('admit_fast', None, 0, None)
+            release.set()
+            thread.join(5)
+
+        self.assertEqual(list(hls_relay.streams), ['admit_slow'])
+        self.assertEqual(hls_relay.resource_governor.pending_streams, 0)
+
+    def test_stream_that_fails_to_open_gives_its_slot_back(self):
+        with patch('hls_relay.MAX_ACTIVE_STREAMS', 1):
+            with patch('hls_relay.StreamState', side_effect=OSError('disk full')), self.assertRaises(OSError):
+                hls_relay.open_upload_stream('admit_failed', None, 0, None)
+            self.assertEqual(self.upload('admit_after_failure', 'Initialization', 0, 0, b'init').status_code, 200)
+
+    def test_reorder_buffer_bytes_are_limited(self):
+        self.upload('admit_pending', 'Initialization', 0, 0, b'init')
+        with patch('hls_relay.MAX_PENDING_REORDER_BYTES', 100):
+            self.assertEqual(self.upload('admit_pending', 'Media', 2, 2.0, b'x' * 60).status_code, 200)
+            self.assertEqual(self.upload('admit_pending', 'Media', 3, 2.0, b'x' * 60).status_code, 503)
+            # The missing segment drains the buffer, and is not held back by it
+            self.assertEqual(self.upload('admit_pending', 'Media', 1, 2.0, b'x' * 60).status_code, 200)
+            self.assertEqual(self.upload('admit_pending', 'Media', 3, 2.0, b'x' * 60).status_code, 200)
+
+        self.assertEqual(hls_relay.streams['admit_pending'].written_segment_count, 3)
+        self.assertEqual(hls_relay.pending_reorder_bytes(), 0)
+
+    def test_upload_bytes_in_flight_are_limited(self):
+        governor = hls_relay.resource_governor
+        with patch('hls_relay.MAX_INFLIGHT_UPLOAD_BYTES', 100):
+            governor.begin_upload(500)
+            with self.assertRaises(hls_relay.AdmissionError):
+                governor.begin_upload(1)
+            governor.end_upload(500)
+            governor.begin_upload(60)
+            governor.begin_upload(40)
+            response = self.upload('admit_inflight', 'Initialization', 0, 0, b'init')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(governor.inflight_upload_bytes, 100)
+
+    def test_ffmpeg_relays_over_the_limit_are_deferred(self):
+        running = MagicMock()
+        running.poll.return_value = None
+        hls_relay.resource_governor.register_ffmpeg(running)
+
+        with patch('hls_relay.MAX_FFMPEG_RELAYS', 1), patch('subprocess.Popen') as mock_popen:
+            self.upload('admit_relay', 'Initialization', 0, 0, b'init', target='youtube')
+            responses = [self.upload('admit_relay', 'Media', seq, 2.0, target='youtube') for seq in (1, 2, 3)]
+
+        self.assertEqual([response.status_code for response in responses], [200, 200, 200])
+        mock_popen.assert_not_called()
+        relay = hls_relay.streams['admit_relay'].relays['youtube']
+        self.assertGreater(relay.restart_not_before, 0)
+        self.assertTrue(any('deferred' in event['message'] for event in hls_relay.streams['admit_relay'].events))
+        self.assertEqual(hls_relay.resource_governor.rejections['ffmpeg_relays'], 1)
+
+    def test_admin_status_reports_budget_usage(self):
+        self.upload('admit_status', 'Initialization', 0, 0, b'init')
+        self.upload('admit_status', 'Media', 2, 2.0, b'x' * 10)
+
+        self.assertEqual(self.client.get('/admin/status').status_code, 401)
+        status = self.client.get('/admin/status', headers=self.auth_headers).get_json()
+
+        self.assertEqual(status['active_streams'], {'used': 1, 'limit': hls_relay.MAX_ACTIVE_STREAMS})
+        self.assertEqual(status['pending_reorder_bytes']['used'], 10)
+        self.assertEqual(status['inflight_upload_bytes']['used'], 0)
+        self.assertEqual(status['streams'][0]['stream_key'], 'admit_status')
+        self.assertEqual(status['streams'][0]['pending_reorder_bytes'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import http.client
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestAsyncIngestServer(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.listen_socket = hls_relay.listening_socket('127.0.0.1', 0)
+        self.port = self.listen_socket.getsockname()[1]
+        self.server = hls_relay.AsyncIngestServer(hls_relay.app, [self.listen_socket])
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        self.server.ready.wait(5)
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.close()
+        self.thread.join(5)
+        self.listen_socket.close()
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def connect(self):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+
+    def upload_headers(self, stream_key, sequence):
+        return {
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': 'Initialization' if sequence == 0 else 'Media',
+            'Discontinuity': 'false',
+            'Duration': '0' if sequence == 0 else '2.0',
+            'Sequence': str(sequence),
+        }
+
+    def request(self, connection, method, path, body=None, headers=None):
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_uploads_and_playlist_on_one_kept_alive_connection(self):
+        connection = self.connect()
+        for sequence in range(3):
+            response, body = self.request(connection, 'POST', '/upload_segment', b'data%d' % sequence, self.upload_headers('async_key', sequence))
+            self.assertEqual(response.status, 200, body)
+            self.assertEqual(response.headers['Relay-Pending-Segments'], '0')
+        stream = hls_relay.streams['async_key']
+
+        response, playlist = self.request(connection, 'GET', f'/segments/{stream.stream_id}/playlist.m3u8')
+        self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+        self.assertTrue(playlist.decode().endswith('p0_segment_000002.m4s\n'))
+        response, segment = self.request(connection, 'GET', f'/segments/{stream.stream_id}/p0_segment_000002.m4s')
+        self.assertEqual(segment, b'data2')
+        response, body = self.request(connection, 'HEAD', '/status/async_key')
+        self.assertEqual((response.status, body), (200, b''))
+        response, body = self.request(connection, 'GET', '/status/async_key')
+        self.assertIn(b'"written_media_segments":2', body)
+        connection.close()
+
+    def test_chunked_upload_with_expect_continue(self):
+        connection = self.connect()
+        self.request(connection, 'POST', '/upload_segment', b'init', self.upload_headers('async_chunked_key', 0))
+        data = bytes(range(256)) * 1000
+        connection.putrequest('POST', '/upload_segment')
+        for name, value in {**self.upload_headers('async_chunked_key', 1), 'Transfer-Encoding': 'chunked', 'Expect': '100-continue'}.items():
+            connection.putheader(name, value)
+        connection.endheaders()
+        self.assertEqual(connection.sock.recv(64), b'HTTP/1.1 100 Continue\r\n\r\n')
+        for start in range(0, len(data), 100000):
+            chunk = data[start:start + 100000]
+            connection.send(b'%x;ext=1\r\n%s\r\n' % (len(chunk), chunk))
+        connection.send(b'0\r\nTrailer: x\r\n\r\n')
+        response = connection.getresponse()
+        response.read()
+
+        self.assertEqual(response.status, 200)
+        stream = hls_relay.streams['async_chunked_key']
+        with open(f'{stream.stream_dir}/p0_segment_000001.m4s', 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_slow_uploads_do_not_hold_executor_threads(self):
+        # More trickling uploads than there are threads, each stuck halfway through its body
+        for sequence in range(hls_relay.ASYNC_EXECUTOR_THREADS + 2):
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            self.sockets.append(sock)
+            headers = ''.join(f'{name}: {value}\r\n' for name, value in self.upload_headers(f'async_slow_{sequence}', 0).items())
+            sock.sendall(f'POST /upload_segment HTTP/1.1\r\nHost: x\r\n{headers}Content-Length: 1000\r\n\r\n'.encode() + b'x' * 10)
+
+        connection = self.connect()
+        started = time.monotonic()
+        response, _ = self.request(connection, 'GET', '/status/async_slow_0')
+        self.assertEqual(response.status, 200)
+        self.assertLess(time.monotonic() - started, 1)
+
+        self.sockets[0].sendall(b'x' * 990)
+        self.sockets[0].settimeout(5)
+        self.assertTrue(self.sockets[0].recv(100).startswith(b'HTTP/1.1 200 OK'))
+
+    def test_malformed_and_oversized_requests_are_refused(self):
+        for request, status in (
+            (b'NONSENSE\r\n\r\n', b'400'),
+            (b'POST /upload_segment HTTP/1.1\r\nContent-Length: x\r\n\r\n', b'400'),
+            (b'POST /upload_segment HTTP/1.1\r\nContent-Length: 11\r\n\r\n', b'413'),
+            (b'GET / HTTP/1.1\r\nX: ' + b'a' * (hls_relay.ASYNC_MAX_HEADER_BYTES + 1) + b'\r\n\r\n', b'431'),
+            (b'POST /upload_segment HTTP/1.1\r\nContent-Length: +5\r\n\r\n', b'400'),
+            (b'POST /upload_segment HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n0x5\r\nhello\r\n0\r\n\r\n', b'400'),
+            (b'POST /upload_segment HTTP/1.1\r\nTransfer-Encoding: gzip, chunked\r\n\r\n0\r\n\r\n', b'501'),
+            (b'POST /upload_segment HTTP/1.1\r\nTransfer-Encoding: xchunked\r\n\r\n0\r\n\r\n', b'501'),
+        ):
+            with patch('hls_relay.ASYNC_MAX_REQUEST_BYTES', 10):
+                sock = socket.create_connection(('127.0.0.1', self.port))
+                self.sockets.append(sock)
+                sock.settimeout(5)
+                sock.sendall(request)
+                self.assertEqual(sock.recv(100)[9:12], status, request[:40])
+
+    def test_ambiguous_body_lengths_are_refused_and_the_connection_closed(self):
+        smuggled = b'GET /status/async_smuggled_key HTTP/1.1\r\nHost: x\r\n\r\n'
+        for framing in (
+            b'Content-Length: %d\r\nTransfer-Encoding: chunked\r\n' % (len(smuggled) + 5),
+            b'Transfer-Encoding: chunked\r\nContent-Length: 5\r\n',
+            b'Content-Length: 5\r\nContent-Length: %d\r\n' % (len(smuggled) + 5),
+        ):
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            self.sockets.append(sock)
+            sock.settimeout(5)
+            sock.sendall(b'POST /upload_segment HTTP/1.1\r\nHost: x\r\n' + framing + b'\r\n0\r\n\r\n' + smuggled)
+            received = b''
+            while data := sock.recv(4096):
+                received += data
+
+            self.assertTrue(received.startswith(b'HTTP/1.1 400 '), framing)
+            self.assertEqual(received.count(b'HTTP/1.1'), 1, framing)
+
+    def test_connections_beyond_the_limit_wait_in_the_backlog(self):
+        self.server.close()
+        self.thread.join(5)
+        with patch('hls_relay.ASYNC_MAX_CONNECTIONS', 1):
+            self.server = hls_relay.AsyncIngestServer(hls_relay.app, [self.listen_socket])
+            self.thread = threading.Thread(target=self.server.run, daemon=True)
+            self.thread.start()
+            self.server.ready.wait(5)
+        first = self.connect()
+        self.assertEqual(self.request(first, 'GET', '/status/async_limit_key')[0].status, 200)
+
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sockets.append(sock)
+        sock.sendall(b'GET /status/async_limit_key HTTP/1.1\r\nHost: x\r\n\r\n')
+        sock.settimeout(0.3)
+        with self.assertRaises(socket.timeout):
+            sock.recv(100)
+
+        first.close()
+        sock.settimeout(5)
+        self.assertTrue(sock.recv(100).startswith(b'HTTP/1.1 200 OK'))
+
+    def test_connections_wait_while_not_accepting(self):
+        self.server.set_accepting(False)
+        time.sleep(0.1)
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sockets.append(sock)
+        sock.sendall(b'GET /status/async_wait_key HTTP/1.1\r\nHost: x\r\n\r\n')
+        sock.settimeout(0.3)
+        with self.assertRaises(socket.timeout):
+            sock.recv(100)
+
+        self.server.set_accepting(True)
+        sock.settimeout(5)
+        self.assertTrue(sock.recv(100).startswith(b'HTTP/1.1 200 OK'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class TestBackpressureHints(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, segment_type, sequence, duration, data=b'data'):
+        return self.client.post(
+            '/upload_segment',
+            headers={
+                **self.auth_headers,
+                'Target': 'passive',
+                'Stream-Key': stream_key,
+                'Segment-Type': segment_type,
+                'Discontinuity': 'false',
+                'Duration': str(duration),
+                'Sequence': str(sequence),
+            },
+            data=data,
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+    def test_upload_response_reports_reorder_buffer_and_upstream(self):
+        with patch.object(hls_relay.upstream_monitor, 'throughput_bps', return_value=12345678.9):
+            self.upload('hints_key', 'Initialization', 0, 0, b'init')
+            response = self.upload('hints_key', 'Media', 2, 2.0)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Relay-Pending-Segments'], '1')
+        self.assertEqual(response.headers['Relay-Upstream-Bps'], '12345679')
+        # No relay is running, so there is no lag and no bitrate limit to suggest
+        self.assertNotIn('Relay-Lag', response.headers)
+        self.assertNotIn('Relay-Max-Bitrate', response.headers)
+
+    def test_ignored_segment_response_has_hints_too(self):
+        self.upload('hints_ignored_key', 'Initialization', 0, 0, b'init')
+        response = self.upload('hints_ignored_key', 'Media', 1, 0)
+
+        self.assertEqual(response.get_data(as_text=True), 'Non-positive duration segment ignored.')
+        self.assertEqual(response.headers['Relay-Pending-Segments'], '0')
+
+    def test_lagging_relays_suggest_a_bitrate_that_fits_the_upstream(self):
+        stream = hls_relay.StreamState('hints_lag_key')
+        stream.written_media_duration = 30.0
+        for target in ('youtube', 'twitch'):
+            relay = stream.get_relay(target, 'key')
+            relay.process = MagicMock()
+            relay.process.poll.return_value = None
+            relay.position = (0, 20.0)
+
+        with patch.object(hls_relay.upstream_monitor, 'throughput_bps', return_value=10e6):
+            hints = stream.backpressure_hints()
+            _, _, headers = hls_relay.with_backpressure_hints(('Segment uploaded', 200), stream)
+
+        self.assertEqual(hints['relay_lag'], 10.0)
+        self.assertEqual(hints['max_bitrate_bps'], 10e6 * hls_relay.RENDITION_BANDWIDTH_HEADROOM / 2)
+        self.assertEqual(headers['Relay-Lag'], '10.0')
+        self.assertEqual(headers['Relay-Max-Bitrate'], '4000000')
+
+        for relay in stream.relays.values():
+            relay.position = (0, 29.0)
+        with patch.object(hls_relay.upstream_monitor, 'throughput_bps', return_value=10e6):
+            self.assertIsNone(stream.backpressure_hints()['max_bitrate_bps'])
+
+    def test_ingest_throughput_covers_the_utilization_window(self):
+        stream = hls_relay.StreamState('hints_ingest_key')
+        self.assertIsNone(stream.ingest_bps(now=1000.0))
+
+        stream.record_ingest(500000, now=1000.0)
+        stream.record_ingest(500000, now=1002.0)
+        self.assertEqual(stream.ingest_bps(now=1004.0), 1000000 * 8 / 4)
+
+        stream.record_ingest(250000, now=1000.0 + hls_relay.UPLOAD_UTIL_WINDOW + 1)
+        self.assertEqual(
+            stream.ingest_bps(now=1000.0 + hls_relay.UPLOAD_UTIL_WINDOW + 1),
+            (500000 + 250000) * 8 / hls_relay.UPLOAD_UTIL_WINDOW,
+        )
+
+    def test_rendition_uploads_count_toward_the_stream_ingest(self):
+        self.upload('hints_rendition_key', 'Initialization', 0, 0, b'init')
+        self.client.post(
+            '/upload_segment',
+            headers={
+                **self.auth_headers,
+                'Target': 'passive',
+                'Stream-Key': 'hints_rendition_key',
+                'Segment-Type': 'Initialization',
+                'Discontinuity': 'false',
+                'Duration': '0',
+                'Sequence': '0',
+                'Rendition': 'low',
+            },
+            data=b'lowinit',
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+        stream = hls_relay.streams['hints_rendition_key']
+        self.assertEqual([size for _, size in stream.ingest_history], [4, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
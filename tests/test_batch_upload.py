@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+def batch_part(sequence, segment_type='Media', duration=2.0, data=b'data', discontinuity=False, **extra_headers):
+    headers = {
+        'Segment-Type': segment_type,
+        'Discontinuity': 'true' if discontinuity else 'false',
+        'Duration': str(duration),
+        'Sequence': str(sequence),
+        'Content-Length': str(len(data)),
+        **extra_headers,
+    }
+    head = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    return head.encode() + b'\r\n' + data + b'\r\n'
+
+
+class TestBatchUpload(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload_batch(self, stream_key, body, **extra_headers):
+        return self.client.post(
+            '/upload_segments',
+            headers={**self.auth_headers, 'Target': 'passive', 'Stream-Key': stream_key, **extra_headers},
+            data=body,
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+    def leftover_parts(self):
+        return [name for name in os.listdir(self.test_dir) if name.endswith('.part')]
+
+    def test_backlog_is_applied_with_one_playlist_update(self):
+        body = batch_part(0, 'Initialization', 0, b'init') + b''.join(batch_part(seq, data=b'media%d' % seq) for seq in (3, 1, 5, 2, 4))
+        update_playlist = hls_relay.StreamState.update_playlist
+
+        with patch.object(hls_relay.StreamState, 'update_playlist', autospec=True, side_effect=update_playlist) as mock_update:
+            response = self.upload_batch('batch_key', body)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), '6 segments uploaded')
+        self.assertEqual(mock_update.call_count, 1)
+        stream = hls_relay.streams['batch_key']
+        self.assertEqual([entry['name'] for entry in stream.playlist_entries], [f'p0_segment_{seq:06d}.m4s' for seq in range(1, 6)])
+        with open(os.path.join(stream.stream_dir, 'p0_segment_000003.m4s'), 'rb') as f:
+            self.assertEqual(f.read(), b'media3')
+        self.assertEqual(self.leftover_parts(), [])
+
+    def test_batch_continues_single_uploads(self):
+        self.upload_batch('batch_continue_key', batch_part(0, 'Initialization', 0, b'init') + batch_part(1))
+        stream = hls_relay.streams['batch_continue_key']
+        response = self.upload_batch('batch_continue_key', batch_part(2) + batch_part(3) + batch_part(4, 'Finalization', 0, b''))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(stream.written_segment_count, 4)
+        self.assertTrue(stream.finalized)
+        with open(stream.playlist_file) as f:
+            self.assertTrue(f.read().endswith('#EXT-X-ENDLIST\n'))
+
+    def test_new_period_inside_batch_keeps_earlier_segments(self):
+        body = (
+            batch_part(0, 'Initialization', 0, b'init')
+            + batch_part(1) + batch_part(2)
+            + batch_part(3, 'Initialization', 0, b'init2')
+            + batch_part(4)
+        )
+
+        self.upload_batch('batch_period_key', body)
+
+        stream = hls_relay.streams['batch_period_key']
+        self.assertEqual(
+            [entry['name'] for entry in stream.playlist_entries],
+            ['p0_segment_000001.m4s', 'p0_segment_000002.m4s', 'p1_segment_000004.m4s'],
+        )
+        self.assertEqual(stream.playlist_entries[-1]['map'], 'p1_segment_000003.mp4')
+
+    def test_parts_can_name_their_rendition(self):
+        body = (
+            batch_part(0, 'Initialization', 0, b'init') + batch_part(1)
+            + batch_part(0, 'Initialization', 0, b'init', Rendition='low') + batch_part(1, Rendition='low')
+        )
+
+        self.upload_batch('batch_rendition_key', body)
+
+        stream = hls_relay.streams['batch_rendition_key']
+        self.assertEqual(stream.written_segment_count, 1)
+        self.assertEqual(stream.renditions['low'].written_segment_count, 1)
+
+    def test_malformed_body_is_rejected_without_leftovers(self):
+        cases = {
+            'missing length': b'Segment-Type: Media\r\nDiscontinuity: false\r\nDuration: 2\r\nSequence: 1\r\n\r\ndata',
+            'truncated data': batch_part(0, 'Initialization', 0, b'init') + batch_part(1, data=b'data')[:-4],
+            'missing header': batch_part(0, 'Initialization', 0, b'init').replace(b'Sequence: 0\r\n', b''),
+            'empty': b'',
+        }
+        for name, body in cases.items():
+            with self.subTest(name):
+                response = self.upload_batch('batch_bad_key', body)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(self.leftover_parts(), [])
+        self.assertNotIn('batch_bad_key', hls_relay.streams)
+
+    def test_batch_size_is_limited(self):
+        body = batch_part(0, 'Initialization', 0, b'init') + batch_part(1) + batch_part(2)
+
+        read_batch_part_data = hls_relay.read_batch_part_data
+        with patch('hls_relay.BATCH_MAX_SEGMENTS', 2), \
+             patch('hls_relay.read_batch_part_data', side_effect=read_batch_part_data) as mock_read:
+            response = self.upload_batch('batch_limit_key', body)
+
+        self.assertEqual(response.status_code, 413)
+        # The third part is refused before its data is written to disk
+        self.assertEqual(mock_read.call_count, 2)
+        self.assertEqual(self.leftover_parts(), [])
+
+    def test_parts_stored_before_a_failed_part_are_applied_and_reported(self):
+        self.upload_batch('batch_partial_key', batch_part(0, 'Initialization', 0, b'init') + batch_part(1))
+
+        with patch('hls_relay.MAX_PENDING_REORDER_BYTES', 3):
+            # Sequence 4 would wait behind the gap at 3, beyond the reorder buffer limit
+            response = self.upload_batch('batch_partial_key', batch_part(2) + batch_part(4) + batch_part(3))
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.headers['Parts-Consumed'], '1')
+        self.assertEqual(response.headers['Failed-Status'], '503')
+        self.assertIn('1 segments uploaded from the first 1 parts; part 2 failed with 503', response.get_data(as_text=True))
+        stream = hls_relay.streams['batch_partial_key']
+        self.assertEqual([entry['name'] for entry in stream.playlist_entries], ['p0_segment_000001.m4s', 'p0_segment_000002.m4s'])
+        self.assertEqual(self.leftover_parts(), [])
+
+        # Nothing stored: the failed part's own response
+        with patch('hls_relay.MAX_PENDING_REORDER_BYTES', 3):
+            response = self.upload_batch('batch_partial_key', batch_part(4))
+        self.assertEqual(response.status_code, 503)
+
+    def test_relay_error_after_applied_parts_is_a_partial_result(self):
+        body = batch_part(0, 'Initialization', 0, b'init') + b''.join(batch_part(seq) for seq in (1, 2, 3))
+
+        with patch.object(hls_relay.Relay, 'ensure_running', side_effect=RuntimeError('ffmpeg failed to start')):
+            response = self.upload_batch('batch_relay_key', body, Target='youtube')
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.headers['Parts-Consumed'], '4')
+        self.assertEqual(response.headers['Relay-Status'], '500')
+        self.assertNotIn('Failed-Status', response.headers)
+        self.assertIn('relays failed with 500: Error starting ffmpeg relay: ffmpeg failed to start', response.get_data(as_text=True))
+        self.assertEqual(hls_relay.streams['batch_relay_key'].written_segment_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestCrashRecovery(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, segment_type, sequence, stream_id=None, target='passive'):
+        headers = {
+            **self.auth_headers,
+            'Target': target,
+            'Stream-Key': stream_key,
+            'Segment-Type': segment_type,
+            'Discontinuity': 'false',
+            'Duration': '0' if segment_type == 'Initialization' else '2.0',
+            'Sequence': str(sequence),
+        }
+        if stream_id is not None:
+            headers['Stream-ID'] = stream_id
+        return self.client.post('/upload_segment', headers=headers, data=b'data%d' % sequence, environ_overrides={'REMOTE_ADDR': '127.0.0.1'})
+
+    def crashed_stream(self, stream_key, segments, stream_id=None):
+        """Upload a stream, then forget it as a crash of the relay process would"""
+        self.upload(stream_key, 'Initialization', 0, stream_id)
+        for seq in range(1, segments + 1):
+            self.upload(stream_key, 'Media', seq, stream_id)
+        with hls_relay.stream_creation_lock:
+            stream = hls_relay.streams.pop(stream_key)
+        stream.check_missing_segments_stop_event.set()
+        return stream
+
+    def test_recent_unfinalized_streams_are_restored(self):
+        self.crashed_stream('recover_key', 3)
+        old = self.crashed_stream('recover_old_key', 3)
+        old_time = time.time() - hls_relay.RECOVERY_MAX_AGE - 1
+        os.utime(old.playlist_file, (old_time, old_time))
+        finished = self.crashed_stream('recover_done_key', 3)
+        finished.finalize_playlist()
+
+        recovered = hls_relay.recover_streams()
+
+        self.assertEqual([stream.stream_key for stream in recovered], ['recover_key'])
+        stream = hls_relay.streams['recover_key']
+        self.assertEqual(stream.written_segment_count, 3)
+        self.assertTrue(stream.check_missing_segments_started)
+        self.assertNotIn('recover_old_key', hls_relay.streams)
+        self.assertNotIn('recover_done_key', hls_relay.streams)
+
+        # The returning client continues the recovered stream
+        self.assertEqual(self.upload('recover_key', 'Media', 4, stream.timestamp).status_code, 200)
+        self.assertIs(hls_relay.streams['recover_key'], stream)
+        self.assertEqual(stream.written_segment_count, 4)
+
+    def test_newest_stream_of_a_key_is_restored(self):
+        older = self.crashed_stream('recover_newest_key', 2, stream_id='older')
+        newer = self.crashed_stream('recover_newest_key', 2, stream_id='newer')
+        old_time = time.time() - 10
+        os.utime(older.playlist_file, (old_time, old_time))
+
+        hls_relay.recover_streams()
+
+        self.assertEqual(hls_relay.streams['recover_newest_key'].stream_dir, newer.stream_dir)
+
+    def test_reconnected_client_is_not_replaced(self):
+        crashed = self.crashed_stream('recover_race_key', 2)
+        self.upload('recover_race_key', 'Media', 3, crashed.timestamp)
+        current = hls_relay.streams['recover_race_key']
+
+        self.assertEqual(hls_relay.recover_streams(), [])
+        self.assertIs(hls_relay.streams['recover_race_key'], current)
+
+    def test_relays_are_prelaunched_at_the_live_edge(self):
+        crashed = self.crashed_stream('recover_relay_key', 4)
+        crashed.journal.append('relay_start', target='youtube', stream_key_target=True, engine='ffmpeg', start_index=0)
+
+        with patch('hls_relay.RECOVERY_PRELAUNCH_RELAYS', True), \
+             patch.object(hls_relay.StreamState, 'start_ffmpeg_relay') as mock_start:
+            hls_relay.recover_streams()
+
+        mock_start.assert_called_once_with('youtube', 'recover_relay_key', live_start_index=3)
+        stream = hls_relay.streams['recover_relay_key']
+        self.assertEqual(stream.restored_relay_targets, {'youtube': 'recover_relay_key'})
+        self.assertFalse(stream.just_restored)
+
+    def test_separate_destination_keys_are_not_persisted(self):
+        crashed = self.crashed_stream('recover_secret_key', 4)
+        crashed.get_relay('youtube', 'recover_secret_key')
+        crashed.get_relay('twitch', 'separate_twitch_key')
+        crashed.write_checkpoint()
+        crashed.journal.append('relay_start', target='twitch', stream_key_target=False, engine='ffmpeg', start_index=0)
+        crashed.journal.close()
+        for name in os.listdir(crashed.stream_dir):
+            with open(os.path.join(crashed.stream_dir, name), 'rb') as f:
+                self.assertNotIn(b'separate_twitch_key', f.read(), name)
+
+        with patch('hls_relay.RECOVERY_PRELAUNCH_RELAYS', True), \
+             patch.object(hls_relay.StreamState, 'start_ffmpeg_relay') as mock_start:
+            hls_relay.recover_streams()
+
+        # The twitch key is only known again once the client resends it
+        mock_start.assert_called_once_with('youtube', 'recover_secret_key', live_start_index=3)
+
+    def test_abandoned_recovered_stream_is_finalized(self):
+        self.crashed_stream('recover_abandoned_key', 2)
+
+        with patch('hls_relay.MISSING_SEGMENT_TIMEOUT', 0):
+            stream = hls_relay.recover_streams()[0]
+            deadline = time.time() + 5
+            while not stream.finalized and time.time() < deadline:
+                time.sleep(0.05)
+
+        self.assertTrue(stream.finalized)
+        self.assertNotIn('recover_abandoned_key', hls_relay.streams)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestDiskHealth(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.health = hls_relay.DiskHealth()
+        self.patchers = [
+            patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir),
+            patch('hls_relay.disk_health', self.health),
+            patch('hls_relay.resource_governor', hls_relay.ResourceGovernor()),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, sequence):
+        return self.client.post('/upload_segment', data=b'data%d' % sequence, headers={
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': 'Initialization' if sequence == 0 else 'Media',
+            'Discontinuity': 'false',
+            'Duration': '0' if sequence == 0 else '2.0',
+            'Sequence': str(sequence),
+        })
+
+    def test_writes_and_appends_are_timed(self):
+        self.upload('disk_timed_key', 0)
+        self.upload('disk_timed_key', 1)
+
+        self.assertIsNotNone(self.health.latency('segment_write'))
+        self.assertIsNotNone(self.health.latency('playlist_append'))
+        self.assertEqual(self.health.assess(None, None), ('ok', []))
+
+    def test_slow_disk_is_degraded_and_logged_to_every_stream(self):
+        self.upload('disk_slow_key', 0)
+        stream = hls_relay.streams['disk_slow_key']
+        for _ in range(20):
+            self.health.record('playlist_append', hls_relay.DISK_LATENCY_DEGRADED * 2)
+
+        level, reasons = self.health.assess(10 ** 15, None)
+        self.health.apply(level, reasons, 10 ** 15)
+
+        self.assertEqual(level, 'degraded')
+        self.assertTrue(self.health.active('memory_tier'))
+        self.assertFalse(self.health.active('refuse_streams'))
+        self.assertIn('Disk degraded (playlist_append p95', stream.events[-1]['message'])
+        self.assertIn('started memory_tier', stream.events[-1]['message'])
+        # Old samples fall out of the window
+        with patch('hls_relay.DISK_LATENCY_WINDOW', -1):
+            self.assertEqual(self.health.assess(10 ** 15, None), ('ok', []))
+
+    def test_low_space_refuses_new_streams_and_reclaims_space(self):
+        self.upload('disk_existing_key', 0)
+        free = hls_relay.DISK_FREE_CRITICAL_BYTES - 1
+        actions = ['drop_archive', 'memory_tier', 'emergency_retention', 'refuse_streams']
+        with patch('shutil.disk_usage', return_value=SimpleNamespace(free=free)), \
+             patch.dict('hls_relay.DISK_HEALTH_ACTIONS', {'critical': actions}), \
+             patch('hls_relay.RETENTION_MAX_AGE', 86400), \
+             patch.object(hls_relay.retention_manager, 'run_pass') as mock_run_pass:
+            self.health.check()
+            self.health.emergency_thread.join(5)
+
+        self.assertEqual(self.health.level, 'critical')
+        mock_run_pass.assert_called_once_with(reclaim_bytes=hls_relay.DISK_FREE_DEGRADED_BYTES - free)
+        response = self.upload('disk_new_key', 0)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(hls_relay.resource_governor.rejections['disk'], 1)
+        self.assertEqual(self.upload('disk_existing_key', 1).status_code, 200)
+
+        self.health.apply('ok', [], 10 ** 15)
+        self.assertEqual(self.upload('disk_new_key', 0).status_code, 200)
+        self.assertIn('stopped drop_archive, emergency_retention, memory_tier, refuse_streams',
+                      hls_relay.streams['disk_existing_key'].events[-1]['message'])
+
+    def test_low_space_deletes_nothing_by_default(self):
+        free = hls_relay.DISK_FREE_CRITICAL_BYTES - 1
+        with patch('shutil.disk_usage', return_value=SimpleNamespace(free=free)), \
+             patch.object(hls_relay.retention_manager, 'run_pass') as mock_run_pass:
+            self.health.check()
+            self.assertEqual(self.upload('disk_default_key', 0).status_code, 200)
+            # Opting into emergency retention still needs a retention policy
+            with patch.dict('hls_relay.DISK_HEALTH_ACTIONS', {'critical': ['emergency_retention']}):
+                self.health.check()
+
+        self.assertEqual(self.health.level, 'critical')
+        self.assertIsNone(self.health.emergency_thread)
+        mock_run_pass.assert_not_called()
+
+    def test_failing_probe_is_critical(self):
+        with patch('os.fsync', side_effect=OSError(5, 'Input/output error')):
+            self.health.check()
+
+        self.assertEqual(self.health.level, 'critical')
+        self.assertIn('probe write failed', self.health.status()['reasons'][0])
+
+    def test_degraded_disk_keeps_segments_in_memory_and_archives_unless_told_not_to(self):
+        hot_dir = tempfile.mkdtemp()
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, hot_dir)
+        self.addCleanup(shutil.rmtree, archive_dir)
+        self.health.apply('degraded', ['test'], None)
+
+        with patch('hls_relay.HOT_TIER_DIR', hot_dir), patch('hls_relay.hot_tier', hls_relay.HotTier()):
+            hls_relay.hot_tier.thread = True
+            self.upload('disk_hot_key', 0)
+            self.assertEqual(hls_relay.hot_tier.move_consumed(now=time.time() + hls_relay.HOT_TIER_HOLD), 0)
+        stream_dir = hls_relay.streams['disk_hot_key'].stream_dir
+        self.assertTrue(os.listdir(os.path.join(hot_dir, os.path.basename(stream_dir))))
+
+        # Archived directories are only deleted instead when drop_archive is added
+        manager = hls_relay.RetentionManager()
+        os.makedirs(os.path.join(manager.trash_dir(), 'disk_kept_stream'))
+        with open(os.path.join(manager.trash_dir(), 'disk_kept_stream', 'playlist.m3u8'), 'w') as f:
+            f.write('#EXTM3U\n')
+        with patch('hls_relay.RETENTION_ARCHIVE_DIR', archive_dir):
+            manager.run_pass()
+        self.assertEqual(os.listdir(archive_dir), ['disk_kept_stream'])
+
+        with patch.dict('hls_relay.DISK_HEALTH_ACTIONS', {'degraded': ['drop_archive', 'memory_tier']}):
+            self.health.apply('degraded', ['test'], None)
+        os.makedirs(os.path.join(manager.trash_dir(), 'disk_old_stream'))
+        with patch('hls_relay.RETENTION_ARCHIVE_DIR', archive_dir):
+            manager.run_pass()
+        self.assertEqual(os.listdir(archive_dir), ['disk_kept_stream'])
+        self.assertEqual(manager.status()['removed_dirs'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
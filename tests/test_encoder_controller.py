@@ -0,0 +1,100 @@
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class TestEncoderController(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def feed(self, controller, speed, start=1000.0):
+        for offset in range(hls_relay.ENCODER_SAMPLE_WINDOW):
+            controller.record_speed(speed, now=start + offset)
+        return start + hls_relay.ENCODER_SAMPLE_WINDOW
+
+    def test_starts_with_default_preset_and_max_bitrate(self):
+        controller = hls_relay.EncoderController()
+
+        args = controller.video_args()
+
+        self.assertEqual(args[args.index('-preset') + 1], hls_relay.X264_DEFAULT_PRESET)
+        self.assertEqual(args[args.index('-b:v') + 1], f'{hls_relay.X264_BITRATE_MAX_KBPS}k')
+        self.assertEqual(args[args.index('-bufsize') + 1], f'{hls_relay.X264_BITRATE_MAX_KBPS * 2}k')
+
+    def test_slow_encode_steps_preset_then_bitrate_down(self):
+        controller = hls_relay.EncoderController()
+        now = 1000.0
+        changes = []
+        for _ in range(4):
+            now = self.feed(controller, 0.8, start=now + hls_relay.ENCODER_ADJUST_COOLDOWN)
+            changes.append(controller.decide(cpu_headroom=0.0, now=now))
+
+        self.assertTrue(all(changes))
+        self.assertEqual(controller.preset, 'ultrafast')
+        self.assertEqual(controller.bitrate_kbps, hls_relay.X264_BITRATE_MAX_KBPS - 2 * hls_relay.X264_BITRATE_STEP_KBPS)
+
+    def test_changes_respect_cooldown_and_sample_window(self):
+        controller = hls_relay.EncoderController()
+        controller.record_speed(0.5, now=1000.0)
+        self.assertIsNone(controller.decide(cpu_headroom=0.0, now=1000.0))
+
+        now = self.feed(controller, 0.5)
+        self.assertIsNotNone(controller.decide(cpu_headroom=0.0, now=now))
+        self.assertIsNone(controller.decide(cpu_headroom=0.0, now=now + 1))
+
+    def test_spare_cpu_restores_bitrate_before_slower_preset(self):
+        controller = hls_relay.EncoderController()
+        controller.bitrate_kbps = hls_relay.X264_BITRATE_MAX_KBPS - hls_relay.X264_BITRATE_STEP_KBPS
+
+        now = self.feed(controller, 1.0)
+        self.assertIsNotNone(controller.decide(cpu_headroom=0.8, now=now))
+        self.assertEqual(controller.bitrate_kbps, hls_relay.X264_BITRATE_MAX_KBPS)
+        self.assertEqual(controller.preset, hls_relay.X264_DEFAULT_PRESET)
+
+        now = self.feed(controller, 1.0, start=now + hls_relay.ENCODER_ADJUST_COOLDOWN)
+        self.assertIsNotNone(controller.decide(cpu_headroom=0.8, now=now))
+        self.assertEqual(controller.preset, 'faster')
+
+    def test_realtime_without_headroom_keeps_settings(self):
+        controller = hls_relay.EncoderController()
+
+        now = self.feed(controller, 1.0)
+
+        self.assertIsNone(controller.decide(cpu_headroom=0.1, now=now))
+        self.assertIsNone(controller.decide(cpu_headroom=None, now=now))
+
+    def test_speed_is_parsed_from_ffmpeg_progress(self):
+        line = 'frame= 1201 fps= 29 q=28.0 size=   20480kB time=00:00:40.03 bitrate=4191.2kbits/s speed=0.962x'
+
+        self.assertEqual(hls_relay.FFMPEG_SPEED_RE.search(line).group(1), '0.962')
+
+    def test_relay_restarts_after_next_fetched_segment_with_new_settings(self):
+        stream = hls_relay.StreamState('encoder_key')
+        relay = stream.get_relay('twitch', 'encoder_key')
+        relay.video_mode = 'transcode'
+        relay.process = MagicMock()
+        relay.process.poll.return_value = None
+        relay.position = (7, 16.0)
+        stream.written_segment_count = 10
+        self.feed(relay.encoder, 0.7, start=0.0)
+
+        with patch.object(hls_relay.cpu_monitor, 'headroom', return_value=0.0):
+            relay.check_encoder()
+
+        self.assertEqual(relay.restart_request[1], 8)
+        self.assertIn('veryfast/8000k -> superfast/8000k', relay.restart_request[0])
+        command = relay.build_command(live_start_index=8)
+        self.assertEqual(command[command.index('-preset') + 1], 'superfast')
+
+
+if __name__ == '__main__':
+    unittest.main()
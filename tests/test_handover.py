@@ -0,0 +1,241 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from base64 import b64encode
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class ExecCalled(Exception):
+    pass
+
+
+class TestHandover(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+        self.children = []
+        # Test client responses are not closed, so they would keep counting as requests in progress
+        self.drain_patcher = patch('hls_relay.HANDOVER_DRAIN_TIMEOUT', 0.01)
+        self.drain_patcher.start()
+
+    def tearDown(self):
+        for child in self.children:
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+        self.drain_patcher.stop()
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, segment_type, sequence, rendition=None):
+        headers = {
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': segment_type,
+            'Discontinuity': 'false',
+            'Duration': '0' if segment_type == 'Initialization' else '2.0',
+            'Sequence': str(sequence),
+        }
+        if rendition is not None:
+            headers['Rendition'] = rendition
+        return self.client.post('/upload_segment', headers=headers, data=b'data%d' % sequence, environ_overrides={'REMOTE_ADDR': '127.0.0.1'})
+
+    def make_stream(self, stream_key, segments):
+        self.upload(stream_key, 'Initialization', 0)
+        for seq in range(1, segments + 1):
+            self.upload(stream_key, 'Media', seq)
+        return hls_relay.streams[stream_key]
+
+    def hand_over_in_memory(self, stream):
+        """Handover state as the new process reads it, after forgetting the stream"""
+        hls_relay.stop_native_uploads([stream])
+        state = json.loads(json.dumps(stream.handover_state()))
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        return state
+
+    def test_ffmpeg_child_and_pending_segments_are_taken_over(self):
+        stream = self.make_stream('handover_key', 3)
+        self.upload('handover_key', 'Media', 5)
+        self.upload('handover_key', 'Initialization', 0, rendition='low')
+        child = subprocess.Popen(
+            [sys.executable, '-c', 'import time; print("frame=1", flush=True); time.sleep(30)'],
+            stdout=subprocess.PIPE, text=True, bufsize=1,
+        )
+        self.children.append(child)
+        relay = stream.get_relay('twitch', 'handover_key')
+        relay.process = child
+        relay.video_mode = 'transcode'
+        relay.encoder.preset_index = 0
+
+        state = self.hand_over_in_memory(stream)
+        # The new process owns its own copy of the output pipe
+        state['relays'][0]['stdout_fd'] = os.dup(child.stdout.fileno())
+        child.stdout.close()
+        taken = hls_relay.StreamState.take_over(state)
+
+        self.assertEqual(taken.written_segment_count, 3)
+        self.assertEqual(taken.arrived_segments[5]['filename'], 'p0_segment_000005.m4s')
+        self.assertIn('low', taken.renditions)
+        adopted = taken.relays['twitch']
+        self.assertIsInstance(adopted.process, hls_relay.AdoptedProcess)
+        self.assertEqual(adopted.process.pid, child.pid)
+        self.assertTrue(adopted.is_running())
+        self.assertEqual((adopted.video_mode, adopted.encoder.preset_index), ('transcode', 0))
+
+        adopted.stop()
+        self.assertEqual(adopted.last_exit, {'code': -15, 'signal': None})
+        self.assertIsNone(adopted.process)
+
+    def test_native_upload_continues_its_remote_playlist(self):
+        stream = self.make_stream('handover_native_key', 4)
+        uploads = []
+
+        def fake_request(method, url, body=None, headers=None, timeout=30):
+            uploads.append((url.split('file=')[1], body))
+            return 200, b''
+
+        with patch('hls_relay.RELAY_ENGINES', {'youtube': 'native'}), \
+             patch.object(hls_relay.upload_pool, 'request', side_effect=fake_request):
+            stream.start_ffmpeg_relay('youtube', 'key', live_start_index=0)
+            relay = stream.relays['youtube']
+            deadline = time.time() + 5
+            while relay.position != (3, 8.0) and time.time() < deadline:
+                time.sleep(0.01)
+
+            state = self.hand_over_in_memory(stream)
+            taken = hls_relay.StreamState.take_over(state)
+            hls_relay.streams['handover_native_key'] = taken
+            self.upload('handover_native_key', 'Media', 5)
+            adopted = taken.relays['youtube']
+            deadline = time.time() + 5
+            while adopted.position != (4, 10.0) and time.time() < deadline:
+                time.sleep(0.01)
+            adopted.stop()
+
+        files = [name for name, _ in uploads]
+        self.assertEqual(files.count('p0_segment_000004.m4s'), 1)
+        playlist = [body for name, body in uploads if name == 'media.m3u8'][-1].decode()
+        self.assertIn('#EXT-X-MEDIA-SEQUENCE:0', playlist)
+        self.assertNotIn('#EXT-X-DISCONTINUITY\n', playlist)
+        self.assertTrue(playlist.endswith('p0_segment_000004.m4s\n#EXTINF:2.000000,\np0_segment_000005.m4s\n'))
+
+    def test_native_uploads_are_stopped_together_before_the_streams_are_locked(self):
+        streams = [self.make_stream('handover_wait_key_%d' % i, 2) for i in range(2)]
+        calls = []
+
+        def lock_is_free(stream):
+            result = []
+
+            def check():
+                result.append(stream.playlist_lock.acquire(blocking=False))
+                if result[0]:
+                    stream.playlist_lock.release()
+
+            checker = threading.Thread(target=check)
+            checker.start()
+            checker.join()
+            return result[0]
+
+        terminate = hls_relay.NativeHlsUploader.terminate
+        wait = hls_relay.NativeHlsUploader.wait
+
+        def record_terminate(uploader):
+            calls.append('terminate')
+            terminate(uploader)
+
+        def record_wait(uploader, timeout=None):
+            calls.append(('wait', all(lock_is_free(stream) for stream in streams)))
+            return wait(uploader, timeout)
+
+        server = SimpleNamespace(accepting=True, trigger=MagicMock())
+        listen_socket = MagicMock()
+        listen_socket.fileno.return_value = 1234
+        with patch('hls_relay.RELAY_ENGINES', {'youtube': 'native'}), \
+             patch.object(hls_relay.upload_pool, 'request', return_value=(200, b'')):
+            for stream in streams:
+                stream.start_ffmpeg_relay('youtube', stream.stream_key, live_start_index=0)
+            with patch.object(hls_relay.NativeHlsUploader, 'terminate', record_terminate), \
+                 patch.object(hls_relay.NativeHlsUploader, 'wait', record_wait), \
+                 patch('os.execv', side_effect=ExecCalled), \
+                 patch('os.set_inheritable'), \
+                 patch.dict(os.environ):
+                with self.assertRaises(ExecCalled):
+                    hls_relay.hand_over(server, listen_socket)
+                path = os.environ[hls_relay.HANDOVER_ENV]
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+                os.remove(path)
+            for stream in streams:
+                stream.playlist_lock.release()
+
+        self.assertEqual(calls[:4], ['terminate', 'terminate', ('wait', True), ('wait', True)])
+
+    def test_drain_waits_for_streamed_responses(self):
+        drain = hls_relay.RequestDrain(lambda environ, start_response: iter([b'a', b'b']))
+
+        response = drain({}, None)
+        self.assertFalse(drain.drain(0.01))
+        list(response)
+        response.close()
+
+        self.assertTrue(drain.drain(0.01))
+
+    def test_hand_over_passes_socket_and_streams_to_the_new_process(self):
+        self.make_stream('handover_exec_key', 2)
+        server = SimpleNamespace(accepting=True, trigger=MagicMock())
+        listen_socket = MagicMock()
+        listen_socket.fileno.return_value = 1234
+
+        with patch('os.execv', side_effect=ExecCalled) as mock_exec, \
+             patch('os.set_inheritable') as mock_inheritable, \
+             patch.dict(os.environ):
+            with self.assertRaises(ExecCalled):
+                hls_relay.hand_over(server, listen_socket)
+            self.assertFalse(server.accepting)
+            mock_exec.assert_called_once_with(sys.executable, sys.orig_argv)
+            mock_inheritable.assert_called_once_with(1234, True)
+            with hls_relay.stream_creation_lock:
+                hls_relay.streams.clear()
+
+            with patch('socket.socket') as mock_socket:
+                self.assertIs(hls_relay.take_over_from_previous_process(), mock_socket.return_value)
+            mock_socket.assert_called_once_with(fileno=1234)
+            self.assertNotIn(hls_relay.HANDOVER_ENV, os.environ)
+
+        self.assertEqual(hls_relay.streams['handover_exec_key'].written_segment_count, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, hls_relay.HANDOVER_FILE)))
+
+    def test_hand_over_is_cancelled_when_the_new_version_does_not_compile(self):
+        script = os.path.join(self.test_dir, 'broken.py')
+        with open(script, 'w') as f:
+            f.write('def broken(:\n')
+        server = SimpleNamespace(accepting=True, trigger=MagicMock())
+
+        with patch.object(sys, 'argv', [script]), patch('os.execv') as mock_exec:
+            hls_relay.hand_over(server, MagicMock())
+
+        mock_exec.assert_not_called()
+        self.assertTrue(server.accepting)
+        self.assertIsNone(hls_relay.take_over_from_previous_process())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class TestHotTier(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.hot_dir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir),
+            patch('hls_relay.HOT_TIER_DIR', self.hot_dir),
+            patch('hls_relay.hot_tier', hls_relay.HotTier()),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        # Segments are moved by the tests, not by a background thread
+        hls_relay.hot_tier.thread = MagicMock()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+        shutil.rmtree(self.hot_dir)
+
+    def upload(self, stream_key, sequence, data=None):
+        return self.client.post('/upload_segment', data=data or b'data%d' % sequence, headers={
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': 'Initialization' if sequence == 0 else 'Media',
+            'Discontinuity': 'false',
+            'Duration': '0' if sequence == 0 else '2.0',
+            'Sequence': str(sequence),
+        })
+
+    def make_stream(self, stream_key, segments):
+        for sequence in range(segments + 1):
+            self.upload(stream_key, sequence)
+        return hls_relay.streams[stream_key]
+
+    def hot_path(self, stream, name):
+        return os.path.join(self.hot_dir, stream.stream_id, name)
+
+    def cold_path(self, stream, name):
+        return os.path.join(stream.stream_dir, name)
+
+    def fetch(self, stream, name):
+        return self.client.get(f'/segments/{stream.stream_id}/{name}', environ_overrides={'REMOTE_ADDR': '127.0.0.1'})
+
+    def test_segments_are_written_to_the_hot_tier_and_served_from_it(self):
+        stream = self.make_stream('hot_key', 2)
+
+        self.assertTrue(os.path.exists(self.hot_path(stream, 'p0_segment_000002.m4s')))
+        self.assertFalse(os.path.exists(self.cold_path(stream, 'p0_segment_000002.m4s')))
+        self.assertTrue(os.path.exists(stream.playlist_file))
+        self.assertEqual(self.fetch(stream, 'p0_segment_000002.m4s').get_data(), b'data2')
+
+    def test_segments_move_once_every_running_relay_fetched_them(self):
+        stream = self.make_stream('hot_relay_key', 2)
+        relays = [stream.get_relay('youtube', 'key'), stream.get_relay('twitch', 'key')]
+        for relay in relays:
+            relay.process = MagicMock(**{'poll.return_value': None})
+
+        relays[0].note_fetch('p0_segment_000002.m4s')
+        relays[1].note_fetch('p0_segment_000001.m4s')
+        hls_relay.hot_tier.move_consumed()
+
+        self.assertTrue(os.path.exists(self.cold_path(stream, 'p0_segment_000001.m4s')))
+        self.assertFalse(os.path.exists(self.hot_path(stream, 'p0_segment_000001.m4s')))
+        self.assertTrue(os.path.exists(self.hot_path(stream, 'p0_segment_000002.m4s')))
+        # The init segment is not in the playlist, so it waits for HOT_TIER_HOLD
+        self.assertTrue(os.path.exists(self.hot_path(stream, 'p0_segment_000000.mp4')))
+        self.assertEqual(self.fetch(stream, 'p0_segment_000001.m4s').get_data(), b'data1')
+
+        hls_relay.hot_tier.move_consumed(now=time.time() + hls_relay.HOT_TIER_HOLD)
+        self.assertTrue(os.path.exists(self.hot_path(stream, 'p0_segment_000002.m4s')))
+
+    def test_unread_segments_move_after_the_hold_time(self):
+        stream = self.make_stream('hot_hold_key', 2)
+
+        self.assertEqual(hls_relay.hot_tier.move_consumed(), 0)
+        self.assertEqual(hls_relay.hot_tier.move_consumed(now=time.time() + hls_relay.HOT_TIER_HOLD), 3)
+
+        self.assertEqual(os.listdir(os.path.join(self.hot_dir, stream.stream_id)), [])
+        self.assertEqual(self.fetch(stream, 'p0_segment_000002.m4s').get_data(), b'data2')
+        self.assertEqual(hls_relay.hot_tier.status()['used_bytes'], 0)
+
+    def test_full_hot_tier_writes_to_disk_or_spills(self):
+        with patch('hls_relay.HOT_TIER_MAX_BYTES', 10):
+            stream = self.make_stream('hot_full_key', 1)
+            self.upload('hot_full_key', 2)
+            self.assertTrue(os.path.exists(self.hot_path(stream, 'p0_segment_000001.m4s')))
+            self.assertTrue(os.path.exists(self.cold_path(stream, 'p0_segment_000002.m4s')))
+            self.assertEqual(hls_relay.hot_tier.status()['written_to_disk'], 1)
+
+            with patch('hls_relay.HOT_TIER_OVERFLOW', 'spill'):
+                self.upload('hot_full_key', 3)
+                # The upload does not wait for the mover, which is woken to make room
+                self.assertTrue(os.path.exists(self.cold_path(stream, 'p0_segment_000003.m4s')))
+                self.assertTrue(hls_relay.hot_tier.wakeup.is_set())
+                self.assertEqual(hls_relay.hot_tier.spill(), 1)
+                self.upload('hot_full_key', 4)
+            self.assertTrue(os.path.exists(self.hot_path(stream, 'p0_segment_000004.m4s')))
+            self.assertTrue(os.path.exists(self.cold_path(stream, 'p0_segment_000000.mp4')))
+            self.assertFalse(os.path.exists(self.hot_path(stream, 'p0_segment_000000.mp4')))
+            self.assertEqual(hls_relay.hot_tier.status()['spilled'], 1)
+
+    def test_segments_behind_a_stalled_relay_move_after_the_max_hold(self):
+        stream = self.make_stream('hot_stalled_key', 2)
+        relay = stream.get_relay('youtube', 'key')
+        relay.process = MagicMock(**{'poll.return_value': None})
+        relay.note_fetch('p0_segment_000001.m4s')
+
+        hls_relay.hot_tier.move_consumed(now=time.time() + hls_relay.HOT_TIER_HOLD)
+        self.assertTrue(os.path.exists(self.hot_path(stream, 'p0_segment_000002.m4s')))
+
+        hls_relay.hot_tier.move_consumed(now=time.time() + hls_relay.HOT_TIER_MAX_HOLD)
+        self.assertFalse(os.path.exists(self.hot_path(stream, 'p0_segment_000002.m4s')))
+        self.assertTrue(os.path.exists(self.cold_path(stream, 'p0_segment_000002.m4s')))
+
+    def test_segment_rewritten_while_moving_stays_hot(self):
+        stream = self.make_stream('hot_rewrite_key', 1)
+        hot_path = self.hot_path(stream, 'p0_segment_000001.m4s')
+        copyfile = shutil.copyfile
+
+        def copy_then_rewrite(source, destination):
+            copyfile(source, destination)
+            if source == hot_path:
+                # A retransmit replaces the segment while it is copied
+                with open(hot_path + '.new', 'wb') as f:
+                    f.write(b'retransmitted')
+                os.replace(hot_path + '.new', hot_path)
+
+        with patch('shutil.copyfile', side_effect=copy_then_rewrite):
+            hls_relay.hot_tier.move_consumed(now=time.time() + hls_relay.HOT_TIER_HOLD)
+
+        self.assertEqual(self.fetch(stream, 'p0_segment_000001.m4s').get_data(), b'retransmitted')
+        hls_relay.hot_tier.move_consumed(now=time.time() + hls_relay.HOT_TIER_HOLD)
+        self.assertFalse(os.path.exists(hot_path))
+        with open(self.cold_path(stream, 'p0_segment_000001.m4s'), 'rb') as f:
+            self.assertEqual(f.read(), b'retransmitted')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import hls_relay
+
+
+def box(box_type, payload):
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+
+def make_init_segment(codec=b'avc1', profile=100, level=41, width=1920, height=1080, bit_depth=8, colr=None, extra_boxes=b''):
+    if codec in (b'avc1', b'avc3'):
+        avcc = (
+            bytes([1, profile, 0, level, 0xFF, 0xE1])
+            + struct.pack(">H", 4) + bytes([0x67, profile, 0x00, level])
+            + bytes([1]) + struct.pack(">H", 2) + b'\x68\xee'
+            + bytes([0xFC | 1, 0xF8 | (bit_depth - 8), 0xF8 | (bit_depth - 8), 0])
+        )
+        children = box(b'avcC', avcc)
+    else:
+        children = box(b'hvcC', b'\x01' + b'\x00' * 22)
+    if colr is not None:
+        children += box(b'colr', b'nclx' + struct.pack(">HHHB", *colr, 0))
+    children += extra_boxes
+
+    sample_entry = (
+        b'\x00' * 6 + b'\x00\x01' + b'\x00' * 16
+        + struct.pack(">HH", width, height)
+        + b'\x00\x48\x00\x00' * 2 + b'\x00' * 4 + b'\x00\x01' + b'\x00' * 32 + b'\x00\x18\xff\xff'
+        + children
+    )
+    stsd = box(b'stsd', b'\x00' * 4 + struct.pack(">I", 1) + box(codec, sample_entry))
+    hdlr = box(b'hdlr', b'\x00' * 8 + b'vide' + b'\x00' * 12 + b'video\x00')
+    trak = box(b'trak', box(b'mdia', hdlr + box(b'minf', box(b'stbl', stsd))))
+    return box(b'ftyp', b'iso5\x00\x00\x02\x00iso5') + box(b'moov', box(b'mvhd', b'\x00' * 100) + trak)
+
+
+class TestInitProbe(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def test_probe_reads_avc_profile_level_and_dimensions(self):
+        info = hls_relay.probe_init_segment(make_init_segment(colr=(1, 1, 1)))
+
+        self.assertEqual(info['codec'], 'avc1')
+        self.assertEqual((info['profile'], info['level']), (100, 41))
+        self.assertEqual((info['width'], info['height']), (1920, 1080))
+        self.assertEqual((info['bit_depth'], info['chroma_format']), (8, 1))
+        self.assertEqual(info['transfer_characteristics'], 1)
+        self.assertFalse(info['dolby_vision'])
+
+    def test_sdr_h264_can_be_copied_to_twitch(self):
+        copy_ok, reason = hls_relay.twitch_copy_decision(hls_relay.probe_init_segment(make_init_segment()))
+
+        self.assertTrue(copy_ok)
+        self.assertEqual(reason, 'H.264 profile 100@4.1 8-bit SDR')
+
+    def test_incompatible_sources_are_transcoded(self):
+        cases = {
+            'hevc': make_init_segment(codec=b'hvc1'),
+            'dolby vision entry': make_init_segment(codec=b'dvh1'),
+            'dolby vision config': make_init_segment(extra_boxes=box(b'dvvC', b'\x00' * 24)),
+            'hlg': make_init_segment(colr=(9, 18, 9)),
+            'pq': make_init_segment(colr=(9, 16, 9)),
+            'high 10': make_init_segment(profile=110, bit_depth=10),
+            'level': make_init_segment(level=51),
+            '4k': make_init_segment(width=3840, height=2160),
+        }
+        for name, data in cases.items():
+            with self.subTest(name):
+                copy_ok, _ = hls_relay.twitch_copy_decision(hls_relay.probe_init_segment(data))
+                self.assertFalse(copy_ok)
+
+        self.assertEqual(hls_relay.twitch_copy_decision(None), (False, 'init segment could not be parsed'))
+
+    def write_init(self, stream, name, data):
+        with open(os.path.join(stream.stream_dir, name), 'wb') as f:
+            f.write(data)
+
+    def test_twitch_relay_copies_compatible_video_and_logs_decision(self):
+        stream = hls_relay.StreamState('twitch_copy_key')
+        self.write_init(stream, 'p0_segment_000000.mp4', make_init_segment())
+        stream.initialize_playlist(0, 'p0_segment_000000.mp4')
+
+        with patch('subprocess.Popen') as mock_popen:
+            stream.start_ffmpeg_relay('twitch', 'twitch_copy_key', live_start_index=0)
+
+        command = mock_popen.call_args[0][0]
+        self.assertEqual(command[command.index('-c:v') + 1], 'copy')
+        self.assertNotIn('libx264', command)
+        self.assertTrue(any(event['message'] == 'Twitch video: copy (H.264 profile 100@4.1 8-bit SDR)' for event in stream.events))
+
+    def test_twitch_relay_transcodes_hevc(self):
+        stream = hls_relay.StreamState('twitch_hevc_key')
+        self.write_init(stream, 'p0_segment_000000.mp4', make_init_segment(codec=b'hvc1'))
+        stream.initialize_playlist(0, 'p0_segment_000000.mp4')
+
+        with patch('subprocess.Popen') as mock_popen:
+            stream.start_ffmpeg_relay('twitch', 'twitch_hevc_key', live_start_index=0)
+
+        command = mock_popen.call_args[0][0]
+        self.assertEqual(command[command.index('-c:v') + 1], 'libx264')
+        self.assertEqual(stream.relays['twitch'].video_mode, 'transcode')
+
+    def test_codec_change_in_new_period_restarts_at_period_boundary(self):
+        stream = hls_relay.StreamState('twitch_period_key')
+        self.write_init(stream, 'p0_segment_000000.mp4', make_init_segment())
+        stream.initialize_playlist(0, 'p0_segment_000000.mp4')
+        with patch('subprocess.Popen') as mock_popen:
+            mock_popen.return_value.poll.return_value = None
+            mock_popen.return_value.stdout = []
+            stream.start_ffmpeg_relay('twitch', 'twitch_period_key', live_start_index=0)
+        stream.written_segment_count = 5
+
+        self.write_init(stream, 'p1_segment_000000.mp4', make_init_segment(codec=b'hvc1'))
+        stream.init_segment_name = 'p1_segment_000000.mp4'
+        stream.check_relay_video_modes()
+
+        relay = stream.relays['twitch']
+        self.assertEqual(relay.restart_request[1], 5)
+
+        with patch.object(relay, 'stop') as mock_stop, \
+             patch.object(stream, 'start_ffmpeg_relay') as mock_start:
+            relay.ensure_running(5, False)
+            mock_start.assert_not_called()
+
+            relay.ensure_running(6, False)
+
+        mock_stop.assert_called_once()
+        mock_start.assert_called_once_with('twitch', 'twitch_period_key', live_start_index=5, realtime=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+import hls_relay
+
+
+class BlockedOutput(io.StringIO):
+    """An output whose writes wait until released, like a full pipe or a stalled disk"""
+
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+
+    def write(self, text):
+        self.released.wait(5)
+        return super().write(text)
+
+
+class TestLogPipeline(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = hls_relay.LogPipeline()
+        self.output = io.StringIO()
+
+    def records(self):
+        return [json.loads(line) for line in self.output.getvalue().splitlines()]
+
+    def test_records_are_written_as_json_lines_by_the_writer_thread(self):
+        with patch('sys.stdout', self.output):
+            self.pipeline.log('Saved segment', stream='key_1', sequence=3)
+            self.pipeline.log('Not shown', level='debug')
+            self.pipeline.flush()
+
+        [record] = self.records()
+        self.assertEqual((record['level'], record['message'], record['stream'], record['sequence']), ('info', 'Saved segment', 'key_1', 3))
+        self.assertIsNotNone(datetime.fromisoformat(record['time']))
+
+    def test_logging_does_not_wait_for_a_blocked_output(self):
+        output = BlockedOutput()
+        with patch('sys.stdout', output), patch('hls_relay.LOG_QUEUE_SIZE', 10):
+            pipeline = hls_relay.LogPipeline()
+            started = time.monotonic()
+            for n in range(300):
+                pipeline.log(f'record {n}')
+            self.assertLess(time.monotonic() - started, 1)
+            output.released.set()
+            pipeline.flush()
+
+        lines = output.getvalue().splitlines()
+        self.assertLess(len(lines), 300)
+        self.assertRegex(json.loads(lines[-1])['message'], r'^\d+ log records dropped, queue full$')
+
+    def test_info_records_are_rate_limited_per_stream(self):
+        with patch('sys.stdout', self.output), patch('hls_relay.LOG_STREAM_BURST', 3), patch('hls_relay.LOG_STREAM_RATE', 0.001):
+            for n in range(10):
+                self.pipeline.log(f'ffmpeg line {n}', stream='busy')
+            self.pipeline.log('Relay failed', level='error', stream='busy')
+            self.pipeline.log('Other stream', stream='quiet')
+            self.pipeline.buckets['busy'] = (1, time.monotonic(), self.pipeline.buckets['busy'][2])
+            self.pipeline.log('Later line', stream='busy')
+            self.pipeline.flush()
+
+        messages = [(record['message'], record.get('suppressed')) for record in self.records()]
+        self.assertEqual(messages, [
+            ('ffmpeg line 0', None), ('ffmpeg line 1', None), ('ffmpeg line 2', None),
+            ('Relay failed', None), ('Other stream', None), ('Later line', 7),
+        ])
+
+    def test_log_dir_gets_a_file_per_day(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        first_day = datetime(2024, 3, 1, 23, 59, 59).timestamp()
+        with patch('hls_relay.LOG_DIR', log_dir), patch('hls_relay.LOG_FORMAT', 'text'):
+            self.pipeline.write([{'time': first_day, 'level': 'info', 'message': 'Before midnight'}])
+            self.pipeline.write([{'time': first_day + 2, 'level': 'warning', 'message': 'After midnight', 'stream': 'key_1'}])
+            self.pipeline.file.close()
+
+        self.assertEqual(sorted(os.listdir(log_dir)), ['20240301.log', '20240302.log'])
+        with open(os.path.join(log_dir, '20240302.log')) as f:
+            self.assertEqual(f.read(), '2024-03-02T00:00:01.000 WARNING After midnight stream=key_1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import re
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir),
+            patch('hls_relay.metrics', hls_relay.RelayMetrics()),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, sequence, headers=None):
+        return self.client.post('/upload_segment', data=b'data%d' % sequence, headers={
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': 'Initialization' if sequence == 0 else 'Media',
+            'Discontinuity': 'false',
+            'Duration': '0' if sequence == 0 else '2.0',
+            'Sequence': str(sequence),
+            **(headers or {}),
+        })
+
+    def scrape(self):
+        response = self.client.get('/metrics', headers=self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        samples = {}
+        for line in response.get_data(as_text=True).splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_uploads_are_counted_and_timed(self):
+        for sequence in range(3):
+            self.upload('metrics_key', sequence)
+        self.upload('metrics_key', 3, {'Duration': 'x'})
+
+        samples = self.scrape()
+        self.assertEqual(samples['hls_relay_upload_requests_total{endpoint="segment",status="2xx"}'], 3)
+        self.assertEqual(samples['hls_relay_upload_requests_total{endpoint="segment",status="4xx"}'], 1)
+        self.assertEqual(samples['hls_relay_upload_request_duration_seconds_count{endpoint="segment"}'], 4)
+        self.assertEqual(samples['hls_relay_upload_body_bytes_bucket{endpoint="segment",le="4096.0"}'], 4)
+        self.assertEqual(samples['hls_relay_upload_body_bytes_sum{endpoint="segment"}'], 20)
+        self.assertEqual(samples['hls_relay_disk_operation_seconds_count{operation="segment_write"}'], 3)
+        self.assertEqual(samples['hls_relay_disk_operation_seconds_count{operation="playlist_append"}'], 3)
+        self.assertEqual(samples['hls_relay_playlist_update_seconds_count'], 3)
+        self.assertEqual(samples['hls_relay_active_streams'], 1)
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+
+    def test_reorder_depth_and_gap_skips(self):
+        for sequence in (0, 1, 3):
+            self.upload('metrics_gap_key', sequence)
+        self.assertEqual(self.scrape()['hls_relay_gap_skips_total'], 0)
+        with patch('hls_relay.GAP_SKIP_TIMEOUT', 0):
+            hls_relay.streams['metrics_gap_key'].update_playlist()
+
+        samples = self.scrape()
+        self.assertEqual(samples['hls_relay_gap_skips_total'], 1)
+        # Only the update after sequence 3 arrived behind the gap at 2 left a segment waiting
+        self.assertEqual(samples['hls_relay_reorder_depth_segments_count'], 4)
+        self.assertEqual(samples['hls_relay_reorder_depth_segments_bucket{le="0.0"}'], 3)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = hls_relay.Histogram('test_seconds', 'Test', (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        self.assertEqual(hls_relay.render_metric_families([(histogram.name, histogram.kind, histogram.help_text, histogram.samples())]), (
+            '# HELP test_seconds Test\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="0.1"} 2\n'
+            'test_seconds_bucket{le="1.0"} 3\n'
+            'test_seconds_bucket{le="+Inf"} 4\n'
+            'test_seconds_sum 3.65\n'
+            'test_seconds_count 4\n'
+        ))
+
+    def test_relay_exit_labels_stay_bounded(self):
+        hls_relay.metrics.record_exit('youtube', 1, None)
+        hls_relay.metrics.record_exit('youtube', None, 'SIGKILL')
+        hls_relay.metrics.record_exit('youtube', None, 'Permission denied: /some/path')
+        hls_relay.metrics.record_exit('twitch', 1, None)
+        hls_relay.metrics.relay_restarts.inc(target='twitch', cause='exit')
+
+        samples = self.scrape()
+        self.assertEqual(samples['hls_relay_relay_exits_total{target="youtube",exit="1"}'], 1)
+        self.assertEqual(samples['hls_relay_relay_exits_total{target="youtube",exit="killed"}'], 1)
+        self.assertEqual(samples['hls_relay_relay_exits_total{target="youtube",exit="error"}'], 1)
+        self.assertEqual(samples['hls_relay_relay_restarts_total{target="twitch",cause="exit"}'], 1)
+
+    def test_workers_metrics_are_merged_with_a_worker_label(self):
+        other = '# HELP hls_relay_gap_skips_total Skips\n# TYPE hls_relay_gap_skips_total counter\nhls_relay_gap_skips_total 4\n'
+        with patch('hls_relay.WORKER_PROCESSES', 2), \
+             patch('hls_relay.current_worker', hls_relay.Worker(0, None)), \
+             patch.object(hls_relay.worker_pool, 'request', return_value=(200, other.encode())) as mock_request:
+            text = self.client.get('/metrics', headers=self.auth_headers).get_data(as_text=True)
+
+        self.assertEqual(mock_request.call_args.args[1], f'http://127.0.0.1:{hls_relay.worker_port(1)}/metrics')
+        skips = re.search(r'# TYPE hls_relay_gap_skips_total counter\n((?:hls_relay_gap_skips_total.*\n)+)', text).group(1)
+        self.assertEqual(skips, 'hls_relay_gap_skips_total{worker="0"} 0\nhls_relay_gap_skips_total{worker="1"} 4\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class StandInIngest(ThreadingHTTPServer):
+    """Local stand-in for YouTube's HLS ingest that records every uploaded file"""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.uploads = []  # (cid, file, body, connection id)
+        self.failures = {}  # file -> number of 500 responses to send first
+        self.lock = threading.Lock()
+
+    def files(self):
+        with self.lock:
+            return [upload[1] for upload in self.uploads]
+
+    def last_body(self, file_name):
+        with self.lock:
+            return [upload[2] for upload in self.uploads if upload[1] == file_name][-1]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        file_name = query['file'][0]
+        with self.server.lock:
+            failures = self.server.failures.get(file_name, 0)
+            if failures:
+                self.server.failures[file_name] = failures - 1
+            else:
+                self.server.uploads.append((query['cid'][0], file_name, body, id(self.connection)))
+        self.send_response(500 if failures else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestNativeUpload(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.server = StandInIngest()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_address[1]}/upload?cid={{stream_key}}&file={{file}}'
+        self.patchers = [
+            patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir),
+            patch('hls_relay.YOUTUBE_UPLOAD_URL', url),
+            patch('hls_relay.RELAY_ENGINES', {'youtube': 'native', 'twitch': 'ffmpeg'}),
+            patch('hls_relay.NATIVE_UPLOAD_BACKOFF', 0.01),
+            patch('hls_relay.NATIVE_PLAYLIST_WINDOW', 3),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        hls_relay.upload_pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir)
+
+    def make_stream(self, key, count):
+        stream = hls_relay.StreamState(key)
+        with open(os.path.join(stream.stream_dir, 'p0_segment_000000.mp4'), 'wb') as f:
+            f.write(b'init')
+        stream.initialize_playlist(0, 'p0_segment_000000.mp4')
+        stream.last_playlist_sequence = 0
+        for seq in range(1, count + 1):
+            self.add_segment(stream, seq)
+        return stream
+
+    def add_segment(self, stream, seq, discontinuity=False):
+        name = f'p0_segment_{seq:06d}.m4s'
+        with open(os.path.join(stream.stream_dir, name), 'wb') as f:
+            f.write(b'media%d' % seq)
+        with stream.playlist_lock:
+            stream.arrived_segments[seq] = {'filename': name, 'duration': 2.0, 'is_init': False, 'discontinuity': discontinuity}
+            stream.update_playlist()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('condition not reached in time')
+
+    def test_uploads_init_segments_and_playlists_without_ffmpeg(self):
+        stream = self.make_stream('native_key', 3)
+
+        with patch('subprocess.Popen') as mock_popen:
+            stream.start_ffmpeg_relay('youtube', 'native_key', live_start_index=0)
+        relay = stream.relays['youtube']
+        self.wait_for(lambda: relay.position == (2, 6.0))
+
+        mock_popen.assert_not_called()
+        files = self.server.files()
+        self.assertEqual(files[:4], ['p0_segment_000000.mp4', 'p0_segment_000001.m4s', 'media.m3u8', 'master.m3u8'])
+        self.assertEqual(self.server.uploads[0][0], 'native_key')
+        self.assertIn('BANDWIDTH=', self.server.last_body('master.m3u8').decode())
+        playlist = self.server.last_body('media.m3u8').decode()
+        self.assertIn('#EXT-X-MAP:URI="p0_segment_000000.mp4"', playlist)
+        self.assertTrue(playlist.rstrip().endswith('p0_segment_000003.m4s'))
+        # All files go over one kept-alive connection
+        self.assertEqual(len({upload[3] for upload in self.server.uploads}), 1)
+        relay.stop()
+
+    def test_playlist_slides_and_ends_when_stream_is_finalized(self):
+        stream = self.make_stream('native_final_key', 3)
+        stream.start_ffmpeg_relay('youtube', 'native_final_key', live_start_index=0)
+        relay = stream.relays['youtube']
+        self.add_segment(stream, 4, discontinuity=True)
+        self.add_segment(stream, 5)
+
+        uploader = relay.process
+        stream.finalize_playlist()
+        self.assertEqual(uploader.wait(timeout=5), 0)
+
+        playlist = self.server.last_body('media.m3u8').decode()
+        self.assertIn('#EXT-X-MEDIA-SEQUENCE:2', playlist)
+        self.assertIn('#EXT-X-DISCONTINUITY\n#EXTINF:2.000000,\np0_segment_000004.m4s', playlist)
+        self.assertTrue(playlist.endswith('#EXT-X-ENDLIST\n'))
+        # Without a drain thread when the upload already ended before finalize_playlist() looked at it
+        self.wait_for(lambda: relay.last_exit is not None)
+        self.assertEqual(relay.last_exit, {'code': 0, 'signal': None})
+
+    def test_failed_upload_is_retried_with_backoff(self):
+        self.server.failures['p0_segment_000002.m4s'] = 2
+        stream = self.make_stream('native_retry_key', 3)
+        stream.start_ffmpeg_relay('youtube', 'native_retry_key', live_start_index=1)
+        relay = stream.relays['youtube']
+
+        self.wait_for(lambda: relay.position == (2, 6.0))
+
+        self.assertEqual(self.server.files().count('p0_segment_000002.m4s'), 1)
+        self.assertIsNone(relay.process.error)
+        relay.stop()
+
+    def test_request_is_only_resent_when_the_server_cannot_have_applied_it(self):
+        pool = hls_relay.HttpConnectionPool()
+        answered = MagicMock(**{'getresponse.return_value': MagicMock(status=200, will_close=True, **{'read.return_value': b'', 'getheaders.return_value': []})})
+
+        def acquire_stale(failure):
+            stale = MagicMock(**{'getresponse.side_effect': failure})
+            return patch.object(pool, '_acquire', side_effect=[(stale, True), (answered, False)])
+
+        with acquire_stale(http.client.RemoteDisconnected('closed')):
+            self.assertEqual(pool.request('POST', 'http://ingest/upload', b'segment'), (200, b''))
+        with acquire_stale(TimeoutError('timed out')):
+            self.assertEqual(pool.request('GET', 'http://ingest/status'), (200, b''))
+        with acquire_stale(TimeoutError('timed out')), self.assertRaises(TimeoutError):
+            # The server may have stored the segment before the response timed out
+            pool.request('POST', 'http://ingest/upload', b'segment')
+
+    def test_persistent_failure_ends_the_upload_for_restart_backoff(self):
+        self.server.failures['p0_segment_000001.m4s'] = 100
+        stream = self.make_stream('native_fail_key', 3)
+        with patch('hls_relay.NATIVE_UPLOAD_RETRIES', 2):
+            stream.start_ffmpeg_relay('youtube', 'native_fail_key', live_start_index=0)
+            relay = stream.relays['youtube']
+            self.assertEqual(relay.process.wait(timeout=5), 1)
+
+        self.assertFalse(relay.is_running())
+        self.assertIn('HTTP 500', relay.process.error)
+        relay.ensure_running(4, False)
+        self.assertGreater(relay.restart_not_before, 0)
+
+    def test_restored_stream_keeps_segment_order_for_native_upload(self):
+        stream = self.make_stream('native_restore_key', 3)
+        restored = hls_relay.StreamState.restore('native_restore_key', stream.stream_dir)
+
+        self.assertEqual([entry['name'] for entry in restored.playlist_entries], [entry['name'] for entry in stream.playlist_entries])
+        self.assertEqual(restored.playlist_entries[0]['map'], 'p0_segment_000000.mp4')
+
+    def test_catchup_jump_continues_the_remote_playlist_with_a_discontinuity(self):
+        stream = self.make_stream('native_jump_key', 3)
+        stream.catchup_mode = 'jump'
+        stream.start_ffmpeg_relay('youtube', 'native_jump_key', live_start_index=0)
+        relay = stream.relays['youtube']
+        self.wait_for(lambda: relay.position == (2, 6.0))
+        # The ingest stalls, so the upload falls behind
+        self.server.failures['p0_segment_000004.m4s'] = 100
+        with patch('hls_relay.NATIVE_UPLOAD_BACKOFF', 5):
+            for seq in range(4, 9):
+                self.add_segment(stream, seq)
+            with patch('hls_relay.CATCHUP_LAG_THRESHOLD', 5):
+                relay.check_catchup()
+        self.wait_for(lambda: b'p0_segment_000008.m4s' in self.server.last_body('media.m3u8'))
+
+        self.assertEqual(relay.position, (7, 16.0))
+        playlist = self.server.last_body('media.m3u8').decode()
+        self.assertIn('#EXT-X-MEDIA-SEQUENCE:1\n', playlist)
+        self.assertIn('p0_segment_000003.m4s\n#EXT-X-DISCONTINUITY\n#EXTINF:2.000000,\np0_segment_000008.m4s', playlist)
+        self.assertNotIn('p0_segment_000004.m4s', self.server.files())
+        relay.stop()
+
+    def test_native_engine_is_youtube_only(self):
+        stream = self.make_stream('native_twitch_key', 3)
+        with patch('hls_relay.RELAY_ENGINES', {'twitch': 'native'}):
+            with self.assertRaises(ValueError):
+                stream.start_ffmpeg_relay('twitch', 'native_twitch_key', live_start_index=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
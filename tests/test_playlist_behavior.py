@@ -308,9 +308,9 @@ class TestPlaylistBehavior(unittest.TestCase):
 
             with hls_relay.stream_creation_lock:
                 stream = hls_relay.streams['backoff_event_key']
-                stream.ffmpeg_process = MagicMock()
-                stream.ffmpeg_process.poll.return_value = 1
-                stream.ffmpeg_process.returncode = 1
+                stream.relays['youtube'].process = MagicMock()
+                stream.relays['youtube'].process.poll.return_value = 1
+                stream.relays['youtube'].process.returncode = 1
 
             response = self.upload('backoff_event_key', 'Media', 4, 2.0, data=b'media4', extra_headers={'Target': 'youtube'})
 
@@ -320,5 +320,97 @@ class TestPlaylistBehavior(unittest.TestCase):
             self.assertTrue(any('restart suppressed' in event['message'] for event in stream.events))
 
 
+    def make_lagging_stream(self, stream_key, catchup_mode):
+        stream = hls_relay.StreamState(stream_key)
+        stream.catchup_mode = catchup_mode
+        stream.initialize_playlist(0, 'p0_segment_000000.mp4')
+        stream.last_playlist_sequence = 0
+        for seq in range(1, 21):
+            stream.arrived_segments[seq] = {
+                'filename': f'p0_segment_{seq:06d}.m4s',
+                'duration': 2.0,
+                'is_init': False,
+                'discontinuity': False,
+            }
+        stream.update_playlist()
+        relay = stream.get_relay('youtube', stream_key)
+        relay.process = MagicMock()
+        relay.process.poll.return_value = None
+        # The relay is still reading the fifth media segment: 30 seconds behind the edge
+        stream.note_relay_fetch('p0_segment_000005.m4s')
+        return stream
+
+    def test_relay_fetch_updates_relay_lag(self):
+        stream = self.make_lagging_stream('lag_key', 'off')
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams['lag_key'] = stream
+
+        response = self.client.get(
+            f"/segments/{stream.stream_id}/p0_segment_000018.m4s",
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+        self.assertEqual(response.status_code, 404)
+        self.assertAlmostEqual(stream.relay_lag(), 30.0)
+
+        with open(os.path.join(stream.stream_dir, 'p0_segment_000018.m4s'), 'wb') as f:
+            f.write(b'segment')
+        response = self.client.get(
+            f"/segments/{stream.stream_id}/p0_segment_000018.m4s",
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(stream.relay_lag(), 4.0)
+        self.assertAlmostEqual(hls_relay.get_stream_status_data('lag_key')['relay_lag'], 4.0)
+
+    def test_segment_positions_are_pruned_behind_the_slowest_relay(self):
+        with patch('hls_relay.STATE_CHECKPOINT_ENTRIES', 3):
+            stream = self.make_lagging_stream('positions_key', 'off')
+            # As recorded before pruning, with the relay reading the fifth media segment
+            stream.relays['youtube'].position = (4, 10.0)
+            stream.segment_positions = {f'p0_segment_{seq:06d}.m4s': (seq - 1, seq * 2.0) for seq in range(1, 21)}
+            stream.arrived_segments[21] = {'filename': 'p0_segment_000021.m4s', 'duration': 2.0, 'is_init': False, 'discontinuity': False}
+            stream.update_playlist()
+            self.assertEqual(next(iter(stream.segment_positions)), 'p0_segment_000005.m4s')
+
+            stream.relays['youtube'].process.poll.return_value = 0
+            stream.arrived_segments[22] = {'filename': 'p0_segment_000022.m4s', 'duration': 2.0, 'is_init': False, 'discontinuity': False}
+            stream.update_playlist()
+            self.assertEqual(list(stream.segment_positions), ['p0_segment_000020.m4s', 'p0_segment_000021.m4s', 'p0_segment_000022.m4s'])
+
+    def test_catchup_restart_relaunches_without_realtime_pacing(self):
+        stream = self.make_lagging_stream('catchup_restart_key', 'restart')
+
+        with patch.object(stream.relays['youtube'], 'stop') as mock_stop, \
+             patch.object(stream, 'start_ffmpeg_relay') as mock_start:
+            stream.relays['youtube'].check_catchup()
+
+        mock_stop.assert_called_once()
+        mock_start.assert_called_once_with('youtube', 'catchup_restart_key', live_start_index=4, realtime=False)
+
+    def test_catchup_jump_relaunches_at_live_edge(self):
+        stream = self.make_lagging_stream('catchup_jump_key', 'jump')
+
+        with patch.object(stream.relays['youtube'], 'stop') as mock_stop, \
+             patch.object(stream, 'start_ffmpeg_relay') as mock_start:
+            stream.relays['youtube'].check_catchup()
+            stream.relays['youtube'].check_catchup()
+
+        mock_stop.assert_called_once()
+        mock_start.assert_called_once_with('youtube', 'catchup_jump_key', live_start_index=19)
+        self.assertTrue(any('jumping to live edge' in event['message'] for event in stream.events))
+
+    def test_catchup_without_realtime_drops_re_flag(self):
+        stream = hls_relay.StreamState('catchup_command_key')
+
+        with patch('subprocess.Popen') as mock_popen:
+            stream.start_ffmpeg_relay('youtube', 'catchup_command_key', live_start_index=4, realtime=False)
+
+        command = mock_popen.call_args[0][0]
+        self.assertNotIn('-re', command)
+        self.assertTrue(stream.relays['youtube'].catchup_active)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class TestProcessPlacement(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        hls_relay._placement_warnings.clear()
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        hls_relay._ffmpeg_cgroup = None
+        shutil.rmtree(self.test_dir)
+
+    def test_no_placement_configured_adds_no_wrappers(self):
+        self.assertEqual(hls_relay.ffmpeg_placement_prefix(), [])
+
+    def test_placement_prefix_applies_affinity_nice_and_ionice(self):
+        with patch.multiple(hls_relay, FFMPEG_CPUS={3, 2}, FFMPEG_NICE=10, FFMPEG_IONICE_CLASS='best-effort', FFMPEG_IONICE_LEVEL=6), \
+             patch('shutil.which', return_value='/usr/bin/tool'):
+            prefix = hls_relay.ffmpeg_placement_prefix()
+
+        self.assertEqual(prefix, ['taskset', '-c', '2,3', 'nice', '-n', '10', 'ionice', '-c', '2', '-n', '6'])
+
+    def test_pinned_ingest_gives_ffmpeg_the_original_cpu_set(self):
+        with patch.multiple(hls_relay, INGEST_CPUS={0}, _initial_cpus={0, 1, 2}), \
+             patch('shutil.which', return_value='/usr/bin/taskset'):
+            prefix = hls_relay.ffmpeg_placement_prefix()
+
+        self.assertEqual(prefix, ['taskset', '-c', '0,1,2'])
+
+    def test_missing_tools_are_skipped(self):
+        with patch.multiple(hls_relay, FFMPEG_NICE=5, FFMPEG_IONICE_CLASS='idle'), \
+             patch('shutil.which', return_value=None):
+            prefix = hls_relay.ffmpeg_placement_prefix()
+
+        self.assertEqual(prefix, [])
+        self.assertEqual(len(hls_relay._placement_warnings), 2)
+
+    def test_relay_command_is_wrapped(self):
+        stream = hls_relay.StreamState('placement_key')
+        with patch.multiple(hls_relay, FFMPEG_NICE=10), \
+             patch('shutil.which', return_value='/usr/bin/nice'), \
+             patch('subprocess.Popen') as mock_popen:
+            stream.start_ffmpeg_relay('youtube', 'placement_key', live_start_index=0)
+
+        self.assertEqual(mock_popen.call_args[0][0][:4], ['nice', '-n', '10', 'ffmpeg'])
+
+    def test_cgroup_cap_is_written_and_process_assigned(self):
+        cgroup_root = os.path.join(self.test_dir, 'cgroup')
+        cgroup_path = os.path.join(cgroup_root, 'ffmpeg')
+        os.makedirs(cgroup_root)
+        with open(os.path.join(cgroup_root, 'cgroup.controllers'), 'w') as f:
+            f.write('cpuset cpu io memory pids\n')
+        os.makedirs(cgroup_path)
+        for name in ('cpu.max', 'cgroup.procs'):
+            open(os.path.join(cgroup_path, name), 'w').close()
+
+        with patch.multiple(hls_relay, FFMPEG_CGROUP_CPU_LIMIT=2.5, FFMPEG_CGROUP_PATH=cgroup_path):
+            hls_relay.assign_ffmpeg_cgroup(4242)
+
+        with open(os.path.join(cgroup_path, 'cpu.max')) as f:
+            self.assertEqual(f.read(), '250000 100000\n')
+        with open(os.path.join(cgroup_path, 'cgroup.procs')) as f:
+            self.assertEqual(f.read(), '4242\n')
+
+    def test_cgroup_cap_is_disabled_when_unavailable(self):
+        missing = os.path.join(self.test_dir, 'no_cgroup', 'ffmpeg')
+        with patch.multiple(hls_relay, FFMPEG_CGROUP_CPU_LIMIT=1.0, FFMPEG_CGROUP_PATH=missing):
+            hls_relay.assign_ffmpeg_cgroup(4242)
+
+        self.assertIs(hls_relay._ffmpeg_cgroup, False)
+
+    def test_read_process_usage_reports_own_process(self):
+        usage = hls_relay.read_process_usage(os.getpid())
+
+        self.assertIsNotNone(usage)
+        self.assertGreaterEqual(usage[0], 0.0)
+        self.assertGreater(usage[1], 0)
+
+    def test_relay_status_reports_cpu_and_rss(self):
+        stream = hls_relay.StreamState('usage_key')
+        relay = stream.get_relay('youtube', 'usage_key')
+        relay.process = MagicMock(pid=1234)
+        relay.process.poll.return_value = None
+        relay.usage_sample = (100.0, 10.0)
+
+        with patch('hls_relay.read_process_usage', return_value=(11.0, 50 * 1048576)), \
+             patch('time.monotonic', return_value=102.0):
+            status = relay.status(now=0.0)
+
+        self.assertEqual(status['cpu_percent'], 50.0)
+        self.assertEqual(status['rss_bytes'], 50 * 1048576)
+
+
+if __name__ == '__main__':
+    unittest.main()
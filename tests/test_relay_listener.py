@@ -0,0 +1,123 @@
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from base64 import b64encode
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from waitress import wasyncore
+from werkzeug.test import Client
+
+import hls_relay
+
+
+class ExecCalled(Exception):
+    pass
+
+
+class TestRelayListener(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def make_stream(self, stream_key, segments):
+        for sequence in range(segments + 1):
+            self.client.post('/upload_segment', data=b'data%d' % sequence, headers={
+                **self.auth_headers,
+                'Target': 'passive',
+                'Stream-Key': stream_key,
+                'Segment-Type': 'Initialization' if sequence == 0 else 'Media',
+                'Discontinuity': 'false',
+                'Duration': '0' if sequence == 0 else '2.0',
+                'Sequence': str(sequence),
+            })
+        return hls_relay.streams[stream_key]
+
+    def test_only_playlists_and_segments_are_served(self):
+        stream = self.make_stream('relay_listener_key', 2)
+        client = Client(hls_relay.relay_app)
+
+        response = client.get(f'/segments/{stream.stream_id}/p0_segment_000002.m4s', environ_overrides={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(response.get_data(), b'data2')
+        self.assertEqual(client.get('/status/relay_listener_key').status_code, 404)
+        self.assertEqual(client.post('/upload_segment').status_code, 404)
+
+    def test_relays_read_from_the_listener_of_their_worker(self):
+        stream = self.make_stream('relay_listener_port_key', 1)
+        relay = stream.get_relay('youtube', 'key')
+        url = f'/segments/{stream.stream_id}/playlist.m3u8'
+
+        self.assertIn(f'http://127.0.0.1:{hls_relay.PORT}{url}', relay.build_command())
+        with patch('hls_relay.RELAY_LISTENER_PORT', 9100):
+            self.assertIn(f'http://127.0.0.1:9100{url}', relay.build_command())
+            with patch('hls_relay.current_worker', hls_relay.Worker(2, None)):
+                self.assertIn(f'http://127.0.0.1:9102{url}', relay.build_command())
+
+    def test_relay_reads_are_served_by_their_own_threads(self):
+        stream = self.make_stream('relay_listener_server_key', 2)
+        sock = hls_relay.listening_socket('127.0.0.1', 0)
+        for mode in ('asyncio', 'waitress'):
+            with self.subTest(mode=mode), patch('hls_relay.SERVER_MODE', mode):
+                server = hls_relay.create_http_server(hls_relay.relay_app, [sock], 1)
+                thread = threading.Thread(target=server.run, daemon=True)
+                thread.start()
+                connection = http.client.HTTPConnection('127.0.0.1', sock.getsockname()[1], timeout=5)
+                connection.request('GET', f'/segments/{stream.stream_id}/playlist.m3u8')
+                response = connection.getresponse()
+
+                self.assertEqual(response.status, 200)
+                self.assertTrue(response.read().endswith(b'p0_segment_000002.m4s\n'))
+                connection.close()
+                if mode == 'asyncio':
+                    server.close()
+                    thread.join(5)
+                else:
+                    # Also closes the socket
+                    server.task_dispatcher.shutdown()
+                    wasyncore.close_all(server._map)
+
+    def test_listener_socket_is_handed_over(self):
+        server = SimpleNamespace(accepting=True, trigger=MagicMock())
+        relay_server = SimpleNamespace(accepting=True, trigger=MagicMock())
+        relay_socket = MagicMock()
+        relay_socket.fileno.return_value = 4321
+        listen_socket = MagicMock()
+        listen_socket.fileno.return_value = 1234
+
+        # Test client responses are not closed, so they would keep counting as requests in progress
+        with patch('hls_relay.HANDOVER_DRAIN_TIMEOUT', 0.01), \
+             patch('hls_relay.relay_socket', relay_socket), \
+             patch('os.execv', side_effect=ExecCalled), \
+             patch('os.set_inheritable') as mock_inheritable, \
+             patch.dict(os.environ):
+            with self.assertRaises(ExecCalled):
+                hls_relay.hand_over(server, listen_socket, relay_server)
+            self.assertFalse(relay_server.accepting)
+            mock_inheritable.assert_any_call(4321, True)
+            with open(os.environ[hls_relay.HANDOVER_ENV]) as f:
+                self.assertEqual(json.load(f)['relay_fd'], 4321)
+
+            with patch('socket.socket') as mock_socket:
+                hls_relay.take_over_from_previous_process()
+            mock_socket.assert_any_call(fileno=4321)
+            self.assertIs(hls_relay.relay_socket, mock_socket.return_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from unittest.mock import MagicMock, patch
+
+import hls_relay
+
+
+class TestRenditions(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, segment_type, sequence, duration, data=b'data', rendition=None, target='passive'):
+        headers = {
+            **self.auth_headers,
+            'Target': target,
+            'Stream-Key': stream_key,
+            'Segment-Type': segment_type,
+            'Discontinuity': 'false',
+            'Duration': str(duration),
+            'Sequence': str(sequence),
+        }
+        if rendition is not None:
+            headers['Rendition'] = rendition
+        return self.client.post(
+            '/upload_segment',
+            headers=headers,
+            data=data,
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+    def make_stream(self, key, main_segments, low_segments, main_size=4000, low_size=1000):
+        """Stream with a main and a 'low' rendition, each with 2 s segments numbered from 1"""
+        stream = hls_relay.StreamState(key)
+        low = stream.get_rendition('low')
+        for source, count, size in ((stream, main_segments, main_size), (low, low_segments, low_size)):
+            with open(os.path.join(source.stream_dir, 'p0_segment_000000.mp4'), 'wb') as f:
+                f.write(b'init')
+            source.initialize_playlist(0, 'p0_segment_000000.mp4')
+            source.last_playlist_sequence = 0
+            for seq in range(1, count + 1):
+                name = f'p0_segment_{seq:06d}.m4s'
+                with open(os.path.join(source.stream_dir, name), 'wb') as f:
+                    f.write(b'x' * size)
+                source.arrived_segments[seq] = {'filename': name, 'duration': 2.0, 'is_init': False, 'discontinuity': False}
+                source.update_playlist()
+        return stream, low
+
+    def running_relay(self, stream, target, position):
+        relay = stream.get_relay(target, 'key')
+        relay.process = MagicMock()
+        relay.process.poll.return_value = None
+        relay.position = position
+        return relay
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('condition not reached in time')
+
+    def test_rendition_uploads_get_own_playlist_and_master(self):
+        for rendition in (None, '1080p'):
+            self.assertEqual(self.upload('rendition_key', 'Initialization', 0, 0, data=b'init', rendition=rendition).status_code, 200)
+            for seq in (1, 2):
+                self.assertEqual(self.upload('rendition_key', 'Media', seq, 2.0, rendition=rendition).status_code, 200)
+
+        stream = hls_relay.streams['rendition_key']
+        child = stream.renditions['1080p']
+        self.assertEqual(stream.written_segment_count, 2)
+        self.assertEqual(child.written_segment_count, 2)
+        self.assertTrue(os.path.exists(os.path.join(stream.stream_dir, '1080p', 'p0_segment_000002.m4s')))
+        with open(os.path.join(stream.stream_dir, 'master.m3u8')) as f:
+            master = f.read()
+        self.assertIn('\nplaylist.m3u8\n', master)
+        self.assertIn('\n1080p/playlist.m3u8\n', master)
+
+        response = self.client.get(f'/segments/{stream.stream_id}/1080p/playlist.m3u8', environ_overrides={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('p0_segment_000002.m4s', response.get_data(as_text=True))
+
+    def test_main_rendition_name_is_the_main_stream(self):
+        self.upload('main_name_key', 'Initialization', 0, 0, data=b'init', rendition='main')
+
+        self.assertEqual(hls_relay.streams['main_name_key'].renditions, {})
+
+    def test_invalid_rendition_is_rejected(self):
+        response = self.upload('bad_rendition_key', 'Initialization', 0, 0, data=b'init', rendition='../x')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_data(as_text=True), 'Invalid Rendition')
+
+    def test_lagging_relay_switches_down_at_next_sequence(self):
+        stream, low = self.make_stream('switch_key', 12, 12)
+        relay = self.running_relay(stream, 'youtube', (5, 12.0))
+
+        with patch.object(hls_relay.upstream_monitor, 'throughput_bps', return_value=10000.0):
+            stream.check_renditions(now=1000.0)
+
+        self.assertIs(stream.relay_source, low)
+        reason, start_index, source = relay.restart_request
+        self.assertIs(source, low)
+        self.assertEqual(low.playlist_entries[start_index]['sequence'], 7)
+        self.assertIn('rendition low', reason)
+
+        with patch.object(relay, 'stop'), patch.object(stream, 'start_ffmpeg_relay') as mock_start:
+            relay.ensure_running(stream.written_segment_count, False)
+        mock_start.assert_called_once_with('youtube', 'key', live_start_index=start_index, realtime=True)
+        self.assertIs(relay.source, low)
+        self.assertIn(f'http://127.0.0.1:{hls_relay.PORT}/segments/{stream.stream_id}/low/playlist.m3u8', relay.build_command(start_index))
+
+    def test_switch_waits_until_rendition_has_the_segment(self):
+        stream, low = self.make_stream('wait_key', 12, 6)
+        relay = self.running_relay(stream, 'youtube', (5, 12.0))
+
+        with patch.object(hls_relay.upstream_monitor, 'throughput_bps', return_value=None):
+            stream.check_renditions(now=1000.0)
+
+        self.assertEqual(relay.restart_request[1], 6)
+        with patch.object(relay, 'stop') as mock_stop:
+            relay.ensure_running(stream.written_segment_count, False)
+        mock_stop.assert_not_called()
+
+    def test_upswitch_after_hold_and_backoff_when_it_fails(self):
+        stream, low = self.make_stream('upswitch_key', 12, 12)
+        relay = self.running_relay(stream, 'youtube', (11, 24.0))
+        relay.source = low
+        stream.relay_source = low
+        stream.upswitch_not_before = 1000.0
+
+        stream.check_renditions(now=999.0)
+        self.assertIsNone(relay.restart_request)
+
+        stream.check_renditions(now=1000.0)
+        self.assertIs(relay.restart_request[2], stream)
+
+        # The higher rendition lags again shortly after: back down, and wait twice as long
+        relay.restart_request = None
+        relay.source = stream
+        relay.position = (0, 2.0)
+        with patch.object(hls_relay.upstream_monitor, 'throughput_bps', return_value=None):
+            stream.check_renditions(now=1010.0)
+        self.assertIs(stream.relay_source, low)
+        self.assertEqual(stream.upswitch_hold, 2 * hls_relay.RENDITION_UPSWITCH_HOLD)
+        self.assertEqual(stream.upswitch_not_before, 1010.0 + 2 * hls_relay.RENDITION_UPSWITCH_HOLD)
+
+    def test_fetches_update_position_only_for_the_relayed_rendition(self):
+        stream, low = self.make_stream('fetch_key', 4, 4)
+        relay = self.running_relay(stream, 'youtube', None)
+        relay.source = low
+
+        stream.note_relay_fetch('p0_segment_000002.m4s', 'youtube', None)
+        self.assertIsNone(relay.position)
+        stream.note_relay_fetch('p0_segment_000002.m4s', 'youtube', 'low')
+        self.assertEqual(relay.position, (1, 4.0))
+
+    def test_restore_finds_renditions(self):
+        stream, _ = self.make_stream('restore_rendition_key', 3, 2)
+
+        restored = hls_relay.StreamState.restore('restore_rendition_key', stream.stream_dir)
+
+        self.assertEqual(restored.renditions['low'].written_segment_count, 2)
+        self.assertEqual(restored.renditions['low'].stream_id, restored.stream_id)
+
+    def test_native_upload_continues_playlist_across_switch(self):
+        stream, low = self.make_stream('native_switch_key', 4, 4)
+        uploads = []
+
+        def fake_request(method, url, body=None, headers=None, timeout=30):
+            uploads.append((url.split('file=')[1], body))
+            return 200, b''
+
+        with patch('hls_relay.RELAY_ENGINES', {'youtube': 'native'}), \
+             patch.object(hls_relay.upload_pool, 'request', side_effect=fake_request):
+            stream.start_ffmpeg_relay('youtube', 'key', live_start_index=0)
+            relay = stream.relays['youtube']
+            self.wait_for(lambda: relay.position == (3, 8.0))
+            stream.switch_rendition(low, 'test')
+            relay.ensure_running(stream.written_segment_count, False)
+            # Switched at the next sequence, which the low rendition does not have yet
+            self.assertIs(relay.source, stream)
+            name = 'p0_segment_000005.m4s'
+            with open(os.path.join(low.stream_dir, name), 'wb') as f:
+                f.write(b'y')
+            with low.playlist_lock:
+                low.arrived_segments[5] = {'filename': name, 'duration': 2.0, 'is_init': False, 'discontinuity': False}
+                low.update_playlist()
+            relay.ensure_running(stream.written_segment_count, False)
+            self.assertIs(relay.source, low)
+            self.wait_for(lambda: relay.position == (4, 10.0))
+            relay.stop()
+
+        files = [name for name, _ in uploads]
+        self.assertIn('low_p0_segment_000000.mp4', files)
+        self.assertIn('low_p0_segment_000005.m4s', files)
+        playlist = [body for name, body in uploads if name == 'media.m3u8'][-1].decode()
+        self.assertIn('#EXT-X-MEDIA-SEQUENCE:0', playlist)
+        self.assertIn('#EXT-X-DISCONTINUITY\n#EXT-X-MAP:URI="low_p0_segment_000000.mp4"\n#EXTINF:2.000000,\nlow_p0_segment_000005.m4s', playlist)
+
+    def test_upstream_monitor_measures_transmit_rate(self):
+        monitor = hls_relay.UpstreamMonitor()
+        readings = iter([1000, 126000])
+        times = iter([10.0, 12.0])
+        # Samples come from the background thread only
+        monitor.thread = True
+        with patch.object(monitor, '_read_tx_bytes', side_effect=lambda: next(readings)), \
+             patch('time.monotonic', side_effect=lambda: next(times)):
+            monitor.sample()
+            self.assertIsNone(monitor.throughput_bps())
+            monitor.sample()
+            self.assertEqual(monitor.throughput_bps(), 500000.0)
+            self.assertEqual(monitor.throughput_bps(), 500000.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -76,6 +76,29 @@ class TestRequestValidation(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.get_data(as_text=True), 'Invalid Stream-ID')
 
+    def test_invalid_catchup_mode_is_rejected(self):
+        response = self.upload_with_target('passive', 'catchup_key', 'Initialization', 0, 0, data=b'init')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(
+            '/upload_segment',
+            headers={
+                **self.auth_headers,
+                'Target': 'passive',
+                'Stream-Key': 'catchup_key',
+                'Segment-Type': 'Media',
+                'Discontinuity': 'false',
+                'Duration': '2.0',
+                'Sequence': '1',
+                'Catch-Up': 'sometimes',
+            },
+            data=b'media',
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_data(as_text=True), 'Invalid Catch-Up')
+
     def test_zero_duration_finalization_closes_playlist(self):
         self.assertEqual(self.upload('finalize_key', 'Initialization', 0, 0, data=b'init').status_code, 200)
         self.assertEqual(self.upload('finalize_key', 'Media', 1, 2.0, data=b'media').status_code, 200)
@@ -228,9 +251,9 @@ class TestRequestValidation(unittest.TestCase):
 
             with hls_relay.stream_creation_lock:
                 stream = hls_relay.streams['ffmpeg_backoff_key']
-                stream.ffmpeg_process = MagicMock()
-                stream.ffmpeg_process.poll.return_value = 1
-                stream.ffmpeg_process.returncode = 1
+                stream.relays['youtube'].process = MagicMock()
+                stream.relays['youtube'].process.poll.return_value = 1
+                stream.relays['youtube'].process.returncode = 1
 
             response = self.upload_with_target('youtube', 'ffmpeg_backoff_key', 'Media', 4, 2.0, data=b'media4')
 
@@ -244,7 +267,7 @@ class TestRequestValidation(unittest.TestCase):
 
             with hls_relay.stream_creation_lock:
                 stream = hls_relay.streams['ffmpeg_backoff_key']
-                stream.ffmpeg_restart_not_before = 0.0
+                stream.relays['youtube'].restart_not_before = 0.0
 
             response = self.upload_with_target('youtube', 'ffmpeg_backoff_key', 'Media', 6, 2.0, data=b'media6')
 
@@ -277,8 +300,8 @@ class TestRequestValidation(unittest.TestCase):
 
             with hls_relay.stream_creation_lock:
                 stream = hls_relay.streams['drain_key']
-                stream.ffmpeg_process = MagicMock()
-                stream.ffmpeg_process.poll.return_value = None
+                stream.relays['youtube'].process = MagicMock()
+                stream.relays['youtube'].process.poll.return_value = None
 
             response = self.upload_with_target('youtube', 'drain_key', 'Finalization', 4, 0, data=b'')
 
@@ -293,8 +316,8 @@ class TestRequestValidation(unittest.TestCase):
 
             with hls_relay.stream_creation_lock:
                 old_stream = hls_relay.streams['replace_key']
-                old_stream.ffmpeg_process = MagicMock()
-                old_stream.ffmpeg_process.poll.return_value = None
+                old_stream.relays['youtube'].process = MagicMock()
+                old_stream.relays['youtube'].process.poll.return_value = None
 
             response = self.upload_with_target('youtube', 'replace_key', 'Initialization', 0, 0, data=b'new_init', stream_id='session_b')
 
@@ -303,5 +326,61 @@ class TestRequestValidation(unittest.TestCase):
             self.assertFalse(mock_begin_drain.called)
 
 
+    def test_parse_targets_supports_lists_and_per_target_keys(self):
+        self.assertEqual(
+            hls_relay.parse_targets('YouTube, twitch=live_123_abc', 'ingest_key'),
+            [('youtube', 'ingest_key'), ('twitch', 'live_123_abc')],
+        )
+        self.assertEqual(hls_relay.parse_targets('passive', 'ingest_key'), [])
+        self.assertIsNone(hls_relay.parse_targets('youtube, youtube', 'ingest_key'))
+        self.assertIsNone(hls_relay.parse_targets('tiktok', 'ingest_key'))
+        self.assertIsNone(hls_relay.parse_targets('twitch=bad/key', 'ingest_key'))
+
+    def test_unsupported_target_is_rejected(self):
+        response = self.upload_with_target('tiktok', 'bad_target_key', 'Initialization', 0, 0, data=b'init')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_data(as_text=True), 'Invalid Target')
+
+    def test_multiple_targets_start_one_relay_each(self):
+        target = 'youtube, twitch=twitch_key'
+        with patch('subprocess.Popen') as mock_popen:
+            mock_popen.return_value.poll.return_value = None
+            mock_popen.return_value.stdout = []
+            self.assertEqual(self.upload_with_target(target, 'fanout_key', 'Initialization', 0, 0, data=b'init').status_code, 200)
+            for seq in range(1, 4):
+                self.assertEqual(self.upload_with_target(target, 'fanout_key', 'Media', seq, 2.0, data=b'media').status_code, 200)
+
+        self.assertEqual(mock_popen.call_count, 2)
+        outputs = [call[0][0][-1] for call in mock_popen.call_args_list]
+        self.assertIn('https://a.upload.youtube.com/http_upload_hls?cid=fanout_key&copy=0&file=master.m3u8', outputs)
+        self.assertIn('rtmp://ingest.global-contribute.live-video.net/app/twitch_key', outputs)
+
+    def test_failing_destination_backs_off_without_touching_others(self):
+        target = 'youtube, twitch=twitch_key'
+        with patch.object(hls_relay.StreamState, 'start_ffmpeg_relay') as mock_start:
+            self.assertEqual(self.upload_with_target(target, 'independent_key', 'Initialization', 0, 0, data=b'init').status_code, 200)
+            for seq in range(1, 4):
+                self.assertEqual(self.upload_with_target(target, 'independent_key', 'Media', seq, 2.0, data=b'media').status_code, 200)
+            self.assertEqual(mock_start.call_count, 2)
+
+            with hls_relay.stream_creation_lock:
+                stream = hls_relay.streams['independent_key']
+                youtube_process = MagicMock()
+                youtube_process.poll.return_value = None
+                stream.relays['youtube'].process = youtube_process
+                stream.relays['twitch'].process = MagicMock()
+                stream.relays['twitch'].process.poll.return_value = 1
+                stream.relays['twitch'].process.returncode = 1
+
+            response = self.upload_with_target(target, 'independent_key', 'Media', 4, 2.0, data=b'media')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock_start.call_count, 2)
+            self.assertIs(stream.relays['youtube'].process, youtube_process)
+            self.assertEqual(stream.relays['twitch'].last_exit, {'code': 1, 'signal': None})
+            self.assertGreater(stream.relays['twitch'].restart_not_before, 0.0)
+            self.assertEqual(stream.relays['youtube'].restart_not_before, 0.0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
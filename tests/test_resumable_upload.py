@@ -0,0 +1,197 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestResumableUpload(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def headers(self, stream_key, sequence, segment_type='Media', duration=2.0):
+        return {
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': segment_type,
+            'Discontinuity': 'false',
+            'Duration': str(duration),
+            'Sequence': str(sequence),
+        }
+
+    def put_chunk(self, upload_id, stream_key, sequence, data, start, total, **kwargs):
+        headers = self.headers(stream_key, sequence, **kwargs)
+        headers['Content-Range'] = f'bytes {start}-{start + len(data) - 1}/{total}'
+        return self.client.put(
+            f'/upload_segment/{upload_id}',
+            headers=headers,
+            data=data,
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+    def query_offset(self, upload_id, stream_key, sequence):
+        return self.client.head(
+            f'/upload_segment/{upload_id}',
+            headers={**self.auth_headers, 'Stream-Key': stream_key, 'Sequence': str(sequence)},
+        )
+
+    def start_stream(self, stream_key):
+        self.put_chunk('init1', stream_key, 0, b'init', 0, 4, segment_type='Initialization', duration=0)
+        return hls_relay.streams[stream_key]
+
+    def test_concurrent_retries_of_the_last_chunk_ingest_the_segment_once(self):
+        stream = self.start_stream('resume_race_key')
+        self.put_chunk('race1', 'resume_race_key', 1, b'first', 0, 10)
+        path = hls_relay.resumable_upload_path('resume_race_key', 1, 'race1')
+        release = threading.Event()
+        file_digest = hls_relay.file_digest
+
+        def slow_digest(digest_path):
+            # The first complete request holds the upload's lock while the retries queue behind it
+            release.wait(5)
+            return file_digest(digest_path)
+
+        statuses = []
+
+        def retry():
+            client = hls_relay.app.test_client()
+            headers = self.headers('resume_race_key', 1)
+            headers['Content-Range'] = 'bytes 5-9/10'
+            response = client.put('/upload_segment/race1', headers=headers, data=b'_last', environ_overrides={'REMOTE_ADDR': '127.0.0.1'})
+            statuses.append(response.status_code)
+
+        with patch('hls_relay.file_digest', side_effect=slow_digest):
+            threads = [threading.Thread(target=retry) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            deadline = time.time() + 5
+            while hls_relay.resumable_upload_locks.get(path, [None, 0])[1] < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(sorted(statuses), [200, 409, 409])
+        self.assertEqual(stream.written_segment_count, 1)
+        with open(os.path.join(stream.stream_dir, 'p0_segment_000001.m4s'), 'rb') as f:
+            self.assertEqual(f.read(), b'first_last')
+        self.assertNotIn(path, hls_relay.resumable_upload_locks)
+
+    def test_chunks_are_stored_until_the_segment_is_complete(self):
+        stream = self.start_stream('resume_key')
+        data = bytes(range(256)) * 40
+
+        response = self.put_chunk('up1', 'resume_key', 1, data[:4000], 0, len(data))
+        self.assertEqual(response.status_code, 308)
+        self.assertEqual(response.headers['Upload-Offset'], '4000')
+        self.assertEqual(stream.written_segment_count, 0)
+        self.assertEqual(self.query_offset('up1', 'resume_key', 1).headers['Upload-Offset'], '4000')
+
+        response = self.put_chunk('up1', 'resume_key', 1, data[4000:], 4000, len(data))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(stream.written_segment_count, 1)
+        with open(os.path.join(stream.stream_dir, 'p0_segment_000001.m4s'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.query_offset('up1', 'resume_key', 1).status_code, 404)
+        self.assertEqual(os.listdir(os.path.join(self.test_dir, hls_relay.RESUMABLE_UPLOADS_DIR, 'resume_key')), [])
+
+    def test_chunk_at_wrong_offset_is_refused_with_stored_offset(self):
+        self.start_stream('resume_offset_key')
+        self.put_chunk('up2', 'resume_offset_key', 1, b'a' * 100, 0, 300)
+
+        response = self.put_chunk('up2', 'resume_offset_key', 1, b'b' * 100, 200, 300)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.headers['Upload-Offset'], '100')
+
+    def test_uploads_are_keyed_by_sequence(self):
+        self.start_stream('resume_seq_key')
+        self.put_chunk('up3', 'resume_seq_key', 1, b'a' * 10, 0, 20)
+
+        self.assertEqual(self.query_offset('up3', 'resume_seq_key', 2).status_code, 404)
+        self.assertEqual(self.put_chunk('up3', 'resume_seq_key', 2, b'b' * 10, 10, 20).status_code, 409)
+
+    def test_partial_upload_survives_a_restart(self):
+        self.start_stream('resume_restart_key')
+        self.put_chunk('up4', 'resume_restart_key', 1, b'a' * 10, 0, 20)
+        with hls_relay.resumable_upload_locks_guard:
+            hls_relay.resumable_upload_locks.clear()
+
+        response = self.put_chunk('up4', 'resume_restart_key', 1, b'b' * 10, 10, 20)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.query_offset('../x', 'resume_bad_key', 1).status_code, 404)
+        self.assertEqual(self.query_offset('up5', 'resume_bad_key', 'x').status_code, 400)
+        self.assertEqual(self.put_chunk('up5', 'resume_bad_key', 1, b'a', 5, 5).status_code, 400)
+        with patch('hls_relay.RESUMABLE_UPLOAD_MAX_BYTES', 10):
+            self.assertEqual(self.put_chunk('up5', 'resume_bad_key', 1, b'a', 0, 11).status_code, 413)
+        headers = self.headers('resume_bad_key', 1)
+        response = self.client.put('/upload_segment/up5', headers=headers, data=b'a')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Content-Range', response.get_data(as_text=True))
+
+    def test_stale_partial_uploads_expire(self):
+        directory = os.path.join(self.test_dir, hls_relay.RESUMABLE_UPLOADS_DIR, 'resume_expire_key')
+        os.makedirs(directory)
+        old_path = os.path.join(directory, '1_old.part')
+        new_path = os.path.join(directory, '2_new.part')
+        for path in (old_path, new_path):
+            with open(path, 'wb') as f:
+                f.write(b'x')
+        old_time = time.time() - hls_relay.RESUMABLE_UPLOAD_TTL - 1
+        os.utime(old_path, (old_time, old_time))
+
+        hls_relay.expire_resumable_uploads(directory)
+
+        self.assertEqual(os.listdir(directory), ['2_new.part'])
+
+    def test_abandoned_uploads_of_every_key_are_swept(self):
+        uploads_dir = os.path.join(self.test_dir, hls_relay.RESUMABLE_UPLOADS_DIR)
+        old_time = time.time() - hls_relay.RESUMABLE_UPLOAD_TTL - 1
+        for stream_key, name, mtime in [('gone_key', '1_old.part', old_time), ('live_key', '1_old.part', old_time), ('live_key', '2_new.part', None)]:
+            os.makedirs(os.path.join(uploads_dir, stream_key), exist_ok=True)
+            path = os.path.join(uploads_dir, stream_key, name)
+            with open(path, 'wb') as f:
+                f.write(b'x')
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+        os.utime(os.path.join(uploads_dir, 'gone_key'), (old_time, old_time))
+
+        hls_relay.sweep_resumable_uploads()
+
+        self.assertEqual(os.listdir(uploads_dir), ['live_key'])
+        self.assertEqual(os.listdir(os.path.join(uploads_dir, 'live_key')), ['2_new.part'])
+
+    def test_no_range_is_reported_before_any_byte_is_stored(self):
+        self.start_stream('resume_empty_key')
+        headers = {**self.headers('resume_empty_key', 1), 'Content-Range': 'bytes 0-9/20'}
+
+        # The connection dropped before any byte of the chunk arrived
+        response = self.client.put('/upload_segment/up6', headers=headers, data=b'')
+
+        self.assertEqual(response.status_code, 308)
+        self.assertEqual(response.headers['Upload-Offset'], '0')
+        self.assertNotIn('Range', response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir),
+            patch('hls_relay.RETENTION_IO_BYTES_PER_SECOND', None),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.manager = hls_relay.RetentionManager()
+        self.now = time.time()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def make_dir(self, stream_key, age, size=100, finalized=True, name=None):
+        """A stream directory of an earlier session whose playlist last changed age seconds ago"""
+        name = name or f'{stream_key}_{age}'
+        stream_dir = os.path.join(self.test_dir, name)
+        os.makedirs(os.path.join(stream_dir, '720p'))
+        with open(os.path.join(stream_dir, hls_relay.STATE_JOURNAL_FILE), 'w') as f:
+            f.write(json.dumps({'op': 'stream', 'stream_key': stream_key}) + '\n')
+        with open(os.path.join(stream_dir, '720p', 'p0_segment_000001.m4s'), 'wb') as f:
+            f.write(b'x' * size)
+        playlist_file = os.path.join(stream_dir, 'playlist.m3u8')
+        with open(playlist_file, 'w') as f:
+            f.write('#EXTM3U\n' + ('#EXT-X-ENDLIST\n' if finalized else ''))
+        os.utime(playlist_file, (self.now - age, self.now - age))
+        return name
+
+    def remaining(self):
+        return sorted(name for name in os.listdir(self.test_dir) if not name.startswith('.'))
+
+    def test_old_sessions_are_removed_but_live_and_resumable_ones_kept(self):
+        self.client.post('/upload_segment', data=b'init', headers={
+            **self.auth_headers, 'Target': 'passive', 'Stream-Key': 'retention_live', 'Stream-ID': 'old',
+            'Segment-Type': 'Initialization', 'Discontinuity': 'false', 'Duration': '0', 'Sequence': '0',
+        })
+        live = hls_relay.streams['retention_live'].stream_id
+        os.utime(hls_relay.streams['retention_live'].stream_dir, (self.now - 5000, self.now - 5000))
+        self.make_dir('retention_old', 5000, size=1000)
+        unfinalized = self.make_dir('retention_unfinalized', 60, finalized=False)
+        self.make_dir('retention_abandoned', 5000, finalized=False)
+        recent = self.make_dir('retention_recent', 60)
+
+        with patch('hls_relay.RETENTION_MAX_AGE', 3600):
+            reclaimed = self.manager.run_pass(self.now)
+
+        self.assertEqual(self.remaining(), sorted([live, unfinalized, recent]))
+        self.assertGreater(reclaimed, 1000)
+        status = self.manager.status()
+        self.assertEqual((status['removed_dirs'], status['reclaimed_bytes'], status['stream_dirs']), (2, reclaimed, 3))
+
+    def test_only_the_newest_sessions_of_a_key_are_kept(self):
+        names = [self.make_dir('retention_key', age) for age in (100, 200, 300, 400)]
+        other = self.make_dir('retention_other', 500)
+
+        with patch('hls_relay.RETENTION_MAX_SESSIONS_PER_KEY', 2):
+            self.manager.run_pass(self.now)
+
+        self.assertEqual(self.remaining(), sorted(names[:2] + [other]))
+
+    def test_oldest_sessions_go_first_when_over_the_byte_quota(self):
+        names = [self.make_dir(f'retention_quota_{age}', age, size=1000) for age in (100, 200, 300, 400)]
+
+        with patch('hls_relay.RETENTION_MAX_BYTES', 2500):
+            self.manager.run_pass(self.now)
+
+        self.assertEqual(self.remaining(), sorted(names[:2]))
+        self.assertLessEqual(self.manager.status()['used_bytes'], 2500)
+
+    def test_archiving_is_paced_and_finishes_after_an_interruption(self):
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        name = self.make_dir('retention_archive', 5000, size=1000)
+        # A directory an earlier run had started to remove
+        os.makedirs(self.manager.trash_dir())
+        interrupted = self.make_dir('retention_interrupted', 6000)
+        os.rename(os.path.join(self.test_dir, interrupted), os.path.join(self.manager.trash_dir(), interrupted))
+
+        with patch('hls_relay.RETENTION_MAX_AGE', 3600), \
+             patch('hls_relay.RETENTION_ARCHIVE_DIR', archive_dir), \
+             patch('hls_relay.RETENTION_IO_BYTES_PER_SECOND', 100), \
+             patch('hls_relay.RETENTION_BATCH_FILES', 1), \
+             patch('time.sleep') as mock_sleep:
+            self.manager.run_pass(self.now)
+
+        self.assertEqual(self.remaining(), [])
+        self.assertEqual(os.listdir(self.manager.trash_dir()), [])
+        with open(os.path.join(archive_dir, name, '720p', 'p0_segment_000001.m4s'), 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 1000)
+        self.assertTrue(os.path.exists(os.path.join(archive_dir, interrupted, 'playlist.m3u8')))
+        # The 1000 byte segment takes about 10 seconds at 100 bytes per second
+        self.assertGreater(max(call.args[0] for call in mock_sleep.call_args_list), 9)
+        self.assertEqual(self.manager.status()['archived_dirs'], 2)
+
+    def test_admin_status_reports_usage(self):
+        self.make_dir('retention_status', 100, size=1000)
+        with patch('hls_relay.retention_manager', self.manager), patch('hls_relay.RETENTION_MAX_BYTES', 10 ** 9):
+            self.manager.run_pass(self.now)
+            status = self.client.get('/admin/status', headers=self.auth_headers).get_json()
+
+        self.assertEqual(status['retention']['stream_dirs'], 1)
+        self.assertGreater(status['retention']['used_bytes'], 1000)
+        self.assertEqual(status['retention']['max_bytes'], 10 ** 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
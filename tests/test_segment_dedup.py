@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestSegmentDedup(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, segment_type, sequence, duration, data=b'data', stream_id=None):
+        headers = {
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': segment_type,
+            'Discontinuity': 'false',
+            'Duration': str(duration),
+            'Sequence': str(sequence),
+        }
+        if stream_id is not None:
+            headers['Stream-ID'] = stream_id
+        return self.client.post(
+            '/upload_segment',
+            headers=headers,
+            data=data,
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+    def segment_bytes(self, stream, name):
+        with open(os.path.join(stream.stream_dir, name), 'rb') as f:
+            return f.read()
+
+    def test_identical_retransmit_is_not_written_again(self):
+        self.upload('dedup_key', 'Initialization', 0, 0, b'init')
+        self.upload('dedup_key', 'Media', 2, 2.0, b'second')
+        stream = hls_relay.streams['dedup_key']
+        # Changed behind the relay's back: a second write would restore the uploaded bytes
+        with open(os.path.join(stream.stream_dir, 'p0_segment_000002.m4s'), 'wb') as f:
+            f.write(b'marker')
+
+        response = self.upload('dedup_key', 'Media', 2, 2.0, b'second')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.segment_bytes(stream, 'p0_segment_000002.m4s'), b'marker')
+        self.assertEqual(stream.dedup_stats, {'duplicates': 1, 'bytes_saved': 6, 'conflicts': 0})
+        self.assertEqual(stream.arrived_segments[2]['filename'], 'p0_segment_000002.m4s')
+
+    def test_conflicting_payload_for_listed_segment_keeps_the_original(self):
+        self.upload('dedup_conflict_key', 'Initialization', 0, 0, b'init')
+        self.upload('dedup_conflict_key', 'Media', 1, 2.0, b'original')
+        stream = hls_relay.streams['dedup_conflict_key']
+
+        self.upload('dedup_conflict_key', 'Media', 1, 2.0, b'different')
+
+        self.assertEqual(self.segment_bytes(stream, 'p0_segment_000001.m4s'), b'original')
+        self.assertEqual(stream.dedup_stats['conflicts'], 1)
+        self.assertIn('Conflicting payload for sequence 1; kept the listed segment', [event['message'] for event in stream.events])
+
+    def test_conflicting_payload_for_queued_segment_replaces_it(self):
+        self.upload('dedup_queued_key', 'Initialization', 0, 0, b'init')
+        self.upload('dedup_queued_key', 'Media', 2, 2.0, b'first')
+        stream = hls_relay.streams['dedup_queued_key']
+
+        self.upload('dedup_queued_key', 'Media', 2, 2.0, b'second')
+        self.upload('dedup_queued_key', 'Media', 1, 2.0, b'one')
+
+        self.assertEqual(self.segment_bytes(stream, 'p0_segment_000002.m4s'), b'second')
+        self.assertEqual(stream.dedup_stats['conflicts'], 1)
+        self.assertEqual(stream.written_segment_count, 2)
+
+    def test_retransmitted_init_segment_does_not_start_a_new_period(self):
+        self.upload('dedup_init_key', 'Initialization', 0, 0, b'init')
+        self.upload('dedup_init_key', 'Initialization', 0, 0, b'init')
+        stream = hls_relay.streams['dedup_init_key']
+
+        self.assertEqual(stream.period_index, 0)
+        self.assertFalse(os.path.exists(os.path.join(stream.stream_dir, 'p1_segment_000000.mp4')))
+        self.assertEqual(stream.dedup_stats['duplicates'], 1)
+
+        # A different init segment still starts a new period
+        self.upload('dedup_init_key', 'Initialization', 0, 0, b'init2')
+        self.assertEqual(stream.period_index, 1)
+
+    def test_retransmit_from_the_previous_period_is_not_written_again(self):
+        self.upload('dedup_period_key', 'Initialization', 0, 0, b'init')
+        self.upload('dedup_period_key', 'Media', 1, 2.0, b'one')
+        self.upload('dedup_period_key', 'Media', 2, 2.0, b'two')
+        self.upload('dedup_period_key', 'Initialization', 3, 0, b'init2')
+        stream = hls_relay.streams['dedup_period_key']
+        self.assertEqual(stream.period_index, 1)
+
+        self.upload('dedup_period_key', 'Media', 2, 2.0, b'two')
+        self.upload('dedup_period_key', 'Media', 1, 2.0, b'changed')
+
+        self.assertEqual(stream.dedup_stats, {'duplicates': 1, 'bytes_saved': 3, 'conflicts': 1})
+        self.assertFalse(os.path.exists(os.path.join(stream.stream_dir, 'p1_segment_000002.m4s')))
+        self.assertFalse(os.path.exists(os.path.join(stream.stream_dir, 'p1_segment_000001.m4s')))
+
+    def test_new_sequences_are_not_looked_up_on_disk(self):
+        self.upload('dedup_new_key', 'Initialization', 0, 0, b'init')
+        self.upload('dedup_new_key', 'Media', 1, 2.0, b'one')
+
+        with patch('hls_relay.file_digest') as mock_digest:
+            self.upload('dedup_new_key', 'Media', 2, 2.0, b'two')
+            self.upload('dedup_new_key', 'Media', 4, 2.0, b'four')
+
+        mock_digest.assert_not_called()
+        self.assertEqual(hls_relay.streams['dedup_new_key'].written_segment_count, 2)
+
+    def test_restored_stream_recognises_segments_written_before_restart(self):
+        self.upload('dedup_restore_key', 'Initialization', 0, 0, b'init', stream_id='s1')
+        self.upload('dedup_restore_key', 'Media', 1, 2.0, b'one', stream_id='s1')
+        stream = hls_relay.streams['dedup_restore_key']
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        restored = hls_relay.StreamState.restore('dedup_restore_key', stream.stream_dir)
+
+        segment = {'is_init': False, 'is_final': False, 'discontinuity': False, 'duration': 2.0, 'sequence': 1, 'rendition': None,
+                   'size': 3, 'digest': hls_relay.file_digest(os.path.join(stream.stream_dir, 'p0_segment_000001.m4s'))}
+        with restored.playlist_lock:
+            hls_relay.store_segment(restored, segment, lambda path: self.fail('duplicate was written'))
+
+        self.assertEqual(restored.dedup_stats['duplicates'], 1)
+
+    def test_digests_are_kept_for_the_dedup_window_only(self):
+        with patch('hls_relay.DEDUP_WINDOW_SEGMENTS', 3):
+            self.upload('dedup_window_key', 'Initialization', 0, 0, b'init')
+            for sequence in range(1, 7):
+                self.upload('dedup_window_key', 'Media', sequence, 2.0, b'media%d' % sequence)
+            stream = hls_relay.streams['dedup_window_key']
+            self.assertEqual(list(stream.segment_hashes), ['p0_segment_000004.m4s', 'p0_segment_000005.m4s', 'p0_segment_000006.m4s'])
+
+            with patch('hls_relay.file_digest', side_effect=hls_relay.file_digest) as mock_digest:
+                # Behind the window: not hashed from disk
+                self.assertIsNone(stream.known_digest('p0_segment_000002.m4s'))
+                mock_digest.assert_not_called()
+                self.assertIsNotNone(stream.known_digest('p0_segment_000000.mp4'))
+                self.assertIsNotNone(stream.known_digest('p0_segment_000005.m4s'))
+            self.assertEqual(len(stream.segment_hashes), 3)
+
+    def test_status_reports_dedup_counts(self):
+        self.upload('dedup_status_key', 'Initialization', 0, 0, b'init')
+        self.upload('dedup_status_key', 'Media', 1, 2.0, b'one')
+        self.upload('dedup_status_key', 'Media', 1, 2.0, b'one')
+
+        status = self.client.get('/status/dedup_status_key').get_json()
+
+        self.assertEqual(status['dedup'], {'duplicates': 1, 'bytes_saved': 3, 'conflicts': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestStateJournal(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def add(self, stream, sequence, is_init=False, period=0, discontinuity=False):
+        name = f"p{period}_segment_{sequence:06d}.{'mp4' if is_init else 'm4s'}"
+        stream.arrived_segments[sequence] = {'filename': name, 'duration': 2.0, 'is_init': is_init, 'discontinuity': discontinuity}
+        stream.update_playlist()
+
+    def make_stream(self, key, segments):
+        """Stream with an init segment at sequence 0 and media segments 1..segments, all in period 0"""
+        stream = hls_relay.StreamState(key)
+        stream.initialize_playlist(0, 'p0_segment_000000.mp4')
+        self.add(stream, 0, is_init=True)
+        for seq in range(1, segments + 1):
+            self.add(stream, seq)
+        return stream
+
+    def assertSameState(self, restored, stream):
+        for name in ('last_playlist_sequence', 'period_index', 'init_segment_name', 'written_segment_count', 'written_media_duration'):
+            self.assertEqual(getattr(restored, name), getattr(stream, name), name)
+        self.assertEqual(list(restored.playlist_entries), list(stream.playlist_entries))
+        self.assertTrue(restored.map_written)
+
+    def test_restore_replays_periods_skips_and_relay_exits(self):
+        stream = self.make_stream('journal_key', 3)
+        stream.start_period(4, 'p1_segment_000004.mp4', 1)
+        self.add(stream, 4, is_init=True, period=1)
+        self.add(stream, 5, period=1)
+        self.add(stream, 7, period=1)
+        stream._gap_wait_start = time.time() - hls_relay.GAP_SKIP_TIMEOUT
+        stream.update_playlist()
+        relay = stream.get_relay('youtube', 'key')
+        relay._set_exit(1, None)
+
+        with patch.object(hls_relay.StreamState, '_restore_from_playlist') as mock_parse:
+            restored = hls_relay.StreamState.restore('journal_key', stream.stream_dir)
+
+        mock_parse.assert_not_called()
+        self.assertSameState(restored, stream)
+        self.assertEqual(restored.last_playlist_sequence, 7)
+        self.assertTrue(restored.playlist_entries[-1]['discontinuity'])
+        self.assertEqual(restored.playlist_entries[-1]['discontinuity_sequence'], 2)
+        self.assertEqual(restored.last_ffmpeg_exit, {'target': 'youtube', 'code': 1, 'signal': None})
+
+    def test_restore_reads_only_the_records_after_the_checkpoint(self):
+        with patch('hls_relay.STATE_CHECKPOINT_INTERVAL', 10), patch('hls_relay.STATE_CHECKPOINT_ENTRIES', 4):
+            stream = self.make_stream('checkpoint_key', 25)
+            restored = hls_relay.StreamState.restore('checkpoint_key', stream.stream_dir)
+
+        self.assertEqual(restored.playlist_entries.base, 13)
+        self.assertIsNone(restored.playlist_entries._older)
+        self.assertEqual(restored.segment_positions['p0_segment_000025.m4s'], stream.segment_positions['p0_segment_000025.m4s'])
+        self.assertNotIn('p0_segment_000001.m4s', restored.segment_positions)
+        # Older entries are read back from the journal when asked for
+        self.assertSameState(restored, stream)
+
+    def test_torn_last_record_is_dropped(self):
+        stream = self.make_stream('torn_key', 3)
+        with open(stream.journal.path, 'ab') as f:
+            f.write(b'{"op":"media","sequence":4,"na')
+
+        restored = hls_relay.StreamState.restore('torn_key', stream.stream_dir)
+
+        self.assertSameState(restored, stream)
+        with open(stream.journal.path, 'rb') as f:
+            self.assertTrue(f.read().endswith(b'}\n'))
+
+    def test_stream_without_journal_is_parsed_once_and_journaled(self):
+        stream = self.make_stream('legacy_key', 3)
+        stream.finalize_playlist()
+        os.remove(stream.journal.path)
+        os.remove(stream.journal.checkpoint_path)
+
+        restored = hls_relay.StreamState.restore('legacy_key', stream.stream_dir)
+        self.assertSameState(restored, stream)
+        with open(stream.playlist_file) as f:
+            self.assertNotIn('#EXT-X-ENDLIST', f.read())
+
+        with patch.object(hls_relay.StreamState, '_restore_from_playlist') as mock_parse:
+            again = hls_relay.StreamState.restore('legacy_key', stream.stream_dir)
+        mock_parse.assert_not_called()
+        self.assertSameState(again, stream)
+
+    def test_finalized_stream_resumes_after_restore(self):
+        stream = self.make_stream('final_key', 2)
+        stream.finalize_playlist()
+
+        restored = hls_relay.StreamState.restore('final_key', stream.stream_dir)
+        self.add(restored, 3)
+
+        with open(stream.playlist_file) as f:
+            playlist = f.read()
+        self.assertNotIn('#EXT-X-ENDLIST', playlist)
+        self.assertTrue(playlist.endswith('p0_segment_000003.m4s\n'))
+        self.assertEqual(hls_relay.StreamState.restore('final_key', stream.stream_dir).written_segment_count, 3)
+
+    def test_failed_journal_write_falls_back_to_the_playlist(self):
+        stream = self.make_stream('broken_key', 2)
+        stream.journal.close()
+        with patch('builtins.open', side_effect=OSError('disk full')):
+            stream.journal.append('advance', sequence=3)
+
+        self.assertTrue(stream.journal.failed)
+        self.assertFalse(stream.journal.exists())
+        self.assertSameState(hls_relay.StreamState.restore('broken_key', stream.stream_dir), stream)
+
+
+    def test_checkpoint_makes_the_journal_durable(self):
+        sync = hls_relay.StateJournal.sync
+        with patch('hls_relay.STATE_CHECKPOINT_INTERVAL', 10), \
+             patch.object(hls_relay.StateJournal, 'sync', autospec=True, side_effect=sync) as mock_sync:
+            stream = self.make_stream('durable_key', 5)
+            mock_sync.assert_not_called()
+            self.add(stream, 6)
+            self.add(stream, 7)
+
+        mock_sync.assert_called_once_with(stream.journal)
+
+    def test_failed_journal_keeps_older_entries_of_a_restored_stream(self):
+        with patch('hls_relay.STATE_CHECKPOINT_INTERVAL', 10), patch('hls_relay.STATE_CHECKPOINT_ENTRIES', 4):
+            stream = self.make_stream('abandon_key', 25)
+            restored = hls_relay.StreamState.restore('abandon_key', stream.stream_dir)
+        restored.journal.close()
+        real_open = open
+
+        def open_read_only(path, mode='r', *args, **kwargs):
+            if 'a' in mode:
+                raise OSError('disk full')
+            return real_open(path, mode, *args, **kwargs)
+
+        with patch('builtins.open', side_effect=open_read_only):
+            restored.journal.append('advance', sequence=26)
+
+        self.assertFalse(restored.journal.exists())
+        self.assertEqual(restored.playlist_entries[0]['name'], 'p0_segment_000001.m4s')
+        self.assertEqual(list(restored.playlist_entries), list(stream.playlist_entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+class TestStreamLocking(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, segment_type, sequence, duration, data=b'data', stream_id=None):
+        headers = {
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': segment_type,
+            'Discontinuity': 'false',
+            'Duration': str(duration),
+            'Sequence': str(sequence),
+        }
+        if stream_id is not None:
+            headers['Stream-ID'] = stream_id
+        return hls_relay.app.test_client().post(
+            '/upload_segment',
+            headers=headers,
+            data=data,
+            environ_overrides={'REMOTE_ADDR': '127.0.0.1'},
+        )
+
+    def make_stream_on_disk(self, stream_key, stream_id):
+        self.upload(stream_key, 'Initialization', 0, 0, b'init', stream_id=stream_id)
+        self.upload(stream_key, 'Media', 1, 2.0, stream_id=stream_id)
+        with hls_relay.stream_creation_lock:
+            hls_relay.streams.clear()
+
+    def start_blocked_restore(self, stream_key, stream_id):
+        """Upload to stream_key in a thread whose restore from disk blocks until the returned event is set"""
+        entered = threading.Event()
+        release = threading.Event()
+        restore = hls_relay.StreamState.restore.__func__
+        calls = []
+
+        def slow_restore(cls, key, stream_dir):
+            calls.append(key)
+            entered.set()
+            release.wait(5)
+            return restore(cls, key, stream_dir)
+
+        patcher = patch.object(hls_relay.StreamState, 'restore', classmethod(slow_restore))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.upload(stream_key, 'Media', 2, 2.0, stream_id=stream_id)))
+        thread.start()
+        self.assertTrue(entered.wait(5))
+        return release, thread, results, calls
+
+    def test_restore_does_not_block_other_stream_keys(self):
+        self.make_stream_on_disk('lock_slow', 'r1')
+        release, thread, results, _ = self.start_blocked_restore('lock_slow', 'r1')
+        try:
+            started = time.perf_counter()
+            response = self.upload('lock_other', 'Initialization', 0, 0, b'init')
+            elapsed = time.perf_counter() - started
+        finally:
+            release.set()
+            thread.join(5)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(results[0].status_code, 200)
+
+    def test_uploads_for_the_same_key_wait_for_the_restore(self):
+        self.make_stream_on_disk('lock_same', 'r2')
+        release, thread, results, calls = self.start_blocked_restore('lock_same', 'r2')
+        second = []
+        waiter = threading.Thread(target=lambda: second.append(self.upload('lock_same', 'Media', 3, 2.0, stream_id='r2')))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertFalse(second)
+
+        release.set()
+        thread.join(5)
+        waiter.join(5)
+
+        self.assertEqual([results[0].status_code, second[0].status_code], [200, 200])
+        self.assertEqual(calls, ['lock_same'])
+        self.assertEqual(hls_relay.streams['lock_same'].written_segment_count, 3)
+        self.assertGreaterEqual(hls_relay.stream_key_lock('lock_same').contended, 1)
+
+    def test_timed_lock_records_waits(self):
+        lock = hls_relay.TimedLock()
+        with lock:
+            pass
+        lock.acquire()
+        waiter = threading.Thread(target=lambda: (lock.acquire(), lock.release()))
+        waiter.start()
+        time.sleep(0.05)
+        lock.release()
+        waiter.join(5)
+
+        stats = hls_relay.lock_wait_stats([lock])
+        self.assertEqual(stats['acquisitions'], 3)
+        self.assertEqual(stats['contended'], 1)
+        self.assertGreater(stats['max_wait_ms'], 20)
+
+    def test_admin_status_reports_lock_waits(self):
+        status = hls_relay.app.test_client().get('/admin/status', headers=self.auth_headers).get_json()
+
+        self.assertEqual(set(status['lock_waits']), {'streams', 'stream_keys'})
+        self.assertIn('max_wait_ms', status['lock_waits']['stream_keys'])
+
+
+if __name__ == '__main__':
+    unittest.main()
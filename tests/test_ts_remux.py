@@ -0,0 +1,253 @@
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import hls_relay
+
+SPS = b'\x67\x64\x00\x28\xac\xd9'
+PPS = b'\x68\xeb\xe3\xcb'
+# AAC LC, 48 kHz, stereo
+AUDIO_SPECIFIC_CONFIG = b'\x11\x90'
+
+
+def box(box_type, payload):
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+
+def full_box(box_type, version, flags, payload):
+    return box(box_type, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def descriptor(tag, payload):
+    return bytes([tag, len(payload)]) + payload
+
+
+def make_trak(track_id, timescale, handler, sample_entry):
+    tkhd = full_box(b'tkhd', 0, 3, struct.pack(">III", 0, 0, track_id) + b'\x00' * 68)
+    mdhd = full_box(b'mdhd', 0, 0, struct.pack(">IIII", 0, 0, timescale, 0) + b'\x55\xc4\x00\x00')
+    hdlr = full_box(b'hdlr', 0, 0, b'\x00' * 4 + handler + b'\x00' * 12 + b'track\x00')
+    stsd = full_box(b'stsd', 0, 0, struct.pack(">I", 1) + sample_entry)
+    return box(b'trak', tkhd + box(b'mdia', mdhd + hdlr + box(b'minf', box(b'stbl', stsd))))
+
+
+def make_av_init(with_audio=True):
+    avcc = bytes([1, 0x64, 0x00, 0x28, 0xFF, 0xE1]) + struct.pack(">H", len(SPS)) + SPS + b'\x01' + struct.pack(">H", len(PPS)) + PPS
+    avc1 = box(b'avc1', (
+        b'\x00' * 6 + b'\x00\x01' + b'\x00' * 16 + struct.pack(">HH", 1280, 720)
+        + b'\x00\x48\x00\x00' * 2 + b'\x00' * 4 + b'\x00\x01' + b'\x00' * 32 + b'\x00\x18\xff\xff'
+        + box(b'avcC', avcc)
+    ))
+    traks = make_trak(1, 90000, b'vide', avc1)
+    trex = full_box(b'trex', 0, 0, struct.pack(">IIIII", 1, 1, 0, 0, 0))
+    if with_audio:
+        decoder_config = descriptor(0x04, bytes([0x40, 0x15]) + b'\x00' * 11 + descriptor(0x05, AUDIO_SPECIFIC_CONFIG))
+        esds = full_box(b'esds', 0, 0, descriptor(0x03, b'\x00\x02\x00' + decoder_config + descriptor(0x06, b'\x02')))
+        mp4a = box(b'mp4a', b'\x00' * 6 + b'\x00\x01' + b'\x00' * 8 + b'\x00\x02\x00\x10' + b'\x00' * 4 + struct.pack(">I", 48000 << 16) + esds)
+        traks += make_trak(2, 48000, b'soun', mp4a)
+        trex += full_box(b'trex', 0, 0, struct.pack(">IIIII", 2, 1, 1024, 0, 0x02000000))
+    moov = box(b'moov', full_box(b'mvhd', 0, 0, b'\x00' * 96) + traks + box(b'mvex', trex))
+    return box(b'ftyp', b'iso6\x00\x00\x00\x00iso6') + moov
+
+
+def avc_sample(*nals):
+    return b''.join(struct.pack(">I", len(nal)) + nal for nal in nals)
+
+
+def make_fragment(video_samples, audio_samples=(), video_time=0, audio_time=0):
+    """video_samples: (bytes, is_sync, composition offset); audio_samples: bytes. 30 fps / 1024-sample AAC."""
+    def traf(track_id, base_time, samples, data_offset):
+        flags = 0x001 | 0x100 | 0x200 | 0x400 | 0x800
+        entries = b''.join(
+            struct.pack(">IIIi", duration, len(data), 0x02000000 if sync else 0x01010000, composition)
+            for data, sync, composition, duration in samples
+        )
+        trun = full_box(b'trun', 1, flags, struct.pack(">Ii", len(samples), data_offset) + entries)
+        tfhd = full_box(b'tfhd', 0, 0x020000, struct.pack(">I", track_id))
+        tfdt = full_box(b'tfdt', 1, 0, struct.pack(">Q", base_time))
+        return box(b'traf', tfhd + tfdt + trun)
+
+    video = [(data, sync, composition, 3000) for data, sync, composition in video_samples]
+    audio = [(data, True, 0, 1024) for data in audio_samples]
+    video_bytes = b''.join(sample[0] for sample in video)
+
+    def moof(offset):
+        trafs = traf(1, video_time, video, offset)
+        if audio:
+            trafs += traf(2, audio_time, audio, offset + len(video_bytes))
+        return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack(">I", 1)) + trafs)
+
+    data_offset = len(moof(0)) + 8
+    mdat = box(b'mdat', video_bytes + b''.join(sample[0] for sample in audio))
+    return moof(data_offset) + mdat
+
+
+def parse_ts(data):
+    """Return ({pid: [payload units]}, {pid: [continuity counters]}, [PCR bases]) for a TS byte string"""
+    units, counters, pcrs = {}, {}, []
+    for offset in range(0, len(data), 188):
+        packet = data[offset:offset + 188]
+        assert packet[0] == 0x47
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        start = bool(packet[1] & 0x40)
+        control = (packet[3] >> 4) & 0x03
+        counters.setdefault(pid, []).append(packet[3] & 0x0F)
+        position = 4
+        if control & 0x02:
+            length = packet[4]
+            if length and packet[5] & 0x10:
+                b = packet[6:12]
+                pcrs.append((b[0] << 25) | (b[1] << 17) | (b[2] << 9) | (b[3] << 1) | (b[4] >> 7))
+            position = 5 + length
+        payload = packet[position:]
+        if start or pid not in units:
+            units.setdefault(pid, []).append(b'')
+        units[pid][-1] += payload
+    return units, counters, pcrs
+
+
+def decode_timestamp(data):
+    return ((data[0] >> 1) & 0x07) << 30 | data[1] << 22 | (data[2] >> 1) << 15 | data[3] << 7 | data[4] >> 1
+
+
+def parse_pes(pes):
+    assert pes[:3] == b'\x00\x00\x01'
+    flags = pes[7]
+    header_length = pes[8]
+    pts = decode_timestamp(pes[9:14])
+    dts = decode_timestamp(pes[14:19]) if flags & 0x40 else pts
+    return pes[3], pts, dts, pes[9 + header_length:]
+
+
+class TestTsRemux(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.base_dir_patcher = patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir)
+        self.base_dir_patcher.start()
+
+    def tearDown(self):
+        self.base_dir_patcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def remux_sample_segment(self, remuxer, video_time=0, audio_time=0):
+        big_slice = b'\x41' + bytes(range(256)) * 20
+        fragment = make_fragment(
+            [(avc_sample(b'\x65\x88\x84' + b'\x00' * 400), True, 3000), (avc_sample(big_slice), False, 0)],
+            [b'\x21\x10' + b'\x05' * 300, b'\x21\x10' + b'\x06' * 300],
+            video_time=video_time, audio_time=audio_time,
+        )
+        return remuxer.remux_segment(fragment), big_slice
+
+    def test_init_tracks_are_parsed(self):
+        tracks = hls_relay.parse_init_tracks(make_av_init())
+
+        self.assertEqual(tracks[1]['codec'], 'avc')
+        self.assertEqual(tracks[1]['length_size'], 4)
+        self.assertEqual(tracks[1]['parameter_sets'], b'\x00\x00\x00\x01' + SPS + b'\x00\x00\x00\x01' + PPS)
+        self.assertEqual(tracks[2]['adts'], (1, 3, 2))
+        self.assertEqual(tracks[2]['timescale'], 48000)
+
+    def test_segment_has_psi_and_valid_packets(self):
+        ts, _ = self.remux_sample_segment(hls_relay.TsRemuxer(make_av_init()))
+
+        self.assertEqual(len(ts) % 188, 0)
+        units, _, _ = parse_ts(ts)
+        pat = units[0][0]
+        section = pat[1:1 + 3 + (((pat[2] & 0x0F) << 8) | pat[3])]
+        self.assertEqual(hls_relay.mpeg_crc32(section), 0)
+        pmt = units[hls_relay.TS_PMT_PID][0]
+        section = pmt[1:1 + 3 + (((pmt[2] & 0x0F) << 8) | pmt[3])]
+        self.assertEqual(hls_relay.mpeg_crc32(section), 0)
+        self.assertEqual((section[12], section[17]), (0x1B, 0x0F))
+
+    def test_video_becomes_annexb_with_timestamps(self):
+        ts, big_slice = self.remux_sample_segment(hls_relay.TsRemuxer(make_av_init()), video_time=90000)
+        units, _, pcrs = parse_ts(ts)
+        delay = hls_relay.TS_MUX_DELAY
+
+        key = parse_pes(units[hls_relay.TS_VIDEO_PID][0])
+        self.assertEqual(key[0], 0xE0)
+        self.assertEqual((key[1], key[2]), (90000 + 3000 + delay, 90000 + delay))
+        self.assertTrue(key[3].startswith(b'\x00\x00\x00\x01\x09\xf0\x00\x00\x00\x01' + SPS + b'\x00\x00\x00\x01' + PPS + b'\x00\x00\x00\x01\x65'))
+
+        delta = parse_pes(units[hls_relay.TS_VIDEO_PID][1])
+        self.assertEqual(delta[3], b'\x00\x00\x00\x01\x09\xf0\x00\x00\x00\x01' + big_slice)
+        self.assertEqual(pcrs, [90000, 93000])
+
+    def test_audio_gets_adts_headers(self):
+        ts, _ = self.remux_sample_segment(hls_relay.TsRemuxer(make_av_init()), audio_time=48000)
+        units, _, _ = parse_ts(ts)
+
+        stream_id, pts, _, payload = parse_pes(units[hls_relay.TS_AUDIO_PID][1])
+        self.assertEqual(stream_id, 0xC0)
+        self.assertEqual(pts, 90000 + 1920 + hls_relay.TS_MUX_DELAY)
+        self.assertEqual(payload[:2], b'\xff\xf1')
+        self.assertEqual(((payload[3] & 0x03) << 11) | (payload[4] << 3) | (payload[5] >> 5), len(payload))
+
+    def test_continuity_counters_carry_across_segments(self):
+        remuxer = hls_relay.TsRemuxer(make_av_init())
+        first, _ = self.remux_sample_segment(remuxer)
+        second, _ = self.remux_sample_segment(remuxer, video_time=6000, audio_time=2048)
+
+        _, counters, _ = parse_ts(first + second)
+        for pid, values in counters.items():
+            with self.subTest(pid=pid):
+                self.assertEqual(values, [value % 16 for value in range(len(values))])
+
+    @unittest.skipIf(hls_relay.numpy is None, 'NumPy not installed')
+    def test_numpy_packetising_matches_pure_python(self):
+        accelerated, _ = self.remux_sample_segment(hls_relay.TsRemuxer(make_av_init()))
+        with patch('hls_relay.numpy', None):
+            pure, _ = self.remux_sample_segment(hls_relay.TsRemuxer(make_av_init()))
+
+        self.assertEqual(accelerated, pure)
+
+    def test_unsupported_codec_is_rejected(self):
+        init = make_av_init(with_audio=False).replace(b'avc1', b'av01')
+
+        with self.assertRaises(ValueError):
+            hls_relay.TsRemuxer(init)
+
+    def test_remux_engine_uploads_ts_segments(self):
+        stream = hls_relay.StreamState('remux_key')
+        with open(os.path.join(stream.stream_dir, 'p0_segment_000000.mp4'), 'wb') as f:
+            f.write(make_av_init())
+        stream.initialize_playlist(0, 'p0_segment_000000.mp4')
+        stream.last_playlist_sequence = 0
+        for seq in (1, 2):
+            name = f'p0_segment_{seq:06d}.m4s'
+            with open(os.path.join(stream.stream_dir, name), 'wb') as f:
+                f.write(make_fragment([(avc_sample(b'\x65\x88'), True, 0)], video_time=seq * 3000))
+            stream.arrived_segments[seq] = {'filename': name, 'duration': 2.0, 'is_init': False, 'discontinuity': False}
+            stream.update_playlist()
+
+        uploads = {}
+
+        def fake_request(method, url, body=None, headers=None, timeout=30):
+            uploads[url.split('file=')[1]] = (headers['Content-Type'], body)
+            return 200, b''
+
+        with patch('hls_relay.RELAY_ENGINES', {'youtube': 'remux'}), \
+             patch.object(hls_relay.upload_pool, 'request', side_effect=fake_request):
+            stream.start_ffmpeg_relay('youtube', 'remux_key', live_start_index=0)
+            relay = stream.relays['youtube']
+            deadline = time.time() + 5
+            while relay.position != (1, 4.0) and time.time() < deadline:
+                time.sleep(0.01)
+            relay.stop()
+
+        self.assertEqual(relay.engine_label, 'remux upload')
+        self.assertEqual(uploads['p0_segment_000002.ts'][0], 'video/mp2t')
+        self.assertEqual(uploads['p0_segment_000002.ts'][1][0], 0x47)
+        self.assertNotIn('p0_segment_000000.mp4', uploads)
+        playlist = uploads['media.m3u8'][1].decode()
+        self.assertIn('#EXT-X-VERSION:3', playlist)
+        self.assertNotIn('EXT-X-MAP', playlist)
+        self.assertTrue(playlist.rstrip().endswith('p0_segment_000002.ts'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+from unittest.mock import patch
+
+import hls_relay
+
+
+def key_of_worker(index, workers=2):
+    """A stream key that belongs to worker index"""
+    with patch('hls_relay.WORKER_PROCESSES', workers):
+        return next(f'shard_{n}' for n in range(1000) if hls_relay.stream_worker(f'shard_{n}') == index)
+
+
+class TestWorkerSharding(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('hls_relay.BASE_SEGMENTS_DIR', self.test_dir),
+            patch('hls_relay.WORKER_PROCESSES', 2),
+            patch('hls_relay.current_worker', hls_relay.Worker(0, None)),
+            patch('hls_relay.resource_governor', hls_relay.ResourceGovernor()),
+            patch.dict(os.environ, {hls_relay.WORKER_TOKEN_ENV: 'worker_token'}),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.client = hls_relay.app.test_client()
+        token = b64encode(b'brute:force').decode()
+        self.auth_headers = {"Authorization": f"Basic {token}"}
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        with hls_relay.stream_creation_lock:
+            for stream in hls_relay.streams.values():
+                stream.check_missing_segments_stop_event.set()
+            hls_relay.streams.clear()
+        shutil.rmtree(self.test_dir)
+
+    def upload(self, stream_key, sequence, port='80', remote_addr='127.0.0.1'):
+        headers = {
+            **self.auth_headers,
+            'Target': 'passive',
+            'Stream-Key': stream_key,
+            'Segment-Type': 'Initialization' if sequence == 0 else 'Media',
+            'Discontinuity': 'false',
+            'Duration': '0' if sequence == 0 else '2.0',
+            'Sequence': str(sequence),
+        }
+        if port != '80':
+            headers[hls_relay.WORKER_TOKEN_HEADER] = 'worker_token'
+        return self.client.post('/upload_segment', headers=headers, data=b'data%d' % sequence,
+                                environ_overrides={'REMOTE_ADDR': remote_addr, 'SERVER_PORT': port})
+
+    def test_uploads_for_another_worker_are_passed_on_to_it(self):
+        other_key = key_of_worker(1)
+        with patch.object(hls_relay.worker_pool, 'exchange', return_value=(
+            200, [('Content-Type', 'text/plain'), ('Relay-Pending-Segments', '0'), ('Connection', 'close')], b'Segment stored',
+        )) as mock_exchange:
+            response = self.upload(other_key, 1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), b'Segment stored')
+        self.assertEqual(response.headers['Relay-Pending-Segments'], '0')
+        self.assertNotIn('Connection', response.headers)
+        method, url = mock_exchange.call_args.args
+        self.assertEqual((method, url), ('POST', f'http://127.0.0.1:{hls_relay.worker_port(1)}/upload_segment'))
+        self.assertEqual(mock_exchange.call_args.kwargs['body'], b'data1')
+        self.assertEqual(mock_exchange.call_args.kwargs['headers']['Stream-Key'], other_key)
+        self.assertEqual(mock_exchange.call_args.kwargs['headers'][hls_relay.WORKER_TOKEN_HEADER], 'worker_token')
+        self.assertNotIn(other_key, hls_relay.streams)
+
+    def test_own_streams_and_requests_from_other_workers_are_handled_here(self):
+        own_key, other_key = key_of_worker(0), key_of_worker(1)
+        with patch.object(hls_relay.worker_pool, 'exchange') as mock_exchange:
+            self.assertEqual(self.upload(own_key, 0).status_code, 200)
+            self.assertEqual(self.upload(other_key, 0, port=str(hls_relay.worker_port(0))).status_code, 200)
+            self.assertEqual(self.client.get(f'/status/{own_key}').get_json()['written_media_segments'], 0)
+
+        mock_exchange.assert_not_called()
+        self.assertIn(own_key, hls_relay.streams)
+        self.assertIn(other_key, hls_relay.streams)
+
+    def test_only_other_workers_may_upload_on_the_loopback_port(self):
+        other_key = key_of_worker(1)
+        response = self.client.post('/upload_segment', headers={
+            **self.auth_headers, 'Stream-Key': other_key, hls_relay.WORKER_TOKEN_HEADER: 'guessed',
+        }, environ_overrides={'REMOTE_ADDR': '127.0.0.1', 'SERVER_PORT': str(hls_relay.worker_port(0))})
+
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn(other_key, hls_relay.streams)
+
+    def test_segments_are_never_passed_on(self):
+        other_key = key_of_worker(1)
+        self.upload(other_key, 0, port=str(hls_relay.worker_port(0)))
+        stream_id = hls_relay.streams[other_key].stream_id
+        with patch.object(hls_relay.worker_pool, 'exchange') as mock_exchange:
+            response = self.client.get(f'/segments/{stream_id}/playlist.m3u8', headers={'Stream-Key': other_key},
+                                       environ_overrides={'REMOTE_ADDR': '203.0.113.7'})
+
+        mock_exchange.assert_not_called()
+        self.assertEqual(response.status_code, 403)
+
+    def test_status_of_another_workers_stream_is_asked_from_it(self):
+        other_key = key_of_worker(1)
+        body = json.dumps({'stream_key': other_key, 'active': True}).encode()
+        with patch.object(hls_relay.worker_pool, 'exchange', return_value=(200, [('Content-Type', 'application/json')], body)) as mock_exchange:
+            response = self.client.get(f'/status/{other_key}')
+
+        self.assertTrue(response.get_json()['active'])
+        self.assertEqual(mock_exchange.call_args.args[1], f'http://127.0.0.1:{hls_relay.worker_port(1)}/status/{other_key}')
+
+    def test_unreachable_worker_is_reported_as_busy(self):
+        with patch.object(hls_relay.worker_pool, 'exchange', side_effect=ConnectionRefusedError('refused')):
+            response = self.upload(key_of_worker(1), 1)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], str(hls_relay.WORKER_RESTART_COOLDOWN))
+
+    def test_admin_status_adds_up_all_workers(self):
+        own_key = key_of_worker(0)
+        self.upload(own_key, 0)
+        other = {
+            'active_streams': {'used': 2, 'limit': 16},
+            'ffmpeg_relays': {'used': 1, 'limit': None},
+            'rejections': {'streams': 3},
+            'streams': [{'stream_key': 'elsewhere'}],
+        }
+        with patch('hls_relay.WORKER_PROCESSES', 3), patch('hls_relay.MAX_ACTIVE_STREAMS', 16), \
+             patch.object(hls_relay.worker_pool, 'request', side_effect=[(200, json.dumps(other).encode()), OSError('down')]):
+            status = self.client.get('/admin/status', headers=self.auth_headers).get_json()
+
+        self.assertEqual(status['active_streams'], {'used': 3, 'limit': 32})
+        self.assertEqual(status['ffmpeg_relays'], {'used': 1, 'limit': None})
+        self.assertEqual(status['rejections']['streams'], 3)
+        self.assertEqual([(stream['worker'], stream['stream_key']) for stream in status['streams']], [(0, own_key), (1, 'elsewhere')])
+        self.assertEqual(status['workers'][2], {'worker': 2, 'error': 'down'})
+
+    def test_workers_recover_and_relay_only_their_own_streams(self):
+        for key in (key_of_worker(0), key_of_worker(1)):
+            self.upload(key, 0, port=str(hls_relay.worker_port(0)))
+            self.upload(key, 1, port=str(hls_relay.worker_port(0)))
+        with hls_relay.stream_creation_lock:
+            crashed = dict(hls_relay.streams)
+            hls_relay.streams.clear()
+        for stream in crashed.values():
+            stream.check_missing_segments_stop_event.set()
+
+        recovered = hls_relay.recover_streams()
+
+        self.assertEqual([stream.stream_key for stream in recovered], [key_of_worker(0)])
+        relay = recovered[0].get_relay('youtube', 'key')
+        self.assertIn(f'http://127.0.0.1:{hls_relay.worker_port(0)}/segments/{recovered[0].stream_id}/playlist.m3u8', relay.build_command())
+
+
+if __name__ == '__main__':
+    unittest.main()